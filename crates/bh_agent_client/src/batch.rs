@@ -0,0 +1,106 @@
+use bh_agent_common::{AgentError, BatchOperation, BatchResult, FileStat, HandleRef};
+use pyo3::exceptions::PyValueError;
+use pyo3::prelude::*;
+use pyo3::types::{PyBytes, PyTuple};
+
+use crate::convert::{buffer_bytes, parse_mode_and_type, popen_config, process_channel, user_id};
+
+// Batch operations are passed from Python as tuples of an operation name followed by its
+// arguments. Handles are either an int, or a 1-tuple holding the index of the earlier operation
+// in the batch that produces the handle.
+
+fn handle(obj: &PyAny) -> PyResult<HandleRef> {
+    if let Ok(id) = obj.extract::<u64>() {
+        return Ok(HandleRef::Id(id));
+    }
+    let (index,) = obj.extract::<(u32,)>()?;
+    Ok(HandleRef::Result(index))
+}
+
+pub fn parse_operation(op: &PyTuple) -> PyResult<BatchOperation> {
+    let name: &str = op.get_item(0)?.extract()?;
+    let arg = |index: usize| op.get_item(index);
+
+    Ok(match name {
+        "run_process" => BatchOperation::RunCommand(popen_config(
+            arg(1)?.extract()?,
+            arg(2)?.extract()?,
+            arg(3)?.extract()?,
+            arg(4)?.extract()?,
+            arg(5)?.extract()?,
+            arg(6)?.extract()?,
+            arg(7)?.extract()?,
+            arg(8)?.extract()?,
+            arg(9)?.extract()?,
+            arg(10)?.extract()?,
+            arg(11)?.extract()?,
+            arg(12)?.extract()?,
+        )),
+        "get_process_channel" => BatchOperation::GetProcessChannel(
+            handle(arg(1)?)?,
+            process_channel(arg(2)?.extract()?)?,
+        ),
+        "process_poll" => BatchOperation::ProcessPoll(handle(arg(1)?)?),
+        "process_returncode" => BatchOperation::ProcessReturncode(handle(arg(1)?)?),
+        "file_open" => {
+            let (mode, type_) = parse_mode_and_type(arg(2)?.extract()?);
+            BatchOperation::FileOpen(arg(1)?.extract()?, mode, type_)
+        }
+        "file_close" => BatchOperation::FileClose(handle(arg(1)?)?),
+        "file_read" => BatchOperation::FileRead(handle(arg(1)?)?, arg(2)?.extract()?),
+        "file_write" => {
+            BatchOperation::FileWrite(handle(arg(1)?)?, buffer_bytes(op.py(), arg(2)?)?)
+        }
+        "chown" => BatchOperation::Chown(
+            arg(1)?.extract()?,
+            arg(2)?.extract::<Option<String>>()?.map(user_id),
+            arg(3)?.extract::<Option<String>>()?.map(user_id),
+        ),
+        "chmod" => BatchOperation::Chmod(arg(1)?.extract()?, arg(2)?.extract()?),
+        "stat" => BatchOperation::Stat(arg(1)?.extract()?),
+        "mkdir" => {
+            BatchOperation::Mkdir(arg(1)?.extract()?, arg(2)?.extract()?, arg(3)?.extract()?)
+        }
+        "remove" => BatchOperation::Remove(arg(1)?.extract()?, arg(2)?.extract()?),
+        "rename" => BatchOperation::Rename(arg(1)?.extract()?, arg(2)?.extract()?),
+        "symlink" => BatchOperation::Symlink(arg(1)?.extract()?, arg(2)?.extract()?),
+        "store_add" => BatchOperation::StoreAdd(arg(1)?.extract()?, arg(2)?.extract()?),
+        "store_install" => {
+            BatchOperation::StoreInstall(arg(1)?.extract()?, arg(2)?.extract()?, arg(3)?.extract()?)
+        }
+        "get_metadata" => BatchOperation::GetMetadata(arg(1)?.extract()?),
+        "set_metadata" => BatchOperation::SetMetadata(arg(1)?.extract()?, arg(2)?.extract()?),
+        _ => {
+            return Err(PyValueError::new_err(format!(
+                "Unknown batch operation: {}",
+                name
+            )))
+        }
+    })
+}
+
+/// Converts the results of a batch into (ok, value) pairs, where the value of a failed operation
+/// is its error message.
+pub fn results_into_py(
+    py: Python,
+    results: Vec<Result<BatchResult, AgentError>>,
+) -> PyResult<Vec<(bool, PyObject)>> {
+    results
+        .into_iter()
+        .map(|result| match result {
+            Ok(value) => Ok((true, result_into_py(py, value)?)),
+            Err(e) => Ok((false, e.to_string().into_py(py))),
+        })
+        .collect()
+}
+
+fn result_into_py(py: Python, result: BatchResult) -> PyResult<PyObject> {
+    Ok(match result {
+        BatchResult::None => py.None(),
+        BatchResult::Handle(id) => id.into_py(py),
+        BatchResult::ExitCode(code) => code.into_py(py),
+        BatchResult::Data(data) => PyBytes::new(py, &data).into_py(py),
+        BatchResult::Stat(stat) => Py::<FileStat>::new(py, stat)?.into_py(py),
+        BatchResult::Metadata(value) => value.into_py(py),
+    })
+}
@@ -1,44 +1,180 @@
-use crate::client::build_client;
+use crate::batch::{parse_operation, results_into_py};
+#[cfg(target_family = "unix")]
+use crate::client::connect_pool;
+use crate::client::{build_pool, wait_context, Pool};
+use crate::convert::{
+    buffer_bytes, check_writable_buffer, copy_into_buffer, parse_mode_and_type, popen_config,
+    process_channel, timeout_ms, user_id,
+};
+use crate::transfer::{
+    download_directory, download_file, transfer_context, upload_directory, upload_file,
+};
 use anyhow::Result;
 use bh_agent_common::{
-    AgentError, BhAgentServiceClient, EnvironmentId, FileId, FileOpenMode, FileOpenType, FileStat,
-    ProcessChannel, ProcessId, Redirection, RemotePOpenConfig, UserId,
+    hash_file, AgentError, AgentMetrics, ByteRange, Compression, EnvironmentId, FileId, FileStat,
+    HashAlgorithm, ProcessId, Redirection, StatColumns, SubscriptionId, WireCodec,
+    DEFAULT_COMPRESSION_THRESHOLD,
 };
 use log::debug;
-use pyo3::exceptions::PyRuntimeError;
+use pyo3::buffer::PyBuffer;
+use pyo3::exceptions::{PyRuntimeError, PyValueError};
 use pyo3::prelude::*;
-use pyo3::types::PyBytes;
-use pyo3::{pyclass, pymethods, pymodule, PyResult, Python};
+use pyo3::types::{PyBytes, PyTuple};
+use pyo3::{pyclass, pyfunction, pymethods, pymodule, wrap_pyfunction, PyResult, Python};
 use std::future::Future;
-use std::net::{IpAddr, SocketAddr, ToSocketAddrs};
+use std::net::ToSocketAddrs;
+#[cfg(target_family = "unix")]
+use std::os::unix::io::{FromRawFd, RawFd};
+use std::path::PathBuf;
 use std::str::FromStr;
 use tarpc::client::RpcError;
 use tarpc::context;
 use tokio::runtime;
 
+// The workers only drive connections and decode responses, the real work happens on the agents,
+// so a few threads are enough to keep up with many concurrent Python callers. The runtime is
+// shared by every client in the process, and is the one asyncio awaitables are driven on.
+const CLIENT_WORKER_THREADS: usize = 4;
+
+type ProcessConfig = (
+    Vec<String>,
+    Option<Vec<(String, String)>>,
+    Option<String>,
+    bool,
+);
+
 #[pyclass]
 struct BhAgentClient {
-    tokio_runtime: runtime::Runtime,
-    client: BhAgentServiceClient,
+    tokio_runtime: &'static runtime::Runtime,
+    pool: Pool,
+    codec: WireCodec,
+    compressed: bool,
+}
+
+/// Blocks on a future with the GIL released, so other Python threads keep running while we wait
+/// for the agent. The runtime is multi-threaded, so any number of Python threads can do this at
+/// once and their requests are multiplexed over the pool's connections.
+fn block_on<F>(py: Python, runtime: &runtime::Runtime, fut: F) -> F::Output
+where
+    F: Future + Send,
+    F::Output: Send,
+{
+    py.allow_threads(|| runtime.block_on(fut))
 }
 
-fn run_in_runtime<F, R>(client: &BhAgentClient, fut: F) -> PyResult<R>
+fn run_in_runtime<F, R>(py: Python, client: &BhAgentClient, fut: F) -> PyResult<R>
 where
-    F: Future<Output = Result<Result<R, AgentError>, RpcError>> + Sized,
+    F: Future<Output = Result<Result<R, AgentError>, RpcError>> + Send,
+    R: Send,
 {
-    client
-        .tokio_runtime
-        .block_on(fut)
+    block_on(py, client.tokio_runtime, fut)
         .map_err(|e| PyRuntimeError::new_err(e.to_string()))
         .map(|r| r.map_err(|e| PyRuntimeError::new_err(e.to_string())))
         .and_then(|r| r)
 }
 
+fn run_transfer<F, R>(py: Python, client: &BhAgentClient, fut: F) -> PyResult<R>
+where
+    F: Future<Output = Result<R>> + Send,
+    R: Send,
+{
+    block_on(py, client.tokio_runtime, fut).map_err(|e| PyRuntimeError::new_err(e.to_string()))
+}
+
+/// Turns an RPC into a Python awaitable. The RPC runs on the client runtime and the result is
+/// converted with `convert` once it completes.
+fn await_rpc_with<'py, F, R, C>(py: Python<'py>, fut: F, convert: C) -> PyResult<&'py PyAny>
+where
+    F: Future<Output = Result<Result<R, AgentError>, RpcError>> + Send + 'static,
+    R: Send + 'static,
+    C: FnOnce(Python, R) -> PyResult<PyObject> + Send + 'static,
+{
+    pyo3_asyncio::tokio::future_into_py(py, async move {
+        let result = fut
+            .await
+            .map_err(|e| PyRuntimeError::new_err(e.to_string()))?
+            .map_err(|e| PyRuntimeError::new_err(e.to_string()))?;
+        Python::with_gil(|py| convert(py, result))
+    })
+}
+
+fn await_rpc<'py, F, R>(py: Python<'py>, fut: F) -> PyResult<&'py PyAny>
+where
+    F: Future<Output = Result<Result<R, AgentError>, RpcError>> + Send + 'static,
+    R: IntoPy<PyObject> + Send + 'static,
+{
+    await_rpc_with(py, fut, |py, result| Ok(result.into_py(py)))
+}
+
+fn await_transfer<'py, F, R>(py: Python<'py>, fut: F) -> PyResult<&'py PyAny>
+where
+    F: Future<Output = Result<R>> + Send + 'static,
+    R: IntoPy<PyObject> + Send + 'static,
+{
+    pyo3_asyncio::tokio::future_into_py(py, async move {
+        fut.await
+            .map_err(|e| PyRuntimeError::new_err(e.to_string()))
+    })
+}
+
+/// Parses the connection options shared by the ways of connecting to an agent. Compression is
+/// only asked for if a level is given.
+fn connection_options(
+    codec: Option<String>,
+    compression_level: Option<i32>,
+    compression_threshold: Option<usize>,
+) -> PyResult<(WireCodec, Option<Compression>)> {
+    let codec = match codec {
+        Some(name) => WireCodec::from_str(&name).map_err(PyValueError::new_err)?,
+        None => WireCodec::SUPPORTED[0],
+    };
+    let compression = compression_level.map(|level| Compression {
+        level,
+        threshold: compression_threshold.unwrap_or(DEFAULT_COMPRESSION_THRESHOLD),
+    });
+    Ok((codec, compression))
+}
+
+impl BhAgentClient {
+    fn from_pool(
+        tokio_runtime: &'static runtime::Runtime,
+        pool: anyhow::Result<(Pool, WireCodec, bool)>,
+    ) -> PyResult<Self> {
+        match pool {
+            Ok((pool, codec, compressed)) => Ok(Self {
+                tokio_runtime,
+                pool,
+                codec,
+                compressed,
+            }),
+            Err(e) => Err(PyRuntimeError::new_err(format!(
+                "Failed to initialize client: {}",
+                e
+            ))),
+        }
+    }
+}
+
 #[pymethods]
 impl BhAgentClient {
     #[staticmethod]
-    fn initialize_client(host: String, port: u16) -> PyResult<Self> {
-        debug!("Initializing client with {}:{}", host, port);
+    #[pyo3(signature = (
+        host, port, codec = None, compression_level = None, compression_threshold = None,
+        bulk_connections = 1
+    ))]
+    fn initialize_client(
+        py: Python,
+        host: String,
+        port: u16,
+        codec: Option<String>,
+        compression_level: Option<i32>,
+        compression_threshold: Option<usize>,
+        bulk_connections: usize,
+    ) -> PyResult<Self> {
+        debug!(
+            "Initializing client with {}:{}, codec {:?}, compression level {:?}",
+            host, port, codec, compression_level
+        );
 
         let socket_addr = match format!("{}:{}", host, port).to_socket_addrs() {
             Ok(mut addrs) => match addrs.next() {
@@ -55,38 +191,131 @@ impl BhAgentClient {
             }
         };
 
-        let tokio_runtime = runtime::Builder::new_current_thread()
-            .enable_all()
-            .build()
-            .unwrap();
-        match tokio_runtime.block_on(build_client(socket_addr)) {
-            Ok(client) => Ok(Self {
+        let (codec, compression) =
+            connection_options(codec, compression_level, compression_threshold)?;
+        let tokio_runtime = pyo3_asyncio::tokio::get_runtime();
+        Self::from_pool(
+            tokio_runtime,
+            block_on(
+                py,
                 tokio_runtime,
-                client,
-            }),
-            Err(e) => Err(PyRuntimeError::new_err(format!(
-                "Failed to initialize client: {}",
-                e
-            ))),
+                build_pool(socket_addr, codec, compression, bulk_connections),
+            ),
+        )
+    }
+
+    /// Connects over sockets shared with an agent started with `--socket-fd` for each of them.
+    /// The client takes ownership of the file descriptors.
+    #[cfg(target_family = "unix")]
+    #[staticmethod]
+    #[pyo3(signature = (fds, codec = None, compression_level = None, compression_threshold = None))]
+    fn from_sockets(
+        py: Python,
+        fds: Vec<RawFd>,
+        codec: Option<String>,
+        compression_level: Option<i32>,
+        compression_threshold: Option<usize>,
+    ) -> PyResult<Self> {
+        debug!(
+            "Initializing client with sockets {:?}, codec {:?}, compression level {:?}",
+            fds, codec, compression_level
+        );
+
+        // Safety: the caller hands the descriptors over to us. They are owned from here on, so
+        // they are closed if anything below fails.
+        let sockets = fds
+            .into_iter()
+            .map(|fd| unsafe { std::os::unix::net::UnixStream::from_raw_fd(fd) })
+            .collect::<Vec<_>>();
+        let (codec, compression) =
+            connection_options(codec, compression_level, compression_threshold)?;
+        for socket in &sockets {
+            socket.set_nonblocking(true)?;
         }
+        let tokio_runtime = pyo3_asyncio::tokio::get_runtime();
+        Self::from_pool(
+            tokio_runtime,
+            block_on(py, tokio_runtime, async move {
+                let sockets = sockets
+                    .into_iter()
+                    .map(tokio::net::UnixStream::from_std)
+                    .collect::<std::io::Result<Vec<_>>>()?;
+                connect_pool(sockets, codec, compression).await
+            }),
+        )
+    }
+
+    #[getter]
+    fn codec(&self) -> String {
+        self.codec.to_string()
+    }
+
+    #[getter]
+    fn compressed(&self) -> bool {
+        self.compressed
     }
 
-    fn get_environments(&self) -> PyResult<Vec<EnvironmentId>> {
+    fn get_environments(&self, py: Python) -> PyResult<Vec<EnvironmentId>> {
         debug!("Getting environments");
 
-        self.tokio_runtime
-            .block_on(self.client.get_environments(context::current()))
-            .map_err(|e| PyRuntimeError::new_err(e.to_string()))
+        block_on(
+            py,
+            self.tokio_runtime,
+            self.pool.control().get_environments(context::current()),
+        )
+        .map_err(|e| PyRuntimeError::new_err(e.to_string()))
     }
 
-    fn get_tempdir(&self, env_id: EnvironmentId) -> PyResult<String> {
+    fn create_environment(&self, py: Python) -> PyResult<EnvironmentId> {
+        debug!("Creating environment");
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool.control().create_environment(context::current()),
+        )
+    }
+
+    fn destroy_environment(&self, py: Python, env_id: EnvironmentId) -> PyResult<()> {
+        debug!("Destroying environment {}", env_id);
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .destroy_environment(context::current(), env_id),
+        )
+    }
+
+    fn get_metrics(&self, py: Python) -> PyResult<AgentMetrics> {
+        debug!("Getting agent metrics");
+
+        block_on(
+            py,
+            self.tokio_runtime,
+            self.pool.control().get_metrics(context::current()),
+        )
+        .map_err(|e| PyRuntimeError::new_err(e.to_string()))
+    }
+
+    fn get_tempdir(&self, py: Python, env_id: EnvironmentId) -> PyResult<String> {
         debug!("Getting tempdir for environment {}", env_id);
 
-        run_in_runtime(self, self.client.get_tempdir(context::current(), env_id))
+        run_in_runtime(
+            py,
+            self,
+            self.pool.control().get_tempdir(context::current(), env_id),
+        )
     }
 
+    #[pyo3(signature = (
+        env_id, argv, stdin, stdout, stderr, executable, env, cwd, setuid, setgid, setpgid,
+        capture = false, capture_limit = None
+    ))]
     fn run_process(
         &self,
+        py: Python,
         env_id: EnvironmentId,
         argv: Vec<String>,
         stdin: bool,
@@ -98,9 +327,11 @@ impl BhAgentClient {
         setuid: Option<u32>,
         setgid: Option<u32>,
         setpgid: Option<bool>,
+        capture: bool,
+        capture_limit: Option<u64>,
     ) -> PyResult<ProcessId> {
         debug!(
-            "Running process with argv {:?}, stdin {}, stdout {}, stderr {}, executable {:?}, env {:?}, cwd {:?}, setuid {:?}, setgid {:?}, setpgid {:?}",
+            "Running process with argv {:?}, stdin {}, stdout {}, stderr {}, executable {:?}, env {:?}, cwd {:?}, setuid {:?}, setgid {:?}, setpgid {:?}, capture {}, capture_limit {:?}",
             argv,
             stdin,
             stdout,
@@ -110,46 +341,73 @@ impl BhAgentClient {
             cwd,
             setuid,
             setgid,
-            setpgid,);
+            setpgid,
+            capture,
+            capture_limit,);
 
-        let config = RemotePOpenConfig {
+        let config = popen_config(
             argv,
-            stdin: match stdin {
-                true => Redirection::Save,
-                false => Redirection::None,
-            },
-            stdout: match stdout {
-                true => Redirection::Save,
-                false => Redirection::None,
-            },
-            stderr: match stderr {
-                true => Redirection::Save,
-                false => Redirection::None,
-            },
+            stdin,
+            stdout,
+            stderr,
             executable,
             env,
             cwd,
             setuid,
             setgid,
-            setpgid: setpgid.unwrap_or(false),
-        };
+            setpgid,
+            capture,
+            capture_limit,
+        );
         run_in_runtime(
+            py,
             self,
-            self.client.run_command(context::current(), env_id, config),
+            self.pool
+                .control()
+                .run_command(context::current(), env_id, config),
         )
     }
 
-    fn get_process_ids(&self, env_id: EnvironmentId) -> PyResult<Vec<ProcessId>> {
+    fn get_process_ids(&self, py: Python, env_id: EnvironmentId) -> PyResult<Vec<ProcessId>> {
         debug!("Getting process ids for environment {}", env_id);
 
         run_in_runtime(
+            py,
             self,
-            self.client.get_process_ids(context::current(), env_id),
+            self.pool
+                .control()
+                .get_process_ids(context::current(), env_id),
         )
     }
 
+    /// Returns the argv, environment and working directory a process was started with, and whether
+    /// its output is captured.
+    fn get_process_config(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+    ) -> PyResult<ProcessConfig> {
+        debug!(
+            "Getting config for process {} in environment {}",
+            proc_id, env_id
+        );
+
+        let config = run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .get_process_config(context::current(), env_id, proc_id),
+        )?;
+        let captured = matches!(config.stdout, Redirection::Capture)
+            || matches!(config.stderr, Redirection::Capture);
+        Ok((config.argv, config.env, config.cwd, captured))
+    }
+
     fn get_process_channel(
         &self,
+        py: Python,
         env_id: EnvironmentId,
         proc_id: ProcessId,
         channel: i32, // TODO: This is just 0, 1, 2 for now
@@ -160,36 +418,40 @@ impl BhAgentClient {
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client.get_process_channel(
+            self.pool.control().get_process_channel(
                 context::current(),
                 env_id,
                 proc_id,
-                match channel {
-                    0 => ProcessChannel::Stdin,
-                    1 => ProcessChannel::Stdout,
-                    2 => ProcessChannel::Stderr,
-                    _ => return Err(PyRuntimeError::new_err("Invalid channel")),
-                },
+                process_channel(channel)?,
             ),
         )
     }
 
-    fn process_poll(&self, env_id: EnvironmentId, proc_id: ProcessId) -> PyResult<Option<u32>> {
+    fn process_poll(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+    ) -> PyResult<Option<u32>> {
         debug!(
             "Polling process for environment {}, process {}",
             env_id, proc_id
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client
+            self.pool
+                .control()
                 .process_poll(context::current(), env_id, proc_id),
         )
     }
 
     fn process_wait(
         &self,
+        py: Python,
         env_id: EnvironmentId,
         proc_id: ProcessId,
         timeout: Option<f64>,
@@ -200,21 +462,77 @@ impl BhAgentClient {
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client.process_wait(
-                context::current(),
+            self.pool.control().process_wait(
+                wait_context(timeout),
+                env_id,
+                proc_id,
+                timeout_ms(timeout),
+            ),
+        )
+    }
+
+    fn process_wait_many(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        proc_ids: Vec<ProcessId>,
+        wait_all: bool,
+        timeout: Option<f64>,
+    ) -> PyResult<Vec<(ProcessId, u32)>> {
+        debug!(
+            "Waiting for processes for environment {}, processes {:?}, all {}, timeout {:?}",
+            env_id, proc_ids, wait_all, timeout
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool.control().process_wait_many(
+                wait_context(timeout),
+                env_id,
+                proc_ids,
+                wait_all,
+                timeout_ms(timeout),
+            ),
+        )
+    }
+
+    #[pyo3(signature = (env_id, proc_id, channel, offset, size = None))]
+    fn process_read_capture(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+        channel: i32,
+        offset: u64,
+        size: Option<u32>,
+    ) -> PyResult<Py<PyBytes>> {
+        debug!(
+            "Reading captured output for environment {}, process {}, channel {}, offset {}, size {:?}",
+            env_id, proc_id, channel, offset, size
+        );
+
+        let channel = process_channel(channel)?;
+        run_in_runtime(
+            py,
+            self,
+            self.pool.bulk().process_read_capture(
+                wait_context(None),
                 env_id,
                 proc_id,
-                match timeout {
-                    Some(t) => Some((t * 1000.0) as u32),
-                    None => None,
-                },
+                channel,
+                offset,
+                size,
             ),
         )
+        .map(|bytes| PyBytes::new(py, bytes.as_slice()).into())
     }
 
     fn process_returncode(
         &self,
+        py: Python,
         env_id: EnvironmentId,
         proc_id: ProcessId,
     ) -> PyResult<Option<u32>> {
@@ -224,8 +542,10 @@ impl BhAgentClient {
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client
+            self.pool
+                .control()
                 .process_returncode(context::current(), env_id, proc_id),
         )
     }
@@ -233,6 +553,7 @@ impl BhAgentClient {
     // File IO
     fn file_open(
         &self,
+        py: Python,
         env_id: EnvironmentId,
         path: String,
         mode_and_type: String,
@@ -242,57 +563,56 @@ impl BhAgentClient {
             env_id, path, mode_and_type
         );
 
-        // Mode parsing
-        let mut mode = FileOpenMode::Read;
-        mode_and_type.chars().for_each(|c| match c {
-            'r' => mode = FileOpenMode::Read,
-            'w' => mode = FileOpenMode::Write,
-            'x' => mode = FileOpenMode::ExclusiveWrite,
-            'a' => mode = FileOpenMode::Append,
-            '+' => mode = FileOpenMode::Update,
-            _ => {}
-        });
-
-        // Type parsing
-        let mut type_ = FileOpenType::Text;
-        if mode_and_type.contains("b") {
-            type_ = FileOpenType::Binary;
-        }
+        let (mode, type_) = parse_mode_and_type(&mode_and_type);
 
         run_in_runtime(
+            py,
             self,
-            self.client
+            self.pool
+                .control()
                 .file_open(context::current(), env_id, path, mode, type_),
         )
     }
 
-    fn file_close(&self, env_id: EnvironmentId, fd: FileId) -> PyResult<()> {
+    fn file_close(&self, py: Python, env_id: EnvironmentId, fd: FileId) -> PyResult<()> {
         debug!("Closing file for environment {}, fd {}", env_id, fd);
 
-        run_in_runtime(self, self.client.file_close(context::current(), env_id, fd))
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .file_close(context::current(), env_id, fd),
+        )
     }
 
-    fn file_is_closed(&self, env_id: EnvironmentId, fd: FileId) -> PyResult<bool> {
+    fn file_is_closed(&self, py: Python, env_id: EnvironmentId, fd: FileId) -> PyResult<bool> {
         debug!(
             "Checking if file is closed for environment {}, fd {}",
             env_id, fd
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client.file_is_closed(context::current(), env_id, fd),
+            self.pool
+                .control()
+                .file_is_closed(context::current(), env_id, fd),
         )
     }
 
-    fn file_is_readable(&self, env_id: EnvironmentId, fd: FileId) -> PyResult<bool> {
+    fn file_is_readable(&self, py: Python, env_id: EnvironmentId, fd: FileId) -> PyResult<bool> {
         debug!(
             "Checking if file is readable for environment {}, fd {}",
             env_id, fd
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client.file_is_readable(context::current(), env_id, fd),
+            self.pool
+                .control()
+                .file_is_readable(context::current(), env_id, fd),
         )
     }
 
@@ -309,13 +629,46 @@ impl BhAgentClient {
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client
+            self.pool
+                .bulk()
                 .file_read(context::current(), env_id, fd, num_bytes),
         )
         .map(|bytes| PyBytes::new(py, bytes.as_slice()).into())
     }
 
+    /// Reads up to len(buffer) bytes into a writable buffer and returns the number of bytes read.
+    fn file_readinto(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        fd: FileId,
+        buffer: PyBuffer<u8>,
+    ) -> PyResult<usize> {
+        debug!(
+            "Reading file into buffer for environment {}, fd {}, buffer length {}",
+            env_id,
+            fd,
+            buffer.len_bytes()
+        );
+
+        check_writable_buffer(&buffer)?;
+        if buffer.len_bytes() == 0 {
+            return Ok(0);
+        }
+        let num_bytes = buffer.len_bytes().min(u32::MAX as usize) as u32;
+        let data = run_in_runtime(
+            py,
+            self,
+            self.pool
+                .bulk()
+                .file_read(context::current(), env_id, fd, Some(num_bytes)),
+        )?;
+        copy_into_buffer(&buffer, &data)?;
+        Ok(data.len())
+    }
+
     fn file_read_lines(
         &self,
         py: Python,
@@ -329,8 +682,10 @@ impl BhAgentClient {
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client
+            self.pool
+                .bulk()
                 .file_read_lines(context::current(), env_id, fd, hint),
         )
         .map(|lines| {
@@ -341,23 +696,27 @@ impl BhAgentClient {
         })
     }
 
-    fn file_is_seekable(&self, env_id: EnvironmentId, fd: FileId) -> PyResult<bool> {
+    fn file_is_seekable(&self, py: Python, env_id: EnvironmentId, fd: FileId) -> PyResult<bool> {
         debug!(
             "Checking if file is seekable for environment {}, fd {}",
             env_id, fd
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client.file_is_seekable(context::current(), env_id, fd),
+            self.pool
+                .control()
+                .file_is_seekable(context::current(), env_id, fd),
         )
     }
 
     fn file_seek(
         &self,
+        py: Python,
         env_id: EnvironmentId,
         fd: FileId,
-        offset: i32,
+        offset: i64,
         whence: i32,
     ) -> PyResult<()> {
         debug!(
@@ -366,31 +725,49 @@ impl BhAgentClient {
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client
+            self.pool
+                .control()
                 .file_seek(context::current(), env_id, fd, offset, whence),
         )
     }
 
-    fn file_tell(&self, env_id: EnvironmentId, fd: FileId) -> PyResult<i32> {
+    fn file_tell(&self, py: Python, env_id: EnvironmentId, fd: FileId) -> PyResult<u64> {
         debug!("Telling file for environment {}, fd {}", env_id, fd);
 
-        run_in_runtime(self, self.client.file_tell(context::current(), env_id, fd))
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .file_tell(context::current(), env_id, fd),
+        )
     }
 
-    fn file_is_writable(&self, env_id: EnvironmentId, fd: FileId) -> PyResult<bool> {
+    fn file_is_writable(&self, py: Python, env_id: EnvironmentId, fd: FileId) -> PyResult<bool> {
         debug!(
             "Checking if file is writable for environment {}, fd {}",
             env_id, fd
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client.file_is_writable(context::current(), env_id, fd),
+            self.pool
+                .control()
+                .file_is_writable(context::current(), env_id, fd),
         )
     }
 
-    fn file_write(&self, env_id: EnvironmentId, fd: FileId, data: Vec<u8>) -> PyResult<()> {
+    fn file_write(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        fd: FileId,
+        data: &PyAny,
+    ) -> PyResult<()> {
+        let data = buffer_bytes(py, data)?;
         debug!(
             "Writing file for environment {}, fd {}, data length {:?}",
             env_id,
@@ -399,26 +776,183 @@ impl BhAgentClient {
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client.file_write(context::current(), env_id, fd, data),
+            self.pool
+                .bulk()
+                .file_write(context::current(), env_id, fd, data),
         )
     }
 
-    fn file_set_blocking(&self, env_id: EnvironmentId, fd: FileId, blocking: bool) -> PyResult<()> {
+    fn file_set_blocking(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        fd: FileId,
+        blocking: bool,
+    ) -> PyResult<()> {
         debug!(
             "Setting file blocking for environment {}, fd {}, blocking {}",
             env_id, fd, blocking
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client
+            self.pool
+                .control()
                 .file_set_blocking(context::current(), env_id, fd, blocking),
         )
     }
 
+    #[pyo3(signature = (env_id, src, dst, mode = None))]
+    fn file_upload(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        src: PathBuf,
+        dst: String,
+        mode: Option<u32>,
+    ) -> PyResult<u64> {
+        debug!(
+            "Uploading file for environment {}, src {:?}, dst {}, mode {:?}",
+            env_id, src, dst, mode
+        );
+
+        run_transfer(
+            py,
+            self,
+            upload_file(self.pool.bulk_all(), env_id, &src, dst, mode),
+        )
+    }
+
+    fn file_download(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        src: String,
+        dst: PathBuf,
+    ) -> PyResult<FileStat> {
+        debug!(
+            "Downloading file for environment {}, src {}, dst {:?}",
+            env_id, src, dst
+        );
+
+        run_transfer(
+            py,
+            self,
+            download_file(self.pool.bulk_all(), env_id, src, &dst),
+        )
+    }
+
+    #[pyo3(signature = (env_id, src, dst, compression_level = None))]
+    fn directory_upload(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        src: PathBuf,
+        dst: String,
+        compression_level: Option<i32>,
+    ) -> PyResult<u64> {
+        debug!(
+            "Uploading directory for environment {}, src {:?}, dst {}, compression level {:?}",
+            env_id, src, dst, compression_level
+        );
+
+        run_transfer(
+            py,
+            self,
+            upload_directory(self.pool.bulk_all(), env_id, &src, dst, compression_level),
+        )
+    }
+
+    #[pyo3(signature = (env_id, src, dst, compression_level = None))]
+    fn directory_download(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        src: String,
+        dst: PathBuf,
+        compression_level: Option<i32>,
+    ) -> PyResult<()> {
+        debug!(
+            "Downloading directory for environment {}, src {}, dst {:?}, compression level {:?}",
+            env_id, src, dst, compression_level
+        );
+
+        run_transfer(
+            py,
+            self,
+            download_directory(self.pool.bulk_all(), env_id, src, &dst, compression_level),
+        )
+    }
+
+    fn file_subscribe(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        fd: FileId,
+        window: u32,
+    ) -> PyResult<SubscriptionId> {
+        debug!(
+            "Subscribing to file for environment {}, fd {}, window {}",
+            env_id, fd, window
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .file_subscribe(context::current(), env_id, fd, window),
+        )
+    }
+
+    fn subscription_next(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        subscription: SubscriptionId,
+    ) -> PyResult<Option<Py<PyBytes>>> {
+        debug!(
+            "Waiting for subscription data for environment {}, subscription {}",
+            env_id, subscription
+        );
+
+        // Data may take arbitrarily long to arrive
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .bulk()
+                .subscription_next(wait_context(None), env_id, subscription),
+        )
+        .map(|data| data.map(|bytes| PyBytes::new(py, bytes.as_slice()).into()))
+    }
+
+    fn subscription_cancel(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        subscription: SubscriptionId,
+    ) -> PyResult<()> {
+        debug!(
+            "Cancelling subscription for environment {}, subscription {}",
+            env_id, subscription
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .subscription_cancel(context::current(), env_id, subscription),
+        )
+    }
+
     fn chown(
         &self,
+        py: Python,
         env_id: EnvironmentId,
         path: String,
         user: Option<String>,
@@ -429,67 +963,908 @@ impl BhAgentClient {
             env_id, path, user, group
         );
 
-        let parsed_user = user.map(|u| match u.parse::<u32>() {
-            Ok(id) => UserId::Id(id),
-            Err(_) => UserId::Name(u),
-        });
-        let parsed_group = group.map(|g| match g.parse::<u32>() {
-            Ok(id) => UserId::Id(id),
-            Err(_) => UserId::Name(g),
-        });
+        let parsed_user = user.map(user_id);
+        let parsed_group = group.map(user_id);
 
         run_in_runtime(
+            py,
             self,
-            self.client
+            self.pool
+                .control()
                 .chown(context::current(), env_id, path, parsed_user, parsed_group),
         )
     }
 
-    fn chmod(&self, env_id: EnvironmentId, path: String, mode: u32) -> PyResult<()> {
+    fn chmod(&self, py: Python, env_id: EnvironmentId, path: String, mode: u32) -> PyResult<()> {
         debug!(
             "Chmoding file for environment {}, path {}, mode {}",
             env_id, path, mode
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client.chmod(context::current(), env_id, path, mode),
+            self.pool
+                .control()
+                .chmod(context::current(), env_id, path, mode),
         )
     }
 
-    fn stat(&self, env_id: EnvironmentId, path: String) -> PyResult<FileStat> {
+    fn stat(&self, py: Python, env_id: EnvironmentId, path: String) -> PyResult<FileStat> {
         debug!("Stating file for environment {}, path {}", env_id, path);
 
-        run_in_runtime(self, self.client.stat(context::current(), env_id, path))
-    }
-
-    // Metadata API
-    fn get_metadata(&self, env_id: EnvironmentId, key: String) -> PyResult<Option<String>> {
-        debug!("Getting metadata for environment {}, key {}", env_id, key);
         run_in_runtime(
+            py,
             self,
-            self.client.get_metadata(context::current(), env_id, key),
+            self.pool.control().stat(context::current(), env_id, path),
         )
     }
 
-    fn set_metadata(&self, env_id: EnvironmentId, key: String, value: String) -> PyResult<()> {
+    fn stat_many(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        paths: Vec<String>,
+    ) -> PyResult<StatColumns> {
+        debug!("Stating {} files for environment {}", paths.len(), env_id);
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .stat_many(transfer_context(), env_id, paths),
+        )
+    }
+
+    #[pyo3(signature = (env_id, path, max_depth = None))]
+    fn walk(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        path: String,
+        max_depth: Option<u32>,
+    ) -> PyResult<StatColumns> {
+        debug!(
+            "Walking directory for environment {}, path {}, max depth {:?}",
+            env_id, path, max_depth
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .walk(transfer_context(), env_id, path, max_depth),
+        )
+    }
+
+    fn file_hash(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        files: Vec<(String, Option<ByteRange>)>,
+        algorithm: String,
+    ) -> PyResult<Vec<String>> {
+        debug!(
+            "Hashing {} files for environment {}, algorithm {}",
+            files.len(),
+            env_id,
+            algorithm
+        );
+
+        let algorithm = HashAlgorithm::from_str(&algorithm).map_err(PyValueError::new_err)?;
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .file_hash(transfer_context(), env_id, files, algorithm),
+        )
+    }
+
+    #[pyo3(signature = (env_id, path, parents = false, exist_ok = false))]
+    fn mkdir(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        path: String,
+        parents: bool,
+        exist_ok: bool,
+    ) -> PyResult<()> {
+        debug!(
+            "Making directory for environment {}, path {}, parents {}, exist_ok {}",
+            env_id, path, parents, exist_ok
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .mkdir(context::current(), env_id, path, parents, exist_ok),
+        )
+    }
+
+    #[pyo3(signature = (env_id, path, recursive = false))]
+    fn remove(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        path: String,
+        recursive: bool,
+    ) -> PyResult<()> {
+        debug!(
+            "Removing file for environment {}, path {}, recursive {}",
+            env_id, path, recursive
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .remove(context::current(), env_id, path, recursive),
+        )
+    }
+
+    fn rename(&self, py: Python, env_id: EnvironmentId, src: String, dst: String) -> PyResult<()> {
+        debug!(
+            "Renaming file for environment {}, src {}, dst {}",
+            env_id, src, dst
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .rename(context::current(), env_id, src, dst),
+        )
+    }
+
+    fn symlink(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        target: String,
+        link: String,
+    ) -> PyResult<()> {
+        debug!(
+            "Creating symlink for environment {}, target {}, link {}",
+            env_id, target, link
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .symlink(context::current(), env_id, target, link),
+        )
+    }
+
+    #[pyo3(signature = (env_id, directory = false))]
+    fn mktemp(&self, py: Python, env_id: EnvironmentId, directory: bool) -> PyResult<String> {
+        debug!(
+            "Making temporary file for environment {}, directory {}",
+            env_id, directory
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .mktemp(context::current(), env_id, directory),
+        )
+    }
+
+    fn listdir(&self, py: Python, env_id: EnvironmentId, path: String) -> PyResult<Vec<String>> {
+        debug!(
+            "Listing directory for environment {}, path {}",
+            env_id, path
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .listdir(context::current(), env_id, path),
+        )
+    }
+
+    // Content-addressed store
+    fn store_claim(&self, py: Python, hashes: Vec<String>) -> PyResult<(Vec<String>, Vec<String>)> {
+        debug!("Claiming {} hashes in the store", hashes.len());
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool.control().store_claim(context::current(), hashes),
+        )
+    }
+
+    fn store_add(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        sha256: String,
+        path: String,
+    ) -> PyResult<()> {
+        debug!(
+            "Adding to the store for environment {}, sha256 {}, path {}",
+            env_id, sha256, path
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .store_add(context::current(), env_id, sha256, path),
+        )
+    }
+
+    fn store_release(&self, py: Python, hashes: Vec<String>) -> PyResult<()> {
+        debug!("Releasing {} hashes in the store", hashes.len());
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .store_release(context::current(), hashes),
+        )
+    }
+
+    #[pyo3(signature = (env_id, sha256, path, mode = None))]
+    fn store_install(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        sha256: String,
+        path: String,
+        mode: Option<u32>,
+    ) -> PyResult<()> {
+        debug!(
+            "Installing from the store for environment {}, sha256 {}, path {}, mode {:?}",
+            env_id, sha256, path, mode
+        );
+
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .store_install(context::current(), env_id, sha256, path, mode),
+        )
+    }
+
+    // Batching
+    fn batch(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        operations: Vec<&PyTuple>,
+    ) -> PyResult<Vec<(bool, PyObject)>> {
+        debug!(
+            "Running batch for environment {}, {} operations",
+            env_id,
+            operations.len()
+        );
+
+        let operations = operations
+            .into_iter()
+            .map(parse_operation)
+            .collect::<PyResult<Vec<_>>>()?;
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .batch(context::current(), env_id, operations),
+        )
+        .and_then(|results| results_into_py(py, results))
+    }
+
+    // Asyncio API
+    // These mirror the blocking methods above, but return awaitables that are driven by the
+    // client runtime, so a single event loop can drive many agents at once.
+
+    fn batch_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        operations: Vec<&PyTuple>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Running async batch for environment {}, {} operations",
+            env_id,
+            operations.len()
+        );
+
+        let operations = operations
+            .into_iter()
+            .map(parse_operation)
+            .collect::<PyResult<Vec<_>>>()?;
+        let client = self.pool.control().clone();
+        await_rpc_with(
+            py,
+            async move { client.batch(context::current(), env_id, operations).await },
+            |py, results| Ok(results_into_py(py, results)?.into_py(py)),
+        )
+    }
+
+    fn get_tempdir_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+    ) -> PyResult<&'py PyAny> {
+        debug!("Getting tempdir asynchronously for environment {}", env_id);
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client.get_tempdir(context::current(), env_id).await
+        })
+    }
+
+    fn stat_many_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        paths: Vec<String>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Stating {} files asynchronously for environment {}",
+            paths.len(),
+            env_id
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client.stat_many(transfer_context(), env_id, paths).await
+        })
+    }
+
+    #[pyo3(signature = (env_id, path, max_depth = None))]
+    fn walk_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        path: String,
+        max_depth: Option<u32>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Walking directory asynchronously for environment {}, path {}, max depth {:?}",
+            env_id, path, max_depth
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client
+                .walk(transfer_context(), env_id, path, max_depth)
+                .await
+        })
+    }
+
+    fn file_hash_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        files: Vec<(String, Option<ByteRange>)>,
+        algorithm: String,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Hashing {} files asynchronously for environment {}, algorithm {}",
+            files.len(),
+            env_id,
+            algorithm
+        );
+
+        let algorithm = HashAlgorithm::from_str(&algorithm).map_err(PyValueError::new_err)?;
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client
+                .file_hash(transfer_context(), env_id, files, algorithm)
+                .await
+        })
+    }
+
+    fn store_claim_async<'py>(&self, py: Python<'py>, hashes: Vec<String>) -> PyResult<&'py PyAny> {
+        debug!(
+            "Claiming {} hashes in the store asynchronously",
+            hashes.len()
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client.store_claim(context::current(), hashes).await
+        })
+    }
+
+    fn store_release_async<'py>(
+        &self,
+        py: Python<'py>,
+        hashes: Vec<String>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Releasing {} hashes in the store asynchronously",
+            hashes.len()
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client.store_release(context::current(), hashes).await
+        })
+    }
+
+    fn process_poll_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Polling process asynchronously for environment {}, process {}",
+            env_id, proc_id
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client
+                .process_poll(context::current(), env_id, proc_id)
+                .await
+        })
+    }
+
+    fn process_wait_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+        timeout: Option<f64>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Waiting asynchronously for process for environment {}, process {}, timeout {:?}",
+            env_id, proc_id, timeout
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client
+                .process_wait(wait_context(timeout), env_id, proc_id, timeout_ms(timeout))
+                .await
+        })
+    }
+
+    fn process_wait_many_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        proc_ids: Vec<ProcessId>,
+        wait_all: bool,
+        timeout: Option<f64>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Waiting asynchronously for processes for environment {}, processes {:?}, all {}, timeout {:?}",
+            env_id, proc_ids, wait_all, timeout
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client
+                .process_wait_many(
+                    wait_context(timeout),
+                    env_id,
+                    proc_ids,
+                    wait_all,
+                    timeout_ms(timeout),
+                )
+                .await
+        })
+    }
+
+    #[pyo3(signature = (env_id, proc_id, channel, offset, size = None))]
+    fn process_read_capture_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+        channel: i32,
+        offset: u64,
+        size: Option<u32>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Reading captured output asynchronously for environment {}, process {}, channel {}, offset {}, size {:?}",
+            env_id, proc_id, channel, offset, size
+        );
+
+        let channel = process_channel(channel)?;
+        let client = self.pool.bulk().clone();
+        await_rpc_with(
+            py,
+            async move {
+                client
+                    .process_read_capture(
+                        wait_context(None),
+                        env_id,
+                        proc_id,
+                        channel,
+                        offset,
+                        size,
+                    )
+                    .await
+            },
+            |py, bytes| Ok(PyBytes::new(py, bytes.as_slice()).into_py(py)),
+        )
+    }
+
+    fn process_returncode_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Getting process returncode asynchronously for environment {}, process {}",
+            env_id, proc_id
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client
+                .process_returncode(context::current(), env_id, proc_id)
+                .await
+        })
+    }
+
+    fn file_open_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        path: String,
+        mode_and_type: String,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Opening file asynchronously for environment {}, path {}, mode_and_type {}",
+            env_id, path, mode_and_type
+        );
+
+        let (mode, type_) = parse_mode_and_type(&mode_and_type);
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client
+                .file_open(context::current(), env_id, path, mode, type_)
+                .await
+        })
+    }
+
+    fn file_close_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        fd: FileId,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Closing file asynchronously for environment {}, fd {}",
+            env_id, fd
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client.file_close(context::current(), env_id, fd).await
+        })
+    }
+
+    fn file_read_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        fd: FileId,
+        num_bytes: Option<u32>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Reading file asynchronously for environment {}, fd {}, num_bytes {:?}",
+            env_id, fd, num_bytes
+        );
+
+        let client = self.pool.bulk().clone();
+        await_rpc_with(
+            py,
+            async move {
+                client
+                    .file_read(context::current(), env_id, fd, num_bytes)
+                    .await
+            },
+            |py, bytes| Ok(PyBytes::new(py, bytes.as_slice()).into_py(py)),
+        )
+    }
+
+    fn file_read_lines_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        fd: FileId,
+        hint: u32,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Reading file lines asynchronously for environment {}, fd {}, hint {}",
+            env_id, fd, hint
+        );
+
+        let client = self.pool.bulk().clone();
+        await_rpc_with(
+            py,
+            async move {
+                client
+                    .file_read_lines(context::current(), env_id, fd, hint)
+                    .await
+            },
+            |py, lines| {
+                Ok(lines
+                    .into_iter()
+                    .map(|bytes| PyBytes::new(py, bytes.as_slice()).into_py(py))
+                    .collect::<Vec<PyObject>>()
+                    .into_py(py))
+            },
+        )
+    }
+
+    fn file_write_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        fd: FileId,
+        data: &PyAny,
+    ) -> PyResult<&'py PyAny> {
+        let data = buffer_bytes(py, data)?;
+        debug!(
+            "Writing file asynchronously for environment {}, fd {}, data length {:?}",
+            env_id,
+            fd,
+            data.len()
+        );
+
+        let client = self.pool.bulk().clone();
+        await_rpc(py, async move {
+            client
+                .file_write(context::current(), env_id, fd, data)
+                .await
+        })
+    }
+
+    fn file_subscribe_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        fd: FileId,
+        window: u32,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Subscribing asynchronously to file for environment {}, fd {}, window {}",
+            env_id, fd, window
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client
+                .file_subscribe(context::current(), env_id, fd, window)
+                .await
+        })
+    }
+
+    fn subscription_next_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        subscription: SubscriptionId,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Waiting asynchronously for subscription data for environment {}, subscription {}",
+            env_id, subscription
+        );
+
+        let client = self.pool.bulk().clone();
+        await_rpc_with(
+            py,
+            async move {
+                client
+                    .subscription_next(wait_context(None), env_id, subscription)
+                    .await
+            },
+            |py, data| {
+                Ok(data
+                    .map(|bytes| PyBytes::new(py, bytes.as_slice()).into_py(py))
+                    .into_py(py))
+            },
+        )
+    }
+
+    fn subscription_cancel_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        subscription: SubscriptionId,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Cancelling subscription asynchronously for environment {}, subscription {}",
+            env_id, subscription
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client
+                .subscription_cancel(context::current(), env_id, subscription)
+                .await
+        })
+    }
+
+    #[pyo3(signature = (env_id, src, dst, mode = None))]
+    fn file_upload_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        src: PathBuf,
+        dst: String,
+        mode: Option<u32>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Uploading file asynchronously for environment {}, src {:?}, dst {}, mode {:?}",
+            env_id, src, dst, mode
+        );
+
+        let clients = self.pool.bulk_all().to_vec();
+        await_transfer(py, async move {
+            upload_file(&clients, env_id, &src, dst, mode).await
+        })
+    }
+
+    fn file_download_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        src: String,
+        dst: PathBuf,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Downloading file asynchronously for environment {}, src {}, dst {:?}",
+            env_id, src, dst
+        );
+
+        let clients = self.pool.bulk_all().to_vec();
+        await_transfer(py, async move {
+            download_file(&clients, env_id, src, &dst).await
+        })
+    }
+
+    #[pyo3(signature = (env_id, src, dst, compression_level = None))]
+    fn directory_upload_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        src: PathBuf,
+        dst: String,
+        compression_level: Option<i32>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Uploading directory asynchronously for environment {}, src {:?}, dst {}",
+            env_id, src, dst
+        );
+
+        let clients = self.pool.bulk_all().to_vec();
+        await_transfer(py, async move {
+            upload_directory(&clients, env_id, &src, dst, compression_level).await
+        })
+    }
+
+    #[pyo3(signature = (env_id, src, dst, compression_level = None))]
+    fn directory_download_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        src: String,
+        dst: PathBuf,
+        compression_level: Option<i32>,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Downloading directory asynchronously for environment {}, src {}, dst {:?}",
+            env_id, src, dst
+        );
+
+        let clients = self.pool.bulk_all().to_vec();
+        await_transfer(py, async move {
+            download_directory(&clients, env_id, src, &dst, compression_level).await
+        })
+    }
+
+    fn stat_async<'py>(
+        &self,
+        py: Python<'py>,
+        env_id: EnvironmentId,
+        path: String,
+    ) -> PyResult<&'py PyAny> {
+        debug!(
+            "Stating file asynchronously for environment {}, path {}",
+            env_id, path
+        );
+
+        let client = self.pool.control().clone();
+        await_rpc(py, async move {
+            client.stat(context::current(), env_id, path).await
+        })
+    }
+
+    // Metadata API
+    fn get_metadata(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        key: String,
+    ) -> PyResult<Option<String>> {
+        debug!("Getting metadata for environment {}, key {}", env_id, key);
+        run_in_runtime(
+            py,
+            self,
+            self.pool
+                .control()
+                .get_metadata(context::current(), env_id, key),
+        )
+    }
+
+    fn set_metadata(
+        &self,
+        py: Python,
+        env_id: EnvironmentId,
+        key: String,
+        value: String,
+    ) -> PyResult<()> {
         debug!(
             "Setting metadata for environment {}, key {}, value {}",
             env_id, key, value
         );
 
         run_in_runtime(
+            py,
             self,
-            self.client
+            self.pool
+                .control()
                 .set_metadata(context::current(), env_id, key, value),
         )
     }
 }
 
+/// Hashes a local file, or part of one, the same way the agent does, so digests from either side
+/// can be compared.
+#[pyfunction]
+#[pyo3(signature = (path, algorithm, offset = 0, length = None))]
+fn file_hash(
+    py: Python,
+    path: PathBuf,
+    algorithm: String,
+    offset: u64,
+    length: Option<u64>,
+) -> PyResult<String> {
+    let algorithm = HashAlgorithm::from_str(&algorithm).map_err(PyValueError::new_err)?;
+    Ok(py.allow_threads(|| hash_file(&path, algorithm, Some((offset, length))))?)
+}
+
 #[pymodule]
 pub fn bh_agent_client(_py: Python, m: &PyModule) -> PyResult<()> {
     pyo3_log::init();
+
+    let mut builder = runtime::Builder::new_multi_thread();
+    builder
+        .worker_threads(CLIENT_WORKER_THREADS)
+        .thread_name("bh-agent-client")
+        .enable_all();
+    pyo3_asyncio::tokio::init(builder);
+
+    m.add_class::<AgentMetrics>()?;
     m.add_class::<FileStat>()?;
+    m.add_class::<StatColumns>()?;
     m.add_class::<BhAgentClient>()?;
+    m.add_function(wrap_pyfunction!(file_hash, m)?)?;
     Ok(())
 }
@@ -1,15 +1,146 @@
-use bh_agent_common::BhAgentServiceClient;
-use tarpc::{client, tokio_serde::formats::Json};
-use tokio::net::ToSocketAddrs;
+use std::net::SocketAddr;
+use std::sync::atomic::{AtomicUsize, Ordering};
+use std::time::{Duration, SystemTime};
 
-pub async fn build_client<A>(socket_addr: A) -> anyhow::Result<BhAgentServiceClient>
+use futures::future;
+
+use bh_agent_common::{client_handshake, new_client, BhAgentServiceClient, Compression, WireCodec};
+use tarpc::context;
+use tokio::io::{AsyncRead, AsyncWrite};
+#[cfg(target_family = "unix")]
+use tokio::net::UnixStream;
+use tokio::net::{TcpStream, ToSocketAddrs};
+
+// Waiting for a process costs the agent nothing, so waits without a timeout may take as long as
+// the process does. Waits with a timeout get some slack on top for the round trip.
+const UNBOUNDED_WAIT: Duration = Duration::from_secs(365 * 24 * 60 * 60);
+const WAIT_SLACK: Duration = Duration::from_secs(10);
+
+/// Connects to an agent, returning the client, the negotiated codec and whether the connection
+/// compresses frames. Compression is only asked for if `compression` is set.
+pub async fn build_client<A>(
+    socket_addr: A,
+    codec: WireCodec,
+    compression: Option<Compression>,
+) -> anyhow::Result<(BhAgentServiceClient, WireCodec, bool)>
 where
     A: ToSocketAddrs,
 {
-    let mut transport = tarpc::serde_transport::tcp::connect(socket_addr, Json::default);
-    transport.config_mut().max_frame_length(usize::MAX);
+    let stream = TcpStream::connect(socket_addr).await?;
+    stream.set_nodelay(true)?;
+    connect_stream(stream, codec, compression).await
+}
+
+/// Sets up a client over an already connected stream, such as a socket shared with an agent this
+/// process started. Returns the same as `build_client`.
+pub async fn connect_stream<S>(
+    mut stream: S,
+    codec: WireCodec,
+    compression: Option<Compression>,
+) -> anyhow::Result<(BhAgentServiceClient, WireCodec, bool)>
+where
+    S: AsyncRead + AsyncWrite + Unpin + Send + 'static,
+{
+    // Always offer JSON last so agents that only speak JSON can still be used
+    let mut preferred = vec![codec];
+    if codec != WireCodec::Json {
+        preferred.push(WireCodec::Json);
+    }
+    let (negotiated, compressed) =
+        client_handshake(&mut stream, &preferred, compression.is_some()).await?;
+    let compression = if compressed { compression } else { None };
 
-    let client = BhAgentServiceClient::new(client::Config::default(), transport.await?).spawn();
+    Ok((
+        new_client(stream, negotiated, compression),
+        negotiated,
+        compressed,
+    ))
+}
+
+/// Connections to one agent. Control requests, such as polls, stats and opens, get a connection
+/// of their own so they never queue behind bulk data, which is spread across the rest. The agent
+/// shares its state between connections, so any of them can use any handle.
+pub struct Pool {
+    control: BhAgentServiceClient,
+    bulk: Vec<BhAgentServiceClient>,
+    next_bulk: AtomicUsize,
+}
+
+impl Pool {
+    /// With no bulk connections, bulk data goes over the control connection.
+    fn new(control: BhAgentServiceClient, mut bulk: Vec<BhAgentServiceClient>) -> Self {
+        if bulk.is_empty() {
+            bulk.push(control.clone());
+        }
+        Self {
+            control,
+            bulk,
+            next_bulk: AtomicUsize::new(0),
+        }
+    }
+
+    pub fn control(&self) -> &BhAgentServiceClient {
+        &self.control
+    }
+
+    /// Returns the next bulk connection, taking turns so concurrent transfers spread out.
+    pub fn bulk(&self) -> &BhAgentServiceClient {
+        let index = self.next_bulk.fetch_add(1, Ordering::Relaxed);
+        &self.bulk[index % self.bulk.len()]
+    }
+
+    /// Every bulk connection, for operations that split their data across them.
+    pub fn bulk_all(&self) -> &[BhAgentServiceClient] {
+        &self.bulk
+    }
+}
+
+/// Connects a pool with a control connection and `bulk_connections` connections for bulk data.
+/// With no bulk connections, everything goes over the control connection. The codec and
+/// compression are negotiated on the control connection and reused for the others.
+pub async fn build_pool(
+    socket_addr: SocketAddr,
+    codec: WireCodec,
+    compression: Option<Compression>,
+    bulk_connections: usize,
+) -> anyhow::Result<(Pool, WireCodec, bool)> {
+    let (control, codec, compressed) = build_client(socket_addr, codec, compression).await?;
+    let compression = if compressed { compression } else { None };
+    let bulk = future::try_join_all((0..bulk_connections).map(|_| async {
+        Ok::<_, anyhow::Error>(build_client(socket_addr, codec, compression).await?.0)
+    }))
+    .await?;
+    Ok((Pool::new(control, bulk), codec, compressed))
+}
+
+/// Sets up a pool over sockets shared with an agent, which serves each of them as a connection.
+/// The first socket is used for control requests and the rest for bulk data.
+#[cfg(target_family = "unix")]
+pub async fn connect_pool(
+    sockets: Vec<UnixStream>,
+    codec: WireCodec,
+    compression: Option<Compression>,
+) -> anyhow::Result<(Pool, WireCodec, bool)> {
+    let mut sockets = sockets.into_iter();
+    let control = sockets
+        .next()
+        .ok_or_else(|| anyhow::anyhow!("At least one socket is required"))?;
+    let (control, codec, compressed) = connect_stream(control, codec, compression).await?;
+    let compression = if compressed { compression } else { None };
+    let bulk = future::try_join_all(sockets.map(|socket| async move {
+        Ok::<_, anyhow::Error>(connect_stream(socket, codec, compression).await?.0)
+    }))
+    .await?;
+    Ok((Pool::new(control, bulk), codec, compressed))
+}
 
-    Ok(client)
+/// Returns a context whose deadline doesn't cut a process wait with the given timeout short.
+pub fn wait_context(timeout: Option<f64>) -> context::Context {
+    let mut ctx = context::current();
+    ctx.deadline = SystemTime::now()
+        + match timeout {
+            Some(t) => Duration::from_secs_f64(t.max(0.0)) + WAIT_SLACK,
+            None => UNBOUNDED_WAIT,
+        };
+    ctx
 }
@@ -0,0 +1,122 @@
+use bh_agent_common::{
+    FileOpenMode, FileOpenType, ProcessChannel, Redirection, RemotePOpenConfig, UserId,
+};
+use pyo3::buffer::PyBuffer;
+use pyo3::exceptions::{PyBufferError, PyRuntimeError};
+use pyo3::{PyAny, PyResult, Python};
+
+// Conversions from the loosely typed arguments the Python side passes in
+
+fn redirection(save: bool, capture: bool) -> Redirection {
+    match (save, capture) {
+        (true, true) => Redirection::Capture,
+        (true, false) => Redirection::Save,
+        (false, _) => Redirection::None,
+    }
+}
+
+pub fn popen_config(
+    argv: Vec<String>,
+    stdin: bool,
+    stdout: bool,
+    stderr: bool,
+    executable: Option<String>,
+    env: Option<Vec<(String, String)>>,
+    cwd: Option<String>,
+    setuid: Option<u32>,
+    setgid: Option<u32>,
+    setpgid: Option<bool>,
+    capture: bool,
+    capture_limit: Option<u64>,
+) -> RemotePOpenConfig {
+    RemotePOpenConfig {
+        argv,
+        // Only output can be captured
+        stdin: redirection(stdin, false),
+        stdout: redirection(stdout, capture),
+        stderr: redirection(stderr, capture),
+        executable,
+        env,
+        cwd,
+        setuid,
+        setgid,
+        setpgid: setpgid.unwrap_or(false),
+        capture_limit,
+    }
+}
+
+pub fn parse_mode_and_type(mode_and_type: &str) -> (FileOpenMode, FileOpenType) {
+    // Mode parsing
+    let mut mode = FileOpenMode::Read;
+    mode_and_type.chars().for_each(|c| match c {
+        'r' => mode = FileOpenMode::Read,
+        'w' => mode = FileOpenMode::Write,
+        'x' => mode = FileOpenMode::ExclusiveWrite,
+        'a' => mode = FileOpenMode::Append,
+        '+' => mode = FileOpenMode::Update,
+        _ => {}
+    });
+
+    // Type parsing
+    let mut type_ = FileOpenType::Text;
+    if mode_and_type.contains("b") {
+        type_ = FileOpenType::Binary;
+    }
+
+    (mode, type_)
+}
+
+// TODO: This is just 0, 1, 2 for now
+pub fn process_channel(channel: i32) -> PyResult<ProcessChannel> {
+    match channel {
+        0 => Ok(ProcessChannel::Stdin),
+        1 => Ok(ProcessChannel::Stdout),
+        2 => Ok(ProcessChannel::Stderr),
+        _ => Err(PyRuntimeError::new_err("Invalid channel")),
+    }
+}
+
+pub fn user_id(user: String) -> UserId {
+    match user.parse::<u32>() {
+        Ok(id) => UserId::Id(id),
+        Err(_) => UserId::Name(user),
+    }
+}
+
+/// Converts a timeout in seconds from Python into the milliseconds the agent expects.
+pub fn timeout_ms(timeout: Option<f64>) -> Option<u32> {
+    timeout.map(|t| (t * 1000.0) as u32)
+}
+
+/// Copies any object supporting the buffer protocol, such as bytes, bytearray, memoryview or
+/// mmap, into a Vec with a single memcpy. Requests own their payload, so this is the only copy
+/// made before serialization.
+pub fn buffer_bytes(py: Python, data: &PyAny) -> PyResult<Vec<u8>> {
+    PyBuffer::<u8>::get(data)?.to_vec(py)
+}
+
+/// Checks that a Python buffer can be filled by copy_into_buffer. Callers check before fetching
+/// the data, so a bad buffer doesn't cost the data that was read for it.
+pub fn check_writable_buffer(buffer: &PyBuffer<u8>) -> PyResult<()> {
+    if buffer.readonly() {
+        return Err(PyBufferError::new_err("buffer is read-only"));
+    }
+    if !buffer.is_c_contiguous() {
+        return Err(PyBufferError::new_err("buffer is not contiguous"));
+    }
+    Ok(())
+}
+
+/// Copies data into the start of a writable, contiguous Python buffer.
+pub fn copy_into_buffer(buffer: &PyBuffer<u8>, data: &[u8]) -> PyResult<()> {
+    check_writable_buffer(buffer)?;
+    if data.len() > buffer.len_bytes() {
+        return Err(PyBufferError::new_err("buffer is too small"));
+    }
+    // Safety: the buffer is writable, contiguous and at least data.len() bytes long, and the GIL
+    // is held so it can't be resized underneath us
+    unsafe {
+        std::ptr::copy_nonoverlapping(data.as_ptr(), buffer.buf_ptr() as *mut u8, data.len());
+    }
+    Ok(())
+}
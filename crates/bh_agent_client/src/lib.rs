@@ -1,4 +1,7 @@
+mod batch;
 mod bindings;
 mod client;
+mod convert;
+mod transfer;
 
 pub use bindings::bh_agent_client;
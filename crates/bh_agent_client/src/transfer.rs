@@ -0,0 +1,304 @@
+use std::fs::File;
+use std::io::{self, Read, Write};
+use std::path::Path;
+use std::time::{Duration, SystemTime};
+
+use anyhow::Result;
+use futures::{future, stream, StreamExt, TryStreamExt};
+use tarpc::context;
+use tokio::sync::mpsc;
+use tokio::task;
+
+use bh_agent_common::{
+    read_archive, write_archive, BhAgentServiceClient, ChunkReader, ChunkWriter, EnvironmentId,
+    FileId, FileStat,
+};
+
+// Chunks are kept small enough that a full window fits comfortably within a request deadline on
+// slow links, and large enough that per-request overhead is negligible.
+pub const CHUNK_SIZE: usize = 1024 * 1024;
+pub const WINDOW: usize = 8;
+const TRANSFER_TIMEOUT: Duration = Duration::from_secs(300);
+
+/// Returns a context whose deadline leaves room for moving or reading a lot of data.
+pub fn transfer_context() -> context::Context {
+    let mut ctx = context::current();
+    ctx.deadline = SystemTime::now() + TRANSFER_TIMEOUT;
+    ctx
+}
+
+/// Yields the contents of a reader as (offset, chunk) pairs.
+struct Chunks<R: Read> {
+    reader: R,
+    offset: u64,
+    chunk_size: usize,
+    done: bool,
+}
+
+impl<R: Read> Iterator for Chunks<R> {
+    type Item = std::io::Result<(u64, Vec<u8>)>;
+
+    fn next(&mut self) -> Option<Self::Item> {
+        if self.done {
+            return None;
+        }
+        let mut chunk = Vec::with_capacity(self.chunk_size);
+        match (&mut self.reader)
+            .take(self.chunk_size as u64)
+            .read_to_end(&mut chunk)
+        {
+            Ok(0) => {
+                self.done = true;
+                None
+            }
+            Ok(n) => {
+                let offset = self.offset;
+                self.offset += n as u64;
+                Some(Ok((offset, chunk)))
+            }
+            Err(e) => {
+                self.done = true;
+                Some(Err(e))
+            }
+        }
+    }
+}
+
+/// Picks the connection for a chunk, so the chunks of a transfer are spread across every
+/// connection in turn.
+fn chunk_client(clients: &[BhAgentServiceClient], offset: u64) -> &BhAgentServiceClient {
+    &clients[(offset / CHUNK_SIZE as u64) as usize % clients.len()]
+}
+
+async fn upload_chunks(
+    clients: &[BhAgentServiceClient],
+    env_id: EnvironmentId,
+    fd: FileId,
+    src: File,
+) -> Result<u64> {
+    let chunks = Chunks {
+        reader: src,
+        offset: 0,
+        chunk_size: CHUNK_SIZE,
+        done: false,
+    };
+    stream::iter(chunks)
+        .map(|chunk| async move {
+            let (offset, data) = chunk?;
+            let len = data.len() as u64;
+            chunk_client(clients, offset)
+                .file_upload_chunk(transfer_context(), env_id, fd, offset, data)
+                .await??;
+            Ok::<u64, anyhow::Error>(len)
+        })
+        .buffer_unordered(WINDOW)
+        .try_fold(0, |total, len| future::ready(Ok(total + len)))
+        .await
+}
+
+/// Uploads a local file to the agent, keeping up to `WINDOW` chunks in flight, spread across the
+/// given connections. Returns the number of bytes written.
+pub async fn upload_file(
+    clients: &[BhAgentServiceClient],
+    env_id: EnvironmentId,
+    src: &Path,
+    dst: String,
+    mode: Option<u32>,
+) -> Result<u64> {
+    let client = &clients[0];
+    let file = File::open(src)?;
+    let fd = client
+        .file_upload_begin(transfer_context(), env_id, dst.clone())
+        .await??;
+    match upload_chunks(clients, env_id, fd, file).await {
+        Ok(total) => {
+            client
+                .file_upload_finish(transfer_context(), env_id, fd, mode)
+                .await??;
+            Ok(total)
+        }
+        Err(e) => {
+            let _ = client
+                .file_upload_abort(context::current(), env_id, fd, dst)
+                .await;
+            Err(e)
+        }
+    }
+}
+
+async fn download_chunks(
+    clients: &[BhAgentServiceClient],
+    env_id: EnvironmentId,
+    fd: FileId,
+    size: u64,
+    dst: &mut File,
+) -> Result<()> {
+    let mut chunks = stream::iter((0..size).step_by(CHUNK_SIZE))
+        .map(|offset| async move {
+            Ok::<Vec<u8>, anyhow::Error>(
+                chunk_client(clients, offset)
+                    .file_download_chunk(transfer_context(), env_id, fd, offset, CHUNK_SIZE as u32)
+                    .await??,
+            )
+        })
+        .buffered(WINDOW);
+    while let Some(chunk) = chunks.try_next().await? {
+        dst.write_all(&chunk)?;
+    }
+
+    // Pipes, devices and procfs files report a size of zero, so read those until end of file.
+    // They can't be read at an offset, so these reads are sequential.
+    if size == 0 {
+        loop {
+            let chunk = clients[0]
+                .file_read(transfer_context(), env_id, fd, Some(CHUNK_SIZE as u32))
+                .await??;
+            if chunk.is_empty() {
+                break;
+            }
+            dst.write_all(&chunk)?;
+        }
+    }
+    Ok(())
+}
+
+/// Downloads a file from the agent, keeping up to `WINDOW` chunks in flight, spread across the
+/// given connections. Returns the stat of the remote file, taken when it was opened.
+pub async fn download_file(
+    clients: &[BhAgentServiceClient],
+    env_id: EnvironmentId,
+    src: String,
+    dst: &Path,
+) -> Result<FileStat> {
+    let client = &clients[0];
+    let (fd, stat) = client
+        .file_download_begin(transfer_context(), env_id, src)
+        .await??;
+    let result = match File::create(dst) {
+        Ok(mut file) => {
+            let result = download_chunks(clients, env_id, fd, stat.size as u64, &mut file).await;
+            // Don't leave a partly written file behind
+            if result.is_err() {
+                let _ = std::fs::remove_file(dst);
+            }
+            result
+        }
+        Err(e) => Err(e.into()),
+    };
+    client.file_close(context::current(), env_id, fd).await??;
+    result.map(|_| stat)
+}
+
+// The agent packs up to this many 64 KiB chunks of a directory ahead of the client
+const ARCHIVE_WINDOW: u32 = 64;
+
+/// Uploads a local directory to the agent as a tar stream, which the agent unpacks into `dst` as
+/// it arrives. The directory is packed on a blocking thread while chunks are sent, so it is never
+/// staged as a whole. Returns the size of the stream.
+pub async fn upload_directory(
+    clients: &[BhAgentServiceClient],
+    env_id: EnvironmentId,
+    src: &Path,
+    dst: String,
+    compression_level: Option<i32>,
+) -> Result<u64> {
+    let client = &clients[0];
+    let archive = client
+        .archive_upload_begin(transfer_context(), env_id, dst, compression_level.is_some())
+        .await??;
+
+    let (sender, receiver) = mpsc::channel(WINDOW);
+    let src = src.to_path_buf();
+    let packer = task::spawn_blocking(move || {
+        let mut offset = 0;
+        let out = ChunkWriter::new(CHUNK_SIZE, |chunk: Vec<u8>| {
+            let len = chunk.len() as u64;
+            sender
+                .blocking_send((offset, chunk))
+                .map_err(|_| io::Error::from(io::ErrorKind::BrokenPipe))?;
+            offset += len;
+            Ok(())
+        });
+        write_archive(&src, out, compression_level)
+    });
+
+    let sent = stream::unfold(receiver, |mut receiver| async move {
+        receiver.recv().await.map(|chunk| (chunk, receiver))
+    })
+    .map(|(offset, data)| async move {
+        let len = data.len() as u64;
+        chunk_client(clients, offset)
+            .archive_upload_chunk(transfer_context(), env_id, archive, offset, data)
+            .await??;
+        Ok::<u64, anyhow::Error>(len)
+    })
+    .buffer_unordered(WINDOW)
+    .try_fold(0, |total, len| future::ready(Ok(total + len)))
+    .await;
+
+    // If sending failed the packer stops at its next chunk. The agent's own error, if it has
+    // one, says more than a failed chunk does.
+    let packed = packer.await?;
+    let finished = client
+        .archive_upload_finish(transfer_context(), env_id, archive)
+        .await?;
+    finished?;
+    let total = sent?;
+    packed?;
+    Ok(total)
+}
+
+/// Downloads a directory from the agent as a tar stream, unpacking it into `dst` on a blocking
+/// thread as it arrives.
+pub async fn download_directory(
+    clients: &[BhAgentServiceClient],
+    env_id: EnvironmentId,
+    src: String,
+    dst: &Path,
+    compression_level: Option<i32>,
+) -> Result<()> {
+    let client = &clients[0];
+    let subscription = client
+        .archive_download(
+            transfer_context(),
+            env_id,
+            src,
+            compression_level,
+            ARCHIVE_WINDOW,
+        )
+        .await??;
+
+    let (sender, mut receiver) = mpsc::channel::<Vec<u8>>(WINDOW);
+    let dst = dst.to_path_buf();
+    let unpacker = task::spawn_blocking(move || {
+        read_archive(
+            ChunkReader::new(move || receiver.blocking_recv()),
+            &dst,
+            compression_level.is_some(),
+        )
+    });
+
+    let received = async {
+        while let Some(data) = client
+            .subscription_next(transfer_context(), env_id, subscription)
+            .await??
+        {
+            if sender.send(data).await.is_err() {
+                // The unpacker has given up, its error says why
+                let _ = client
+                    .subscription_cancel(context::current(), env_id, subscription)
+                    .await;
+                break;
+            }
+        }
+        Ok::<(), anyhow::Error>(())
+    }
+    .await;
+    drop(sender);
+
+    // A download that failed on the agent leaves the unpacker with a truncated stream, so the
+    // agent's error comes first
+    let unpacked = unpacker.await?;
+    received?;
+    Ok(unpacked?)
+}
@@ -7,6 +7,8 @@ use thiserror::Error;
 pub enum AgentError {
     #[error("Invalid environment ID")]
     InvalidEnvironmentId,
+    #[error("The default environment can't be destroyed")]
+    DefaultEnvironment,
     #[error("IO Error: {0}")]
     IoError(String),
     #[error("Invalid file ID")]
@@ -29,6 +31,16 @@ pub enum AgentError {
     Errno(i32),
     #[error("Unsupported platform")]
     UnsupportedPlatform,
+    #[error("Batch operation refers to operation {0}, which did not produce a handle")]
+    InvalidBatchReference(u32),
+    #[error("Invalid subscription ID")]
+    InvalidSubscriptionId,
+    #[error("Invalid archive ID")]
+    InvalidArchiveId,
+    #[error("Invalid hash {0}, expected a lowercase hex SHA-256")]
+    InvalidHash(String),
+    #[error("Uploaded content does not match hash {0}")]
+    HashMismatch(String),
     #[error("The server state is inconsistent")]
     Inconsistent,
     #[error("Unknown Error")]
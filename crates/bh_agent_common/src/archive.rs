@@ -0,0 +1,208 @@
+use std::io::{self, Read, Write};
+use std::path::Path;
+
+// Directories are moved as tar streams. Both ends pack and unpack them on a blocking thread and
+// hand the stream over in chunks, so a directory is never staged in memory or on disk as a whole.
+
+/// Packs the contents of `dir` into a tar stream, compressed with zstd if a level is given.
+/// Symlinks are stored as links rather than followed, and modes and mtimes are kept.
+pub fn write_archive<W: Write>(
+    dir: &Path,
+    out: W,
+    compression_level: Option<i32>,
+) -> io::Result<()> {
+    match compression_level {
+        Some(level) => {
+            let mut encoder = zstd::Encoder::new(out, level)?;
+            write_tar(dir, &mut encoder)?;
+            encoder.finish()?.flush()
+        }
+        None => {
+            let mut out = out;
+            write_tar(dir, &mut out)?;
+            out.flush()
+        }
+    }
+}
+
+fn write_tar<W: Write>(dir: &Path, out: W) -> io::Result<()> {
+    let mut builder = tar::Builder::new(out);
+    builder.follow_symlinks(false);
+    builder.append_dir_all(".", dir)?;
+    builder.finish()
+}
+
+/// Unpacks a tar stream written by `write_archive` into `dir`, creating it if needed and
+/// replacing files that are already there.
+pub fn read_archive<R: Read>(input: R, dir: &Path, compressed: bool) -> io::Result<()> {
+    std::fs::create_dir_all(dir)?;
+    if compressed {
+        read_tar(zstd::Decoder::new(input)?, dir)
+    } else {
+        read_tar(input, dir)
+    }
+}
+
+fn read_tar<R: Read>(input: R, dir: &Path) -> io::Result<()> {
+    let mut archive = tar::Archive::new(input);
+    archive.set_preserve_permissions(true);
+    archive.set_preserve_mtime(true);
+    archive.set_overwrite(true);
+    archive.unpack(dir)?;
+    // Consume the padding after the last entry, so the writer isn't cut off before it finishes
+    io::copy(&mut archive.into_inner(), &mut io::sink())?;
+    Ok(())
+}
+
+/// Collects what is written to it into chunks of a fixed size and passes each one on as it fills
+/// up. The last, partial, chunk is passed on by `flush`.
+pub struct ChunkWriter<F: FnMut(Vec<u8>) -> io::Result<()>> {
+    chunk: Vec<u8>,
+    chunk_size: usize,
+    send: F,
+}
+
+impl<F: FnMut(Vec<u8>) -> io::Result<()>> ChunkWriter<F> {
+    pub fn new(chunk_size: usize, send: F) -> Self {
+        Self {
+            chunk: Vec::with_capacity(chunk_size),
+            chunk_size,
+            send,
+        }
+    }
+
+    fn send_chunk(&mut self) -> io::Result<()> {
+        let chunk = std::mem::replace(&mut self.chunk, Vec::with_capacity(self.chunk_size));
+        (self.send)(chunk)
+    }
+}
+
+impl<F: FnMut(Vec<u8>) -> io::Result<()>> Write for ChunkWriter<F> {
+    fn write(&mut self, buf: &[u8]) -> io::Result<usize> {
+        let n = buf.len().min(self.chunk_size - self.chunk.len());
+        self.chunk.extend_from_slice(&buf[..n]);
+        if self.chunk.len() == self.chunk_size {
+            self.send_chunk()?;
+        }
+        Ok(n)
+    }
+
+    fn flush(&mut self) -> io::Result<()> {
+        if !self.chunk.is_empty() {
+            self.send_chunk()?;
+        }
+        Ok(())
+    }
+}
+
+/// Reads the chunks returned by `receive` as one stream, which ends when it returns None.
+pub struct ChunkReader<F: FnMut() -> Option<Vec<u8>>> {
+    receive: F,
+    chunk: Vec<u8>,
+    pos: usize,
+}
+
+impl<F: FnMut() -> Option<Vec<u8>>> ChunkReader<F> {
+    pub fn new(receive: F) -> Self {
+        Self {
+            receive,
+            chunk: Vec::new(),
+            pos: 0,
+        }
+    }
+}
+
+impl<F: FnMut() -> Option<Vec<u8>>> Read for ChunkReader<F> {
+    fn read(&mut self, buf: &mut [u8]) -> io::Result<usize> {
+        while self.pos == self.chunk.len() {
+            match (self.receive)() {
+                Some(chunk) => {
+                    self.chunk = chunk;
+                    self.pos = 0;
+                }
+                None => return Ok(0),
+            }
+        }
+        let n = buf.len().min(self.chunk.len() - self.pos);
+        buf[..n].copy_from_slice(&self.chunk[self.pos..self.pos + n]);
+        self.pos += n;
+        Ok(n)
+    }
+}
+
+#[cfg(all(test, target_family = "unix"))]
+mod tests {
+    use std::fs;
+    use std::os::unix::fs::{symlink, PermissionsExt};
+    use std::path::PathBuf;
+    use std::sync::mpsc;
+    use std::thread;
+    use std::time::{Duration, SystemTime};
+
+    use super::*;
+
+    fn scratch(name: &str) -> PathBuf {
+        let dir = std::env::temp_dir().join(format!("bh-archive-{}-{}", std::process::id(), name));
+        let _ = fs::remove_dir_all(&dir);
+        dir
+    }
+
+    fn roundtrip(name: &str, compression_level: Option<i32>) {
+        let src = scratch(&format!("{}-src", name));
+        let dst = scratch(&format!("{}-dst", name));
+        fs::create_dir_all(src.join("nested")).unwrap();
+        fs::write(src.join("nested/script"), b"#!/bin/sh\n").unwrap();
+        fs::set_permissions(src.join("nested/script"), fs::Permissions::from_mode(0o750)).unwrap();
+        let mtime = SystemTime::UNIX_EPOCH + Duration::from_secs(1_000_000_000);
+        fs::File::options()
+            .write(true)
+            .open(src.join("nested/script"))
+            .unwrap()
+            .set_modified(mtime)
+            .unwrap();
+        symlink("nested/script", src.join("link")).unwrap();
+
+        // Small chunks, so entries span several of them
+        let (sender, receiver) = mpsc::sync_channel(4);
+        let writer = {
+            let src = src.clone();
+            thread::spawn(move || {
+                let out = ChunkWriter::new(100, |chunk| {
+                    sender
+                        .send(chunk)
+                        .map_err(|_| io::ErrorKind::BrokenPipe.into())
+                });
+                write_archive(&src, out, compression_level)
+            })
+        };
+        read_archive(
+            ChunkReader::new(move || receiver.recv().ok()),
+            &dst,
+            compression_level.is_some(),
+        )
+        .unwrap();
+        writer.join().unwrap().unwrap();
+
+        let script = fs::metadata(dst.join("nested/script")).unwrap();
+        assert_eq!(script.permissions().mode() & 0o777, 0o750);
+        assert_eq!(script.modified().unwrap(), mtime);
+        assert_eq!(fs::read(dst.join("nested/script")).unwrap(), b"#!/bin/sh\n");
+        assert_eq!(
+            fs::read_link(dst.join("link")).unwrap(),
+            Path::new("nested/script")
+        );
+
+        fs::remove_dir_all(src).unwrap();
+        fs::remove_dir_all(dst).unwrap();
+    }
+
+    #[test]
+    fn roundtrip_keeps_modes_mtimes_and_symlinks() {
+        roundtrip("raw", None);
+    }
+
+    #[test]
+    fn roundtrip_compressed() {
+        roundtrip("zstd", Some(3));
+    }
+}
@@ -0,0 +1,157 @@
+use std::error::Error;
+use std::io;
+use std::pin::Pin;
+
+use bytes::{BufMut, Bytes, BytesMut};
+use tarpc::tokio_serde::{Deserializer, Serializer};
+
+// On a connection that negotiated compression, every frame starts with one of these tags
+const RAW: u8 = 0;
+const ZSTD: u8 = 1;
+
+pub const DEFAULT_COMPRESSION_LEVEL: i32 = 3;
+pub const DEFAULT_COMPRESSION_THRESHOLD: usize = 4096;
+
+/// How a peer compresses the messages it sends. Each side picks its own settings, only whether
+/// the connection uses compression at all is negotiated.
+///
+/// Messages smaller than the threshold are sent as they are, which keeps control requests cheap,
+/// so in practice only bulk data such as file reads, writes and transfer chunks is compressed.
+#[derive(Copy, Clone, Debug, PartialEq, Eq)]
+pub struct Compression {
+    pub level: i32,
+    pub threshold: usize,
+}
+
+impl Default for Compression {
+    fn default() -> Self {
+        Self {
+            level: DEFAULT_COMPRESSION_LEVEL,
+            threshold: DEFAULT_COMPRESSION_THRESHOLD,
+        }
+    }
+}
+
+/// Wraps a serde codec, compressing serialized messages with zstd. Without compression, messages
+/// pass through untagged, which is what connections that didn't negotiate it expect.
+pub struct Compressed<C> {
+    inner: C,
+    compression: Option<Compression>,
+}
+
+impl<C> Compressed<C> {
+    pub fn new(inner: C, compression: Option<Compression>) -> Self {
+        Self { inner, compression }
+    }
+}
+
+fn invalid_data<E: Into<Box<dyn Error + Send + Sync>>>(e: E) -> io::Error {
+    io::Error::new(io::ErrorKind::InvalidData, e)
+}
+
+fn tagged(tag: u8, data: &[u8]) -> Bytes {
+    let mut frame = BytesMut::with_capacity(data.len() + 1);
+    frame.put_u8(tag);
+    frame.put_slice(data);
+    frame.freeze()
+}
+
+impl<T, C> Serializer<T> for Compressed<C>
+where
+    C: Serializer<T> + Unpin,
+    C::Error: Into<Box<dyn Error + Send + Sync>>,
+{
+    type Error = io::Error;
+
+    fn serialize(self: Pin<&mut Self>, item: &T) -> io::Result<Bytes> {
+        let this = self.get_mut();
+        let message = Pin::new(&mut this.inner)
+            .serialize(item)
+            .map_err(invalid_data)?;
+        let compression = match this.compression {
+            Some(compression) => compression,
+            None => return Ok(message),
+        };
+        if message.len() >= compression.threshold {
+            let compressed = zstd::bulk::compress(&message, compression.level)?;
+            // Data that is already compressed, or random, is sent as is
+            if compressed.len() < message.len() {
+                return Ok(tagged(ZSTD, &compressed));
+            }
+        }
+        Ok(tagged(RAW, &message))
+    }
+}
+
+impl<T, C> Deserializer<T> for Compressed<C>
+where
+    C: Deserializer<T> + Unpin,
+    C::Error: Into<Box<dyn Error + Send + Sync>>,
+{
+    type Error = io::Error;
+
+    fn deserialize(self: Pin<&mut Self>, src: &BytesMut) -> io::Result<T> {
+        let this = self.get_mut();
+        if this.compression.is_none() {
+            return Pin::new(&mut this.inner)
+                .deserialize(src)
+                .map_err(invalid_data);
+        }
+        let message = match src.split_first() {
+            Some((&RAW, message)) => BytesMut::from(message),
+            Some((&ZSTD, compressed)) => BytesMut::from(&zstd::stream::decode_all(compressed)?[..]),
+            Some((tag, _)) => return Err(invalid_data(format!("Unknown frame tag {}", tag))),
+            None => return Err(invalid_data("Empty frame")),
+        };
+        Pin::new(&mut this.inner)
+            .deserialize(&message)
+            .map_err(invalid_data)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use tarpc::tokio_serde::formats::Bincode;
+
+    use super::*;
+
+    fn roundtrip(compression: Option<Compression>, data: &[u8]) -> usize {
+        let mut codec = Compressed::new(Bincode::<Vec<u8>, Vec<u8>>::default(), compression);
+        let frame = Pin::new(&mut codec).serialize(&data.to_vec()).unwrap();
+        let decoded = Pin::new(&mut codec)
+            .deserialize(&BytesMut::from(&frame[..]))
+            .unwrap();
+        assert_eq!(decoded, data);
+        frame.len()
+    }
+
+    #[test]
+    fn compresses_large_messages() {
+        let data = vec![0x5au8; 64 * 1024];
+        let plain = roundtrip(None, &data);
+        assert!(roundtrip(Some(Compression::default()), &data) < plain / 10);
+    }
+
+    #[test]
+    fn small_and_incompressible_messages_are_sent_raw() {
+        let small = vec![0x5au8; 16];
+        assert_eq!(
+            roundtrip(Some(Compression::default()), &small),
+            roundtrip(None, &small) + 1
+        );
+
+        let mut state = 0x2545f4914f6cdd1du64;
+        let random: Vec<u8> = (0..64 * 1024)
+            .map(|_| {
+                state ^= state << 13;
+                state ^= state >> 7;
+                state ^= state << 17;
+                state as u8
+            })
+            .collect();
+        assert_eq!(
+            roundtrip(Some(Compression::default()), &random),
+            roundtrip(None, &random) + 1
+        );
+    }
+}
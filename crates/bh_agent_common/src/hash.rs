@@ -0,0 +1,111 @@
+use std::fs::File;
+use std::io::{self, Read, Seek, SeekFrom};
+use std::path::Path;
+use std::str::FromStr;
+
+use serde::{Deserialize, Serialize};
+use sha2::{Digest, Sha256};
+use xxhash_rust::xxh3::Xxh3;
+
+// Files are hashed as they are read, this much at a time
+const HASH_BUFFER_SIZE: usize = 256 * 1024;
+
+/// The hashes files can be checked with. XXH3 is the 64-bit variant, which is fast enough to be
+/// limited by the disk and suits checking whether a file changed. SHA-256 is for content that
+/// has to be trusted.
+#[derive(Copy, Clone, Debug, Serialize, Deserialize, PartialEq)]
+pub enum HashAlgorithm {
+    Xxh3,
+    Sha256,
+}
+
+impl FromStr for HashAlgorithm {
+    type Err = String;
+
+    fn from_str(s: &str) -> Result<Self, Self::Err> {
+        match s.to_ascii_lowercase().as_str() {
+            "xxh3" => Ok(HashAlgorithm::Xxh3),
+            "sha256" => Ok(HashAlgorithm::Sha256),
+            _ => Err(format!("Unknown hash algorithm: {}", s)),
+        }
+    }
+}
+
+/// A part of a file to hash: an offset, and a length, or None to hash to the end of the file.
+pub type ByteRange = (u64, Option<u64>);
+
+fn hash_reader<R: Read>(mut input: R, mut update: impl FnMut(&[u8])) -> io::Result<()> {
+    let mut buffer = vec![0u8; HASH_BUFFER_SIZE];
+    loop {
+        match input.read(&mut buffer) {
+            Ok(0) => return Ok(()),
+            Ok(n) => update(&buffer[..n]),
+            Err(e) if e.kind() == io::ErrorKind::Interrupted => continue,
+            Err(e) => return Err(e),
+        }
+    }
+}
+
+/// Hashes a file, or part of one, streaming it from disk, and returns the lowercase hex digest.
+/// A range that extends past the end of the file is hashed up to the end.
+pub fn hash_file(
+    path: &Path,
+    algorithm: HashAlgorithm,
+    range: Option<ByteRange>,
+) -> io::Result<String> {
+    let mut file = File::open(path)?;
+    let (offset, length) = range.unwrap_or((0, None));
+    if offset > 0 {
+        file.seek(SeekFrom::Start(offset))?;
+    }
+    match length {
+        Some(length) => hash_stream(file.take(length), algorithm),
+        None => hash_stream(file, algorithm),
+    }
+}
+
+/// Hashes everything read from `input` and returns the lowercase hex digest.
+pub fn hash_stream<R: Read>(input: R, algorithm: HashAlgorithm) -> io::Result<String> {
+    Ok(match algorithm {
+        HashAlgorithm::Xxh3 => {
+            let mut hasher = Xxh3::new();
+            hash_reader(input, |data| hasher.update(data))?;
+            format!("{:016x}", hasher.digest())
+        }
+        HashAlgorithm::Sha256 => {
+            let mut hasher = Sha256::new();
+            hash_reader(input, |data| hasher.update(data))?;
+            format!("{:x}", hasher.finalize())
+        }
+    })
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn hashes_files_and_ranges() {
+        let path = std::env::temp_dir().join(format!("bh-hash-{}", std::process::id()));
+        std::fs::write(&path, b"abc").unwrap();
+        assert_eq!(
+            hash_file(&path, HashAlgorithm::Sha256, None).unwrap(),
+            "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+        );
+        assert_eq!(
+            hash_file(&path, HashAlgorithm::Xxh3, None).unwrap(),
+            format!("{:016x}", xxhash_rust::xxh3::xxh3_64(b"abc"))
+        );
+
+        std::fs::write(&path, b"xxabcxx").unwrap();
+        assert_eq!(
+            hash_file(&path, HashAlgorithm::Sha256, Some((2, Some(3)))).unwrap(),
+            "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad"
+        );
+        assert_eq!(
+            hash_file(&path, HashAlgorithm::Xxh3, Some((5, None))).unwrap(),
+            hash_file(&path, HashAlgorithm::Xxh3, Some((5, Some(100)))).unwrap()
+        );
+        std::fs::remove_file(path).unwrap();
+    }
+}
@@ -1,7 +1,15 @@
 mod agent_error;
+mod archive;
+mod compression;
+mod hash;
 mod service;
+mod transport;
 mod types;
 
 pub use agent_error::*;
+pub use archive::*;
+pub use compression::*;
+pub use hash::*;
 pub use service::*;
+pub use transport::*;
 pub use types::*;
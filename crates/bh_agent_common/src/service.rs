@@ -1,15 +1,23 @@
 use crate::agent_error::AgentError;
 use crate::{
-    EnvironmentId, FileId, FileOpenMode, FileOpenType, FileStat, ProcessChannel, ProcessId,
-    RemotePOpenConfig, UserId,
+    AgentMetrics, ArchiveId, BatchOperation, BatchResult, ByteRange, EnvironmentId, FileId,
+    FileOpenMode, FileOpenType, FileStat, HashAlgorithm, ProcessChannel, ProcessId,
+    RemotePOpenConfig, StatColumns, SubscriptionId, UserId,
 };
 use anyhow::Result;
 
 #[tarpc::service]
 pub trait BhAgentService {
-    // Environment enumeration
+    // Load reporting
+    async fn get_metrics() -> AgentMetrics;
+
+    // Environment management
     async fn get_environments() -> Vec<EnvironmentId>;
 
+    async fn create_environment() -> Result<EnvironmentId, AgentError>;
+
+    async fn destroy_environment(env_id: EnvironmentId) -> Result<(), AgentError>;
+
     async fn get_tempdir(env_id: EnvironmentId) -> Result<String, AgentError>;
 
     // Process management
@@ -20,6 +28,11 @@ pub trait BhAgentService {
 
     async fn get_process_ids(env_id: EnvironmentId) -> Result<Vec<ProcessId>, AgentError>;
 
+    async fn get_process_config(
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+    ) -> Result<RemotePOpenConfig, AgentError>;
+
     async fn get_process_channel(
         env_id: EnvironmentId,
         proc_id: ProcessId,
@@ -42,6 +55,27 @@ pub trait BhAgentService {
         proc_id: ProcessId,
     ) -> Result<Option<u32>, AgentError>;
 
+    // Waits until any of the processes has exited, or all of them if `all` is set, or until the
+    // timeout elapses. Returns the exit codes of the processes that have exited by then.
+    async fn process_wait_many(
+        env_id: EnvironmentId,
+        proc_ids: Vec<ProcessId>,
+        all: bool,
+        timeout: Option<u32>,
+    ) -> Result<Vec<(ProcessId, u32)>, AgentError>;
+
+    // Reads output the agent captured for a process started with Redirection::Capture, starting
+    // at `offset` bytes into the channel. Waits until there is data past the offset, and returns
+    // up to `size` bytes of it, or everything captured if unset. An empty result means the
+    // channel is exhausted.
+    async fn process_read_capture(
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+        channel: ProcessChannel,
+        offset: u64,
+        size: Option<u32>,
+    ) -> Result<Vec<u8>, AgentError>;
+
     // File IO
     // Implement most of the methods in binharness.IO, but omit ones that there can just be
     // replicated on the client side without a performance hit.
@@ -78,11 +112,11 @@ pub trait BhAgentService {
     async fn file_seek(
         env_id: EnvironmentId,
         fd: FileId,
-        offset: i32,
+        offset: i64,
         whence: i32,
     ) -> Result<(), AgentError>;
 
-    async fn file_tell(env_id: EnvironmentId, fd: FileId) -> Result<i32, AgentError>;
+    async fn file_tell(env_id: EnvironmentId, fd: FileId) -> Result<u64, AgentError>;
 
     async fn file_is_writable(env_id: EnvironmentId, fd: FileId) -> Result<bool, AgentError>;
 
@@ -95,6 +129,95 @@ pub trait BhAgentService {
         blocking: bool,
     ) -> Result<(), AgentError>;
 
+    // Bulk transfers
+    // Files are moved in chunks addressed by offset, so the client can keep a window of chunks in
+    // flight instead of paying a round trip per chunk. An upload opens, writes, sets the mode of
+    // and closes the file, or is abandoned with file_upload_abort; a download is ended with
+    // file_close.
+    async fn file_upload_begin(env_id: EnvironmentId, path: String) -> Result<FileId, AgentError>;
+
+    async fn file_upload_chunk(
+        env_id: EnvironmentId,
+        fd: FileId,
+        offset: u64,
+        data: Vec<u8>,
+    ) -> Result<(), AgentError>;
+
+    async fn file_upload_finish(
+        env_id: EnvironmentId,
+        fd: FileId,
+        mode: Option<u32>,
+    ) -> Result<(), AgentError>;
+
+    async fn file_upload_abort(
+        env_id: EnvironmentId,
+        fd: FileId,
+        path: String,
+    ) -> Result<(), AgentError>;
+
+    async fn file_download_begin(
+        env_id: EnvironmentId,
+        path: String,
+    ) -> Result<(FileId, FileStat), AgentError>;
+
+    async fn file_download_chunk(
+        env_id: EnvironmentId,
+        fd: FileId,
+        offset: u64,
+        len: u32,
+    ) -> Result<Vec<u8>, AgentError>;
+
+    // Directory transfers
+    // A directory is moved as a tar stream, compressed with zstd if asked for, that keeps modes,
+    // mtimes and symlinks. An upload is sent in chunks addressed by offset, like a file upload,
+    // and unpacked as they arrive; archive_upload_finish reports whether it all unpacked. A
+    // download is packed in the background and read like a subscription.
+    async fn archive_upload_begin(
+        env_id: EnvironmentId,
+        path: String,
+        compressed: bool,
+    ) -> Result<ArchiveId, AgentError>;
+
+    async fn archive_upload_chunk(
+        env_id: EnvironmentId,
+        archive: ArchiveId,
+        offset: u64,
+        data: Vec<u8>,
+    ) -> Result<(), AgentError>;
+
+    async fn archive_upload_finish(
+        env_id: EnvironmentId,
+        archive: ArchiveId,
+    ) -> Result<(), AgentError>;
+
+    async fn archive_download(
+        env_id: EnvironmentId,
+        path: String,
+        compression_level: Option<i32>,
+        window: u32,
+    ) -> Result<SubscriptionId, AgentError>;
+
+    // Output subscriptions
+    // The agent reads a file, usually a process' stdout or stderr, in the background as data is
+    // produced and queues up to `window` chunks of it. subscription_next waits until data is
+    // available and returns everything queued, or None once the file is exhausted. The background
+    // reader stops when the queue is full, so a slow client applies backpressure to the writer.
+    async fn file_subscribe(
+        env_id: EnvironmentId,
+        fd: FileId,
+        window: u32,
+    ) -> Result<SubscriptionId, AgentError>;
+
+    async fn subscription_next(
+        env_id: EnvironmentId,
+        subscription: SubscriptionId,
+    ) -> Result<Option<Vec<u8>>, AgentError>;
+
+    async fn subscription_cancel(
+        env_id: EnvironmentId,
+        subscription: SubscriptionId,
+    ) -> Result<(), AgentError>;
+
     async fn chown(
         env_id: EnvironmentId,
         path: String,
@@ -106,6 +229,80 @@ pub trait BhAgentService {
 
     async fn stat(env_id: EnvironmentId, path: String) -> Result<FileStat, AgentError>;
 
+    // Stats many files in a single round trip, answered in columns. stat_many follows symlinks
+    // like stat does. walk stats everything under a directory, to at most max_depth levels down,
+    // without following symlinks.
+    async fn stat_many(
+        env_id: EnvironmentId,
+        paths: Vec<String>,
+    ) -> Result<StatColumns, AgentError>;
+
+    async fn walk(
+        env_id: EnvironmentId,
+        path: String,
+        max_depth: Option<u32>,
+    ) -> Result<StatColumns, AgentError>;
+
+    // Hashes each file, or the given range of it, on the agent and returns the hex digests in
+    // order, so checking whether files changed doesn't mean downloading them.
+    async fn file_hash(
+        env_id: EnvironmentId,
+        files: Vec<(String, Option<ByteRange>)>,
+        algorithm: HashAlgorithm,
+    ) -> Result<Vec<String>, AgentError>;
+
+    // Filesystem
+    // Native versions of the helpers clients would otherwise run as processes. mktemp creates its
+    // file or directory in the environment's scratch directory and returns its path.
+    async fn mkdir(
+        env_id: EnvironmentId,
+        path: String,
+        parents: bool,
+        exist_ok: bool,
+    ) -> Result<(), AgentError>;
+
+    async fn remove(env_id: EnvironmentId, path: String, recursive: bool)
+        -> Result<(), AgentError>;
+
+    async fn rename(env_id: EnvironmentId, src: String, dst: String) -> Result<(), AgentError>;
+
+    async fn symlink(env_id: EnvironmentId, target: String, link: String)
+        -> Result<(), AgentError>;
+
+    async fn mktemp(env_id: EnvironmentId, directory: bool) -> Result<String, AgentError>;
+
+    async fn listdir(env_id: EnvironmentId, path: String) -> Result<Vec<String>, AgentError>;
+
+    // Content-addressed store
+    // Files sent to the agent are kept by the SHA-256 of their contents, shared by every
+    // environment and connection, so content the agent already has is never sent again.
+    // store_claim returns the hashes the caller should upload, and those another client is still
+    // uploading, after waiting a little for them. An uploaded file is moved into the store with
+    // store_add, or the claim is given up with store_release. store_install copies a stored file
+    // into place, replacing whatever was there atomically.
+    async fn store_claim(hashes: Vec<String>) -> Result<(Vec<String>, Vec<String>), AgentError>;
+
+    async fn store_add(env_id: EnvironmentId, hash: String, path: String)
+        -> Result<(), AgentError>;
+
+    async fn store_release(hashes: Vec<String>) -> Result<(), AgentError>;
+
+    async fn store_install(
+        env_id: EnvironmentId,
+        hash: String,
+        path: String,
+        mode: Option<u32>,
+    ) -> Result<(), AgentError>;
+
+    // Batching
+    // Runs the operations in order and returns one result per operation, so a sequence of
+    // dependent calls costs a single round trip. A failed operation does not stop the batch, but
+    // later operations referring to its result will fail.
+    async fn batch(
+        env_id: EnvironmentId,
+        operations: Vec<BatchOperation>,
+    ) -> Result<Vec<Result<BatchResult, AgentError>>, AgentError>;
+
     // Metadata API
     async fn get_metadata(env_id: EnvironmentId, key: String)
         -> Result<Option<String>, AgentError>;
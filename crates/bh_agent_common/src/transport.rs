@@ -0,0 +1,278 @@
+use std::fmt::{Display, Formatter};
+use std::io;
+use std::str::FromStr;
+
+use serde::{Deserialize, Serialize};
+use tarpc::serde_transport;
+use tarpc::tokio_serde::formats::{Bincode, Json};
+use tarpc::tokio_util::codec::{Framed, LengthDelimitedCodec};
+use tokio::io::{AsyncRead, AsyncReadExt, AsyncWrite, AsyncWriteExt};
+
+use crate::{BhAgentServiceClient, Compressed, Compression};
+
+// Before the tarpc transport is started, the client sends a short handshake listing the wire
+// codecs it can speak, in order of preference, and the server answers with the one it picked:
+//
+//   client -> server: "BHAG" | version | count | codec...
+//   server -> client: "BHAG" | version | codec (NO_CODEC if none matched)
+//
+// A codec byte with the COMPRESSED bit set asks for that codec with compressed frames. Clients
+// that want compression offer the compressed variant of each codec ahead of the plain one, and
+// agents that predate compression don't recognize those bytes and pick a plain codec instead.
+//
+// An agent that is already serving as many connections as it allows answers with AGENT_BUSY
+// instead of a codec and hangs up, so the client gets a clear error rather than a stalled socket.
+//
+// Clients that predate the handshake start sending length-delimited JSON frames right away. A
+// frame starts with a big-endian length, so its first byte can't be 'B' unless the frame is over
+// a gigabyte long; the server uses that to tell the two apart and keeps speaking JSON to them.
+pub const HANDSHAKE_MAGIC: &[u8; 4] = b"BHAG";
+pub const PROTOCOL_VERSION: u8 = 1;
+const NO_CODEC: u8 = 0xff;
+const AGENT_BUSY: u8 = 0xfe;
+const COMPRESSED: u8 = 0x80;
+
+#[derive(Copy, Clone, Debug, PartialEq, Eq, Serialize, Deserialize)]
+pub enum WireCodec {
+    Json,
+    Bincode,
+}
+
+impl WireCodec {
+    /// Every codec this build can speak, most preferred first.
+    pub const SUPPORTED: [WireCodec; 2] = [WireCodec::Bincode, WireCodec::Json];
+
+    fn to_byte(self) -> u8 {
+        match self {
+            WireCodec::Json => 0,
+            WireCodec::Bincode => 1,
+        }
+    }
+
+    fn from_byte(byte: u8) -> Option<Self> {
+        match byte {
+            0 => Some(WireCodec::Json),
+            1 => Some(WireCodec::Bincode),
+            _ => None,
+        }
+    }
+}
+
+/// Parses a codec byte from the handshake, returning the codec and whether frames are compressed.
+fn parse_codec(byte: u8) -> Option<(WireCodec, bool)> {
+    WireCodec::from_byte(byte & !COMPRESSED).map(|codec| (codec, byte & COMPRESSED != 0))
+}
+
+fn codec_byte(codec: WireCodec, compressed: bool) -> u8 {
+    codec.to_byte() | if compressed { COMPRESSED } else { 0 }
+}
+
+impl Display for WireCodec {
+    fn fmt(&self, f: &mut Formatter<'_>) -> std::fmt::Result {
+        match self {
+            WireCodec::Json => write!(f, "json"),
+            WireCodec::Bincode => write!(f, "bincode"),
+        }
+    }
+}
+
+impl FromStr for WireCodec {
+    type Err = String;
+
+    fn from_str(s: &str) -> Result<Self, Self::Err> {
+        match s.to_ascii_lowercase().as_str() {
+            "json" => Ok(WireCodec::Json),
+            "bincode" => Ok(WireCodec::Bincode),
+            _ => Err(format!("Unknown wire codec: {}", s)),
+        }
+    }
+}
+
+/// Returns true if the first byte read from a new connection starts a handshake rather than a
+/// legacy JSON frame.
+pub fn is_handshake(first_byte: u8) -> bool {
+    first_byte == HANDSHAKE_MAGIC[0]
+}
+
+/// Negotiates a codec with the agent, returning it and whether the connection compresses frames.
+pub async fn client_handshake<S>(
+    io: &mut S,
+    preferred: &[WireCodec],
+    compress: bool,
+) -> io::Result<(WireCodec, bool)>
+where
+    S: AsyncRead + AsyncWrite + Unpin,
+{
+    let mut offered = Vec::with_capacity(preferred.len() * 2);
+    for &codec in preferred {
+        if compress {
+            offered.push(codec_byte(codec, true));
+        }
+        offered.push(codec_byte(codec, false));
+    }
+
+    let mut hello = Vec::with_capacity(HANDSHAKE_MAGIC.len() + 2 + offered.len());
+    hello.extend_from_slice(HANDSHAKE_MAGIC);
+    hello.push(PROTOCOL_VERSION);
+    hello.push(offered.len() as u8);
+    hello.extend(offered);
+    io.write_all(&hello).await?;
+    io.flush().await?;
+
+    let mut reply = [0u8; 6];
+    io.read_exact(&mut reply).await?;
+    if &reply[..4] != HANDSHAKE_MAGIC {
+        return Err(io::Error::new(
+            io::ErrorKind::InvalidData,
+            "Agent sent an invalid handshake reply",
+        ));
+    }
+    if reply[5] == AGENT_BUSY {
+        return Err(io::Error::new(
+            io::ErrorKind::ConnectionRefused,
+            "Agent is already serving its maximum number of connections",
+        ));
+    }
+    parse_codec(reply[5]).ok_or_else(|| {
+        io::Error::new(
+            io::ErrorKind::Unsupported,
+            "Agent does not support any of the requested wire codecs",
+        )
+    })
+}
+
+/// Reads the client's hello and returns the codec bytes it offered.
+async fn read_hello<S>(io: &mut S) -> io::Result<Vec<u8>>
+where
+    S: AsyncRead + Unpin,
+{
+    let mut hello = [0u8; 6];
+    io.read_exact(&mut hello).await?;
+    if &hello[..4] != HANDSHAKE_MAGIC {
+        return Err(io::Error::new(
+            io::ErrorKind::InvalidData,
+            "Client sent an invalid handshake",
+        ));
+    }
+    let mut offered = vec![0u8; hello[5] as usize];
+    io.read_exact(&mut offered).await?;
+    Ok(offered)
+}
+
+async fn write_reply<S>(io: &mut S, byte: u8) -> io::Result<()>
+where
+    S: AsyncWrite + Unpin,
+{
+    let mut reply = Vec::with_capacity(6);
+    reply.extend_from_slice(HANDSHAKE_MAGIC);
+    reply.push(PROTOCOL_VERSION);
+    reply.push(byte);
+    io.write_all(&reply).await?;
+    io.flush().await
+}
+
+/// Picks the first codec the client offered that the agent supports, only accepting compressed
+/// frames if `allow_compression` is set.
+pub async fn server_handshake<S>(
+    io: &mut S,
+    allow_compression: bool,
+) -> io::Result<(WireCodec, bool)>
+where
+    S: AsyncRead + AsyncWrite + Unpin,
+{
+    let offered = read_hello(io).await?;
+    let chosen = offered
+        .into_iter()
+        .filter_map(parse_codec)
+        .find(|&(_, compressed)| allow_compression || !compressed);
+    let reply = chosen
+        .map(|(codec, compressed)| codec_byte(codec, compressed))
+        .unwrap_or(NO_CODEC);
+    write_reply(io, reply).await?;
+
+    chosen.ok_or_else(|| {
+        io::Error::new(
+            io::ErrorKind::Unsupported,
+            "Client did not offer a supported wire codec",
+        )
+    })
+}
+
+/// Answers a client's handshake by telling it the agent is busy. The caller is expected to close
+/// the connection afterwards.
+pub async fn server_refuse_handshake<S>(io: &mut S) -> io::Result<()>
+where
+    S: AsyncRead + AsyncWrite + Unpin,
+{
+    read_hello(io).await?;
+    write_reply(io, AGENT_BUSY).await
+}
+
+/// Wraps a byte stream in the length-delimited framing used by every agent transport.
+pub fn framed<S>(io: S) -> Framed<S, LengthDelimitedCodec>
+where
+    S: AsyncRead + AsyncWrite,
+{
+    LengthDelimitedCodec::builder()
+        .max_frame_length(usize::MAX)
+        .new_framed(io)
+}
+
+/// Starts a client on a stream that has already completed the handshake. `compression` must be
+/// set if, and only if, the handshake negotiated it. Must be called from within a tokio runtime,
+/// which the client's dispatch task is spawned onto.
+pub fn new_client<S>(
+    io: S,
+    codec: WireCodec,
+    compression: Option<Compression>,
+) -> BhAgentServiceClient
+where
+    S: AsyncRead + AsyncWrite + Send + 'static,
+{
+    let config = tarpc::client::Config::default();
+    match codec {
+        WireCodec::Json => BhAgentServiceClient::new(
+            config,
+            serde_transport::new(framed(io), Compressed::new(Json::default(), compression)),
+        )
+        .spawn(),
+        WireCodec::Bincode => BhAgentServiceClient::new(
+            config,
+            serde_transport::new(framed(io), Compressed::new(Bincode::default(), compression)),
+        )
+        .spawn(),
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_codec_bytes_roundtrip() {
+        for codec in WireCodec::SUPPORTED {
+            assert_eq!(WireCodec::from_byte(codec.to_byte()), Some(codec));
+        }
+        assert_eq!(WireCodec::from_byte(NO_CODEC), None);
+        assert_eq!(WireCodec::from_byte(AGENT_BUSY), None);
+        assert_eq!(parse_codec(NO_CODEC), None);
+        assert_eq!(parse_codec(AGENT_BUSY), None);
+    }
+
+    #[test]
+    fn test_compressed_codec_bytes() {
+        for codec in WireCodec::SUPPORTED {
+            assert_eq!(parse_codec(codec_byte(codec, true)), Some((codec, true)));
+            assert_eq!(parse_codec(codec_byte(codec, false)), Some((codec, false)));
+            // Agents that predate compression must not recognize compressed codecs
+            assert_eq!(WireCodec::from_byte(codec_byte(codec, true)), None);
+        }
+    }
+
+    #[test]
+    fn test_legacy_frames_are_not_handshakes() {
+        // A legacy JSON frame starts with a big-endian u32 length
+        assert!(!is_handshake(0));
+        assert!(is_handshake(HANDSHAKE_MAGIC[0]));
+    }
+}
@@ -5,6 +5,8 @@ use serde::{Deserialize, Serialize};
 pub type EnvironmentId = u64;
 pub type ProcessId = u64;
 pub type FileId = u64;
+pub type SubscriptionId = u64;
+pub type ArchiveId = u64;
 
 #[derive(Copy, Clone, Debug, Serialize, Deserialize)]
 pub enum ProcessChannel {
@@ -18,6 +20,9 @@ pub enum Redirection {
     #[default]
     None,
     Save,
+    /// Drained by the agent in the background, so the process never blocks on a full pipe. The
+    /// output is read back by offset with process_read_capture.
+    Capture,
 }
 
 #[derive(Clone, Debug, Default, Serialize, Deserialize)]
@@ -32,6 +37,9 @@ pub struct RemotePOpenConfig {
     pub setuid: Option<u32>,
     pub setgid: Option<u32>,
     pub setpgid: bool,
+    /// How much captured output the agent keeps in memory per channel before spilling it to disk.
+    /// The agent's default is used if unset.
+    pub capture_limit: Option<u64>,
 }
 
 #[derive(Copy, Clone, Debug, Serialize, Deserialize, PartialEq)]
@@ -55,7 +63,7 @@ pub enum UserId {
     Name(String),
 }
 
-#[derive(Clone, Debug, Serialize, Deserialize, PartialEq)]
+#[derive(Clone, Debug, Default, Serialize, Deserialize, PartialEq)]
 #[cfg_attr(feature = "python", pyclass(get_all))]
 pub struct FileStat {
     pub mode: u16,
@@ -67,6 +75,97 @@ pub struct FileStat {
     pub ctime: i64,
 }
 
+/// The stats of many files, kept in columns rather than as one FileStat each, which keeps the
+/// answer to a large directory scan compact. Entry `i` of every column belongs to the same file.
+/// Files that couldn't be stat'ed are listed in `errors` with the reason, and are zero in the
+/// other columns.
+#[derive(Clone, Debug, Default, Serialize, Deserialize, PartialEq)]
+#[cfg_attr(feature = "python", pyclass(get_all))]
+pub struct StatColumns {
+    /// The path of each file, relative to the walked directory. Empty when stat'ing given paths,
+    /// whose entries are in the order the paths were given.
+    pub paths: Vec<String>,
+    pub mode: Vec<u16>,
+    pub uid: Vec<u32>,
+    pub gid: Vec<u32>,
+    pub size: Vec<i64>,
+    pub atime: Vec<i64>,
+    pub mtime: Vec<i64>,
+    pub ctime: Vec<i64>,
+    pub errors: Vec<(u32, String)>,
+}
+
+impl StatColumns {
+    pub fn push(&mut self, stat: &FileStat) {
+        self.mode.push(stat.mode);
+        self.uid.push(stat.uid);
+        self.gid.push(stat.gid);
+        self.size.push(stat.size);
+        self.atime.push(stat.atime);
+        self.mtime.push(stat.mtime);
+        self.ctime.push(stat.ctime);
+    }
+
+    pub fn push_error(&mut self, error: String) {
+        self.errors.push((self.mode.len() as u32, error));
+        self.push(&FileStat::default());
+    }
+}
+
+/// A snapshot of how busy an agent is. The queue depth is the number of requests, across every
+/// connection, that the agent has accepted but not yet answered.
+#[derive(Clone, Debug, Serialize, Deserialize, PartialEq)]
+#[cfg_attr(feature = "python", pyclass(get_all))]
+pub struct AgentMetrics {
+    pub connections: u64,
+    pub max_connections: u64,
+    pub rejected_connections: u64,
+    pub queue_depth: u64,
+    pub max_in_flight: u64,
+}
+
+/// A handle used by a batch operation. Handles can be given directly, or by the index of an
+/// earlier operation in the same batch whose result is the handle, such as the FileId returned by
+/// a FileOpen.
+#[derive(Copy, Clone, Debug, Serialize, Deserialize, PartialEq)]
+pub enum HandleRef {
+    Id(u64),
+    Result(u32),
+}
+
+#[derive(Clone, Debug, Serialize, Deserialize)]
+pub enum BatchOperation {
+    RunCommand(RemotePOpenConfig),
+    GetProcessChannel(HandleRef, ProcessChannel),
+    ProcessPoll(HandleRef),
+    ProcessReturncode(HandleRef),
+    FileOpen(String, FileOpenMode, FileOpenType),
+    FileClose(HandleRef),
+    FileRead(HandleRef, Option<u32>),
+    FileWrite(HandleRef, Vec<u8>),
+    Chown(String, Option<UserId>, Option<UserId>),
+    Chmod(String, u32),
+    Stat(String),
+    Mkdir(String, bool, bool),
+    Remove(String, bool),
+    Rename(String, String),
+    Symlink(String, String),
+    StoreAdd(String, String),
+    StoreInstall(String, String, Option<u32>),
+    GetMetadata(String),
+    SetMetadata(String, String),
+}
+
+#[derive(Clone, Debug, Serialize, Deserialize)]
+pub enum BatchResult {
+    None,
+    Handle(u64),
+    ExitCode(Option<u32>),
+    Data(Vec<u8>),
+    Stat(FileStat),
+    Metadata(Option<String>),
+}
+
 #[cfg(target_family = "unix")]
 impl From<nix::sys::stat::FileStat> for FileStat {
     fn from(stat: nix::sys::stat::FileStat) -> Self {
@@ -81,3 +180,32 @@ impl From<nix::sys::stat::FileStat> for FileStat {
         }
     }
 }
+
+impl From<&std::fs::Metadata> for FileStat {
+    fn from(metadata: &std::fs::Metadata) -> Self {
+        #[cfg(target_family = "unix")]
+        {
+            use std::os::unix::fs::MetadataExt;
+            return Self {
+                mode: metadata.mode() as u16,
+                uid: metadata.uid(),
+                gid: metadata.gid(),
+                size: metadata.size() as i64,
+                atime: metadata.atime(),
+                mtime: metadata.mtime(),
+                ctime: metadata.ctime(),
+            };
+        }
+
+        #[cfg(not(target_family = "unix"))]
+        Self {
+            mode: 0,
+            uid: 0,
+            gid: 0,
+            size: metadata.len() as i64,
+            atime: 0,
+            mtime: 0,
+            ctime: 0,
+        }
+    }
+}
@@ -0,0 +1,115 @@
+use std::net::SocketAddr;
+
+use criterion::{criterion_group, criterion_main, BenchmarkId, Criterion, Throughput};
+use futures::future;
+use tarpc::context;
+use tokio::net::{TcpListener, TcpStream};
+use tokio::runtime::Runtime;
+
+use bh_agent_common::{
+    client_handshake, new_client, BhAgentServiceClient, FileId, FileOpenMode, FileOpenType,
+    WireCodec,
+};
+use bh_agent_server::{Agent, Limits};
+
+// Many clients each doing small reads and writes on their own file, so the time goes into
+// request handling and handle lookups rather than moving data
+const CLIENTS: [usize; 4] = [1, 8, 64, 256];
+const OPS_PER_CLIENT: usize = 50;
+const IO_SIZE: usize = 64;
+
+fn start_agent(rt: &Runtime) -> SocketAddr {
+    let listener = rt
+        .block_on(TcpListener::bind(("127.0.0.1", 0)))
+        .expect("failed to bind benchmark agent");
+    let addr = listener.local_addr().unwrap();
+    rt.spawn(async move {
+        // Every client shares one connection, so allow all of them to have a request in flight
+        let agent = Agent::new(Limits {
+            max_in_flight: CLIENTS[CLIENTS.len() - 1] * 2,
+            ..Limits::default()
+        });
+        while let Ok((stream, _)) = listener.accept().await {
+            tokio::spawn(agent.clone().serve_tcp(stream));
+        }
+    });
+    addr
+}
+
+fn connect(rt: &Runtime, addr: SocketAddr) -> BhAgentServiceClient {
+    rt.block_on(async {
+        let mut stream = TcpStream::connect(addr).await.unwrap();
+        stream.set_nodelay(true).unwrap();
+        let (codec, _) = client_handshake(&mut stream, &[WireCodec::Bincode], false)
+            .await
+            .unwrap();
+        new_client(stream, codec, None)
+    })
+}
+
+async fn open_files(client: &BhAgentServiceClient, count: usize) -> Vec<FileId> {
+    let mut fds = Vec::new();
+    for i in 0..count {
+        let path = std::env::temp_dir().join(format!("bh_bench_contention_{}", i));
+        std::fs::write(&path, []).unwrap();
+        let fd = client
+            .file_open(
+                context::current(),
+                0,
+                path.to_string_lossy().into_owned(),
+                FileOpenMode::Update,
+                FileOpenType::Binary,
+            )
+            .await
+            .unwrap()
+            .unwrap();
+        fds.push(fd);
+    }
+    fds
+}
+
+async fn small_io(client: &BhAgentServiceClient, fd: FileId) {
+    let data = vec![0xa5u8; IO_SIZE];
+    for _ in 0..OPS_PER_CLIENT {
+        client
+            .file_write(context::current(), 0, fd, data.clone())
+            .await
+            .unwrap()
+            .unwrap();
+        client
+            .file_download_chunk(context::current(), 0, fd, 0, IO_SIZE as u32)
+            .await
+            .unwrap()
+            .unwrap();
+    }
+}
+
+fn contention(c: &mut Criterion) {
+    let rt = Runtime::new().unwrap();
+    let addr = start_agent(&rt);
+    let client = connect(&rt, addr);
+
+    let mut group = c.benchmark_group("small_io");
+    group.sample_size(10);
+    for clients in CLIENTS {
+        let fds = rt.block_on(open_files(&client, clients));
+        group.throughput(Throughput::Elements((clients * OPS_PER_CLIENT * 2) as u64));
+        group.bench_with_input(BenchmarkId::from_parameter(clients), &fds, |b, fds| {
+            b.to_async(&rt)
+                .iter(|| future::join_all(fds.iter().map(|fd| small_io(&client, *fd))))
+        });
+        rt.block_on(future::join_all(
+            fds.iter()
+                .map(|fd| client.file_close(context::current(), 0, *fd)),
+        ));
+    }
+    group.finish();
+
+    for i in 0..CLIENTS[CLIENTS.len() - 1] {
+        let _ =
+            std::fs::remove_file(std::env::temp_dir().join(format!("bh_bench_contention_{}", i)));
+    }
+}
+
+criterion_group!(benches, contention);
+criterion_main!(benches);
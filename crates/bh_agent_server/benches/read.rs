@@ -0,0 +1,109 @@
+use std::fs::File;
+use std::io::Write;
+use std::path::PathBuf;
+use std::thread;
+
+use criterion::{criterion_group, criterion_main, BatchSize, BenchmarkId, Criterion, Throughput};
+
+use bh_agent_common::FileOpenType;
+use bh_agent_server::util::read_generic;
+
+const KB: usize = 1024;
+const MB: usize = 1024 * KB;
+const SIZES: [usize; 6] = [4 * KB, 64 * KB, MB, 16 * MB, 256 * MB, 1024 * MB];
+// Reads with a size are made in chunks like the client's downloads
+const CHUNK_SIZE: u32 = 4 * MB as u32;
+
+fn bench_path(size: usize) -> PathBuf {
+    std::env::temp_dir().join(format!("bh_bench_read_{}", size))
+}
+
+fn read_whole(file: &mut File) -> usize {
+    read_generic(file, None, FileOpenType::Binary)
+        .unwrap()
+        .len()
+}
+
+fn read_chunked(file: &mut File) -> usize {
+    let mut total = 0;
+    loop {
+        let chunk = read_generic(file, Some(CHUNK_SIZE), FileOpenType::Binary).unwrap();
+        if chunk.is_empty() {
+            return total;
+        }
+        total += chunk.len();
+    }
+}
+
+/// Returns the read end of a pipe that a background thread fills with `size` bytes.
+#[cfg(target_family = "unix")]
+fn filled_pipe(size: usize) -> File {
+    let (read, write) = nix::unistd::pipe().unwrap();
+    let mut write = File::from(write);
+    thread::spawn(move || {
+        let block = vec![0xa5u8; 64 * KB];
+        let mut left = size;
+        while left > 0 {
+            let n = left.min(block.len());
+            write.write_all(&block[..n]).unwrap();
+            left -= n;
+        }
+    });
+    File::from(read)
+}
+
+fn read_throughput(c: &mut Criterion) {
+    let mut file = c.benchmark_group("read_file");
+    file.sample_size(10);
+    for size in SIZES {
+        let path = bench_path(size);
+        std::fs::write(&path, vec![0xa5u8; size]).unwrap();
+        file.throughput(Throughput::Bytes(size as u64));
+        file.bench_with_input(BenchmarkId::new("whole", size), &path, |b, path| {
+            b.iter_batched(
+                || File::open(path).unwrap(),
+                |mut f| assert_eq!(read_whole(&mut f), size),
+                BatchSize::PerIteration,
+            )
+        });
+        file.bench_with_input(BenchmarkId::new("chunked", size), &path, |b, path| {
+            b.iter_batched(
+                || File::open(path).unwrap(),
+                |mut f| assert_eq!(read_chunked(&mut f), size),
+                BatchSize::PerIteration,
+            )
+        });
+        let _ = std::fs::remove_file(&path);
+    }
+    file.finish();
+
+    #[cfg(target_family = "unix")]
+    bench_pipe(c);
+}
+
+#[cfg(target_family = "unix")]
+fn bench_pipe(c: &mut Criterion) {
+    let mut pipe = c.benchmark_group("read_pipe");
+    pipe.sample_size(10);
+    for size in SIZES {
+        pipe.throughput(Throughput::Bytes(size as u64));
+        pipe.bench_with_input(BenchmarkId::new("whole", size), &size, |b, &size| {
+            b.iter_batched(
+                || filled_pipe(size),
+                |mut f| assert_eq!(read_whole(&mut f), size),
+                BatchSize::PerIteration,
+            )
+        });
+        pipe.bench_with_input(BenchmarkId::new("chunked", size), &size, |b, &size| {
+            b.iter_batched(
+                || filled_pipe(size),
+                |mut f| assert_eq!(read_chunked(&mut f), size),
+                BatchSize::PerIteration,
+            )
+        });
+    }
+    pipe.finish();
+}
+
+criterion_group!(benches, read_throughput);
+criterion_main!(benches);
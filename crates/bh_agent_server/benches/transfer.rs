@@ -0,0 +1,219 @@
+use std::net::SocketAddr;
+use std::path::PathBuf;
+
+use criterion::{criterion_group, criterion_main, BenchmarkId, Criterion, Throughput};
+use tarpc::context;
+use tokio::net::{TcpListener, TcpStream};
+use tokio::runtime::Runtime;
+
+use bh_agent_common::{
+    client_handshake, new_client, BhAgentServiceClient, Compression, FileOpenMode, FileOpenType,
+    WireCodec,
+};
+use bh_agent_server::{Agent, Limits};
+
+const CHUNK_SIZE: usize = 4 * 1024 * 1024;
+const SIZES: [usize; 3] = [4 * 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024];
+
+fn start_agent(rt: &Runtime) -> SocketAddr {
+    let listener = rt
+        .block_on(TcpListener::bind(("127.0.0.1", 0)))
+        .expect("failed to bind benchmark agent");
+    let addr = listener.local_addr().unwrap();
+    rt.spawn(async move {
+        let agent = Agent::new(Limits::default());
+        while let Ok((stream, _)) = listener.accept().await {
+            tokio::spawn(agent.clone().serve_tcp(stream));
+        }
+    });
+    addr
+}
+
+fn connect(
+    rt: &Runtime,
+    addr: SocketAddr,
+    codec: WireCodec,
+    compression: Option<Compression>,
+) -> BhAgentServiceClient {
+    rt.block_on(async {
+        let mut stream = TcpStream::connect(addr).await.unwrap();
+        stream.set_nodelay(true).unwrap();
+        let (codec, compressed) = client_handshake(&mut stream, &[codec], compression.is_some())
+            .await
+            .unwrap();
+        assert_eq!(compressed, compression.is_some());
+        new_client(stream, codec, compression)
+    })
+}
+
+fn bench_path(codec: WireCodec, size: usize) -> String {
+    let path: PathBuf = std::env::temp_dir().join(format!("bh_bench_{}_{}", codec, size));
+    path.to_string_lossy().into_owned()
+}
+
+async fn upload(client: &BhAgentServiceClient, path: String, data: &[u8]) {
+    let fd = client
+        .file_open(
+            context::current(),
+            0,
+            path,
+            FileOpenMode::Write,
+            FileOpenType::Binary,
+        )
+        .await
+        .unwrap()
+        .unwrap();
+    for chunk in data.chunks(CHUNK_SIZE) {
+        client
+            .file_write(context::current(), 0, fd, chunk.to_vec())
+            .await
+            .unwrap()
+            .unwrap();
+    }
+    client
+        .file_close(context::current(), 0, fd)
+        .await
+        .unwrap()
+        .unwrap();
+}
+
+async fn download(client: &BhAgentServiceClient, path: String) -> usize {
+    let fd = client
+        .file_open(
+            context::current(),
+            0,
+            path,
+            FileOpenMode::Read,
+            FileOpenType::Binary,
+        )
+        .await
+        .unwrap()
+        .unwrap();
+    let mut total = 0;
+    loop {
+        let chunk = client
+            .file_read(context::current(), 0, fd, Some(CHUNK_SIZE as u32))
+            .await
+            .unwrap()
+            .unwrap();
+        if chunk.is_empty() {
+            break;
+        }
+        total += chunk.len();
+    }
+    client
+        .file_close(context::current(), 0, fd)
+        .await
+        .unwrap()
+        .unwrap();
+    total
+}
+
+fn codec_throughput(c: &mut Criterion) {
+    let rt = Runtime::new().unwrap();
+    let addr = start_agent(&rt);
+
+    let mut inject = c.benchmark_group("inject_files");
+    inject.sample_size(10);
+    for codec in WireCodec::SUPPORTED {
+        let client = connect(&rt, addr, codec, None);
+        for size in SIZES {
+            let data: Vec<u8> = (0..size).map(|i| (i % 251) as u8).collect();
+            inject.throughput(Throughput::Bytes(size as u64));
+            inject.bench_with_input(
+                BenchmarkId::new(codec.to_string(), size),
+                &data,
+                |b, data| {
+                    b.to_async(&rt)
+                        .iter(|| upload(&client, bench_path(codec, size), data))
+                },
+            );
+        }
+    }
+    inject.finish();
+
+    let mut retrieve = c.benchmark_group("retrieve_files");
+    retrieve.sample_size(10);
+    for codec in WireCodec::SUPPORTED {
+        let client = connect(&rt, addr, codec, None);
+        for size in SIZES {
+            let path = bench_path(codec, size);
+            std::fs::write(&path, vec![0xa5u8; size]).unwrap();
+            retrieve.throughput(Throughput::Bytes(size as u64));
+            retrieve.bench_with_input(
+                BenchmarkId::new(codec.to_string(), size),
+                &path,
+                |b, path| b.to_async(&rt).iter(|| download(&client, path.clone())),
+            );
+            let _ = std::fs::remove_file(&path);
+        }
+    }
+    retrieve.finish();
+}
+
+/// Bytes that zstd can't do anything with, like packed or encrypted data.
+fn incompressible(size: usize) -> Vec<u8> {
+    let mut state = 0x2545f4914f6cdd1du64;
+    (0..size)
+        .map(|_| {
+            state ^= state << 13;
+            state ^= state >> 7;
+            state ^= state << 17;
+            state as u8
+        })
+        .collect()
+}
+
+/// Bytes that compress about as well as a typical binary or log file.
+fn compressible(size: usize) -> Vec<u8> {
+    let words: [&[u8]; 4] = [b"\x7fELF\x02\x01\x01", b"mov rax, ", b"[qemu] ", &[0u8; 24]];
+    let mut state = 1u32;
+    let mut data = Vec::with_capacity(size + 32);
+    while data.len() < size {
+        state = state.wrapping_mul(1103515245).wrapping_add(12345);
+        data.extend_from_slice(words[(state >> 16) as usize % words.len()]);
+        data.push((state >> 24) as u8);
+    }
+    data.truncate(size);
+    data
+}
+
+// Loopback is far faster than any real link, so this mostly shows what compression costs. On a
+// link slower than zstd, a compressible payload transfers faster roughly in proportion to its
+// compression ratio, while an incompressible one only pays for the attempt.
+fn compression_throughput(c: &mut Criterion) {
+    let rt = Runtime::new().unwrap();
+    let addr = start_agent(&rt);
+    let size = SIZES[1];
+
+    let mut group = c.benchmark_group("compression");
+    group.sample_size(10);
+    group.throughput(Throughput::Bytes(size as u64));
+    for (kind, data) in [
+        ("compressible", compressible(size)),
+        ("incompressible", incompressible(size)),
+    ] {
+        for (mode, compression) in [("raw", None), ("zstd", Some(Compression::default()))] {
+            let client = connect(&rt, addr, WireCodec::Bincode, compression);
+            let path = std::env::temp_dir()
+                .join(format!("bh_bench_compression_{}_{}", kind, mode))
+                .to_string_lossy()
+                .into_owned();
+            group.bench_with_input(
+                BenchmarkId::new(format!("inject_{}", mode), kind),
+                &data,
+                |b, data| b.to_async(&rt).iter(|| upload(&client, path.clone(), data)),
+            );
+            group.bench_with_input(
+                BenchmarkId::new(format!("retrieve_{}", mode), kind),
+                &path,
+                |b, path| b.to_async(&rt).iter(|| download(&client, path.clone())),
+            );
+            let _ = std::fs::remove_file(&path);
+        }
+    }
+    group.finish();
+}
+
+criterion_group!(benches, codec_throughput, compression_throughput);
+criterion_main!(benches);
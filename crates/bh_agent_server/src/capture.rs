@@ -0,0 +1,225 @@
+use std::fs::{self, File, OpenOptions};
+use std::io::{self, Read, Write};
+use std::path::PathBuf;
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::{Arc, Mutex};
+use std::thread;
+
+use log::{trace, warn};
+use tokio::sync::watch;
+
+use bh_agent_common::AgentError;
+use bh_agent_common::AgentError::{IoError, Unknown};
+
+use crate::util::read_at;
+
+/// How much output is kept in memory per channel when the client doesn't ask for a limit.
+pub const DEFAULT_CAPTURE_LIMIT: u64 = 1024 * 1024;
+// Captures last as long as the agent, so the spill file of a channel is capped too. Output past
+// this is discarded, and reading past the end of what was kept fails.
+const MAX_SPILL: u64 = 1024 * 1024 * 1024;
+const READ_SIZE: usize = 64 * 1024;
+
+static NEXT_SPILL_ID: AtomicU64 = AtomicU64::new(0);
+
+// Output is appended to memory until the limit is reached, then the memory is moved to the end of
+// a spill file. The channel is the spill file followed by whatever is in memory.
+struct Buffer {
+    spill: Option<(PathBuf, File)>,
+    spilled: u64,
+    memory: Vec<u8>,
+    error: Option<String>,
+}
+
+impl Buffer {
+    fn len(&self) -> u64 {
+        self.spilled + self.memory.len() as u64
+    }
+
+    fn append(&mut self, data: &[u8], limit: u64, max_spill: u64) -> io::Result<()> {
+        if (self.memory.len() + data.len()) as u64 <= limit {
+            self.memory.extend_from_slice(data);
+            return Ok(());
+        }
+        if self.len() + data.len() as u64 > max_spill {
+            return Err(io::Error::new(
+                io::ErrorKind::Other,
+                format!("Captured output exceeded {} bytes", max_spill),
+            ));
+        }
+        if self.spill.is_none() {
+            self.spill = Some(create_spill_file()?);
+        }
+        let (_, file) = self.spill.as_mut().unwrap();
+        file.write_all(&self.memory)?;
+        file.write_all(data)?;
+        self.spilled += (self.memory.len() + data.len()) as u64;
+        self.memory.clear();
+        Ok(())
+    }
+
+    fn read(&self, offset: u64, size: u64) -> io::Result<Vec<u8>> {
+        let end = self.len().min(offset.saturating_add(size));
+        if offset >= end {
+            return Ok(Vec::new());
+        }
+        let mut data = Vec::with_capacity((end - offset) as usize);
+        if offset < self.spilled {
+            let (_, file) = self.spill.as_ref().unwrap();
+            let len = end.min(self.spilled) - offset;
+            data.extend(read_at(file, len as usize, offset)?);
+        }
+        if end > self.spilled {
+            let start = offset.saturating_sub(self.spilled) as usize;
+            data.extend_from_slice(&self.memory[start..(end - self.spilled) as usize]);
+        }
+        Ok(data)
+    }
+}
+
+impl Drop for Buffer {
+    fn drop(&mut self) {
+        if let Some((path, _)) = self.spill.take() {
+            let _ = fs::remove_file(path);
+        }
+    }
+}
+
+fn create_spill_file() -> io::Result<(PathBuf, File)> {
+    let path = std::env::temp_dir().join(format!(
+        "bh-capture-{}-{}",
+        std::process::id(),
+        NEXT_SPILL_ID.fetch_add(1, Ordering::Relaxed)
+    ));
+    let file = OpenOptions::new()
+        .read(true)
+        .write(true)
+        .create_new(true)
+        .open(&path)?;
+    trace!("Spilling captured output to {:?}", path);
+    Ok((path, file))
+}
+
+/// The output of a process channel, drained in the background so the process never blocks
+/// writing to it.
+pub struct Capture {
+    buffer: Arc<Mutex<Buffer>>,
+    // The number of bytes captured so far, and whether the channel has been exhausted
+    progress: watch::Receiver<(u64, bool)>,
+}
+
+impl Capture {
+    /// Starts draining `file` on a dedicated thread, keeping up to `limit` bytes in memory.
+    pub fn start(mut file: File, limit: u64) -> io::Result<Capture> {
+        let buffer = Arc::new(Mutex::new(Buffer {
+            spill: None,
+            spilled: 0,
+            memory: Vec::new(),
+            error: None,
+        }));
+        let (progress_sender, progress) = watch::channel((0, false));
+
+        let thread_buffer = buffer.clone();
+        thread::Builder::new()
+            .name("bh-capture".into())
+            .spawn(move || {
+                let mut buf = vec![0u8; READ_SIZE];
+                loop {
+                    let n = match file.read(&mut buf) {
+                        Ok(0) => break,
+                        Ok(n) => n,
+                        Err(e) if e.kind() == io::ErrorKind::Interrupted => continue,
+                        Err(e) => {
+                            warn!("Capture read failed: {}", e);
+                            break;
+                        }
+                    };
+                    let mut buffer = match thread_buffer.lock() {
+                        Ok(buffer) => buffer,
+                        Err(_) => break,
+                    };
+                    // Once spilling has failed the rest of the output is discarded, so the
+                    // process can still run to completion
+                    if buffer.error.is_none() {
+                        if let Err(e) = buffer.append(&buf[..n], limit, MAX_SPILL) {
+                            warn!("Failed to spill captured output: {}", e);
+                            buffer.error = Some(e.to_string());
+                        }
+                    }
+                    progress_sender.send_replace((buffer.len(), false));
+                }
+                let len = thread_buffer.lock().map(|b| b.len()).unwrap_or(0);
+                progress_sender.send_replace((len, true));
+                trace!("Capture finished after {} bytes", len);
+            })?;
+
+        Ok(Capture { buffer, progress })
+    }
+
+    /// Waits until there is output past `offset` and returns up to `size` bytes of it. Returns
+    /// an empty vector once the channel is exhausted.
+    pub async fn read(&self, offset: u64, size: Option<u32>) -> Result<Vec<u8>, AgentError> {
+        let mut progress = self.progress.clone();
+        progress
+            .wait_for(|(len, finished)| *len > offset || *finished)
+            .await
+            .map_err(|_| Unknown)?;
+
+        let buffer = self.buffer.lock()?;
+        if offset >= buffer.len() {
+            if let Some(error) = &buffer.error {
+                return Err(IoError(error.clone()));
+            }
+        }
+        buffer
+            .read(offset, size.map_or(u64::MAX, u64::from))
+            .map_err(|e| IoError(e.to_string()))
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    fn buffer() -> Buffer {
+        Buffer {
+            spill: None,
+            spilled: 0,
+            memory: Vec::new(),
+            error: None,
+        }
+    }
+
+    #[test]
+    fn reads_across_spill_and_memory() {
+        let mut buffer = buffer();
+        let data: Vec<u8> = (0..=255).cycle().take(10_000).collect();
+        for chunk in data.chunks(700) {
+            buffer.append(chunk, 1000, MAX_SPILL).unwrap();
+        }
+        assert!(buffer.spilled > 0);
+        assert!(buffer.memory.len() <= 1000);
+        assert_eq!(buffer.read(0, u64::MAX).unwrap(), data);
+        assert_eq!(buffer.read(4321, 3000).unwrap(), &data[4321..7321]);
+        assert!(buffer.read(10_000, 10).unwrap().is_empty());
+    }
+
+    #[test]
+    fn removes_spill_file() {
+        let mut buffer = buffer();
+        buffer.append(&[0u8; 100], 10, MAX_SPILL).unwrap();
+        let path = buffer.spill.as_ref().unwrap().0.clone();
+        assert!(path.exists());
+        drop(buffer);
+        assert!(!path.exists());
+    }
+
+    #[test]
+    fn caps_spilled_output() {
+        let mut buffer = buffer();
+        buffer.append(&[1u8; 100], 10, 150).unwrap();
+        assert!(buffer.append(&[2u8; 100], 10, 150).is_err());
+        assert_eq!(buffer.len(), 100);
+        assert_eq!(buffer.read(0, u64::MAX).unwrap(), [1u8; 100]);
+    }
+}
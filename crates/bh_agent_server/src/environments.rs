@@ -0,0 +1,105 @@
+use std::fs;
+use std::path::PathBuf;
+use std::sync::Arc;
+
+use log::{debug, warn};
+
+use bh_agent_common::AgentError::{DefaultEnvironment, InvalidEnvironmentId};
+use bh_agent_common::{AgentError, EnvironmentId};
+
+use crate::handles::HandleTable;
+use crate::state::BhAgentState;
+
+/// The environment every agent starts with. It uses the system's temporary directory and can't be
+/// destroyed.
+pub const DEFAULT_ENVIRONMENT: EnvironmentId = 0;
+
+/// The environments hosted by an agent. Each one has its own processes, files, metadata and
+/// scratch directory, so several jobs can share an agent without seeing each other's handles.
+pub struct Environments {
+    table: HandleTable<Arc<BhAgentState>>,
+}
+
+impl Environments {
+    /// Creates the table with the default environment in it. Must be called from within a tokio
+    /// runtime, which each environment's reaper is spawned onto.
+    pub fn new() -> Self {
+        let table = HandleTable::new();
+        let id = table.reserve_id();
+        debug_assert_eq!(id, DEFAULT_ENVIRONMENT);
+        let _ = table.insert_at(id, Arc::new(BhAgentState::new(std::env::temp_dir())));
+        Self { table }
+    }
+
+    pub fn get(&self, env_id: EnvironmentId) -> Result<Arc<BhAgentState>, AgentError> {
+        self.table.get(env_id)?.ok_or(InvalidEnvironmentId)
+    }
+
+    pub fn ids(&self) -> Result<Vec<EnvironmentId>, AgentError> {
+        self.table.ids()
+    }
+
+    /// Creates an environment with a fresh scratch directory.
+    pub fn create(&self) -> Result<EnvironmentId, AgentError> {
+        let env_id = self.table.reserve_id();
+        let tempdir = scratch_dir(env_id);
+        fs::create_dir_all(&tempdir)?;
+        self.table
+            .insert_at(env_id, Arc::new(BhAgentState::new(tempdir)))?;
+        debug!("Created environment {}", env_id);
+        Ok(env_id)
+    }
+
+    /// Destroys an environment, killing its processes and removing its scratch directory.
+    /// Requests already running in the environment finish against the old state.
+    pub fn destroy(&self, env_id: EnvironmentId) -> Result<(), AgentError> {
+        if env_id == DEFAULT_ENVIRONMENT {
+            return Err(DefaultEnvironment);
+        }
+        let state = self.table.remove(env_id)?.ok_or(InvalidEnvironmentId)?;
+        state.kill_processes()?;
+        if let Err(e) = fs::remove_dir_all(state.tempdir()) {
+            warn!(
+                "Failed to remove scratch directory of environment {}: {}",
+                env_id, e
+            );
+        }
+        debug!("Destroyed environment {}", env_id);
+        Ok(())
+    }
+}
+
+fn scratch_dir(env_id: EnvironmentId) -> PathBuf {
+    std::env::temp_dir().join(format!("bh-env-{}-{}", std::process::id(), env_id))
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[tokio::test(flavor = "multi_thread")]
+    async fn create_and_destroy() {
+        let environments = Environments::new();
+        assert_eq!(environments.ids().unwrap(), vec![DEFAULT_ENVIRONMENT]);
+
+        let env_id = environments.create().unwrap();
+        let tempdir = environments.get(env_id).unwrap().tempdir().to_path_buf();
+        assert!(tempdir.is_dir());
+        assert_ne!(tempdir, environments.get(0).unwrap().tempdir());
+        assert_eq!(
+            environments.ids().unwrap(),
+            vec![DEFAULT_ENVIRONMENT, env_id]
+        );
+
+        environments.destroy(env_id).unwrap();
+        assert!(!tempdir.exists());
+        assert!(matches!(
+            environments.get(env_id),
+            Err(InvalidEnvironmentId)
+        ));
+        assert!(matches!(
+            environments.destroy(DEFAULT_ENVIRONMENT),
+            Err(DefaultEnvironment)
+        ));
+    }
+}
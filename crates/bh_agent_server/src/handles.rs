@@ -0,0 +1,108 @@
+use std::collections::HashMap;
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::RwLock;
+
+use bh_agent_common::AgentError;
+
+// IDs are handed out sequentially, so taking the ID modulo the shard count spreads handles evenly
+// and concurrent operations on different handles rarely touch the same lock.
+const SHARDS: usize = 16;
+
+/// A table of handles, such as open files or processes, keyed by an ID allocated on insert.
+/// Lookups only hold a shard lock long enough to clone the entry, which is usually an Arc.
+pub struct HandleTable<T> {
+    shards: Vec<RwLock<HashMap<u64, T>>>,
+    next_id: AtomicU64,
+}
+
+impl<T: Clone> HandleTable<T> {
+    pub fn new() -> HandleTable<T> {
+        Self {
+            shards: (0..SHARDS).map(|_| RwLock::new(HashMap::new())).collect(),
+            next_id: AtomicU64::new(0),
+        }
+    }
+
+    fn shard(&self, id: u64) -> &RwLock<HashMap<u64, T>> {
+        &self.shards[id as usize % SHARDS]
+    }
+
+    /// Allocates an ID without inserting anything, for entries that need to know their own ID.
+    pub fn reserve_id(&self) -> u64 {
+        self.next_id.fetch_add(1, Ordering::Relaxed)
+    }
+
+    pub fn insert(&self, value: T) -> Result<u64, AgentError> {
+        let id = self.reserve_id();
+        self.insert_at(id, value)?;
+        Ok(id)
+    }
+
+    pub fn insert_at(&self, id: u64, value: T) -> Result<(), AgentError> {
+        self.shard(id).write()?.insert(id, value);
+        Ok(())
+    }
+
+    pub fn get(&self, id: u64) -> Result<Option<T>, AgentError> {
+        Ok(self.shard(id).read()?.get(&id).cloned())
+    }
+
+    pub fn contains(&self, id: u64) -> Result<bool, AgentError> {
+        Ok(self.shard(id).read()?.contains_key(&id))
+    }
+
+    pub fn remove(&self, id: u64) -> Result<Option<T>, AgentError> {
+        Ok(self.shard(id).write()?.remove(&id))
+    }
+
+    pub fn ids(&self) -> Result<Vec<u64>, AgentError> {
+        let mut ids = Vec::new();
+        for shard in &self.shards {
+            ids.extend(shard.read()?.keys().copied());
+        }
+        ids.sort_unstable();
+        Ok(ids)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use std::sync::Arc;
+    use std::thread;
+
+    use super::*;
+
+    #[test]
+    fn insert_get_remove() {
+        let table = HandleTable::new();
+        let a = table.insert("a").unwrap();
+        let b = table.insert("b").unwrap();
+        assert_ne!(a, b);
+        assert_eq!(table.get(a).unwrap(), Some("a"));
+        assert_eq!(table.ids().unwrap(), vec![a, b]);
+        assert_eq!(table.remove(a).unwrap(), Some("a"));
+        assert_eq!(table.get(a).unwrap(), None);
+        assert!(!table.contains(a).unwrap());
+        assert!(table.contains(b).unwrap());
+    }
+
+    #[test]
+    fn concurrent_inserts_get_unique_ids() {
+        let table = Arc::new(HandleTable::new());
+        let threads: Vec<_> = (0..8)
+            .map(|_| {
+                let table = table.clone();
+                thread::spawn(move || {
+                    for _ in 0..1000 {
+                        table.insert(()).unwrap();
+                    }
+                })
+            })
+            .collect();
+        for thread in threads {
+            thread.join().unwrap();
+        }
+        let ids = table.ids().unwrap();
+        assert_eq!(ids, (0..8000).collect::<Vec<_>>());
+    }
+}
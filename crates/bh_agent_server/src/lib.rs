@@ -1,5 +1,16 @@
+mod capture;
+mod environments;
+mod handles;
+mod metrics;
+mod reaper;
 pub mod server;
 mod state;
+mod store;
+mod subscription;
+pub mod transport;
+mod unpack;
 pub mod util;
 
+pub use metrics::Limits;
 pub use server::BhAgentServer;
+pub use transport::Agent;
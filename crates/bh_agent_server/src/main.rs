@@ -1,33 +1,70 @@
 use std::net::IpAddr;
+#[cfg(target_family = "unix")]
+use std::os::unix::io::{FromRawFd, RawFd};
+use std::path::PathBuf;
 
 use argh::FromArgs;
-use futures::{future, prelude::*};
-use tarpc::{
-    server::{self, Channel},
-    tokio_serde::formats::Json,
-};
+use futures::{future, prelude::*, stream};
+use tokio::net::TcpListener;
 use tokio::runtime;
 
-use bh_agent_common::BhAgentService;
-use bh_agent_server::BhAgentServer;
+use bh_agent_common::{Compression, DEFAULT_COMPRESSION_LEVEL, DEFAULT_COMPRESSION_THRESHOLD};
+use bh_agent_server::{Agent, Limits};
 
 #[derive(FromArgs)]
 /// bh_agent_server
 struct Args {
     /// address to listen on
     #[argh(positional)]
-    address: IpAddr,
+    address: Option<IpAddr>,
     /// port to listen on
     #[argh(positional)]
-    port: u16,
+    port: Option<u16>,
+    #[cfg(target_family = "unix")]
+    /// serve a connection over this inherited socket instead of listening, may be repeated
+    #[argh(option)]
+    socket_fd: Vec<RawFd>,
     #[cfg(not(target_os = "windows"))]
     /// daemonize the process
     #[argh(switch, short = 'd')]
     daemonize: bool,
+    /// number of async worker threads (defaults to the number of cores)
+    #[argh(option)]
+    worker_threads: Option<usize>,
+    /// maximum number of threads for blocking filesystem and process work
+    #[argh(option, default = "DEFAULT_BLOCKING_THREADS")]
+    blocking_threads: usize,
+    /// maximum number of clients served at once, others are refused
+    #[argh(option, default = "Limits::default().max_connections")]
+    max_connections: usize,
+    /// maximum number of requests in flight on one connection, others are throttled
+    #[argh(option, default = "Limits::default().max_in_flight")]
+    max_in_flight: usize,
+    /// zstd level for compressing data sent to clients that ask for compression
+    #[argh(option, default = "DEFAULT_COMPRESSION_LEVEL")]
+    compression_level: i32,
+    /// messages smaller than this many bytes are sent uncompressed
+    #[argh(option, default = "DEFAULT_COMPRESSION_THRESHOLD")]
+    compression_threshold: usize,
+    /// never compress, even if clients ask for it
+    #[argh(switch)]
+    no_compression: bool,
+    /// directory for the store of files sent to the agent, shared with other agents using it
+    #[argh(option)]
+    store_dir: Option<PathBuf>,
 }
 
-async fn spawn(fut: impl Future<Output = ()> + Send + 'static) {
-    tokio::spawn(fut);
+// Bounds how much blocking filesystem and process work can run at once. Requests beyond this
+// queue on the runtime rather than spawning more threads.
+const DEFAULT_BLOCKING_THREADS: usize = 64;
+
+/// Takes ownership of a socket passed down by the parent process.
+#[cfg(target_family = "unix")]
+fn inherited_socket(fd: RawFd) -> std::io::Result<std::os::unix::net::UnixStream> {
+    // Safety: the fd was handed to us on the command line to serve, and nothing else uses it
+    let socket = unsafe { std::os::unix::net::UnixStream::from_raw_fd(fd) };
+    socket.set_nonblocking(true)?;
+    Ok(socket)
 }
 
 fn main() -> anyhow::Result<()> {
@@ -44,34 +81,71 @@ fn main() -> anyhow::Result<()> {
     }
 
     // Setup runtime
-    let rt = runtime::Builder::new_multi_thread()
+    let mut builder = runtime::Builder::new_multi_thread();
+    builder
         .enable_all()
-        .build()
-        .unwrap();
+        .max_blocking_threads(args.blocking_threads);
+    if let Some(worker_threads) = args.worker_threads {
+        builder.worker_threads(worker_threads);
+    }
+    let rt = builder.build()?;
+
+    let compression = Compression {
+        level: args.compression_level,
+        threshold: args.compression_threshold,
+    };
+    let new_agent = || {
+        let agent = Agent::new(Limits {
+            max_connections: args.max_connections,
+            max_in_flight: args.max_in_flight,
+        })
+        .with_compression((!args.no_compression).then_some(compression));
+        match &args.store_dir {
+            Some(dir) => agent.with_store_dir(dir.clone()),
+            None => agent,
+        }
+    };
+
+    // Serve inherited sockets, exiting once the process that started us hangs up on all of them
+    #[cfg(target_family = "unix")]
+    if !args.socket_fd.is_empty() {
+        rt.block_on(async {
+            let agent = new_agent();
+            let mut connections = Vec::new();
+            for &fd in &args.socket_fd {
+                let socket = tokio::net::UnixStream::from_std(inherited_socket(fd)?)?;
+                let peer = format!("socket {}", fd);
+                connections.push(tokio::spawn(agent.clone().serve_unix(socket, peer)));
+            }
+            future::join_all(connections).await;
+            Ok::<_, anyhow::Error>(())
+        })?;
+        return Ok(());
+    }
 
     // Setup listener
-    let mut listener = rt.block_on(async {
-        return tarpc::serde_transport::tcp::listen(&(args.address, args.port), Json::default)
-            .await;
-    })?;
-    listener.config_mut().max_frame_length(usize::MAX);
+    let (address, port) = match (args.address, args.port) {
+        (Some(address), Some(port)) => (address, port),
+        _ => anyhow::bail!("An address and port to listen on are required"),
+    };
+    let listener = rt.block_on(TcpListener::bind((address, port)))?;
 
     // Run the listener
     rt.block_on(async {
-        listener
-            // Ignore accept errors.
-            .filter_map(|r| future::ready(r.ok()))
-            .map(server::BaseChannel::with_defaults)
-            // serve is generated by the service attribute. It takes as input any type implementing
-            // the generated World trait.
-            .map(|channel| {
-                let server = BhAgentServer::new(channel.transport().peer_addr().unwrap());
-                channel.execute(server.serve()).for_each(spawn)
-            })
-            // Max 10 channels.
-            .buffer_unordered(10)
-            .for_each(|_| async {})
-            .await;
+        let agent = new_agent();
+        stream::unfold(listener, |listener| async move {
+            let accepted = listener.accept().await;
+            Some((accepted, listener))
+        })
+        // Ignore accept errors.
+        .filter_map(|r| future::ready(r.ok()))
+        // Each connection negotiates its codec before being served. Connections over the limit
+        // are refused by the agent rather than left waiting here.
+        .for_each(|(stream, _)| {
+            tokio::spawn(agent.clone().serve_tcp(stream));
+            future::ready(())
+        })
+        .await;
     });
 
     Ok(())
@@ -0,0 +1,96 @@
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::Arc;
+
+use bh_agent_common::AgentMetrics;
+
+/// Limits on how much work the agent takes on at once.
+#[derive(Copy, Clone, Debug)]
+pub struct Limits {
+    /// Connections served at the same time. Clients beyond this are refused during the handshake.
+    pub max_connections: usize,
+    /// Requests a single connection may have in flight. Requests beyond this are answered with a
+    /// throttling error straight away instead of being queued.
+    pub max_in_flight: usize,
+}
+
+impl Default for Limits {
+    fn default() -> Self {
+        Self {
+            max_connections: 64,
+            max_in_flight: 256,
+        }
+    }
+}
+
+/// Load counters shared by every connection to the agent.
+#[derive(Default)]
+pub struct Metrics {
+    connections: AtomicU64,
+    rejected_connections: AtomicU64,
+    queue_depth: AtomicU64,
+}
+
+/// Counts a connection or request as active until dropped.
+pub struct Active {
+    metrics: Arc<Metrics>,
+    counter: fn(&Metrics) -> &AtomicU64,
+}
+
+impl Drop for Active {
+    fn drop(&mut self) {
+        (self.counter)(&self.metrics).fetch_sub(1, Ordering::Relaxed);
+    }
+}
+
+impl Metrics {
+    fn enter(self: &Arc<Self>, counter: fn(&Metrics) -> &AtomicU64) -> Active {
+        counter(self).fetch_add(1, Ordering::Relaxed);
+        Active {
+            metrics: self.clone(),
+            counter,
+        }
+    }
+
+    pub fn connection(self: &Arc<Self>) -> Active {
+        self.enter(|m| &m.connections)
+    }
+
+    pub fn request(self: &Arc<Self>) -> Active {
+        self.enter(|m| &m.queue_depth)
+    }
+
+    pub fn reject_connection(&self) {
+        self.rejected_connections.fetch_add(1, Ordering::Relaxed);
+    }
+
+    pub fn snapshot(&self, limits: &Limits) -> AgentMetrics {
+        AgentMetrics {
+            connections: self.connections.load(Ordering::Relaxed),
+            max_connections: limits.max_connections as u64,
+            rejected_connections: self.rejected_connections.load(Ordering::Relaxed),
+            queue_depth: self.queue_depth.load(Ordering::Relaxed),
+            max_in_flight: limits.max_in_flight as u64,
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn active_counts_until_dropped() {
+        let metrics = Arc::new(Metrics::default());
+        let limits = Limits::default();
+        let first = metrics.request();
+        let second = metrics.request();
+        assert_eq!(metrics.snapshot(&limits).queue_depth, 2);
+        drop(first);
+        assert_eq!(metrics.snapshot(&limits).queue_depth, 1);
+        drop(second);
+        metrics.reject_connection();
+        let snapshot = metrics.snapshot(&limits);
+        assert_eq!(snapshot.queue_depth, 0);
+        assert_eq!(snapshot.rejected_connections, 1);
+    }
+}
@@ -0,0 +1,200 @@
+use std::sync::{Arc, Mutex, RwLock, Weak};
+use std::time::Duration;
+
+use log::trace;
+#[cfg(target_family = "unix")]
+use log::warn;
+use subprocess::Popen;
+use tokio::sync::watch;
+
+// Children are watched until they exit, and waiters are told through a watch channel. On unix the
+// reaper wakes up on SIGCHLD and checks which children have exited, but leaves the actual reaping
+// to Popen so exit codes keep working as before. The periodic sweep is only a safety net there,
+// elsewhere it is how exits are noticed.
+#[cfg(target_family = "unix")]
+const SWEEP_INTERVAL: Duration = Duration::from_secs(1);
+#[cfg(not(target_family = "unix"))]
+const SWEEP_INTERVAL: Duration = Duration::from_millis(10);
+
+struct Child {
+    pid: u32,
+    #[cfg_attr(any(target_os = "linux", target_os = "android"), allow(dead_code))]
+    popen: Arc<RwLock<Popen>>,
+    exited: watch::Sender<bool>,
+}
+
+pub struct Reaper {
+    children: Mutex<Vec<Child>>,
+}
+
+impl Reaper {
+    /// Creates a reaper and spawns the task that drives it. The task stops once the reaper is
+    /// dropped.
+    pub fn start() -> Arc<Reaper> {
+        let reaper = Arc::new(Reaper {
+            children: Mutex::new(Vec::new()),
+        });
+        // Listen for SIGCHLD before any child is watched, so no exit can be missed
+        #[cfg(target_family = "unix")]
+        tokio::spawn(run(Arc::downgrade(&reaper), listen_sigchld()));
+        #[cfg(not(target_family = "unix"))]
+        tokio::spawn(run(Arc::downgrade(&reaper)));
+        reaper
+    }
+
+    /// Watches a child process. The returned receiver becomes true once the child exits.
+    pub fn watch(&self, popen: Arc<RwLock<Popen>>) -> watch::Receiver<bool> {
+        let (exited, receiver) = watch::channel(false);
+        let pid = popen.read().ok().and_then(|p| p.pid());
+        match pid {
+            Some(pid) => {
+                if let Ok(mut children) = self.children.lock() {
+                    children.push(Child { pid, popen, exited });
+                }
+                // The child may have exited before it was added, without another SIGCHLD to
+                // come
+                self.reap();
+            }
+            None => {
+                let _ = exited.send(true);
+            }
+        }
+        receiver
+    }
+
+    fn reap(&self) {
+        let mut children = match self.children.lock() {
+            Ok(children) => children,
+            Err(_) => return,
+        };
+        children.retain(|child| {
+            if has_exited(child) {
+                trace!("Child {} exited", child.pid);
+                let _ = child.exited.send(true);
+                false
+            } else {
+                true
+            }
+        });
+    }
+}
+
+/// Checks whether a child has exited without reaping it.
+#[cfg(any(target_os = "linux", target_os = "android"))]
+fn has_exited(child: &Child) -> bool {
+    use nix::errno::Errno;
+    use nix::sys::wait::{waitid, Id, WaitPidFlag, WaitStatus};
+    use nix::unistd::Pid;
+
+    let flags = WaitPidFlag::WEXITED | WaitPidFlag::WNOHANG | WaitPidFlag::WNOWAIT;
+    match waitid(Id::Pid(Pid::from_raw(child.pid as i32)), flags) {
+        Ok(WaitStatus::StillAlive) => false,
+        Ok(_) => true,
+        // Already reaped by an explicit poll
+        Err(Errno::ECHILD) => true,
+        Err(_) => false,
+    }
+}
+
+/// Checks whether a child has exited. Without waitid the child has to be polled, which is skipped
+/// while something else holds the process and retried on the next sweep.
+#[cfg(not(any(target_os = "linux", target_os = "android")))]
+fn has_exited(child: &Child) -> bool {
+    match child.popen.try_write() {
+        Ok(mut popen) => popen.poll().is_some(),
+        Err(_) => false,
+    }
+}
+
+#[cfg(target_family = "unix")]
+async fn next_sigchld(signal: &mut Option<tokio::signal::unix::Signal>) {
+    use futures::future;
+
+    match signal {
+        Some(signal) => {
+            if signal.recv().await.is_none() {
+                future::pending::<()>().await
+            }
+        }
+        None => future::pending::<()>().await,
+    }
+}
+
+#[cfg(target_family = "unix")]
+fn listen_sigchld() -> Option<tokio::signal::unix::Signal> {
+    use tokio::signal::unix::{signal, SignalKind};
+
+    match signal(SignalKind::child()) {
+        Ok(signal) => Some(signal),
+        Err(e) => {
+            warn!(
+                "Failed to listen for SIGCHLD, falling back to polling: {}",
+                e
+            );
+            None
+        }
+    }
+}
+
+#[cfg(target_family = "unix")]
+async fn run(reaper: Weak<Reaper>, mut sigchld: Option<tokio::signal::unix::Signal>) {
+    let mut sweep = tokio::time::interval(SWEEP_INTERVAL);
+    loop {
+        tokio::select! {
+            _ = next_sigchld(&mut sigchld) => {}
+            _ = sweep.tick() => {}
+        }
+        match reaper.upgrade() {
+            Some(reaper) => reaper.reap(),
+            None => break,
+        }
+    }
+}
+
+#[cfg(not(target_family = "unix"))]
+async fn run(reaper: Weak<Reaper>) {
+    let mut sweep = tokio::time::interval(SWEEP_INTERVAL);
+    loop {
+        sweep.tick().await;
+        match reaper.upgrade() {
+            Some(reaper) => reaper.reap(),
+            None => break,
+        }
+    }
+}
+
+#[cfg(all(test, target_family = "unix"))]
+mod tests {
+    use std::time::{Duration, Instant};
+
+    use subprocess::{Exec, Popen};
+
+    use super::*;
+
+    fn spawn(cmd: &str) -> Arc<RwLock<Popen>> {
+        Arc::new(RwLock::new(Exec::shell(cmd).popen().unwrap()))
+    }
+
+    #[tokio::test(flavor = "multi_thread")]
+    async fn wakes_waiter_on_exit() {
+        let reaper = Reaper::start();
+        let popen = spawn("sleep 0.2");
+        let mut exited = reaper.watch(popen.clone());
+
+        let start = Instant::now();
+        exited.wait_for(|exited| *exited).await.unwrap();
+        // Well under the sweep interval, so the wakeup came from SIGCHLD
+        assert!(start.elapsed() < Duration::from_millis(800));
+        assert!(popen.write().unwrap().poll().is_some());
+    }
+
+    #[tokio::test(flavor = "multi_thread")]
+    async fn watch_after_exit() {
+        let reaper = Reaper::start();
+        let popen = spawn("true");
+        popen.write().unwrap().wait().unwrap();
+
+        let exited = reaper.watch(popen);
+        assert!(*exited.borrow());
+    }
+}
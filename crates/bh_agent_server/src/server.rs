@@ -1,54 +1,179 @@
 use std::io::{Seek, SeekFrom, Write};
-use std::net::SocketAddr;
+#[cfg(target_family = "unix")]
+use std::os::unix::fs::PermissionsExt;
+use std::path::Path;
 use std::sync::Arc;
 
 use anyhow::Result;
+use futures::future;
 use tarpc::context::Context;
 
 use bh_agent_common::{
-    AgentError, BhAgentService, EnvironmentId, FileId, FileOpenMode, FileOpenType, ProcessChannel,
-    ProcessId, RemotePOpenConfig,
+    hash_file, AgentError, AgentMetrics, ArchiveId, BatchOperation, BatchResult, BhAgentService,
+    ByteRange, EnvironmentId, FileId, FileOpenMode, FileOpenType, FileStat, HandleRef,
+    HashAlgorithm, ProcessChannel, ProcessId, RemotePOpenConfig, StatColumns, SubscriptionId,
 };
 use bh_agent_common::{AgentError::*, UserId};
 
 use crate::state::BhAgentState;
+use crate::transport::Agent;
 #[cfg(target_family = "unix")]
-use crate::util::{chmod, chown, set_blocking, stat};
-use crate::util::{read_generic, read_lines};
-
-macro_rules! check_env_id {
-    ($env_id:expr) => {
-        if $env_id != 0 {
-            return Err(AgentError::InvalidEnvironmentId);
-        }
-    };
+use crate::util::{chmod, chown, set_blocking, stat, symlink};
+use crate::util::{listdir, mkdir, mktemp, remove, rename, stat_many, walk};
+use crate::util::{read_at, read_generic, read_lines, write_all_at};
+
+/// Runs blocking work, such as filesystem calls or starting a process, on the runtime's bounded
+/// blocking pool, so a slow disk or a large write doesn't stall other requests on the worker.
+async fn blocking<R, F>(f: F) -> Result<R, AgentError>
+where
+    R: Send + 'static,
+    F: FnOnce() -> Result<R, AgentError> + Send + 'static,
+{
+    tokio::task::spawn_blocking(f).await.map_err(|_| Unknown)?
 }
 
 #[derive(Clone)]
 pub struct BhAgentServer {
-    sockaddr: SocketAddr,
-    state: Arc<BhAgentState>,
+    // Who is on the other end of the connection, such as a TCP address or an inherited socket
+    peer: String,
+    agent: Agent,
 }
 
 impl BhAgentServer {
-    pub fn new(socket_addr: SocketAddr) -> Self {
-        Self {
-            sockaddr: socket_addr,
-            state: Arc::new(BhAgentState::new()),
+    /// Creates the server for one connection. The environments belong to the agent, so every
+    /// connection sees the same processes, files and metadata, and a client that reconnects can
+    /// pick up where it left off.
+    pub fn new(peer: String, agent: Agent) -> Self {
+        Self { peer, agent }
+    }
+
+    fn environment(&self, env_id: EnvironmentId) -> Result<Arc<BhAgentState>, AgentError> {
+        self.agent.environments().get(env_id)
+    }
+}
+
+impl BhAgentServer {
+    async fn run_batch_operation(
+        self,
+        ctx: Context,
+        env_id: EnvironmentId,
+        operation: BatchOperation,
+        results: &[Result<BatchResult, AgentError>],
+    ) -> Result<BatchResult, AgentError> {
+        let resolve = |handle: HandleRef| match handle {
+            HandleRef::Id(id) => Ok(id),
+            HandleRef::Result(index) => match results.get(index as usize) {
+                Some(Ok(BatchResult::Handle(id))) => Ok(*id),
+                _ => Err(InvalidBatchReference(index)),
+            },
+        };
+
+        match operation {
+            BatchOperation::RunCommand(config) => self
+                .run_command(ctx, env_id, config)
+                .await
+                .map(BatchResult::Handle),
+            BatchOperation::GetProcessChannel(proc_id, channel) => self
+                .get_process_channel(ctx, env_id, resolve(proc_id)?, channel)
+                .await
+                .map(BatchResult::Handle),
+            BatchOperation::ProcessPoll(proc_id) => self
+                .process_poll(ctx, env_id, resolve(proc_id)?)
+                .await
+                .map(BatchResult::ExitCode),
+            BatchOperation::ProcessReturncode(proc_id) => self
+                .process_returncode(ctx, env_id, resolve(proc_id)?)
+                .await
+                .map(BatchResult::ExitCode),
+            BatchOperation::FileOpen(path, mode, type_) => self
+                .file_open(ctx, env_id, path, mode, type_)
+                .await
+                .map(BatchResult::Handle),
+            BatchOperation::FileClose(fd) => self
+                .file_close(ctx, env_id, resolve(fd)?)
+                .await
+                .map(|_| BatchResult::None),
+            BatchOperation::FileRead(fd, num_bytes) => self
+                .file_read(ctx, env_id, resolve(fd)?, num_bytes)
+                .await
+                .map(BatchResult::Data),
+            BatchOperation::FileWrite(fd, data) => self
+                .file_write(ctx, env_id, resolve(fd)?, data)
+                .await
+                .map(|_| BatchResult::None),
+            BatchOperation::Chown(path, user, group) => self
+                .chown(ctx, env_id, path, user, group)
+                .await
+                .map(|_| BatchResult::None),
+            BatchOperation::Chmod(path, mode) => self
+                .chmod(ctx, env_id, path, mode)
+                .await
+                .map(|_| BatchResult::None),
+            BatchOperation::Stat(path) => self.stat(ctx, env_id, path).await.map(BatchResult::Stat),
+            BatchOperation::Mkdir(path, parents, exist_ok) => self
+                .mkdir(ctx, env_id, path, parents, exist_ok)
+                .await
+                .map(|_| BatchResult::None),
+            BatchOperation::Remove(path, recursive) => self
+                .remove(ctx, env_id, path, recursive)
+                .await
+                .map(|_| BatchResult::None),
+            BatchOperation::Rename(src, dst) => self
+                .rename(ctx, env_id, src, dst)
+                .await
+                .map(|_| BatchResult::None),
+            BatchOperation::Symlink(target, link) => self
+                .symlink(ctx, env_id, target, link)
+                .await
+                .map(|_| BatchResult::None),
+            BatchOperation::StoreAdd(hash, path) => self
+                .store_add(ctx, env_id, hash, path)
+                .await
+                .map(|_| BatchResult::None),
+            BatchOperation::StoreInstall(hash, path, mode) => self
+                .store_install(ctx, env_id, hash, path, mode)
+                .await
+                .map(|_| BatchResult::None),
+            BatchOperation::GetMetadata(key) => self
+                .get_metadata(ctx, env_id, key)
+                .await
+                .map(BatchResult::Metadata),
+            BatchOperation::SetMetadata(key, value) => self
+                .set_metadata(ctx, env_id, key, value)
+                .await
+                .map(|_| BatchResult::None),
         }
     }
 }
 
 impl BhAgentService for BhAgentServer {
     async fn get_environments(self, _: Context) -> Vec<EnvironmentId> {
-        // Our implementation currently only supports the default environment
-        vec![0]
+        self.agent.environments().ids().unwrap_or_default()
+    }
+
+    async fn create_environment(self, _: Context) -> Result<EnvironmentId, AgentError> {
+        let agent = self.agent.clone();
+        blocking(move || agent.environments().create()).await
+    }
+
+    async fn destroy_environment(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+    ) -> Result<(), AgentError> {
+        // Removing the scratch directory can take a while
+        let agent = self.agent.clone();
+        blocking(move || agent.environments().destroy(env_id)).await
+    }
+
+    async fn get_metrics(self, _: Context) -> AgentMetrics {
+        self.agent.metrics()
     }
 
     async fn get_tempdir(self, _: Context, env_id: EnvironmentId) -> Result<String, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        Ok("/tmp".to_string()) // TODO: make configurable
+        Ok(state.tempdir().to_string_lossy().into_owned())
     }
 
     async fn run_command(
@@ -57,9 +182,9 @@ impl BhAgentService for BhAgentServer {
         env_id: EnvironmentId,
         config: RemotePOpenConfig,
     ) -> Result<ProcessId, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.run_command(config)
+        blocking(move || state.run_command(config)).await
     }
 
     async fn get_process_ids(
@@ -67,9 +192,20 @@ impl BhAgentService for BhAgentServer {
         _: Context,
         env_id: EnvironmentId,
     ) -> Result<Vec<ProcessId>, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
+
+        state.get_process_ids()
+    }
+
+    async fn get_process_config(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+    ) -> Result<RemotePOpenConfig, AgentError> {
+        let state = self.environment(env_id)?;
 
-        self.state.get_process_ids()
+        state.get_process_config(&proc_id)
     }
 
     async fn get_process_channel(
@@ -79,9 +215,9 @@ impl BhAgentService for BhAgentServer {
         proc_id: ProcessId,
         channel: ProcessChannel,
     ) -> Result<FileId, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.get_process_channel(&proc_id, channel)
+        state.get_process_channel(&proc_id, channel)
     }
 
     async fn process_poll(
@@ -90,9 +226,9 @@ impl BhAgentService for BhAgentServer {
         env_id: EnvironmentId,
         proc_id: ProcessId,
     ) -> Result<Option<u32>, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.process_poll(&proc_id)
+        state.process_poll(&proc_id)
     }
 
     async fn process_wait(
@@ -102,9 +238,38 @@ impl BhAgentService for BhAgentServer {
         proc_id: ProcessId,
         timeout: Option<u32>,
     ) -> Result<bool, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.process_wait(&proc_id, timeout)
+        state.process_wait(&proc_id, timeout).await
+    }
+
+    async fn process_wait_many(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        proc_ids: Vec<ProcessId>,
+        all: bool,
+        timeout: Option<u32>,
+    ) -> Result<Vec<(ProcessId, u32)>, AgentError> {
+        let state = self.environment(env_id)?;
+
+        state.process_wait_many(&proc_ids, all, timeout).await
+    }
+
+    async fn process_read_capture(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        proc_id: ProcessId,
+        channel: ProcessChannel,
+        offset: u64,
+        size: Option<u32>,
+    ) -> Result<Vec<u8>, AgentError> {
+        let state = self.environment(env_id)?;
+
+        state
+            .process_read_capture(&proc_id, channel, offset, size)
+            .await
     }
 
     async fn process_returncode(
@@ -113,9 +278,9 @@ impl BhAgentService for BhAgentServer {
         env_id: EnvironmentId,
         proc_id: ProcessId,
     ) -> Result<Option<u32>, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.process_exit_code(&proc_id)
+        state.process_exit_code(&proc_id)
     }
 
     async fn file_open(
@@ -126,9 +291,9 @@ impl BhAgentService for BhAgentServer {
         mode: FileOpenMode,
         type_: FileOpenType,
     ) -> Result<FileId, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.open_path(path, mode, type_)
+        blocking(move || state.open_path(path, mode, type_)).await
     }
 
     async fn file_close(
@@ -137,9 +302,10 @@ impl BhAgentService for BhAgentServer {
         env_id: EnvironmentId,
         fd: FileId,
     ) -> Result<(), AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.close_file(&fd)
+        // Closing can flush to slow storage
+        blocking(move || state.close_file(&fd)).await
     }
 
     async fn file_is_closed(
@@ -148,9 +314,9 @@ impl BhAgentService for BhAgentServer {
         env_id: EnvironmentId,
         fd: FileId,
     ) -> Result<bool, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.is_file_closed(&fd)
+        state.is_file_closed(&fd)
     }
 
     async fn file_is_readable(
@@ -159,10 +325,9 @@ impl BhAgentService for BhAgentServer {
         env_id: EnvironmentId,
         fd: FileId,
     ) -> Result<bool, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state
-            .file_has_any_mode(&fd, &vec![FileOpenMode::Read, FileOpenMode::Update])
+        state.file_has_any_mode(&fd, &vec![FileOpenMode::Read, FileOpenMode::Update])
     }
 
     async fn file_read(
@@ -172,13 +337,15 @@ impl BhAgentService for BhAgentServer {
         fd: FileId,
         num_bytes: Option<u32>,
     ) -> Result<Vec<u8>, AgentError> {
-        check_env_id!(env_id);
-
-        self.state
-            .do_mut_operation(&fd, |file| {
-                read_generic(file, num_bytes, self.state.file_type(&fd)?)
-            })
-            .and_then(|v| v.map_err(|e| IoError(e.to_string())))
+        let state = self.environment(env_id)?;
+
+        blocking(move || {
+            let file_type = state.file_type(&fd)?;
+            state
+                .do_mut_operation(&fd, |file| read_generic(file, num_bytes, file_type))?
+                .map_err(|e| IoError(e.to_string()))
+        })
+        .await
     }
 
     async fn file_read_lines(
@@ -188,15 +355,16 @@ impl BhAgentService for BhAgentServer {
         fd: FileId,
         hint: u32,
     ) -> Result<Vec<Vec<u8>>, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
         // TODO: support hint
 
-        self.state
-            .do_mut_operation(&fd, |file| {
-                read_lines(file).map_err(|e| IoError(e.to_string()))
-            })
-            .and_then(|r| r)
+        blocking(move || {
+            state
+                .do_mut_operation(&fd, |file| read_lines(file))?
+                .map_err(|e| IoError(e.to_string()))
+        })
+        .await
     }
 
     async fn file_is_seekable(
@@ -205,9 +373,10 @@ impl BhAgentService for BhAgentServer {
         env_id: EnvironmentId,
         fd: FileId,
     ) -> Result<bool, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        todo!()
+        // Pipes and sockets have no position to report
+        blocking(move || state.do_mut_operation(&fd, |file| file.stream_position().is_ok())).await
     }
 
     async fn file_seek(
@@ -215,21 +384,24 @@ impl BhAgentService for BhAgentServer {
         _: Context,
         env_id: EnvironmentId,
         fd: FileId,
-        offset: i32,
+        offset: i64,
         whence: i32,
     ) -> Result<(), AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
         let from = match whence {
             0 => SeekFrom::Start(offset as u64),
-            1 => SeekFrom::Current(offset as i64),
-            2 => SeekFrom::End(offset as i64),
+            1 => SeekFrom::Current(offset),
+            2 => SeekFrom::End(offset),
             _ => return Err(AgentError::InvalidSeekWhence),
         };
 
-        self.state
-            .do_mut_operation(&fd, |file| file.seek(from))
-            .map(|_| ())
+        blocking(move || {
+            state
+                .do_mut_operation(&fd, |file| file.seek(from))
+                .map(|_| ())
+        })
+        .await
     }
 
     async fn file_tell(
@@ -237,10 +409,10 @@ impl BhAgentService for BhAgentServer {
         _: Context,
         env_id: EnvironmentId,
         fd: FileId,
-    ) -> Result<i32, AgentError> {
-        check_env_id!(env_id);
+    ) -> Result<u64, AgentError> {
+        let state = self.environment(env_id)?;
 
-        todo!()
+        blocking(move || Ok(state.do_mut_operation(&fd, |file| file.stream_position())??)).await
     }
 
     async fn file_is_writable(
@@ -249,9 +421,9 @@ impl BhAgentService for BhAgentServer {
         env_id: EnvironmentId,
         fd: FileId,
     ) -> Result<bool, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.file_has_any_mode(
+        state.file_has_any_mode(
             &fd,
             &vec![
                 FileOpenMode::Write,
@@ -269,11 +441,9 @@ impl BhAgentService for BhAgentServer {
         fd: FileId,
         data: Vec<u8>,
     ) -> Result<(), AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state
-            .do_mut_operation(&fd, |file| file.write(&data))
-            .map(|_| ())
+        blocking(move || Ok(state.do_mut_operation(&fd, |file| file.write_all(&data))??)).await
     }
 
     async fn file_set_blocking(
@@ -283,11 +453,10 @@ impl BhAgentService for BhAgentServer {
         fd: FileId,
         blocking: bool,
     ) -> Result<(), AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
         #[cfg(target_family = "unix")]
-        return self
-            .state
+        return state
             .do_mut_operation(&fd, |file| set_blocking(file, blocking))
             .map(|_| ());
 
@@ -295,6 +464,189 @@ impl BhAgentService for BhAgentServer {
         return Err(AgentError::UnsupportedPlatform);
     }
 
+    async fn file_upload_begin(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        path: String,
+    ) -> Result<FileId, AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || state.open_path(path, FileOpenMode::Write, FileOpenType::Binary)).await
+    }
+
+    async fn file_upload_chunk(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        fd: FileId,
+        offset: u64,
+        data: Vec<u8>,
+    ) -> Result<(), AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || Ok(state.do_operation(&fd, |file| write_all_at(file, &data, offset))??))
+            .await
+    }
+
+    async fn file_upload_finish(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        fd: FileId,
+        mode: Option<u32>,
+    ) -> Result<(), AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || {
+            // Modes are ignored on platforms without unix permissions
+            #[cfg(target_family = "unix")]
+            if let Some(mode) = mode {
+                state.do_operation(&fd, |file| {
+                    file.set_permissions(PermissionsExt::from_mode(mode))
+                })??;
+            }
+
+            state.close_file(&fd)
+        })
+        .await
+    }
+
+    async fn file_upload_abort(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        fd: FileId,
+        path: String,
+    ) -> Result<(), AgentError> {
+        let state = self.environment(env_id)?;
+
+        // Don't leave a partly written file behind
+        blocking(move || {
+            state.close_file(&fd)?;
+            Ok(std::fs::remove_file(path)?)
+        })
+        .await
+    }
+
+    async fn file_download_begin(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        path: String,
+    ) -> Result<(FileId, FileStat), AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || {
+            let fd = state.open_path(path, FileOpenMode::Read, FileOpenType::Binary)?;
+            match state.do_operation(&fd, |file| file.metadata())? {
+                Ok(metadata) => Ok((fd, FileStat::from(&metadata))),
+                Err(e) => {
+                    let _ = state.close_file(&fd);
+                    Err(e.into())
+                }
+            }
+        })
+        .await
+    }
+
+    async fn file_download_chunk(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        fd: FileId,
+        offset: u64,
+        len: u32,
+    ) -> Result<Vec<u8>, AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || Ok(state.do_operation(&fd, |file| read_at(file, len as usize, offset))??))
+            .await
+    }
+
+    async fn archive_upload_begin(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        path: String,
+        compressed: bool,
+    ) -> Result<ArchiveId, AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || state.unpack_directory(path, compressed)).await
+    }
+
+    async fn archive_upload_chunk(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        archive: ArchiveId,
+        offset: u64,
+        data: Vec<u8>,
+    ) -> Result<(), AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || state.unpack_chunk(&archive, offset, data)).await
+    }
+
+    async fn archive_upload_finish(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        archive: ArchiveId,
+    ) -> Result<(), AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || state.unpack_finish(&archive)).await
+    }
+
+    async fn archive_download(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        path: String,
+        compression_level: Option<i32>,
+        window: u32,
+    ) -> Result<SubscriptionId, AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || state.pack_directory(path, compression_level, window)).await
+    }
+
+    async fn file_subscribe(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        fd: FileId,
+        window: u32,
+    ) -> Result<SubscriptionId, AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || state.subscribe(&fd, window)).await
+    }
+
+    async fn subscription_next(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        subscription: SubscriptionId,
+    ) -> Result<Option<Vec<u8>>, AgentError> {
+        let state = self.environment(env_id)?;
+
+        state.subscription_next(&subscription).await
+    }
+
+    async fn subscription_cancel(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        subscription: SubscriptionId,
+    ) -> Result<(), AgentError> {
+        let state = self.environment(env_id)?;
+
+        state.cancel_subscription(&subscription)
+    }
+
     async fn chown(
         self,
         _: Context,
@@ -303,10 +655,10 @@ impl BhAgentService for BhAgentServer {
         user: Option<UserId>,
         group: Option<UserId>,
     ) -> Result<(), AgentError> {
-        check_env_id!(env_id);
+        self.environment(env_id)?;
 
         #[cfg(target_family = "unix")]
-        return chown(path, user, group);
+        return blocking(move || chown(path, user, group)).await;
 
         #[cfg(not(target_family = "unix"))]
         return Err(AgentError::UnsupportedPlatform);
@@ -319,10 +671,10 @@ impl BhAgentService for BhAgentServer {
         path: String,
         mode: u32,
     ) -> Result<(), AgentError> {
-        check_env_id!(env_id);
+        self.environment(env_id)?;
 
         #[cfg(target_family = "unix")]
-        return chmod(path, mode);
+        return blocking(move || chmod(path, mode)).await;
 
         #[cfg(not(target_family = "unix"))]
         return Err(AgentError::UnsupportedPlatform);
@@ -334,24 +686,196 @@ impl BhAgentService for BhAgentServer {
         env_id: EnvironmentId,
         path: String,
     ) -> Result<bh_agent_common::FileStat, AgentError> {
-        check_env_id!(env_id);
+        self.environment(env_id)?;
 
         #[cfg(target_family = "unix")]
-        return stat(path);
+        return blocking(move || stat(path)).await;
 
         #[cfg(not(target_family = "unix"))]
         return Err(AgentError::UnsupportedPlatform);
     }
 
+    async fn stat_many(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        paths: Vec<String>,
+    ) -> Result<StatColumns, AgentError> {
+        self.environment(env_id)?;
+
+        blocking(move || Ok(stat_many(paths))).await
+    }
+
+    async fn walk(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        path: String,
+        max_depth: Option<u32>,
+    ) -> Result<StatColumns, AgentError> {
+        self.environment(env_id)?;
+
+        blocking(move || walk(path, max_depth)).await
+    }
+
+    async fn file_hash(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        files: Vec<(String, Option<ByteRange>)>,
+        algorithm: HashAlgorithm,
+    ) -> Result<Vec<String>, AgentError> {
+        self.environment(env_id)?;
+
+        // Each file is hashed on its own blocking thread, so a batch of files is read in parallel
+        future::try_join_all(files.into_iter().map(|(path, range)| {
+            blocking(move || Ok(hash_file(Path::new(&path), algorithm, range)?))
+        }))
+        .await
+    }
+
+    async fn mkdir(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        path: String,
+        parents: bool,
+        exist_ok: bool,
+    ) -> Result<(), AgentError> {
+        self.environment(env_id)?;
+
+        blocking(move || mkdir(path, parents, exist_ok)).await
+    }
+
+    async fn remove(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        path: String,
+        recursive: bool,
+    ) -> Result<(), AgentError> {
+        self.environment(env_id)?;
+
+        blocking(move || remove(path, recursive)).await
+    }
+
+    async fn rename(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        src: String,
+        dst: String,
+    ) -> Result<(), AgentError> {
+        self.environment(env_id)?;
+
+        blocking(move || rename(src, dst)).await
+    }
+
+    async fn symlink(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        target: String,
+        link: String,
+    ) -> Result<(), AgentError> {
+        self.environment(env_id)?;
+
+        #[cfg(target_family = "unix")]
+        return blocking(move || symlink(target, link)).await;
+
+        #[cfg(not(target_family = "unix"))]
+        return Err(AgentError::UnsupportedPlatform);
+    }
+
+    async fn mktemp(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        directory: bool,
+    ) -> Result<String, AgentError> {
+        let state = self.environment(env_id)?;
+
+        blocking(move || mktemp(state.tempdir(), directory)).await
+    }
+
+    async fn listdir(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        path: String,
+    ) -> Result<Vec<String>, AgentError> {
+        self.environment(env_id)?;
+
+        blocking(move || listdir(path)).await
+    }
+
+    async fn store_claim(
+        self,
+        _: Context,
+        hashes: Vec<String>,
+    ) -> Result<(Vec<String>, Vec<String>), AgentError> {
+        self.agent.store().claim(hashes).await
+    }
+
+    async fn store_add(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        hash: String,
+        path: String,
+    ) -> Result<(), AgentError> {
+        self.environment(env_id)?;
+
+        let store = self.agent.store().clone();
+        blocking(move || store.add(&hash, Path::new(&path))).await
+    }
+
+    async fn store_release(self, _: Context, hashes: Vec<String>) -> Result<(), AgentError> {
+        self.agent.store().release(&hashes)
+    }
+
+    async fn store_install(
+        self,
+        _: Context,
+        env_id: EnvironmentId,
+        hash: String,
+        path: String,
+        mode: Option<u32>,
+    ) -> Result<(), AgentError> {
+        self.environment(env_id)?;
+
+        let store = self.agent.store().clone();
+        blocking(move || store.install(&hash, Path::new(&path), mode)).await
+    }
+
+    async fn batch(
+        self,
+        ctx: Context,
+        env_id: EnvironmentId,
+        operations: Vec<BatchOperation>,
+    ) -> Result<Vec<Result<BatchResult, AgentError>>, AgentError> {
+        self.environment(env_id)?;
+
+        let mut results = Vec::with_capacity(operations.len());
+        for operation in operations {
+            let result = self
+                .clone()
+                .run_batch_operation(ctx, env_id, operation, &results)
+                .await;
+            results.push(result);
+        }
+        Ok(results)
+    }
+
     async fn get_metadata(
         self,
         _: Context,
         env_id: EnvironmentId,
         key: String,
     ) -> Result<Option<String>, AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.get_metadata(&key)
+        state.get_metadata(&key)
     }
 
     async fn set_metadata(
@@ -361,8 +885,8 @@ impl BhAgentService for BhAgentServer {
         key: String,
         value: String,
     ) -> Result<(), AgentError> {
-        check_env_id!(env_id);
+        let state = self.environment(env_id)?;
 
-        self.state.set_metadata(&key, &value)
+        state.set_metadata(&key, &value)
     }
 }
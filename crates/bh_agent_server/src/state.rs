@@ -1,67 +1,125 @@
-use bimap::BiMap;
-use log::{debug, trace};
+use futures::future;
+use log::trace;
 use std::collections::HashMap;
 use std::ffi::OsString;
 use std::fs::{File, OpenOptions};
+use std::path::{Path, PathBuf};
 use std::sync::{Arc, RwLock};
-use std::thread::sleep;
 use std::time::Duration;
 
 use subprocess::{Popen, PopenConfig};
+use tokio::sync::watch;
 use which::which;
 
 use bh_agent_common::AgentError::{
-    InvalidFileDescriptor, InvalidProcessId, IoError, ProcessStartFailure, Unknown,
+    InvalidArchiveId, InvalidFileDescriptor, InvalidProcessId, InvalidSubscriptionId, IoError,
+    ProcessStartFailure, Unknown,
 };
 use bh_agent_common::{
-    AgentError, FileId, FileOpenMode, FileOpenType, ProcessChannel, ProcessId, Redirection,
-    RemotePOpenConfig,
+    write_archive, AgentError, ArchiveId, FileId, FileOpenMode, FileOpenType, ProcessChannel,
+    ProcessId, Redirection, RemotePOpenConfig, SubscriptionId,
 };
 
+use crate::capture::{Capture, DEFAULT_CAPTURE_LIMIT};
+use crate::handles::HandleTable;
+use crate::reaper::Reaper;
+use crate::subscription::Subscription;
+use crate::unpack::Unpacker;
+
+/// An open file, or one of a process' stdio pipes.
+struct FileEntry {
+    file: RwLock<File>,
+    mode: FileOpenMode,
+    type_: FileOpenType,
+    // The process this is a stdio pipe of
+    process: Option<ProcessId>,
+}
+
+struct ProcessEntry {
+    // What the process was started with, so clients that reattach can describe it
+    config: RemotePOpenConfig,
+    popen: Arc<RwLock<Popen>>,
+    exited: watch::Receiver<bool>,
+    // File IDs of stdin, stdout and stderr, if they are pipes
+    channels: [Option<FileId>; 3],
+    stdout_capture: Option<Arc<Capture>>,
+    stderr_capture: Option<Arc<Capture>>,
+}
+
 // TODO: Someday a simple in-memory key value store might be a good idea
 pub struct BhAgentState {
-    files: RwLock<HashMap<FileId, Arc<RwLock<File>>>>,
-    file_modes: RwLock<HashMap<FileId, FileOpenMode>>,
-    file_types: RwLock<HashMap<FileId, FileOpenType>>,
-    processes: RwLock<HashMap<ProcessId, Arc<RwLock<Popen>>>>,
-    proc_stdin_ids: RwLock<BiMap<ProcessId, FileId>>,
-    proc_stdout_ids: RwLock<BiMap<ProcessId, FileId>>,
-    proc_stderr_ids: RwLock<BiMap<ProcessId, FileId>>,
+    files: HandleTable<Arc<FileEntry>>,
+    processes: HandleTable<Arc<ProcessEntry>>,
+    subscriptions: HandleTable<Arc<Subscription>>,
+    unpackers: HandleTable<Arc<Unpacker>>,
     metadata: RwLock<HashMap<String, String>>,
+    tempdir: PathBuf,
+
+    reaper: Arc<Reaper>,
+}
 
-    next_file_id: RwLock<FileId>,
-    next_process_id: RwLock<ProcessId>,
+fn channel_index(channel: ProcessChannel) -> usize {
+    match channel {
+        ProcessChannel::Stdin => 0,
+        ProcessChannel::Stdout => 1,
+        ProcessChannel::Stderr => 2,
+    }
 }
 
 impl BhAgentState {
-    pub fn new() -> BhAgentState {
+    pub fn new(tempdir: PathBuf) -> BhAgentState {
         Self {
-            files: RwLock::new(HashMap::new()),
-            file_modes: RwLock::new(HashMap::new()),
-            file_types: RwLock::new(HashMap::new()),
-            processes: RwLock::new(HashMap::new()),
-            proc_stdin_ids: RwLock::new(BiMap::new()),
-            proc_stdout_ids: RwLock::new(BiMap::new()),
-            proc_stderr_ids: RwLock::new(BiMap::new()),
+            files: HandleTable::new(),
+            processes: HandleTable::new(),
+            subscriptions: HandleTable::new(),
+            unpackers: HandleTable::new(),
             metadata: RwLock::new(HashMap::new()),
+            tempdir,
+
+            reaper: Reaper::start(),
+        }
+    }
+
+    pub fn tempdir(&self) -> &Path {
+        &self.tempdir
+    }
 
-            next_file_id: RwLock::new(0),
-            next_process_id: RwLock::new(0),
+    /// Kills every process that is still running. Files and captures are released once the last
+    /// reference to the state goes away.
+    pub fn kill_processes(&self) -> Result<(), AgentError> {
+        for proc_id in self.processes.ids()? {
+            if let Some(proc) = self.processes.get(proc_id)? {
+                let mut popen = proc.popen.write()?;
+                if popen.poll().is_none() {
+                    trace!("Killing process {}", proc_id);
+                    let _ = popen.kill();
+                }
+            }
         }
+        Ok(())
+    }
+
+    fn file(&self, fd: &FileId) -> Result<Arc<FileEntry>, AgentError> {
+        self.files.get(*fd)?.ok_or(InvalidFileDescriptor)
     }
 
-    fn take_file_id(&self) -> Result<FileId, AgentError> {
-        let mut next_file_id = self.next_file_id.write()?;
-        let file_id = *next_file_id;
-        *next_file_id += 1;
-        Ok(file_id)
+    fn process(&self, proc_id: &ProcessId) -> Result<Arc<ProcessEntry>, AgentError> {
+        self.processes.get(*proc_id)?.ok_or(InvalidProcessId)
     }
 
-    fn take_proc_id(&self) -> Result<ProcessId, AgentError> {
-        let mut next_process_id = self.next_process_id.write()?;
-        let process_id = *next_process_id;
-        *next_process_id += 1;
-        Ok(process_id)
+    fn insert_file(
+        &self,
+        file: File,
+        mode: FileOpenMode,
+        type_: FileOpenType,
+        process: Option<ProcessId>,
+    ) -> Result<FileId, AgentError> {
+        self.files.insert(Arc::new(FileEntry {
+            file: RwLock::new(file),
+            mode,
+            type_,
+            process,
+        }))
     }
 
     pub fn file_has_any_mode(
@@ -70,21 +128,12 @@ impl BhAgentState {
         modes: &Vec<FileOpenMode>,
     ) -> Result<bool, AgentError> {
         trace!("Checking file {} for modes {:?}", fd, modes);
-        Ok(modes.contains(
-            self.file_modes
-                .read()?
-                .get(fd)
-                .ok_or(InvalidFileDescriptor)?,
-        ))
+        Ok(modes.contains(&self.file(fd)?.mode))
     }
 
     pub fn file_type(&self, fd: &FileId) -> Result<FileOpenType, AgentError> {
         trace!("Getting file type for {}", fd);
-        self.file_types
-            .read()?
-            .get(fd)
-            .ok_or(InvalidFileDescriptor)
-            .map(|t| *t)
+        Ok(self.file(fd)?.type_)
     }
 
     pub fn open_path(
@@ -96,7 +145,7 @@ impl BhAgentState {
         let mut open_opts = OpenOptions::new();
         match mode {
             FileOpenMode::Read => open_opts.read(true),
-            FileOpenMode::Write => open_opts.write(true).create(true),
+            FileOpenMode::Write => open_opts.write(true).create(true).truncate(true),
             FileOpenMode::ExclusiveWrite => open_opts.write(true).create_new(true),
             FileOpenMode::Append => open_opts.append(true),
             FileOpenMode::Update => open_opts.read(true).write(true),
@@ -106,29 +155,19 @@ impl BhAgentState {
             eprintln!("Error opening file: {}", e);
             IoError(e.to_string())
         })?;
-        let file_id = self.take_file_id()?;
-        self.files
-            .write()?
-            .insert(file_id, Arc::new(RwLock::new(file)));
-        self.file_modes.write()?.insert(file_id, mode);
-        self.file_types.write()?.insert(file_id, type_);
-        Ok(file_id)
+        self.insert_file(file, mode, type_, None)
     }
 
     pub fn run_command(&self, config: RemotePOpenConfig) -> Result<ProcessId, AgentError> {
+        let recorded = config.clone();
+        let pipe = |redirection| match redirection {
+            Redirection::None => subprocess::Redirection::None,
+            Redirection::Save | Redirection::Capture => subprocess::Redirection::Pipe,
+        };
         let mut popenconfig = PopenConfig {
-            stdin: match config.stdin {
-                Redirection::None => subprocess::Redirection::None,
-                Redirection::Save => subprocess::Redirection::Pipe,
-            },
-            stdout: match config.stdout {
-                Redirection::None => subprocess::Redirection::None,
-                Redirection::Save => subprocess::Redirection::Pipe,
-            },
-            stderr: match config.stderr {
-                Redirection::None => subprocess::Redirection::None,
-                Redirection::Save => subprocess::Redirection::Pipe,
-            },
+            stdin: pipe(config.stdin),
+            stdout: pipe(config.stdout),
+            stderr: pipe(config.stderr),
             detached: false,
             executable: config
                 .executable
@@ -155,58 +194,71 @@ impl BhAgentState {
                 .map_err(|e| ProcessStartFailure(e.to_string()))?
                 .into_os_string();
         }
-        let proc =
+        let mut proc =
             Popen::create(&argv, popenconfig).map_err(|e| ProcessStartFailure(e.to_string()))?;
 
-        let proc_id = self.take_proc_id()?;
-
-        // Stick the process channels into the file map
-        if proc.stdin.is_some() {
-            trace!("Saving stdin for process {}", proc_id);
-            let file_id = self.take_file_id()?;
-            self.proc_stdin_ids.write()?.insert(proc_id, file_id);
-            self.file_modes
-                .write()?
-                .insert(file_id, FileOpenMode::Write);
-            self.file_types
-                .write()?
-                .insert(file_id, FileOpenType::Binary);
-        } else {
-            trace!("Process {} has no stdin", proc_id);
-        }
-        if proc.stdout.is_some() {
-            trace!("Saving stdout for process {}", proc_id);
-            let file_id = self.take_file_id()?;
-            self.proc_stdout_ids.write()?.insert(proc_id, file_id);
-            self.file_modes.write()?.insert(file_id, FileOpenMode::Read);
-            self.file_types
-                .write()?
-                .insert(file_id, FileOpenType::Binary);
-        } else {
-            trace!("Process {} has no stdout", proc_id);
-        }
-        if proc.stderr.is_some() {
-            trace!("Saving stderr for process {}", proc_id);
-            let file_id = self.take_file_id()?;
-            self.proc_stderr_ids.write()?.insert(proc_id, file_id);
-            self.file_modes.write()?.insert(file_id, FileOpenMode::Read);
-            self.file_types
-                .write()?
-                .insert(file_id, FileOpenType::Binary);
-        } else {
-            trace!("Process {} has no stderr", proc_id);
-        }
+        // The channels are recorded with their process, so its ID is needed up front
+        let proc_id = self.processes.reserve_id();
+
+        // Pipes are moved out of the process into the file table, except captured channels which
+        // are handed to a background reader instead
+        let capture_limit = config.capture_limit.unwrap_or(DEFAULT_CAPTURE_LIMIT);
+        let capture = |file: Option<File>, name: &str| -> Result<_, AgentError> {
+            match file {
+                Some(file) => {
+                    trace!("Capturing {} for process {}", name, proc_id);
+                    Ok(Some(Arc::new(Capture::start(file, capture_limit)?)))
+                }
+                None => Ok(None),
+            }
+        };
+        let stdout_capture = match config.stdout {
+            Redirection::Capture => capture(proc.stdout.take(), "stdout")?,
+            _ => None,
+        };
+        let stderr_capture = match config.stderr {
+            Redirection::Capture => capture(proc.stderr.take(), "stderr")?,
+            _ => None,
+        };
 
-        // Move the proc to the process map
-        self.processes
-            .write()?
-            .insert(proc_id, Arc::new(RwLock::new(proc)));
+        let pipes = [
+            (proc.stdin.take(), FileOpenMode::Write),
+            (proc.stdout.take(), FileOpenMode::Read),
+            (proc.stderr.take(), FileOpenMode::Read),
+        ];
+        let mut channels = [None; 3];
+        for (channel, (pipe, mode)) in channels.iter_mut().zip(pipes) {
+            if let Some(file) = pipe {
+                *channel =
+                    Some(self.insert_file(file, mode, FileOpenType::Binary, Some(proc_id))?);
+            }
+        }
+        trace!("Process {} has channels {:?}", proc_id, channels);
+
+        // Move the proc to the process table, and have the reaper tell us when it exits
+        let popen = Arc::new(RwLock::new(proc));
+        let exited = self.reaper.watch(popen.clone());
+        self.processes.insert_at(
+            proc_id,
+            Arc::new(ProcessEntry {
+                config: recorded,
+                popen,
+                exited,
+                channels,
+                stdout_capture,
+                stderr_capture,
+            }),
+        )?;
 
         Ok(proc_id)
     }
 
     pub fn get_process_ids(&self) -> Result<Vec<ProcessId>, AgentError> {
-        Ok(self.processes.read()?.keys().cloned().collect())
+        self.processes.ids()
+    }
+
+    pub fn get_process_config(&self, proc_id: &ProcessId) -> Result<RemotePOpenConfig, AgentError> {
+        Ok(self.process(proc_id)?.config.clone())
     }
 
     pub fn get_process_channel(
@@ -214,36 +266,21 @@ impl BhAgentState {
         proc_id: &ProcessId,
         channel: ProcessChannel,
     ) -> Result<FileId, AgentError> {
-        let channel_ids = match channel {
-            ProcessChannel::Stdin => &self.proc_stdin_ids,
-            ProcessChannel::Stdout => &self.proc_stdout_ids,
-            ProcessChannel::Stderr => &self.proc_stderr_ids,
-        };
-
-        channel_ids.read()?.get_by_left(proc_id).copied().ok_or({
-            debug!("Failed to get process channel");
-            debug!("Process ID: {}", proc_id);
-            debug!("Channel: {:?}", channel);
-            let proc_is_valid = self.processes.read().unwrap().contains_key(proc_id);
-            debug!("Process is valid: {}", proc_is_valid);
-            debug!(
-                "Process with valid channels: {:?}",
-                channel_ids.read().unwrap().left_values()
-            );
-
+        let fd = self.process(proc_id)?.channels[channel_index(channel)].ok_or_else(|| {
+            trace!("Process {} has no {:?} channel", proc_id, channel);
             InvalidProcessId
-        })
+        })?;
+        // Closed channels are gone from the file table
+        match self.files.get(fd)? {
+            Some(entry) if entry.process == Some(*proc_id) => Ok(fd),
+            _ => Err(InvalidProcessId),
+        }
     }
 
     pub fn process_poll(&self, proc_id: &ProcessId) -> Result<Option<u32>, AgentError> {
         trace!("Polling process {}", proc_id);
-        let proc = self
-            .processes
-            .read()?
-            .get(proc_id)
-            .ok_or(InvalidProcessId)?
-            .clone();
-        let exit_status = proc.write()?.poll();
+        let proc = self.process(proc_id)?;
+        let exit_status = proc.popen.write()?.poll();
         match exit_status {
             None => Ok(None),
             Some(status) => match status {
@@ -255,38 +292,104 @@ impl BhAgentState {
         }
     }
 
-    pub fn process_wait(
+    /// Waits for a process to exit, returning true if the timeout elapsed first. The reaper wakes
+    /// us as soon as the process exits, so no runtime thread is held while waiting.
+    pub async fn process_wait(
         &self,
         proc_id: &ProcessId,
         timeout: Option<u32>,
     ) -> Result<bool, AgentError> {
         trace!("Waiting for process {}", proc_id);
-        // This is implemented as a busy loop to avoid holding the write lock
-        // for too long. Open to suggestions on how to improve this.
-        let mut elapsed = Duration::from_millis(0);
-        loop {
-            match self.process_poll(proc_id)? {
-                None => (),
-                Some(_) => return Ok(false),
+        let mut exited = self.exit_receiver(proc_id)?;
+        let wait = async { exited.wait_for(|exited| *exited).await.map(|_| ()) };
+        match timeout {
+            Some(ms) => match tokio::time::timeout(Duration::from_millis(ms as u64), wait).await {
+                Ok(result) => result.map_err(|_| Unknown)?,
+                Err(_) => return Ok(true),
+            },
+            None => wait.await.map_err(|_| Unknown)?,
+        }
+
+        // Reap the process so its exit code is available
+        self.process_poll(proc_id)?;
+        Ok(false)
+    }
+
+    /// Waits until any, or all, of the processes have exited or the timeout elapses, and returns
+    /// the exit codes of those that have exited.
+    pub async fn process_wait_many(
+        &self,
+        proc_ids: &[ProcessId],
+        all: bool,
+        timeout: Option<u32>,
+    ) -> Result<Vec<(ProcessId, u32)>, AgentError> {
+        trace!("Waiting for processes {:?}, all {}", proc_ids, all);
+        let receivers = proc_ids
+            .iter()
+            .map(|proc_id| Ok((*proc_id, self.exit_receiver(proc_id)?)))
+            .collect::<Result<Vec<_>, AgentError>>()?;
+
+        let waits = receivers.iter().map(|(_, exited)| {
+            let mut exited = exited.clone();
+            Box::pin(async move {
+                let _ = exited.wait_for(|exited| *exited).await;
+            })
+        });
+        let wait = async {
+            if all {
+                future::join_all(waits).await;
+            } else if !receivers.is_empty() {
+                future::select_all(waits).await;
+            }
+        };
+        match timeout {
+            Some(ms) => {
+                let _ = tokio::time::timeout(Duration::from_millis(ms as u64), wait).await;
             }
-            elapsed += Duration::from_millis(100);
-            if elapsed < Duration::from_millis(timeout.unwrap_or(u32::MAX) as u64) {
-                sleep(Duration::from_millis(100));
-            } else {
-                return Ok(true);
+            None => wait.await,
+        }
+
+        let mut exit_codes = Vec::new();
+        for (proc_id, exited) in &receivers {
+            if *exited.borrow() {
+                if let Some(code) = self.process_poll(proc_id)? {
+                    exit_codes.push((*proc_id, code));
+                }
             }
         }
+        Ok(exit_codes)
+    }
+
+    fn exit_receiver(&self, proc_id: &ProcessId) -> Result<watch::Receiver<bool>, AgentError> {
+        Ok(self.process(proc_id)?.exited.clone())
+    }
+
+    pub async fn process_read_capture(
+        &self,
+        proc_id: &ProcessId,
+        channel: ProcessChannel,
+        offset: u64,
+        size: Option<u32>,
+    ) -> Result<Vec<u8>, AgentError> {
+        trace!(
+            "Reading {:?} captured from process {} at offset {}",
+            channel,
+            proc_id,
+            offset
+        );
+        let proc = self.process(proc_id)?;
+        let capture = match channel {
+            ProcessChannel::Stdin => None,
+            ProcessChannel::Stdout => proc.stdout_capture.clone(),
+            ProcessChannel::Stderr => proc.stderr_capture.clone(),
+        };
+        capture.ok_or(InvalidProcessId)?.read(offset, size).await
     }
 
     pub fn process_exit_code(&self, proc_id: &ProcessId) -> Result<Option<u32>, AgentError> {
         trace!("Getting exit code for process {}", proc_id);
-        let proc = self
-            .processes
-            .read()?
-            .get(proc_id)
-            .ok_or(InvalidProcessId)?
-            .clone();
-        let exit_status = proc.read()?.exit_status();
+        let proc = self.process(proc_id)?;
+        let exit_status = proc.popen.read()?.exit_status();
         match exit_status {
             None => Ok(None),
             Some(status) => match status {
@@ -298,82 +401,124 @@ impl BhAgentState {
         }
     }
 
+    /// Closes a file. For a process' stdin this signals end of input to the process. Operations
+    /// already in progress on the file finish first.
     pub fn close_file(&self, fd: &FileId) -> Result<(), AgentError> {
         trace!("Closing file {}", fd);
-        let files_remove = self.files.write()?.remove(fd);
-        if let Some(file) = files_remove {
-            drop(file);
-            return Ok(());
-        }
-        let stdin_remove = self.proc_stdin_ids.write()?.remove_by_right(fd);
-        if let Some((pid, _)) = stdin_remove {
-            let procs_binding = self.processes.read()?;
-            let mut proc_binding = procs_binding.get(&pid).unwrap().write()?;
-            drop(proc_binding.stdin.take());
-            return Ok(());
-        }
-        let stdout_remove = self.proc_stdout_ids.write()?.remove_by_right(fd);
-        if let Some((pid, _)) = stdout_remove {
-            let procs_binding = self.processes.read()?;
-            let mut proc_binding = procs_binding.get(&pid).unwrap().write()?;
-            drop(proc_binding.stdout.take());
-            return Ok(());
-        }
-        let stderr_remove = self.proc_stderr_ids.write()?.remove_by_right(fd);
-        if let Some((pid, _)) = stderr_remove {
-            let procs_binding = self.processes.read()?;
-            let mut proc_binding = procs_binding.get(&pid).unwrap().write()?;
-            drop(proc_binding.stderr.take());
-            return Ok(());
-        }
-        Err(InvalidFileDescriptor)
+        self.files
+            .remove(*fd)?
+            .map(|_| ())
+            .ok_or(InvalidFileDescriptor)
     }
 
     pub fn is_file_closed(&self, fd: &FileId) -> Result<bool, AgentError> {
-        Ok(self.files.read()?.contains_key(fd))
+        Ok(!self.files.contains(*fd)?)
     }
 
+    /// Runs an operation that needs exclusive access to the file, such as one that uses the
+    /// file's cursor.
     pub fn do_mut_operation<R: Sized>(
         &self,
         fd: &FileId,
         op: impl Fn(&mut File) -> R,
     ) -> Result<R, AgentError> {
         trace!("Doing mut operation on file {}", fd);
+        let entry = self.file(fd)?;
+        let mut file = entry.file.write()?;
+        Ok(op(&mut file))
+    }
 
-        // Get file logic
-        if let Some(file_lock) = self.files.read()?.get(fd) {
-            return Ok(op(&mut *file_lock.write()?));
-        } else {
-            trace!("File id map: {:?}", self.files.read()?);
-        }
+    /// Runs an operation that can share the file with others, such as a positional read or write.
+    pub fn do_operation<R: Sized>(
+        &self,
+        fd: &FileId,
+        op: impl Fn(&File) -> R,
+    ) -> Result<R, AgentError> {
+        trace!("Doing operation on file {}", fd);
+        let entry = self.file(fd)?;
+        let file = entry.file.read()?;
+        Ok(op(&file))
+    }
 
-        // If these unwraps fail, the state is bad
-        if let Some(pid) = self.proc_stdin_ids.read()?.get_by_right(fd) {
-            let procs_binding = self.processes.read()?;
-            let mut proc_binding = procs_binding.get(pid).unwrap().write()?;
-            let file = proc_binding.stdin.as_mut().unwrap();
-            return Ok(op(file));
-        } else {
-            trace!("Process stdin id map: {:?}", self.proc_stdin_ids.read()?);
-        }
-        if let Some(pid) = self.proc_stdout_ids.read()?.get_by_right(fd) {
-            let procs_binding = self.processes.read()?;
-            let mut proc_binding = procs_binding.get(pid).unwrap().write()?;
-            let file = proc_binding.stdout.as_mut().unwrap();
-            return Ok(op(file));
-        } else {
-            trace!("Process stdout id map: {:?}", self.proc_stdout_ids.read()?);
+    /// Starts reading a file in the background. The subscription reads a duplicate of the file
+    /// descriptor, so the file stays usable, and in the mode it was in.
+    pub fn subscribe(&self, fd: &FileId, window: u32) -> Result<SubscriptionId, AgentError> {
+        let file = self.do_operation(fd, |file| file.try_clone())??;
+        let subscription = Subscription::start(file, window as usize)?;
+        self.subscriptions.insert(Arc::new(subscription))
+    }
+
+    pub async fn subscription_next(
+        &self,
+        subscription_id: &SubscriptionId,
+    ) -> Result<Option<Vec<u8>>, AgentError> {
+        let subscription = self
+            .subscriptions
+            .get(*subscription_id)?
+            .ok_or(InvalidSubscriptionId)?;
+        let data = subscription.next().await;
+        if !matches!(data, Ok(Some(_))) {
+            self.subscriptions.remove(*subscription_id)?;
         }
-        if let Some(pid) = self.proc_stderr_ids.read()?.get_by_right(fd) {
-            let procs_binding = self.processes.read()?;
-            let mut proc_binding = procs_binding.get(pid).unwrap().write()?;
-            let file = proc_binding.stderr.as_mut().unwrap();
-            return Ok(op(file));
-        } else {
-            trace!("Process stderr id map: {:?}", self.proc_stderr_ids.read()?);
+        Ok(data?)
+    }
+
+    /// Packs a directory into a tar stream in the background, to be read like any other
+    /// subscription.
+    pub fn pack_directory(
+        &self,
+        path: String,
+        compression_level: Option<i32>,
+        window: u32,
+    ) -> Result<SubscriptionId, AgentError> {
+        let path = PathBuf::from(path);
+        if !path.is_dir() {
+            return Err(IoError(format!("{} is not a directory", path.display())));
         }
+        let subscription = Subscription::produce(window as usize, move |out| {
+            write_archive(&path, out, compression_level)
+        })?;
+        self.subscriptions.insert(Arc::new(subscription))
+    }
 
-        Err(InvalidFileDescriptor)
+    /// Starts unpacking a tar stream into a directory as its chunks arrive.
+    pub fn unpack_directory(
+        &self,
+        path: String,
+        compressed: bool,
+    ) -> Result<ArchiveId, AgentError> {
+        let unpacker = Unpacker::start(PathBuf::from(path), compressed)?;
+        self.unpackers.insert(Arc::new(unpacker))
+    }
+
+    pub fn unpack_chunk(
+        &self,
+        archive_id: &ArchiveId,
+        offset: u64,
+        data: Vec<u8>,
+    ) -> Result<(), AgentError> {
+        self.unpacker(archive_id)?.write(offset, data)
+    }
+
+    /// Waits for the rest of the archive to be unpacked and reports whether it all went well.
+    pub fn unpack_finish(&self, archive_id: &ArchiveId) -> Result<(), AgentError> {
+        let unpacker = self
+            .unpackers
+            .remove(*archive_id)?
+            .ok_or(InvalidArchiveId)?;
+        unpacker.finish()
+    }
+
+    fn unpacker(&self, archive_id: &ArchiveId) -> Result<Arc<Unpacker>, AgentError> {
+        self.unpackers.get(*archive_id)?.ok_or(InvalidArchiveId)
+    }
+
+    pub fn cancel_subscription(&self, subscription_id: &SubscriptionId) -> Result<(), AgentError> {
+        self.subscriptions
+            .remove(*subscription_id)?
+            .ok_or(InvalidSubscriptionId)?
+            .cancel();
+        Ok(())
     }
 
     pub fn get_metadata(&self, key: &String) -> Result<Option<String>, AgentError> {
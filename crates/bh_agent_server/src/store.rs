@@ -0,0 +1,404 @@
+use std::collections::HashMap;
+use std::fs::{self, File};
+use std::io::{self, Seek, SeekFrom};
+#[cfg(target_family = "unix")]
+use std::os::unix::fs::{DirBuilderExt, MetadataExt, OpenOptionsExt, PermissionsExt};
+use std::path::{Path, PathBuf};
+use std::sync::atomic::{AtomicU64, Ordering};
+use std::sync::Mutex;
+use std::time::{Duration, Instant};
+
+use futures::future;
+use log::{debug, warn};
+use tokio::sync::watch;
+
+use bh_agent_common::AgentError::{self, HashMismatch, InvalidHash, IoError};
+use bh_agent_common::{hash_file, hash_stream, HashAlgorithm};
+
+// How long claim waits for uploads by other clients before returning what is still pending
+const CLAIM_WAIT: Duration = Duration::from_secs(5);
+// A claim that is neither completed nor released within this long is assumed to belong to a
+// client that went away, and is handed to the next client that asks
+const CLAIM_TIMEOUT: Duration = Duration::from_secs(300);
+
+// Stored objects can be read by anyone who can reach them, but only changed by the agent
+#[cfg(target_family = "unix")]
+const OBJECT_MODE: u32 = 0o644;
+
+// Gives staging files unique names within this agent
+static STAGING_COUNTER: AtomicU64 = AtomicU64::new(0);
+
+/// Files the agent has been sent, kept by the SHA-256 of their contents. The store lives outside
+/// any environment, so it is shared by every environment and connection, and by later agents
+/// using the same directory. Objects are installed without being uploaded again, so the store
+/// directory has to be private to the user running the agent, and is refused otherwise.
+///
+/// Clients claim the hashes they are about to upload, so that when several of them install the
+/// same content at once only one uploads it and the others wait for it.
+pub struct Store {
+    root: PathBuf,
+    claims: Mutex<HashMap<String, Claim>>,
+}
+
+struct Claim {
+    // Dropped when the claim is completed or released, which wakes the clients waiting on it
+    _released: watch::Sender<()>,
+    waiting: watch::Receiver<()>,
+    since: Instant,
+}
+
+impl Claim {
+    fn new() -> Self {
+        let (released, waiting) = watch::channel(());
+        Self {
+            _released: released,
+            waiting,
+            since: Instant::now(),
+        }
+    }
+}
+
+fn staging_name(name: &str) -> String {
+    format!(
+        ".{}.bh-{}-{}",
+        name,
+        std::process::id(),
+        STAGING_COUNTER.fetch_add(1, Ordering::Relaxed)
+    )
+}
+
+fn check_hash(hash: &str) -> Result<(), AgentError> {
+    if hash.len() == 64 && hash.bytes().all(|b| matches!(b, b'0'..=b'9' | b'a'..=b'f')) {
+        Ok(())
+    } else {
+        Err(InvalidHash(hash.to_string()))
+    }
+}
+
+// Whether only this user can change what is in the file or directory
+fn is_private(metadata: &fs::Metadata) -> bool {
+    #[cfg(target_family = "unix")]
+    return metadata.uid() == nix::unistd::getuid().as_raw() && metadata.mode() & 0o022 == 0;
+
+    #[cfg(not(target_family = "unix"))]
+    {
+        let _ = metadata;
+        return true;
+    }
+}
+
+/// Creates the store directory if it doesn't exist yet, and checks that no other user can
+/// add objects to it: it must be a real directory, owned by this user, and not writable by
+/// anyone else.
+fn open_root(root: &Path) -> Result<(), AgentError> {
+    let mut builder = fs::DirBuilder::new();
+    builder.recursive(true);
+    #[cfg(target_family = "unix")]
+    builder.mode(0o700);
+    builder.create(root)?;
+
+    let metadata = fs::symlink_metadata(root)?;
+    if !metadata.is_dir() || !is_private(&metadata) {
+        return Err(IoError(format!(
+            "{} is not a private directory owned by this user",
+            root.display()
+        )));
+    }
+    Ok(())
+}
+
+/// Opens a stored object, if there is one that can be trusted: a regular file, owned by
+/// this user and not writable by anyone else. The checks are made on the open file, so the
+/// object can't be swapped for another one after them.
+fn open_object(root: &Path, hash: &str) -> Result<Option<File>, AgentError> {
+    let mut options = fs::OpenOptions::new();
+    options.read(true);
+    #[cfg(target_family = "unix")]
+    options.custom_flags(nix::libc::O_NOFOLLOW);
+    let file = match options.open(root.join(hash)) {
+        Ok(file) => file,
+        Err(e) if e.kind() == io::ErrorKind::NotFound => return Ok(None),
+        Err(e) => return Err(e.into()),
+    };
+
+    let metadata = file.metadata()?;
+    if !metadata.is_file() || !is_private(&metadata) {
+        warn!("Ignoring {} in the store, it is not a private file", hash);
+        return Ok(None);
+    }
+    Ok(Some(file))
+}
+
+impl Store {
+    pub fn new(root: PathBuf) -> Self {
+        Self {
+            root,
+            claims: Mutex::new(HashMap::new()),
+        }
+    }
+
+    /// The default store, shared by agents run by the same user on this machine. It is in the
+    /// temporary directory, so it is created private to this user, and not used if someone else
+    /// got there first.
+    pub fn default_dir() -> PathBuf {
+        #[cfg(target_family = "unix")]
+        return std::env::temp_dir().join(format!("bh-store-{}", nix::unistd::getuid()));
+
+        #[cfg(not(target_family = "unix"))]
+        return std::env::temp_dir().join("bh-store");
+    }
+
+    fn object(&self, hash: &str) -> PathBuf {
+        self.root.join(hash)
+    }
+
+    /// Splits `hashes` into those the caller should upload, which are claimed for it, and those
+    /// another client is still uploading. Waits a while for such uploads to finish before
+    /// answering, so the pending ones usually only need asking about again if they are large.
+    /// Hashes that are already stored are in neither list.
+    pub async fn claim(
+        &self,
+        hashes: Vec<String>,
+    ) -> Result<(Vec<String>, Vec<String>), AgentError> {
+        for hash in &hashes {
+            check_hash(hash)?;
+        }
+        let deadline = tokio::time::Instant::now() + CLAIM_WAIT;
+        let mut pending = hashes;
+        pending.sort();
+        pending.dedup();
+        let mut claimed = Vec::new();
+        loop {
+            pending = self.unstored(pending).await?;
+            let mut waiting = Vec::new();
+            {
+                let mut claims = self.claims.lock()?;
+                for hash in std::mem::take(&mut pending) {
+                    match claims.get(&hash) {
+                        Some(claim) if claim.since.elapsed() < CLAIM_TIMEOUT => {
+                            waiting.push(claim.waiting.clone());
+                            pending.push(hash);
+                        }
+                        _ => {
+                            claims.insert(hash.clone(), Claim::new());
+                            claimed.push(hash);
+                        }
+                    }
+                }
+            }
+            if waiting.is_empty() || tokio::time::Instant::now() >= deadline {
+                return Ok((claimed, pending));
+            }
+            // Any claim being completed or released is worth another look
+            let released = waiting.iter_mut().map(|w| Box::pin(w.changed()));
+            let _ = tokio::time::timeout_at(deadline, future::select_all(released)).await;
+        }
+    }
+
+    // Filters out the hashes that are already stored. This touches the filesystem, so it runs on
+    // the blocking pool.
+    async fn unstored(&self, hashes: Vec<String>) -> Result<Vec<String>, AgentError> {
+        let root = self.root.clone();
+        tokio::task::spawn_blocking(move || {
+            open_root(&root)?;
+            let mut unstored = Vec::new();
+            for hash in hashes {
+                if open_object(&root, &hash)?.is_none() {
+                    unstored.push(hash);
+                }
+            }
+            Ok(unstored)
+        })
+        .await
+        .map_err(|_| AgentError::Unknown)?
+    }
+
+    /// Gives up claims without adding anything, so other clients can upload the content instead.
+    pub fn release(&self, hashes: &[String]) -> Result<(), AgentError> {
+        let mut claims = self.claims.lock()?;
+        for hash in hashes {
+            claims.remove(hash);
+        }
+        Ok(())
+    }
+
+    /// Moves an uploaded file into the store, if its contents match `hash`, and completes the
+    /// claim on it. The file is removed either way.
+    pub fn add(&self, hash: &str, path: &Path) -> Result<(), AgentError> {
+        let result = self.add_object(hash, path);
+        if result.is_err() {
+            let _ = fs::remove_file(path);
+        }
+        self.release(&[hash.to_string()])?;
+        result
+    }
+
+    fn add_object(&self, hash: &str, path: &Path) -> Result<(), AgentError> {
+        check_hash(hash)?;
+        if hash_file(path, HashAlgorithm::Sha256, None)? != hash {
+            return Err(HashMismatch(hash.to_string()));
+        }
+        open_root(&self.root)?;
+        #[cfg(target_family = "unix")]
+        fs::set_permissions(path, fs::Permissions::from_mode(OBJECT_MODE))?;
+        let object = self.object(hash);
+        if fs::rename(path, &object).is_err() {
+            // Most likely on another filesystem, so copy it across and then move it into place
+            let staging = self.root.join(staging_name(hash));
+            fs::copy(path, &staging)?;
+            if let Err(e) = fs::rename(&staging, &object) {
+                let _ = fs::remove_file(&staging);
+                return Err(e.into());
+            }
+            let _ = fs::remove_file(path);
+        }
+        debug!("Stored {}", hash);
+        Ok(())
+    }
+
+    /// Copies a stored file to `dst`. The copy is written next to `dst` and renamed over it, so
+    /// processes running or reading the file that was there before are unaffected, and `dst`
+    /// never holds a partial copy. The stored file is hashed again first, so a damaged or
+    /// tampered object is dropped from the store rather than installed.
+    pub fn install(&self, hash: &str, dst: &Path, mode: Option<u32>) -> Result<(), AgentError> {
+        check_hash(hash)?;
+        open_root(&self.root)?;
+        let mut object = open_object(&self.root, hash)?
+            .ok_or_else(|| IoError(format!("{} is not in the store", hash)))?;
+        if hash_stream(&mut object, HashAlgorithm::Sha256)? != hash {
+            warn!("Removing {} from the store, its contents don't match", hash);
+            let _ = fs::remove_file(self.object(hash));
+            return Err(HashMismatch(hash.to_string()));
+        }
+        object.seek(SeekFrom::Start(0))?;
+        let name = dst
+            .file_name()
+            .ok_or_else(|| IoError(format!("{} is not a file path", dst.display())))?;
+        let staging = dst.with_file_name(staging_name(&name.to_string_lossy()));
+        let result = (|| {
+            io::copy(&mut object, &mut File::create(&staging)?)?;
+            #[cfg(target_family = "unix")]
+            if let Some(mode) = mode {
+                fs::set_permissions(&staging, fs::Permissions::from_mode(mode))?;
+            }
+            fs::rename(&staging, dst)
+        })();
+        if let Err(e) = result {
+            if let Err(e) = fs::remove_file(&staging) {
+                if e.kind() != io::ErrorKind::NotFound {
+                    warn!("Failed to remove {}: {}", staging.display(), e);
+                }
+            }
+            return Err(e.into());
+        }
+        Ok(())
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use std::sync::Arc;
+
+    use super::*;
+
+    fn scratch(name: &str) -> PathBuf {
+        let dir =
+            std::env::temp_dir().join(format!("bh-store-test-{}-{}", std::process::id(), name));
+        let _ = fs::remove_dir_all(&dir);
+        fs::create_dir_all(&dir).unwrap();
+        dir
+    }
+
+    #[tokio::test(flavor = "multi_thread")]
+    async fn concurrent_claims_upload_once() {
+        let dir = scratch("claims");
+        let store = Arc::new(Store::new(dir.join("store")));
+        let upload = dir.join("upload");
+        fs::write(&upload, b"contents").unwrap();
+        let hash = hash_file(&upload, HashAlgorithm::Sha256, None).unwrap();
+
+        let (claimed, pending) = store.claim(vec![hash.clone(), hash.clone()]).await.unwrap();
+        assert_eq!(claimed, vec![hash.clone()]);
+        assert!(pending.is_empty());
+
+        // A second client waits for the first to finish its upload, and then has nothing to do
+        let second = tokio::spawn({
+            let store = store.clone();
+            let hash = hash.clone();
+            async move { store.claim(vec![hash]).await }
+        });
+        tokio::time::sleep(Duration::from_millis(50)).await;
+        store.add(&hash, &upload).unwrap();
+        let (claimed, pending) = second.await.unwrap().unwrap();
+        assert!(claimed.is_empty() && pending.is_empty());
+        assert!(!upload.exists());
+
+        let installed = dir.join("installed");
+        store.install(&hash, &installed, Some(0o750)).unwrap();
+        store.install(&hash, &installed, Some(0o750)).unwrap();
+        assert_eq!(fs::read(&installed).unwrap(), b"contents");
+        #[cfg(target_family = "unix")]
+        assert_eq!(
+            fs::metadata(&installed).unwrap().permissions().mode() & 0o777,
+            0o750
+        );
+        assert_eq!(fs::read_dir(&dir).unwrap().count(), 2);
+        fs::remove_dir_all(dir).unwrap();
+    }
+
+    #[tokio::test(flavor = "multi_thread")]
+    async fn rejects_bad_hashes_and_contents() {
+        let dir = scratch("bad");
+        let store = Store::new(dir.join("store"));
+        assert!(matches!(
+            store.claim(vec!["../etc/passwd".into()]).await,
+            Err(InvalidHash(_))
+        ));
+
+        let upload = dir.join("upload");
+        fs::write(&upload, b"contents").unwrap();
+        let wrong = "0".repeat(64);
+        store.claim(vec![wrong.clone()]).await.unwrap();
+        assert!(matches!(store.add(&wrong, &upload), Err(HashMismatch(_))));
+        // The failed upload gave up the claim
+        let (claimed, _) = store.claim(vec![wrong]).await.unwrap();
+        assert_eq!(claimed.len(), 1);
+        fs::remove_dir_all(dir).unwrap();
+    }
+
+    #[tokio::test(flavor = "multi_thread")]
+    async fn does_not_trust_tampered_objects() {
+        let dir = scratch("tampered");
+        let store = Store::new(dir.join("store"));
+        let upload = dir.join("upload");
+        fs::write(&upload, b"contents").unwrap();
+        let hash = hash_file(&upload, HashAlgorithm::Sha256, None).unwrap();
+        store.claim(vec![hash.clone()]).await.unwrap();
+        store.add(&hash, &upload).unwrap();
+
+        // Changed after it was stored, so it is dropped rather than installed
+        fs::write(dir.join("store").join(&hash), b"tampered").unwrap();
+        let installed = dir.join("installed");
+        assert!(matches!(
+            store.install(&hash, &installed, None),
+            Err(HashMismatch(_))
+        ));
+        assert!(!installed.exists());
+        let (claimed, _) = store.claim(vec![hash]).await.unwrap();
+        assert_eq!(claimed.len(), 1);
+
+        // A store directory other users can write to is refused
+        #[cfg(target_family = "unix")]
+        {
+            let shared = dir.join("shared");
+            fs::create_dir(&shared).unwrap();
+            fs::set_permissions(&shared, fs::Permissions::from_mode(0o777)).unwrap();
+            let store = Store::new(shared);
+            assert!(matches!(
+                store.claim(vec!["0".repeat(64)]).await,
+                Err(IoError(_))
+            ));
+        }
+        fs::remove_dir_all(dir).unwrap();
+    }
+}
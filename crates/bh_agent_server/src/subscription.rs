@@ -0,0 +1,205 @@
+use std::fs::File;
+use std::io::{self, Read, Write};
+#[cfg(target_family = "unix")]
+use std::os::unix::io::AsRawFd;
+#[cfg(target_family = "unix")]
+use std::os::unix::net::UnixStream;
+use std::thread;
+
+use log::{trace, warn};
+use tokio::sync::{mpsc, Mutex};
+
+use bh_agent_common::ChunkWriter;
+
+// Chunks are read as they are produced, so they're usually much smaller than this. It only bounds
+// how much a single read can pull out of the file.
+const READ_SIZE: usize = 64 * 1024;
+// subscription_next returns everything queued, up to this much
+const MAX_BATCH: usize = 4 * 1024 * 1024;
+
+/// A file that is read in the background, or a stream produced in the background, with the data
+/// queued for the client.
+pub struct Subscription {
+    queue: Mutex<Queue>,
+    // The reader thread waits on the other end of this as well as the file, and stops once this
+    // end is closed
+    #[cfg(target_family = "unix")]
+    stop: std::sync::Mutex<Option<UnixStream>>,
+}
+
+struct Queue {
+    receiver: mpsc::Receiver<io::Result<Vec<u8>>>,
+    // An error that ended the stream after data that was already returned
+    error: Option<io::Error>,
+}
+
+/// Waits until `file` can be read or `stop` is closed, and returns whether the file can be read.
+/// The reader polls rather than switching the file to blocking mode, because the flag would
+/// change for the original descriptor too.
+#[cfg(target_family = "unix")]
+fn wait_readable(file: &File, stop: &UnixStream) -> io::Result<bool> {
+    use nix::libc::{nfds_t, poll, pollfd, POLLIN};
+
+    let mut fds = [
+        pollfd {
+            fd: file.as_raw_fd(),
+            events: POLLIN,
+            revents: 0,
+        },
+        pollfd {
+            fd: stop.as_raw_fd(),
+            events: POLLIN,
+            revents: 0,
+        },
+    ];
+    while unsafe { poll(fds.as_mut_ptr(), fds.len() as nfds_t, -1) } < 0 {
+        let e = io::Error::last_os_error();
+        if e.kind() != io::ErrorKind::Interrupted {
+            return Err(e);
+        }
+    }
+    Ok(fds[1].revents == 0)
+}
+
+impl Subscription {
+    /// Starts reading `file` on a dedicated thread, queueing up to `window` chunks. The thread
+    /// blocks when the queue is full, and exits at end of file, once the subscription is
+    /// cancelled, or once it is dropped and the queue fills up.
+    pub fn start(mut file: File, window: usize) -> io::Result<Subscription> {
+        let (sender, receiver) = mpsc::channel(window.max(1));
+        #[cfg(target_family = "unix")]
+        let (stop, stopped) = UnixStream::pair()?;
+        thread::Builder::new()
+            .name("bh-subscription".into())
+            .spawn(move || {
+                let mut buf = vec![0u8; READ_SIZE];
+                loop {
+                    #[cfg(target_family = "unix")]
+                    match wait_readable(&file, &stopped) {
+                        Ok(true) => {}
+                        Ok(false) => break,
+                        Err(e) => {
+                            warn!("Subscription poll failed: {}", e);
+                            break;
+                        }
+                    }
+                    let n = match file.read(&mut buf) {
+                        Ok(0) => break,
+                        Ok(n) => n,
+                        Err(e)
+                            if matches!(
+                                e.kind(),
+                                io::ErrorKind::Interrupted | io::ErrorKind::WouldBlock
+                            ) =>
+                        {
+                            continue
+                        }
+                        Err(e) => {
+                            warn!("Subscription read failed: {}", e);
+                            break;
+                        }
+                    };
+                    if sender.blocking_send(Ok(buf[..n].to_vec())).is_err() {
+                        break;
+                    }
+                }
+                trace!("Subscription reader finished");
+            })?;
+        Ok(Subscription {
+            #[cfg(target_family = "unix")]
+            stop: std::sync::Mutex::new(Some(stop)),
+            ..Subscription::new(receiver)
+        })
+    }
+
+    /// Runs `produce` on a dedicated thread, queueing what it writes in chunks, up to `window` of
+    /// them. Writes block when the queue is full, and fail once the subscription is dropped. If
+    /// `produce` fails, the client gets the error after the data written before it.
+    pub fn produce<F>(window: usize, produce: F) -> io::Result<Subscription>
+    where
+        F: FnOnce(&mut dyn Write) -> io::Result<()> + Send + 'static,
+    {
+        let (sender, receiver) = mpsc::channel(window.max(1));
+        thread::Builder::new()
+            .name("bh-producer".into())
+            .spawn(move || {
+                let mut out = ChunkWriter::new(READ_SIZE, |chunk| {
+                    sender
+                        .blocking_send(Ok(chunk))
+                        .map_err(|_| io::Error::from(io::ErrorKind::BrokenPipe))
+                });
+                let result = produce(&mut out).and_then(|_| out.flush());
+                drop(out);
+                if let Err(e) = result {
+                    warn!("Subscription producer failed: {}", e);
+                    let _ = sender.blocking_send(Err(e));
+                }
+                trace!("Subscription producer finished");
+            })?;
+        Ok(Subscription::new(receiver))
+    }
+
+    fn new(receiver: mpsc::Receiver<io::Result<Vec<u8>>>) -> Subscription {
+        Subscription {
+            queue: Mutex::new(Queue {
+                receiver,
+                error: None,
+            }),
+            #[cfg(target_family = "unix")]
+            stop: std::sync::Mutex::new(None),
+        }
+    }
+
+    /// Waits for data and returns everything queued, or None once the stream is exhausted.
+    pub async fn next(&self) -> io::Result<Option<Vec<u8>>> {
+        let mut queue = self.queue.lock().await;
+        if let Some(e) = queue.error.take() {
+            return Err(e);
+        }
+        let mut data = match queue.receiver.recv().await {
+            Some(chunk) => chunk?,
+            None => return Ok(None),
+        };
+        while data.len() < MAX_BATCH {
+            match queue.receiver.try_recv() {
+                Ok(Ok(chunk)) => data.extend_from_slice(&chunk),
+                Ok(Err(e)) => {
+                    queue.error = Some(e);
+                    break;
+                }
+                Err(_) => break,
+            }
+        }
+        Ok(Some(data))
+    }
+
+    /// Stops the reader thread of a file, even if it is waiting for data. A pending next returns
+    /// what was already queued, and then None. A producer stops once the subscription is dropped.
+    pub fn cancel(&self) {
+        #[cfg(target_family = "unix")]
+        if let Ok(mut stop) = self.stop.lock() {
+            stop.take();
+        }
+    }
+}
+
+#[cfg(all(test, target_family = "unix"))]
+mod tests {
+    use super::*;
+    use std::os::fd::OwnedFd;
+
+    #[tokio::test(flavor = "multi_thread")]
+    async fn cancel_stops_a_waiting_reader() {
+        let (mut ours, theirs) = UnixStream::pair().unwrap();
+        theirs.set_nonblocking(true).unwrap();
+        let file = File::from(OwnedFd::from(theirs.try_clone().unwrap()));
+        let subscription = Subscription::start(file, 4).unwrap();
+
+        ours.write_all(b"data").unwrap();
+        assert_eq!(subscription.next().await.unwrap(), Some(b"data".to_vec()));
+        // Nothing more is written, but cancelling still ends the subscription
+        subscription.cancel();
+        assert_eq!(subscription.next().await.unwrap(), None);
+        assert!(!crate::util::is_blocking(&theirs).unwrap());
+    }
+}
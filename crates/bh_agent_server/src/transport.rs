@@ -0,0 +1,230 @@
+use std::io;
+use std::path::PathBuf;
+use std::sync::Arc;
+
+use futures::{future, prelude::*};
+use log::{debug, warn};
+use tarpc::serde_transport;
+use tarpc::server::{BaseChannel, Channel};
+use tarpc::tokio_serde::formats::{Bincode, Json};
+use tarpc::{ClientMessage, Response, Transport};
+use tokio::io::{AsyncRead, AsyncWrite};
+use tokio::net::TcpStream;
+#[cfg(target_family = "unix")]
+use tokio::net::UnixStream;
+use tokio::sync::{OwnedSemaphorePermit, Semaphore};
+
+use bh_agent_common::{
+    framed, is_handshake, server_handshake, server_refuse_handshake, AgentMetrics, BhAgentService,
+    BhAgentServiceRequest, BhAgentServiceResponse, Compressed, Compression, WireCodec,
+};
+
+use crate::environments::Environments;
+use crate::metrics::{Limits, Metrics};
+use crate::store::Store;
+use crate::BhAgentServer;
+
+/// Everything shared by the connections to one agent: its environments, the store of files it has
+/// been sent, the limits on how much work it takes on, and the counters reporting how busy it is.
+#[derive(Clone)]
+pub struct Agent {
+    environments: Arc<Environments>,
+    store: Arc<Store>,
+    limits: Limits,
+    // How frames are compressed for clients that ask for it, or None to refuse compression
+    compression: Option<Compression>,
+    connections: Arc<Semaphore>,
+    metrics: Arc<Metrics>,
+}
+
+/// Works out which codec a freshly accepted connection speaks, and whether it compresses frames.
+/// Clients that don't send a handshake are assumed to speak uncompressed JSON.
+async fn negotiate_tcp(
+    stream: &mut TcpStream,
+    allow_compression: bool,
+) -> io::Result<(WireCodec, bool)> {
+    let mut first = [0u8; 1];
+    if stream.peek(&mut first).await? == 0 {
+        return Err(io::ErrorKind::UnexpectedEof.into());
+    }
+    if is_handshake(first[0]) {
+        server_handshake(stream, allow_compression).await
+    } else {
+        Ok((WireCodec::Json, false))
+    }
+}
+
+impl Agent {
+    /// Creates an agent with just the default environment. Must be called from within a tokio
+    /// runtime.
+    pub fn new(limits: Limits) -> Self {
+        Self {
+            environments: Arc::new(Environments::new()),
+            store: Arc::new(Store::new(Store::default_dir())),
+            limits,
+            compression: Some(Compression::default()),
+            connections: Arc::new(Semaphore::new(limits.max_connections)),
+            metrics: Arc::new(Metrics::default()),
+        }
+    }
+
+    /// Sets how frames are compressed for clients that ask for compression. With None, clients
+    /// are always served uncompressed.
+    pub fn with_compression(mut self, compression: Option<Compression>) -> Self {
+        self.compression = compression;
+        self
+    }
+
+    /// Keeps the store of files sent to the agent in `dir` rather than the default location.
+    pub fn with_store_dir(mut self, dir: PathBuf) -> Self {
+        self.store = Arc::new(Store::new(dir));
+        self
+    }
+
+    pub fn metrics(&self) -> AgentMetrics {
+        self.metrics.snapshot(&self.limits)
+    }
+
+    pub(crate) fn environments(&self) -> &Environments {
+        &self.environments
+    }
+
+    pub(crate) fn store(&self) -> &Arc<Store> {
+        &self.store
+    }
+
+    /// Serves a single accepted TCP connection until the client hangs up. If the agent is already
+    /// serving as many connections as it allows, the client is told so and disconnected.
+    pub async fn serve_tcp(self, mut stream: TcpStream) {
+        let peer = match stream.peer_addr() {
+            Ok(addr) => addr.to_string(),
+            Err(e) => {
+                warn!("Dropping connection without a peer address: {}", e);
+                return;
+            }
+        };
+        let _ = stream.set_nodelay(true);
+
+        let _permit = match self.admit(&peer) {
+            Some(permit) => permit,
+            None => {
+                self.refuse(&mut stream).await;
+                return;
+            }
+        };
+
+        let (codec, compressed) = match negotiate_tcp(&mut stream, self.compression.is_some()).await
+        {
+            Ok(negotiated) => negotiated,
+            Err(e) => {
+                warn!("Handshake with {} failed: {}", peer, e);
+                return;
+            }
+        };
+        debug!(
+            "Serving {} using the {} codec, compressed: {}",
+            peer, codec, compressed
+        );
+
+        let server = BhAgentServer::new(peer, self.clone());
+        self.serve(stream, codec, compressed, server).await
+    }
+
+    /// Serves a connection over a socket inherited from the process that started the agent, until
+    /// that process hangs up. Such clients always handshake, and the agent's reply to the
+    /// handshake is what tells them it is ready.
+    #[cfg(target_family = "unix")]
+    pub async fn serve_unix(self, mut stream: UnixStream, peer: String) {
+        let _permit = match self.admit(&peer) {
+            Some(permit) => permit,
+            None => {
+                let _ = server_refuse_handshake(&mut stream).await;
+                return;
+            }
+        };
+
+        let (codec, compressed) =
+            match server_handshake(&mut stream, self.compression.is_some()).await {
+                Ok(negotiated) => negotiated,
+                Err(e) => {
+                    warn!("Handshake with {} failed: {}", peer, e);
+                    return;
+                }
+            };
+        debug!(
+            "Serving {} using the {} codec, compressed: {}",
+            peer, codec, compressed
+        );
+
+        let server = BhAgentServer::new(peer, self.clone());
+        self.serve(stream, codec, compressed, server).await
+    }
+
+    /// Takes one of the agent's connection slots for the lifetime of the returned permit, or
+    /// counts the connection as rejected if they are all in use.
+    fn admit(&self, peer: &str) -> Option<OwnedSemaphorePermit> {
+        match self.connections.clone().try_acquire_owned() {
+            Ok(permit) => Some(permit),
+            Err(_) => {
+                self.metrics.reject_connection();
+                warn!(
+                    "Refusing {}, already serving {} connections",
+                    peer, self.limits.max_connections
+                );
+                None
+            }
+        }
+    }
+
+    /// Tells a client the agent is busy. Clients that predate the handshake have no way to be
+    /// told, so they are just disconnected.
+    async fn refuse(&self, stream: &mut TcpStream) {
+        let mut first = [0u8; 1];
+        if matches!(stream.peek(&mut first).await, Ok(1) if is_handshake(first[0])) {
+            let _ = server_refuse_handshake(stream).await;
+        }
+    }
+
+    /// Serves the agent protocol over a stream that has already completed the handshake.
+    pub async fn serve<S>(&self, io: S, codec: WireCodec, compressed: bool, server: BhAgentServer)
+    where
+        S: AsyncRead + AsyncWrite + Send + 'static,
+    {
+        let _connection = self.metrics.connection();
+        let compression = if compressed { self.compression } else { None };
+        match codec {
+            WireCodec::Json => {
+                let codec = Compressed::new(Json::default(), compression);
+                self.execute(serde_transport::new(framed(io), codec), server)
+                    .await
+            }
+            WireCodec::Bincode => {
+                let codec = Compressed::new(Bincode::default(), compression);
+                self.execute(serde_transport::new(framed(io), codec), server)
+                    .await
+            }
+        }
+    }
+
+    async fn execute<T>(&self, transport: T, server: BhAgentServer)
+    where
+        T: Transport<Response<BhAgentServiceResponse>, ClientMessage<BhAgentServiceRequest>>
+            + Send
+            + 'static,
+    {
+        // Requests over the in-flight limit are answered with a throttling error by tarpc, so a
+        // client flooding the agent finds out right away instead of piling up work.
+        BaseChannel::with_defaults(transport)
+            .max_concurrent_requests(self.limits.max_in_flight)
+            .execute(server.serve())
+            .for_each(|response| {
+                let request = self.metrics.request();
+                tokio::spawn(async move {
+                    response.await;
+                    drop(request);
+                });
+                future::ready(())
+            })
+            .await
+    }
+}
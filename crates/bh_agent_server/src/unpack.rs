@@ -0,0 +1,145 @@
+use std::collections::BTreeMap;
+use std::io;
+use std::path::PathBuf;
+use std::sync::mpsc::{self, SyncSender};
+use std::sync::Mutex;
+use std::thread::{self, JoinHandle};
+
+use log::trace;
+
+use bh_agent_common::AgentError::{self, InvalidArchiveId, IoError, Unknown};
+use bh_agent_common::{read_archive, ChunkReader};
+
+// How many chunks can be queued ahead of the thread unpacking them before writes block
+const WINDOW: usize = 8;
+
+/// A tar stream that is unpacked into a directory on a dedicated thread as its chunks arrive.
+/// Clients keep several chunks in flight, possibly over different connections, so chunks are put
+/// back in order by their offset before they are unpacked.
+pub struct Unpacker {
+    reorder: Mutex<Reorder>,
+    thread: Mutex<Option<JoinHandle<io::Result<()>>>>,
+}
+
+struct Reorder {
+    // Offset of the next chunk the unpacking thread needs
+    next: u64,
+    pending: BTreeMap<u64, Vec<u8>>,
+    // Dropped once the archive is complete, which ends the stream
+    sender: Option<SyncSender<Vec<u8>>>,
+}
+
+impl Unpacker {
+    pub fn start(dir: PathBuf, compressed: bool) -> io::Result<Unpacker> {
+        let (sender, receiver) = mpsc::sync_channel(WINDOW);
+        let thread = thread::Builder::new()
+            .name("bh-unpack".into())
+            .spawn(move || {
+                let result = read_archive(
+                    ChunkReader::new(move || receiver.recv().ok()),
+                    &dir,
+                    compressed,
+                );
+                trace!("Unpacked {}: {:?}", dir.display(), result);
+                result
+            })?;
+        Ok(Unpacker {
+            reorder: Mutex::new(Reorder {
+                next: 0,
+                pending: BTreeMap::new(),
+                sender: Some(sender),
+            }),
+            thread: Mutex::new(Some(thread)),
+        })
+    }
+
+    /// Adds the chunk at `offset`, handing it and any chunks queued behind it to the unpacking
+    /// thread. Blocks while that thread is behind.
+    pub fn write(&self, offset: u64, data: Vec<u8>) -> Result<(), AgentError> {
+        let mut reorder = self.reorder.lock()?;
+        reorder.pending.insert(offset, data);
+        loop {
+            let next = reorder.next;
+            let data = match reorder.pending.remove(&next) {
+                Some(data) => data,
+                None => return Ok(()),
+            };
+            reorder.next += data.len() as u64;
+            let sender = reorder.sender.as_ref().ok_or(InvalidArchiveId)?;
+            if sender.send(data).is_err() {
+                // The thread has given up, finish reports why
+                return Err(IoError("Unpacking stopped".into()));
+            }
+        }
+    }
+
+    /// Ends the stream and waits for the thread to unpack the rest of it.
+    pub fn finish(&self) -> Result<(), AgentError> {
+        let incomplete = {
+            let mut reorder = self.reorder.lock()?;
+            reorder.sender = None;
+            !reorder.pending.is_empty()
+        };
+        let thread = self.thread.lock()?.take().ok_or(InvalidArchiveId)?;
+        thread.join().map_err(|_| Unknown)??;
+        if incomplete {
+            return Err(IoError("Archive is missing data".into()));
+        }
+        Ok(())
+    }
+}
+
+impl Drop for Unpacker {
+    fn drop(&mut self) {
+        // An abandoned upload ends the stream, so the thread doesn't wait for chunks forever
+        if let Ok(reorder) = self.reorder.get_mut() {
+            reorder.sender = None;
+        }
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use std::fs;
+
+    use bh_agent_common::{write_archive, ChunkWriter};
+
+    use super::*;
+
+    #[test]
+    fn unpacks_chunks_received_out_of_order() {
+        let base = std::env::temp_dir().join(format!("bh-unpack-{}", std::process::id()));
+        let src = base.join("src");
+        let dst = base.join("dst");
+        let _ = fs::remove_dir_all(&base);
+        fs::create_dir_all(src.join("nested")).unwrap();
+        for i in 0..20 {
+            fs::write(src.join("nested").join(i.to_string()), vec![i as u8; 1000]).unwrap();
+        }
+
+        let (sender, receiver) = mpsc::channel();
+        let mut offset = 0u64;
+        let out = ChunkWriter::new(512, |chunk: Vec<u8>| {
+            let len = chunk.len() as u64;
+            sender.send((offset, chunk)).unwrap();
+            offset += len;
+            Ok(())
+        });
+        write_archive(&src, out, None).unwrap();
+        let mut chunks: Vec<_> = receiver.try_iter().collect();
+        chunks.reverse();
+
+        let unpacker = Unpacker::start(dst.clone(), false).unwrap();
+        for (offset, chunk) in chunks {
+            unpacker.write(offset, chunk).unwrap();
+        }
+        unpacker.finish().unwrap();
+        for i in 0..20 {
+            assert_eq!(
+                fs::read(dst.join("nested").join(i.to_string())).unwrap(),
+                vec![i as u8; 1000]
+            );
+        }
+        fs::remove_dir_all(base).unwrap();
+    }
+}
@@ -0,0 +1,188 @@
+use std::collections::hash_map::RandomState;
+use std::fs;
+use std::hash::{BuildHasher, Hasher};
+use std::io;
+use std::path::{Path, PathBuf};
+
+use bh_agent_common::{AgentError, FileStat, StatColumns};
+
+// mktemp gives up after this many names turn out to be taken
+const MKTEMP_ATTEMPTS: u32 = 100;
+
+pub fn mkdir(path: String, parents: bool, exist_ok: bool) -> Result<(), AgentError> {
+    let path = Path::new(&path);
+    let result = if parents {
+        fs::create_dir_all(path)
+    } else {
+        fs::create_dir(path)
+    };
+    match result {
+        Err(e) if e.kind() == io::ErrorKind::AlreadyExists && exist_ok && path.is_dir() => Ok(()),
+        result => Ok(result?),
+    }
+}
+
+/// Removes a file, symlink or empty directory, or with `recursive`, a directory and everything in
+/// it. Symlinks are removed rather than followed.
+pub fn remove(path: String, recursive: bool) -> Result<(), AgentError> {
+    let path = Path::new(&path);
+    if fs::symlink_metadata(path)?.is_dir() {
+        if recursive {
+            fs::remove_dir_all(path)?;
+        } else {
+            fs::remove_dir(path)?;
+        }
+    } else {
+        fs::remove_file(path)?;
+    }
+    Ok(())
+}
+
+pub fn rename(src: String, dst: String) -> Result<(), AgentError> {
+    Ok(fs::rename(src, dst)?)
+}
+
+#[cfg(target_family = "unix")]
+pub fn symlink(target: String, link: String) -> Result<(), AgentError> {
+    Ok(std::os::unix::fs::symlink(target, link)?)
+}
+
+/// Creates a file or directory with a fresh name in `dir`, like mktemp, and returns its path.
+pub fn mktemp(dir: &Path, directory: bool) -> Result<String, AgentError> {
+    let random = RandomState::new();
+    for attempt in 0..MKTEMP_ATTEMPTS {
+        let mut hasher = random.build_hasher();
+        hasher.write_u32(attempt);
+        let path = dir.join(format!("tmp.{:016x}", hasher.finish()));
+        let created = if directory {
+            fs::create_dir(&path)
+        } else {
+            fs::OpenOptions::new()
+                .write(true)
+                .create_new(true)
+                .open(&path)
+                .map(|_| ())
+        };
+        match created {
+            Ok(()) => return Ok(path.to_string_lossy().into_owned()),
+            Err(e) if e.kind() == io::ErrorKind::AlreadyExists => continue,
+            Err(e) => return Err(e.into()),
+        }
+    }
+    Err(io::Error::from(io::ErrorKind::AlreadyExists).into())
+}
+
+/// Lists the names of the entries in a directory, in no particular order.
+pub fn listdir(path: String) -> Result<Vec<String>, AgentError> {
+    fs::read_dir(path)?
+        .map(|entry| Ok(entry?.file_name().to_string_lossy().into_owned()))
+        .collect()
+}
+
+/// Stats each path, following symlinks. Paths that can't be stat'ed are reported in the errors
+/// column rather than failing the rest.
+pub fn stat_many(paths: Vec<String>) -> StatColumns {
+    let mut columns = StatColumns::default();
+    for path in paths {
+        match fs::metadata(path) {
+            Ok(metadata) => columns.push(&FileStat::from(&metadata)),
+            Err(e) => columns.push_error(e.to_string()),
+        }
+    }
+    columns
+}
+
+/// Stats everything under `root` without following symlinks, listing each directory before what
+/// is in it. With `max_depth`, only entries up to that many levels down are included, 1 being
+/// the entries of `root` itself. A directory that can't be read is included, but its contents
+/// are not.
+pub fn walk(root: String, max_depth: Option<u32>) -> Result<StatColumns, AgentError> {
+    let root = PathBuf::from(root);
+    let mut columns = StatColumns::default();
+    let mut dirs = vec![(PathBuf::new(), 1)];
+    while let Some((dir, depth)) = dirs.pop() {
+        let entries = match fs::read_dir(root.join(&dir)) {
+            Ok(entries) => entries,
+            Err(e) if dir.as_os_str().is_empty() => return Err(e.into()),
+            Err(_) => continue,
+        };
+        for entry in entries.flatten() {
+            let path = dir.join(entry.file_name());
+            // The entry's own metadata, so symlinks aren't followed
+            match entry.metadata() {
+                Ok(metadata) => {
+                    if metadata.is_dir() && max_depth.map_or(true, |max| depth < max) {
+                        dirs.push((path.clone(), depth + 1));
+                    }
+                    columns.push(&FileStat::from(&metadata));
+                }
+                Err(e) => columns.push_error(e.to_string()),
+            }
+            columns.paths.push(path.to_string_lossy().into_owned());
+        }
+    }
+    Ok(columns)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn create_list_and_remove() {
+        let dir = mktemp(&std::env::temp_dir(), true).unwrap();
+        let nested = Path::new(&dir).join("a/b");
+        let nested = nested.to_string_lossy().into_owned();
+        assert!(mkdir(nested.clone(), false, false).is_err());
+        mkdir(nested.clone(), true, false).unwrap();
+        assert!(mkdir(nested.clone(), false, false).is_err());
+        mkdir(nested, false, true).unwrap();
+
+        let file = mktemp(Path::new(&dir), false).unwrap();
+        assert_ne!(file, mktemp(Path::new(&dir), false).unwrap());
+        let renamed = format!("{}/renamed", dir);
+        rename(file, renamed.clone()).unwrap();
+        let mut names = listdir(dir.clone()).unwrap();
+        names.sort();
+        assert_eq!(names.len(), 3);
+        assert_eq!(names[0], "a");
+        assert!(names.contains(&"renamed".to_string()));
+
+        assert!(remove(dir.clone(), false).is_err());
+        remove(dir.clone(), true).unwrap();
+        assert!(!Path::new(&dir).exists());
+    }
+
+    #[cfg(target_family = "unix")]
+    #[test]
+    fn stat_and_walk() {
+        let dir = mktemp(&std::env::temp_dir(), true).unwrap();
+        let root = Path::new(&dir);
+        fs::create_dir_all(root.join("a/b")).unwrap();
+        fs::write(root.join("a/b/file"), b"12345").unwrap();
+        std::os::unix::fs::symlink(root.join("a"), root.join("link")).unwrap();
+
+        let columns = walk(dir.clone(), None).unwrap();
+        let mut paths = columns.paths.clone();
+        paths.sort();
+        assert_eq!(paths, vec!["a", "a/b", "a/b/file", "link"]);
+        let file = columns.paths.iter().position(|p| p == "a/b/file").unwrap();
+        assert_eq!(columns.size[file], 5);
+        let a = columns.paths.iter().position(|p| p == "a").unwrap();
+        let b = columns.paths.iter().position(|p| p == "a/b").unwrap();
+        assert!(a < b && b < file);
+        assert_eq!(walk(dir.clone(), Some(1)).unwrap().paths.len(), 2);
+        assert!(walk(format!("{}/missing", dir), None).is_err());
+
+        let columns = stat_many(vec![
+            format!("{}/link", dir),
+            format!("{}/missing", dir),
+            format!("{}/a/b/file", dir),
+        ]);
+        assert_eq!(columns.mode[0] as u32 & 0o170000, 0o040000);
+        assert_eq!(columns.errors.len(), 1);
+        assert_eq!(columns.errors[0].0, 1);
+        assert_eq!(columns.size, vec![columns.size[0], 0, 5]);
+        remove(dir, true).unwrap();
+    }
+}
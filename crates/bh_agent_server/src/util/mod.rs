@@ -1,3 +1,5 @@
+mod fs_functions;
+mod positional;
 mod read_chars;
 mod read_lines;
 #[cfg(target_family = "unix")]
@@ -5,6 +7,10 @@ mod set_blocking;
 #[cfg(target_family = "unix")]
 mod unix_functions;
 
+#[cfg(target_family = "unix")]
+pub use fs_functions::symlink;
+pub use fs_functions::{listdir, mkdir, mktemp, remove, rename, stat_many, walk};
+pub use positional::{read_at, write_all_at};
 pub use read_chars::*;
 pub use read_lines::read_lines;
 #[cfg(target_family = "unix")]
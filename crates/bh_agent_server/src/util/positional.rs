@@ -0,0 +1,44 @@
+use std::fs::File;
+use std::io;
+#[cfg(target_family = "unix")]
+use std::os::unix::fs::FileExt;
+#[cfg(target_family = "windows")]
+use std::os::windows::fs::FileExt;
+
+// Positional reads and writes don't touch the file cursor, so chunks of a transfer can be applied
+// in whatever order they arrive.
+
+pub fn write_all_at(file: &File, mut buf: &[u8], mut offset: u64) -> io::Result<()> {
+    while !buf.is_empty() {
+        #[cfg(target_family = "unix")]
+        let written = file.write_at(buf, offset)?;
+        #[cfg(target_family = "windows")]
+        let written = file.seek_write(buf, offset)?;
+        if written == 0 {
+            return Err(io::ErrorKind::WriteZero.into());
+        }
+        buf = &buf[written..];
+        offset += written as u64;
+    }
+    Ok(())
+}
+
+/// Reads up to `len` bytes starting at `offset`. Fewer bytes are only returned at end of file.
+pub fn read_at(file: &File, len: usize, offset: u64) -> io::Result<Vec<u8>> {
+    let mut buf = vec![0u8; len];
+    let mut filled = 0;
+    while filled < len {
+        #[cfg(target_family = "unix")]
+        let read = file.read_at(&mut buf[filled..], offset + filled as u64);
+        #[cfg(target_family = "windows")]
+        let read = file.seek_read(&mut buf[filled..], offset + filled as u64);
+        match read {
+            Ok(0) => break,
+            Ok(n) => filled += n,
+            Err(e) if e.kind() == io::ErrorKind::Interrupted => continue,
+            Err(e) => return Err(e),
+        }
+    }
+    buf.truncate(filled);
+    Ok(buf)
+}
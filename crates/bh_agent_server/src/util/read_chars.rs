@@ -1,5 +1,5 @@
 use std::fs::File;
-use std::io::Read;
+use std::io::{Read, Seek};
 
 use anyhow::Result;
 use log::trace;
@@ -33,7 +33,7 @@ pub fn read_generic(
             }
         } else {
             // if n is None, we just read the whole file, text parsing happens on the client
-            Ok(file.bytes().collect::<Result<Vec<u8>, std::io::Error>>()?)
+            Ok(read_all(file)?)
         }
     })();
     trace!("read_generic: processing inner result...");
@@ -50,11 +50,44 @@ pub fn read_generic(
     })
 }
 
-fn read_bytes(file: &mut File, n: usize) -> Result<Vec<u8>> {
-    Ok(file
-        .bytes()
-        .take(n)
-        .collect::<Result<Vec<u8>, std::io::Error>>()?)
+// Files are read with a few large reads straight into the returned Vec, rather than a read per
+// byte. Regular files are sized up front so the Vec is allocated once; pipes and other streams
+// start at READ_CHUNK and grow as data arrives.
+const READ_CHUNK: usize = 64 * 1024;
+
+/// Reads until end of file. On a non-blocking file, data read before it would block is returned
+/// rather than lost.
+fn read_all(file: &mut File) -> std::io::Result<Vec<u8>> {
+    let mut buf = Vec::with_capacity(size_hint(file).unwrap_or(READ_CHUNK));
+    finish_read(file.read_to_end(&mut buf), buf)
+}
+
+/// Reads up to `n` bytes, stopping early only at end of file, or on a non-blocking file once no
+/// more data is available.
+fn read_bytes(file: &mut File, n: usize) -> std::io::Result<Vec<u8>> {
+    let capacity = size_hint(file).unwrap_or(READ_CHUNK).min(n);
+    let mut buf = Vec::with_capacity(capacity);
+    let result = file.by_ref().take(n as u64).read_to_end(&mut buf);
+    finish_read(result, buf)
+}
+
+fn finish_read(result: std::io::Result<usize>, buf: Vec<u8>) -> std::io::Result<Vec<u8>> {
+    match result {
+        Ok(_) => Ok(buf),
+        Err(e) if e.kind() == std::io::ErrorKind::WouldBlock && !buf.is_empty() => Ok(buf),
+        Err(e) => Err(e),
+    }
+}
+
+/// The number of bytes left in a regular file, plus one so read_to_end can see end of file
+/// without growing the buffer.
+fn size_hint(file: &mut File) -> Option<usize> {
+    let metadata = file.metadata().ok()?;
+    if !metadata.is_file() {
+        return None;
+    }
+    let position = file.stream_position().ok()?;
+    Some(metadata.len().saturating_sub(position) as usize + 1)
 }
 
 fn read_graphemes(file: &mut File, n: usize) -> Result<Vec<u8>> {
@@ -66,3 +99,61 @@ fn read_graphemes(file: &mut File, n: usize) -> Result<Vec<u8>> {
         .as_bytes()
         .to_vec())
 }
+
+#[cfg(all(test, target_family = "unix"))]
+mod tests {
+    use std::io::Write;
+
+    use super::*;
+    use crate::util::set_blocking;
+
+    fn pipe_with(data: &[u8]) -> (File, File) {
+        let (read, write) = nix::unistd::pipe().unwrap();
+        let mut write = File::from(write);
+        write.write_all(data).unwrap();
+        (File::from(read), write)
+    }
+
+    #[test]
+    fn reads_up_to_n() {
+        let (mut read, write) = pipe_with(b"hello world");
+        drop(write);
+        assert_eq!(
+            read_generic(&mut read, Some(5), FileOpenType::Binary).unwrap(),
+            b"hello"
+        );
+        assert_eq!(
+            read_generic(&mut read, None, FileOpenType::Binary).unwrap(),
+            b" world"
+        );
+        assert!(read_generic(&mut read, Some(5), FileOpenType::Binary)
+            .unwrap()
+            .is_empty());
+    }
+
+    #[test]
+    fn keeps_data_read_before_blocking() {
+        let (mut read, _write) = pipe_with(b"partial");
+        set_blocking(&read, false).unwrap();
+        assert_eq!(
+            read_generic(&mut read, Some(1024), FileOpenType::Binary).unwrap(),
+            b"partial"
+        );
+        assert!(read_generic(&mut read, None, FileOpenType::Binary)
+            .unwrap()
+            .is_empty());
+    }
+
+    #[test]
+    fn reads_whole_file() {
+        let path = std::env::temp_dir().join(format!("bh_read_chars_{}", std::process::id()));
+        let data: Vec<u8> = (0..=255).cycle().take(300_000).collect();
+        std::fs::write(&path, &data).unwrap();
+        let mut file = File::open(&path).unwrap();
+        assert_eq!(
+            read_generic(&mut file, None, FileOpenType::Binary).unwrap(),
+            data
+        );
+        std::fs::remove_file(&path).unwrap();
+    }
+}
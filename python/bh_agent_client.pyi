@@ -1,3 +1,19 @@
+from collections.abc import Awaitable
+from mmap import mmap
+from pathlib import Path
+from typing import TypeAlias
+
+# Objects supporting the buffer protocol that the client accepts
+ReadableBuffer: TypeAlias = bytes | bytearray | memoryview | mmap
+WritableBuffer: TypeAlias = bytearray | memoryview | mmap
+
+class AgentMetrics:
+    connections: int
+    max_connections: int
+    rejected_connections: int
+    queue_depth: int
+    max_in_flight: int
+
 class FileStat:
     mode: int
     uid: int
@@ -7,10 +23,46 @@ class FileStat:
     mtime: int
     ctime: int
 
+class StatColumns:
+    paths: list[str]
+    mode: list[int]
+    uid: list[int]
+    gid: list[int]
+    size: list[int]
+    atime: list[int]
+    mtime: list[int]
+    ctime: list[int]
+    errors: list[tuple[int, str]]
+
+def file_hash(
+    path: Path, algorithm: str, offset: int = 0, length: int | None = None
+) -> str: ...
+
 class BhAgentClient:
     @staticmethod
-    def initialize_client(ip_addr: str, port: int) -> BhAgentClient: ...
+    def initialize_client(
+        ip_addr: str,
+        port: int,
+        codec: str | None = None,
+        compression_level: int | None = None,
+        compression_threshold: int | None = None,
+        bulk_connections: int = 1,
+    ) -> BhAgentClient: ...
+    @staticmethod
+    def from_sockets(
+        fds: list[int],
+        codec: str | None = None,
+        compression_level: int | None = None,
+        compression_threshold: int | None = None,
+    ) -> BhAgentClient: ...
+    @property
+    def codec(self) -> str: ...
+    @property
+    def compressed(self) -> bool: ...
     def get_environments(self) -> list[int]: ...
+    def create_environment(self) -> int: ...
+    def destroy_environment(self, env_id: int) -> None: ...
+    def get_metrics(self) -> AgentMetrics: ...
     def get_tempdir(self, env_id: int) -> str: ...
     def run_process(
         self,
@@ -25,28 +77,176 @@ class BhAgentClient:
         setuid: int | None,
         setgid: int | None,
         setpgid: int | None,
+        capture: bool = False,
+        capture_limit: int | None = None,
     ) -> int: ...
     def get_process_ids(self, env_id: int) -> list[int]: ...
+    def get_process_config(
+        self, env_id: int, proc_id: int
+    ) -> tuple[list[str], list[tuple[str, str]] | None, str | None, bool]: ...
     def get_process_channel(self, env_id: int, proc_id: int, channel: int) -> int: ...
     def process_poll(self, env_id: int, proc_id: int) -> int | None: ...
     def process_wait(
         self, env_id: int, proc_id: int, timeout: float | None
     ) -> bool: ...
+    def process_wait_many(
+        self, env_id: int, proc_ids: list[int], wait_all: bool, timeout: float | None
+    ) -> list[tuple[int, int]]: ...
+    def process_read_capture(
+        self,
+        env_id: int,
+        proc_id: int,
+        channel: int,
+        offset: int,
+        size: int | None = None,
+    ) -> bytes: ...
     def process_returncode(self, env_id: int, proc_id: int) -> int | None: ...
     def file_open(self, env_id: int, path: str, mode_and_type: str) -> int: ...
     def file_close(self, env_id: int, fd: int) -> None: ...
     def file_is_closed(self, env_id: int, fd: int) -> bool: ...
     def file_is_readable(self, env_id: int, fd: int) -> bool: ...
     def file_read(self, env_id: int, fd: int, size: int | None) -> bytes: ...
+    def file_readinto(self, env_id: int, fd: int, buffer: WritableBuffer) -> int: ...
     def file_read_lines(self, env_id: int, fd: int, hint: int) -> list[bytes]: ...
     def file_is_seekable(self, env_id: int, fd: int) -> bool: ...
     def file_seek(self, env_id: int, fd: int, offset: int, whence: int) -> int: ...
     def file_tell(self, env_id: int, fd: int) -> int: ...
     def file_is_writable(self, env_id: int, fd: int) -> bool: ...
-    def file_write(self, env_id: int, fd: int, data: bytes) -> int: ...
+    def file_write(self, env_id: int, fd: int, data: ReadableBuffer) -> int: ...
     def file_set_blocking(self, env_id: int, fd: int, blocking: bool) -> None: ...
+    def file_subscribe(self, env_id: int, fd: int, window: int) -> int: ...
+    def subscription_next(self, env_id: int, subscription: int) -> bytes | None: ...
+    def subscription_cancel(self, env_id: int, subscription: int) -> None: ...
+    def file_upload(
+        self, env_id: int, src: Path, dst: str, mode: int | None = None
+    ) -> int: ...
+    def file_download(self, env_id: int, src: str, dst: Path) -> FileStat: ...
+    def directory_upload(
+        self,
+        env_id: int,
+        src: Path,
+        dst: str,
+        compression_level: int | None = None,
+    ) -> int: ...
+    def directory_download(
+        self,
+        env_id: int,
+        src: str,
+        dst: Path,
+        compression_level: int | None = None,
+    ) -> None: ...
     def chown(self, env_id: int, path: str, user: str, group: str) -> None: ...
     def chmod(self, env_id: int, path: str, mode: int) -> None: ...
     def stat(self, env_id: int, path: str) -> FileStat: ...
+    def stat_many(self, env_id: int, paths: list[str]) -> StatColumns: ...
+    def walk(
+        self, env_id: int, path: str, max_depth: int | None = None
+    ) -> StatColumns: ...
+    def file_hash(
+        self,
+        env_id: int,
+        files: list[tuple[str, tuple[int, int | None] | None]],
+        algorithm: str,
+    ) -> list[str]: ...
+    def mkdir(
+        self, env_id: int, path: str, parents: bool = False, exist_ok: bool = False
+    ) -> None: ...
+    def remove(self, env_id: int, path: str, recursive: bool = False) -> None: ...
+    def rename(self, env_id: int, src: str, dst: str) -> None: ...
+    def symlink(self, env_id: int, target: str, link: str) -> None: ...
+    def mktemp(self, env_id: int, directory: bool = False) -> str: ...
+    def listdir(self, env_id: int, path: str) -> list[str]: ...
+    def store_claim(self, hashes: list[str]) -> tuple[list[str], list[str]]: ...
+    def store_add(self, env_id: int, sha256: str, path: str) -> None: ...
+    def store_release(self, hashes: list[str]) -> None: ...
+    def store_install(
+        self, env_id: int, sha256: str, path: str, mode: int | None = None
+    ) -> None: ...
+    def batch(
+        self, env_id: int, operations: list[tuple[object, ...]]
+    ) -> list[tuple[bool, object]]: ...
+    def batch_async(
+        self, env_id: int, operations: list[tuple[object, ...]]
+    ) -> Awaitable[list[tuple[bool, object]]]: ...
+    def get_tempdir_async(self, env_id: int) -> Awaitable[str]: ...
+    def store_claim_async(
+        self, hashes: list[str]
+    ) -> Awaitable[tuple[list[str], list[str]]]: ...
+    def store_release_async(self, hashes: list[str]) -> Awaitable[None]: ...
+    def process_poll_async(
+        self, env_id: int, proc_id: int
+    ) -> Awaitable[int | None]: ...
+    def process_wait_async(
+        self, env_id: int, proc_id: int, timeout: float | None
+    ) -> Awaitable[bool]: ...
+    def process_wait_many_async(
+        self, env_id: int, proc_ids: list[int], wait_all: bool, timeout: float | None
+    ) -> Awaitable[list[tuple[int, int]]]: ...
+    def process_read_capture_async(
+        self,
+        env_id: int,
+        proc_id: int,
+        channel: int,
+        offset: int,
+        size: int | None = None,
+    ) -> Awaitable[bytes]: ...
+    def process_returncode_async(
+        self, env_id: int, proc_id: int
+    ) -> Awaitable[int | None]: ...
+    def file_open_async(
+        self, env_id: int, path: str, mode_and_type: str
+    ) -> Awaitable[int]: ...
+    def file_close_async(self, env_id: int, fd: int) -> Awaitable[None]: ...
+    def file_read_async(
+        self, env_id: int, fd: int, size: int | None
+    ) -> Awaitable[bytes]: ...
+    def file_read_lines_async(
+        self, env_id: int, fd: int, hint: int
+    ) -> Awaitable[list[bytes]]: ...
+    def file_write_async(
+        self, env_id: int, fd: int, data: ReadableBuffer
+    ) -> Awaitable[None]: ...
+    def file_subscribe_async(
+        self, env_id: int, fd: int, window: int
+    ) -> Awaitable[int]: ...
+    def subscription_next_async(
+        self, env_id: int, subscription: int
+    ) -> Awaitable[bytes | None]: ...
+    def subscription_cancel_async(
+        self, env_id: int, subscription: int
+    ) -> Awaitable[None]: ...
+    def file_upload_async(
+        self, env_id: int, src: Path, dst: str, mode: int | None = None
+    ) -> Awaitable[int]: ...
+    def file_download_async(
+        self, env_id: int, src: str, dst: Path
+    ) -> Awaitable[FileStat]: ...
+    def directory_upload_async(
+        self,
+        env_id: int,
+        src: Path,
+        dst: str,
+        compression_level: int | None = None,
+    ) -> Awaitable[int]: ...
+    def directory_download_async(
+        self,
+        env_id: int,
+        src: str,
+        dst: Path,
+        compression_level: int | None = None,
+    ) -> Awaitable[None]: ...
+    def stat_async(self, env_id: int, path: str) -> Awaitable[FileStat]: ...
+    def stat_many_async(
+        self, env_id: int, paths: list[str]
+    ) -> Awaitable[StatColumns]: ...
+    def walk_async(
+        self, env_id: int, path: str, max_depth: int | None = None
+    ) -> Awaitable[StatColumns]: ...
+    def file_hash_async(
+        self,
+        env_id: int,
+        files: list[tuple[str, tuple[int, int | None] | None]],
+        algorithm: str,
+    ) -> Awaitable[list[str]]: ...
     def get_metadata(self, env_id: int, key: str) -> str | None: ...
     def set_metadata(self, env_id: int, key: str, value: str) -> None: ...
@@ -16,6 +16,8 @@ from binharness.serialize import (
 )
 from binharness.types import (
     IO,
+    AsyncIO,
+    AsyncProcess,
     Environment,
     ExecutableInjection,
     Executor,
@@ -36,6 +38,8 @@ __all__ = [
     "AgentConnection",
     "AgentEnvironment",
     "AgentProvider",
+    "AsyncIO",
+    "AsyncProcess",
     "BusyboxInjection",
     "DevEnvironmentAgentProvider",
     "Environment",
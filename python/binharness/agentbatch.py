@@ -0,0 +1,295 @@
+"""binharness.agentbatch - Batched operations for agent environments."""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Generic, TypeVar
+
+from binharness.types.stat import FileStat
+
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from pathlib import Path
+    from types import TracebackType
+
+    from bh_agent_client import BhAgentClient
+    from typing_extensions import Self
+
+T_co = TypeVar("T_co", covariant=True)
+
+
+class BatchNotExecutedError(Exception):
+    """The result of a batch operation was requested before the batch ran."""
+
+
+def _identity(value: Any) -> Any:  # noqa: ANN401
+    return value
+
+
+class AgentBatchResult(Generic[T_co]):
+    """The result of an operation queued in an AgentBatch.
+
+    The value is available once the batch has been executed. Results that are
+    handles, such as file descriptors and process IDs, can be passed to later
+    operations in the same batch before it runs.
+    """
+
+    index: int
+    _convert: Callable[[Any], T_co]
+    _done: bool
+    _ok: bool
+    _value: Any
+
+    def __init__(
+        self: AgentBatchResult[T_co], index: int, convert: Callable[[Any], T_co]
+    ) -> None:
+        """Create an AgentBatchResult."""
+        self.index = index
+        self._convert = convert
+        self._done = False
+        self._ok = False
+        self._value = None
+
+    def _set(
+        self: AgentBatchResult[T_co],
+        ok: bool,  # noqa: FBT001
+        value: Any,  # noqa: ANN401
+    ) -> None:
+        self._done = True
+        self._ok = ok
+        self._value = value
+
+    @property
+    def ok(self: AgentBatchResult[T_co]) -> bool:
+        """Whether the operation succeeded."""
+        if not self._done:
+            raise BatchNotExecutedError
+        return self._ok
+
+    def result(self: AgentBatchResult[T_co]) -> T_co:
+        """Return the value of the operation, raising RuntimeError if it failed."""
+        if not self._done:
+            raise BatchNotExecutedError
+        if not self._ok:
+            raise RuntimeError(self._value)
+        return self._convert(self._value)
+
+
+Handle = int | AgentBatchResult[int]
+
+
+def _handle(handle: Handle) -> int | tuple[int]:
+    if isinstance(handle, AgentBatchResult):
+        return (handle.index,)
+    return handle
+
+
+class AgentBatch:
+    """Queues agent operations so they run in a single round trip.
+
+    Operations run in the order they were queued when the batch is executed,
+    either explicitly or when leaving a `with` or `async with` block. A failed
+    operation does not stop the batch, but later operations using its result
+    will fail.
+    """
+
+    _client: BhAgentClient
+    _env_id: int
+    _operations: list[tuple[Any, ...]]
+    _results: list[AgentBatchResult[Any]]
+
+    def __init__(self: AgentBatch, client: BhAgentClient, env_id: int) -> None:
+        """Create an AgentBatch."""
+        self._client = client
+        self._env_id = env_id
+        self._operations = []
+        self._results = []
+
+    def __len__(self: AgentBatch) -> int:
+        """Return the number of queued operations."""
+        return len(self._operations)
+
+    def _add(
+        self: AgentBatch,
+        operation: tuple[Any, ...],
+        convert: Callable[[Any], T_co] = _identity,
+    ) -> AgentBatchResult[T_co]:
+        result = AgentBatchResult(len(self._operations), convert)
+        self._operations.append(operation)
+        self._results.append(result)
+        return result
+
+    def run_process(  # noqa: PLR0913
+        self: AgentBatch,
+        argv: list[str],
+        env: dict[str, str] | None = None,
+        cwd: Path | None = None,
+        stdin: bool = True,  # noqa: FBT001, FBT002
+        stdout: bool = True,  # noqa: FBT001, FBT002
+        stderr: bool = True,  # noqa: FBT001, FBT002
+        *,
+        capture: bool = False,
+        capture_limit: int | None = None,
+    ) -> AgentBatchResult[int]:
+        """Queue starting a process. The result is the process ID.
+
+        With `capture`, the agent drains stdout and stderr in the background.
+        """
+        return self._add(
+            (
+                "run_process",
+                argv,
+                stdin,
+                stdout,
+                stderr,
+                argv[0],
+                list(env.items()) if env else None,
+                str(cwd) if cwd else None,
+                None,
+                None,
+                False,
+                capture,
+                capture_limit,
+            )
+        )
+
+    def get_process_channel(
+        self: AgentBatch, pid: Handle, channel: int
+    ) -> AgentBatchResult[int]:
+        """Queue getting a file descriptor for a process' stdin, stdout or stderr."""
+        return self._add(("get_process_channel", _handle(pid), channel))
+
+    def process_poll(self: AgentBatch, pid: Handle) -> AgentBatchResult[int | None]:
+        """Queue polling a process."""
+        return self._add(("process_poll", _handle(pid)))
+
+    def process_returncode(
+        self: AgentBatch, pid: Handle
+    ) -> AgentBatchResult[int | None]:
+        """Queue getting a process' exit code."""
+        return self._add(("process_returncode", _handle(pid)))
+
+    def file_open(self: AgentBatch, path: Path, mode: str) -> AgentBatchResult[int]:
+        """Queue opening a file. The result is the file descriptor."""
+        return self._add(("file_open", str(path), mode))
+
+    def file_close(self: AgentBatch, fd: Handle) -> AgentBatchResult[None]:
+        """Queue closing a file."""
+        return self._add(("file_close", _handle(fd)))
+
+    def file_read(self: AgentBatch, fd: Handle, n: int = -1) -> AgentBatchResult[bytes]:
+        """Queue reading up to n bytes from a file."""
+        return self._add(("file_read", _handle(fd), None if n == -1 else n))
+
+    def file_write(
+        self: AgentBatch, fd: Handle, data: bytes | bytearray | memoryview
+    ) -> AgentBatchResult[None]:
+        """Queue writing to a file. Any object supporting the buffer protocol works."""
+        return self._add(("file_write", _handle(fd), data))
+
+    def chown(
+        self: AgentBatch, path: Path, user: str | None, group: str | None
+    ) -> AgentBatchResult[None]:
+        """Queue changing the owner of a file."""
+        return self._add(("chown", str(path), user, group))
+
+    def chmod(self: AgentBatch, path: Path, mode: int) -> AgentBatchResult[None]:
+        """Queue changing the mode of a file."""
+        return self._add(("chmod", str(path), mode))
+
+    def stat(self: AgentBatch, path: Path) -> AgentBatchResult[FileStat]:
+        """Queue getting the stat of a file."""
+        return self._add(("stat", str(path)), FileStat.from_agent)
+
+    def mkdir(
+        self: AgentBatch, path: Path, *, parents: bool = False, exist_ok: bool = False
+    ) -> AgentBatchResult[None]:
+        """Queue creating a directory."""
+        return self._add(("mkdir", str(path), parents, exist_ok))
+
+    def remove(
+        self: AgentBatch, path: Path, *, recursive: bool = False
+    ) -> AgentBatchResult[None]:
+        """Queue removing a file, symlink or directory."""
+        return self._add(("remove", str(path), recursive))
+
+    def rename(self: AgentBatch, src: Path, dst: Path) -> AgentBatchResult[None]:
+        """Queue renaming a file or directory."""
+        return self._add(("rename", str(src), str(dst)))
+
+    def symlink(self: AgentBatch, target: Path, link: Path) -> AgentBatchResult[None]:
+        """Queue creating a symlink at `link` pointing to `target`."""
+        return self._add(("symlink", str(target), str(link)))
+
+    def store_add(self: AgentBatch, sha256: str, path: Path) -> AgentBatchResult[None]:
+        """Queue moving an uploaded file into the agent's store."""
+        return self._add(("store_add", sha256, str(path)))
+
+    def store_install(
+        self: AgentBatch, sha256: str, path: Path, mode: int | None = None
+    ) -> AgentBatchResult[None]:
+        """Queue copying a file from the agent's store into place."""
+        return self._add(("store_install", sha256, str(path), mode))
+
+    def get_metadata(self: AgentBatch, key: str) -> AgentBatchResult[str | None]:
+        """Queue getting a metadata value."""
+        return self._add(("get_metadata", key))
+
+    def set_metadata(self: AgentBatch, key: str, value: str) -> AgentBatchResult[None]:
+        """Queue setting a metadata value."""
+        return self._add(("set_metadata", key, value))
+
+    def execute(self: AgentBatch) -> None:
+        """Run the queued operations on the agent and fill in their results."""
+        operations, results = self._take()
+        if operations:
+            self._apply(results, self._client.batch(self._env_id, operations))
+
+    async def execute_async(self: AgentBatch) -> None:
+        """Run the queued operations without blocking the event loop."""
+        operations, results = self._take()
+        if operations:
+            self._apply(
+                results, await self._client.batch_async(self._env_id, operations)
+            )
+
+    def _take(
+        self: AgentBatch,
+    ) -> tuple[list[tuple[Any, ...]], list[AgentBatchResult[Any]]]:
+        operations, self._operations = self._operations, []
+        results, self._results = self._results, []
+        return operations, results
+
+    @staticmethod
+    def _apply(
+        results: list[AgentBatchResult[Any]], values: list[tuple[bool, object]]
+    ) -> None:
+        for result, (ok, value) in zip(results, values, strict=True):
+            result._set(ok, value)  # noqa: SLF001
+
+    def __enter__(self: Self) -> Self:
+        """Enter the batch context."""
+        return self
+
+    def __exit__(
+        self: AgentBatch,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        """Execute the batch, unless the block raised."""
+        if exc_type is None:
+            self.execute()
+
+    async def __aenter__(self: Self) -> Self:
+        """Enter the batch context."""
+        return self
+
+    async def __aexit__(
+        self: AgentBatch,
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        """Execute the batch asynchronously, unless the block raised."""
+        if exc_type is None:
+            await self.execute_async()
@@ -2,21 +2,175 @@
 
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import stat
-from functools import cached_property
+import threading
+from functools import cached_property, lru_cache
+from io import UnsupportedOperation
 from pathlib import Path
 from typing import TYPE_CHECKING, cast
 
 from bh_agent_client import BhAgentClient
 
+from binharness.agentbatch import AgentBatch
 from binharness.types.environment import Environment
-from binharness.types.io import IO
-from binharness.types.process import Process
-from binharness.types.stat import FileStat
-from binharness.util import normalize_args
+from binharness.types.io import IO, AsyncIO
+from binharness.types.process import AsyncProcess, Process
+from binharness.types.stat import FileStat, FileStats
+from binharness.util import generate_random_suffix, normalize_args
 
 if TYPE_CHECKING:
-    from collections.abc import Sequence
+    from collections.abc import AsyncIterator, Callable, Iterator, Sequence
+
+    from bh_agent_client import AgentMetrics
+
+    from binharness.agentbatch import AgentBatchResult
+
+# Files up to this size are written with the batched file API, so several small
+# files can be injected in a single round trip. Larger files are streamed.
+_BATCH_INJECT_LIMIT = 1024 * 1024
+
+# Local files are read in blocks of this size to hash them
+_HASH_BLOCK_SIZE = 1024 * 1024
+
+# Number of local file hashes remembered, so files that are injected again aren't
+# read again unless they changed
+_HASH_CACHE_SIZE = 4096
+
+# Number of chunks the agent buffers for an output subscription before it
+# stops reading and lets the writer block
+_SUBSCRIPTION_WINDOW = 16
+
+# How much of each captured output channel the agent keeps in memory before it
+# spills to disk, unless run_command is given a limit
+_CAPTURE_LIMIT = 1024 * 1024
+
+# Reads of captured output that look for the end of a line fetch this much
+_CAPTURE_LINE_CHUNK = 4096
+
+# Size of the read-ahead and write buffers of files opened in binary mode
+_FILE_BUFFER_SIZE = 64 * 1024
+
+Channels = tuple[int | None, int | None, int | None]
+
+
+def _queue_run_process(  # noqa: PLR0913
+    batch: AgentBatch,
+    args: list[str],
+    env: dict[str, str] | None,
+    cwd: Path | None,
+    capture: bool,  # noqa: FBT001
+    capture_limit: int | None,
+) -> tuple[AgentBatchResult[int], list[AgentBatchResult[int]]]:
+    pid = batch.run_process(
+        args, env, cwd, capture=capture, capture_limit=capture_limit
+    )
+    # Captured output has no file descriptor, it is read with process_read_capture
+    channels = 1 if capture else 3
+    return pid, [batch.get_process_channel(pid, i) for i in range(channels)]
+
+
+def _channel_fds(channels: list[AgentBatchResult[int]]) -> Channels:
+    fds = [c.result() if c.ok else None for c in channels]
+    fds += [None] * (3 - len(fds))
+    return (fds[0], fds[1], fds[2])
+
+
+# A file to upload into the agent's store: its hash, where it is, and where it is
+# staged on the agent before it is added to the store
+_StoreUpload = tuple[str, Path, Path]
+
+
+def _sha256(path: Path) -> str:
+    """Return the hex SHA-256 of a local file."""
+    st = path.stat()
+    return _sha256_of_version(path.resolve(), st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+@lru_cache(maxsize=_HASH_CACHE_SIZE)
+def _sha256_of_version(
+    path: Path,
+    inode: int,  # noqa: ARG001
+    size: int,  # noqa: ARG001
+    mtime_ns: int,  # noqa: ARG001
+) -> str:
+    """Return the hex SHA-256 of a local file, cached by what stat says about it."""
+    sha256 = hashlib.sha256()
+    with path.open("rb") as f:
+        while block := f.read(_HASH_BLOCK_SIZE):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def _plan_injection(
+    files: list[tuple[Path, Path]],
+    stats: list[tuple[AgentBatchResult[FileStat], AgentBatchResult[FileStat]]],
+) -> tuple[list[Path], list[tuple[Path, Path]]]:
+    """Find the missing parents and the full destination of each file to inject."""
+    missing: dict[Path, None] = {}
+    placements = []
+    for (src, dst), (parent_stat, dst_stat) in zip(files, stats, strict=True):
+        if not parent_stat.ok:
+            missing[dst.parent] = None
+        if dst_stat.ok and stat.S_ISDIR(dst_stat.result().mode):
+            dst = dst / src.name  # noqa: PLW2901
+        placements.append((src, dst))
+    return list(missing), placements
+
+
+def _plan_store_uploads(
+    tempdir: Path, sources: dict[str, Path]
+) -> tuple[list[_StoreUpload], list[_StoreUpload]]:
+    """Split content to upload into the store into small and large files."""
+    small = []
+    large = []
+    for digest, src in sources.items():
+        staging = tempdir / f".bh-store-{digest}-{generate_random_suffix()}"
+        if src.stat().st_size <= _BATCH_INJECT_LIMIT:
+            small.append((digest, src, staging))
+        else:
+            large.append((digest, src, staging))
+    return small, large
+
+
+def _queue_store_adds(
+    batch: AgentBatch, small: list[_StoreUpload], large: list[_StoreUpload]
+) -> list[AgentBatchResult[object]]:
+    """Queue writing the small files, then adding every staged file to the store."""
+    results: list[AgentBatchResult[object]] = []
+    for _, src, staging in small:
+        fd = batch.file_open(staging, "wb")
+        results += [fd, batch.file_write(fd, src.read_bytes()), batch.file_close(fd)]
+    results += [
+        batch.store_add(digest, staging) for digest, _, staging in small + large
+    ]
+    return results
+
+
+def _hash_requests(
+    paths: Sequence[Path], ranges: Sequence[tuple[int, int | None]] | None
+) -> list[tuple[str, tuple[int, int | None] | None]]:
+    if ranges is None:
+        return [(str(path), None) for path in paths]
+    return [(str(path), r) for path, r in zip(paths, ranges, strict=True)]
+
+
+def _queue_mkdirs(
+    batch: AgentBatch, directories: list[Path]
+) -> list[AgentBatchResult[object]]:
+    return [
+        batch.mkdir(directory, parents=True, exist_ok=True) for directory in directories
+    ]
+
+
+def _queue_store_installs(
+    batch: AgentBatch, placements: list[tuple[Path, Path]], digests: list[str]
+) -> list[AgentBatchResult[object]]:
+    return [
+        batch.store_install(digest, dst, src.stat().st_mode)
+        for (src, dst), digest in zip(placements, digests, strict=True)
+    ]
 
 
 class AgentIO(IO[bytes]):
@@ -27,14 +181,33 @@ class AgentIO(IO[bytes]):
     _client: BhAgentClient
     _environment_id: int
     _fd: int
+    _mode: str | None
 
     def __init__(
-        self: AgentIO, client: BhAgentClient, environment_id: int, fd: int
+        self: AgentIO,
+        client: BhAgentClient,
+        environment_id: int,
+        fd: int,
+        mode: str | None = None,
     ) -> None:
-        """Create an AgentIO."""
+        """Create an AgentIO.
+
+        If the mode the file was opened with is given, whether it is readable
+        and writable is answered locally instead of asking the agent.
+        """
         self._client = client
         self._environment_id = environment_id
         self._fd = fd
+        self._mode = mode
+
+    @property
+    def fd(self: AgentIO) -> int:
+        """The agent's ID for the file.
+
+        Any connection to the same agent can reattach to the file with
+        `AgentEnvironment.get_file`.
+        """
+        return self._fd
 
     def close(self: AgentIO) -> None:
         """Close the file."""
@@ -55,8 +228,14 @@ class AgentIO(IO[bytes]):
             self._environment_id, self._fd, None if n == -1 else n
         )
 
+    def readinto(self: AgentIO, b: bytearray | memoryview) -> int:
+        """Read into a writable buffer, returning the number of bytes read."""
+        return self._client.file_readinto(self._environment_id, self._fd, b)
+
     def readable(self: AgentIO) -> bool:
         """Whether the file is readable."""
+        if self._mode is not None:
+            return "r" in self._mode or "+" in self._mode
         return self._client.file_is_readable(self._environment_id, self._fd)
 
     def readline(self: AgentIO, limit: int = -1) -> bytes:  # noqa: ARG002
@@ -76,6 +255,10 @@ class AgentIO(IO[bytes]):
 
     def seekable(self: AgentIO) -> bool:
         """Whether the file is seekable."""
+        return self._seekable
+
+    @cached_property
+    def _seekable(self: AgentIO) -> bool:
         return self._client.file_is_seekable(self._environment_id, self._fd)
 
     def tell(self: AgentIO) -> int:
@@ -84,10 +267,12 @@ class AgentIO(IO[bytes]):
 
     def writable(self: AgentIO) -> bool:
         """Whether the file is writable."""
+        if self._mode is not None:
+            return any(c in self._mode for c in "wxa+")
         return self._client.file_is_writable(self._environment_id, self._fd)
 
-    def write(self: AgentIO, s: bytes) -> int | None:
-        """Write to the file."""
+    def write(self: AgentIO, s: bytes | bytearray | memoryview) -> int | None:
+        """Write to the file. Any object supporting the buffer protocol works."""
         return self._client.file_write(self._environment_id, self._fd, s)
 
     def writelines(self: AgentIO, lines: list[bytes]) -> None:
@@ -98,6 +283,496 @@ class AgentIO(IO[bytes]):
         """Set the file to non-blocking mode."""
         self._client.file_set_blocking(self._environment_id, self._fd, blocking)
 
+    def iter_chunks(
+        self: AgentIO, window: int = _SUBSCRIPTION_WINDOW
+    ) -> Iterator[bytes]:
+        """Iterate over data from the file as it is produced, until end of file.
+
+        The agent reads the file in the background and each iteration returns
+        everything read since the last one, waiting until there is some. Up to
+        `window` chunks are buffered on the agent, after which it stops reading
+        until the iterator catches up. The file should not be read by other
+        means while it is being iterated over.
+        """
+        subscription: int | None = self._client.file_subscribe(
+            self._environment_id, self._fd, window
+        )
+        try:
+            while (
+                data := self._client.subscription_next(
+                    self._environment_id, cast(int, subscription)
+                )
+            ) is not None:
+                yield data
+            subscription = None
+        finally:
+            if subscription is not None:
+                self._client.subscription_cancel(self._environment_id, subscription)
+
+    def on_data(
+        self: AgentIO,
+        callback: Callable[[bytes], object],
+        window: int = _SUBSCRIPTION_WINDOW,
+    ) -> threading.Thread:
+        """Call `callback` with data from the file as it is produced.
+
+        The callback is called from a background thread, which is returned and
+        finishes at end of file.
+        """
+
+        def pump() -> None:
+            for data in self.iter_chunks(window):
+                callback(data)
+
+        thread = threading.Thread(target=pump, daemon=True)
+        thread.start()
+        return thread
+
+
+class BufferedAgentIO(IO[bytes]):
+    """A buffered binary file in an agent environment.
+
+    Reads fetch data ahead in blocks, so `read` and `readline` with small
+    sizes are mostly served locally. Writes are collected until the buffer
+    fills up, the file is flushed, or the file is read, seeked or closed.
+
+    Reads with a size wait for that much data or end of file, so this should
+    only be used for files, not pipes.
+    """
+
+    raw: AgentIO
+    buffer_size: int
+    _read_buffer: bytearray
+    _write_buffer: bytearray
+    _closed: bool
+
+    def __init__(
+        self: BufferedAgentIO, raw: AgentIO, buffer_size: int = _FILE_BUFFER_SIZE
+    ) -> None:
+        """Create a BufferedAgentIO."""
+        self.raw = raw
+        self.buffer_size = buffer_size
+        self._read_buffer = bytearray()
+        self._write_buffer = bytearray()
+        self._closed = False
+
+    def close(self: BufferedAgentIO) -> None:
+        """Flush and close the file."""
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self.raw.close()
+
+    @property
+    def closed(self: BufferedAgentIO) -> bool:
+        """Whether the file is closed."""
+        return self._closed
+
+    def flush(self: BufferedAgentIO) -> None:
+        """Write out buffered data."""
+        if self._write_buffer:
+            self.raw.write(self._write_buffer)
+            self._write_buffer.clear()
+
+    def _prepare_read(self: BufferedAgentIO) -> None:
+        if self._write_buffer:
+            self.flush()
+
+    def _prepare_write(self: BufferedAgentIO) -> None:
+        # Data read ahead hasn't been consumed, so the agent's position is past
+        # where the write belongs
+        if self._read_buffer:
+            self.raw.seek(-len(self._read_buffer), 1)
+            self._read_buffer.clear()
+
+    def _fill(self: BufferedAgentIO, n: int) -> bool:
+        """Read at least n more bytes into the buffer, returning False at EOF."""
+        data = self.raw.read(max(n, self.buffer_size))
+        self._read_buffer += data
+        return bool(data)
+
+    def read(self: BufferedAgentIO, n: int = -1) -> bytes:
+        """Read n bytes from the file."""
+        self._prepare_read()
+        if n < 0:
+            data = bytes(self._read_buffer) + self.raw.read()
+            self._read_buffer.clear()
+            return data
+        if len(self._read_buffer) < n:
+            self._fill(n - len(self._read_buffer))
+        data = bytes(self._read_buffer[:n])
+        del self._read_buffer[:n]
+        return data
+
+    def readinto(self: BufferedAgentIO, b: bytearray | memoryview) -> int:
+        """Read into a writable buffer, returning the number of bytes read."""
+        view = memoryview(b).cast("B")
+        n = min(len(view), len(self._read_buffer))
+        view[:n] = self._read_buffer[:n]
+        del self._read_buffer[:n]
+        # Large reads skip the buffer and are filled in place
+        if n < len(view):
+            self._prepare_read()
+            if len(view) - n >= self.buffer_size:
+                n += self.raw.readinto(view[n:])
+            else:
+                self._fill(len(view) - n)
+                m = min(len(view) - n, len(self._read_buffer))
+                view[n : n + m] = self._read_buffer[:m]
+                del self._read_buffer[:m]
+                n += m
+        return n
+
+    def readable(self: BufferedAgentIO) -> bool:
+        """Whether the file is readable."""
+        return self.raw.readable()
+
+    def readline(self: BufferedAgentIO, limit: int = -1) -> bytes:
+        """Read a line from the file."""
+        self._prepare_read()
+        searched = 0
+        while True:
+            end = self._read_buffer.find(b"\n", searched)
+            if end != -1:
+                end += 1
+                break
+            searched = len(self._read_buffer)
+            if 0 <= limit <= searched or not self._fill(self.buffer_size):
+                end = searched
+                break
+        if limit >= 0:
+            end = min(end, limit)
+        line = bytes(self._read_buffer[:end])
+        del self._read_buffer[:end]
+        return line
+
+    def readlines(self: BufferedAgentIO, hint: int = -1) -> list[bytes]:
+        """Read lines from the file."""
+        lines = []
+        size = 0
+        while line := self.readline():
+            lines.append(line)
+            size += len(line)
+            if 0 < hint <= size:
+                break
+        return lines
+
+    def __iter__(self: BufferedAgentIO) -> Iterator[bytes]:
+        """Iterate over the lines of the file."""
+        while line := self.readline():
+            yield line
+
+    def seek(self: BufferedAgentIO, offset: int, whence: int = 0) -> int | None:
+        """Seek to a position in the file."""
+        self.flush()
+        if whence == 1:
+            offset -= len(self._read_buffer)
+        self._read_buffer.clear()
+        return self.raw.seek(offset, whence)
+
+    def seekable(self: BufferedAgentIO) -> bool:
+        """Whether the file is seekable."""
+        return self.raw.seekable()
+
+    def tell(self: BufferedAgentIO) -> int:
+        """Get the current position in the file."""
+        return self.raw.tell() - len(self._read_buffer) + len(self._write_buffer)
+
+    def writable(self: BufferedAgentIO) -> bool:
+        """Whether the file is writable."""
+        return self.raw.writable()
+
+    def write(self: BufferedAgentIO, s: bytes | bytearray | memoryview) -> int | None:
+        """Write to the file."""
+        self._prepare_write()
+        n = memoryview(s).nbytes
+        # Large writes are sent straight from the caller's buffer
+        if not self._write_buffer and n >= self.buffer_size:
+            self.raw.write(s)
+            return n
+        self._write_buffer += s
+        if len(self._write_buffer) >= self.buffer_size:
+            self.flush()
+        return n
+
+    def writelines(self: BufferedAgentIO, lines: list[bytes]) -> None:
+        """Write lines to the file."""
+        for line in lines:
+            self.write(line)
+
+    def set_blocking(self: BufferedAgentIO, blocking: bool) -> None:  # noqa: FBT001
+        """Set the file to blocking or non-blocking mode."""
+        self.raw.set_blocking(blocking)
+
+
+class AsyncAgentIO(AsyncIO[bytes]):
+    """AsyncAgentIO implements the AsyncIO interface for agents."""
+
+    _client: BhAgentClient
+    _environment_id: int
+    _fd: int
+
+    def __init__(
+        self: AsyncAgentIO, client: BhAgentClient, environment_id: int, fd: int
+    ) -> None:
+        """Create an AsyncAgentIO."""
+        self._client = client
+        self._environment_id = environment_id
+        self._fd = fd
+
+    async def close(self: AsyncAgentIO) -> None:
+        """Close the file."""
+        await self._client.file_close_async(self._environment_id, self._fd)
+
+    async def read(self: AsyncAgentIO, n: int = -1) -> bytes:
+        """Read n bytes from the file."""
+        return await self._client.file_read_async(
+            self._environment_id, self._fd, None if n == -1 else n
+        )
+
+    async def readline(self: AsyncAgentIO, limit: int = -1) -> bytes:  # noqa: ARG002
+        """Read a line from the file."""
+        lines = await self._client.file_read_lines_async(
+            self._environment_id, self._fd, 1
+        )
+        return lines[0] if lines else b""
+
+    async def write(self: AsyncAgentIO, s: bytes) -> int | None:
+        """Write to the file."""
+        await self._client.file_write_async(self._environment_id, self._fd, s)
+        return len(s)
+
+    async def iter_chunks(
+        self: AsyncAgentIO, window: int = _SUBSCRIPTION_WINDOW
+    ) -> AsyncIterator[bytes]:
+        """Iterate over data from the file as it is produced, until end of file.
+
+        See `AgentIO.iter_chunks`.
+        """
+        subscription: int | None = await self._client.file_subscribe_async(
+            self._environment_id, self._fd, window
+        )
+        try:
+            while (
+                data := await self._client.subscription_next_async(
+                    self._environment_id, cast(int, subscription)
+                )
+            ) is not None:
+                yield data
+            subscription = None
+        finally:
+            if subscription is not None:
+                await self._client.subscription_cancel_async(
+                    self._environment_id, subscription
+                )
+
+
+class AgentCaptureIO(IO[bytes]):
+    """Output of a process that the agent captures in the background.
+
+    The agent drains the process' output as it is produced, so the process
+    never blocks on a full pipe. Reads are made by offset into everything
+    captured so far, which makes the stream seekable.
+    """
+
+    _client: BhAgentClient
+    _environment_id: int
+    _pid: int
+    _channel: int
+    _offset: int
+    _closed: bool
+
+    def __init__(
+        self: AgentCaptureIO,
+        client: BhAgentClient,
+        environment_id: int,
+        pid: int,
+        channel: int,
+    ) -> None:
+        """Create an AgentCaptureIO."""
+        self._client = client
+        self._environment_id = environment_id
+        self._pid = pid
+        self._channel = channel
+        self._offset = 0
+        self._closed = False
+
+    def _read_at(self: AgentCaptureIO, offset: int, n: int | None) -> bytes:
+        return self._client.process_read_capture(
+            self._environment_id, self._pid, self._channel, offset, n
+        )
+
+    def close(self: AgentCaptureIO) -> None:
+        """Close the file."""
+        self._closed = True
+
+    @property
+    def closed(self: AgentCaptureIO) -> bool:
+        """Whether the file is closed."""
+        return self._closed
+
+    def flush(self: AgentCaptureIO) -> None:
+        """Flush the file."""
+
+    def read(self: AgentCaptureIO, n: int = -1) -> bytes:
+        """Read n bytes from the file.
+
+        With n given, this returns as soon as some output is available, like a
+        read from a pipe. Otherwise it reads until the process closes the
+        channel.
+        """
+        if n != -1:
+            data = self._read_at(self._offset, n)
+            self._offset += len(data)
+            return data
+        chunks = []
+        while data := self._read_at(self._offset, None):
+            chunks.append(data)
+            self._offset += len(data)
+        return b"".join(chunks)
+
+    def readable(self: AgentCaptureIO) -> bool:
+        """Whether the file is readable."""
+        return True
+
+    def readline(self: AgentCaptureIO, limit: int = -1) -> bytes:
+        """Read a line from the file."""
+        line = b""
+        while limit == -1 or len(line) < limit:
+            size = _CAPTURE_LINE_CHUNK
+            if limit != -1:
+                size = min(size, limit - len(line))
+            data = self._read_at(self._offset + len(line), size)
+            if not data:
+                break
+            end = data.find(b"\n")
+            if end != -1:
+                line += data[: end + 1]
+                break
+            line += data
+        self._offset += len(line)
+        return line
+
+    def readlines(self: AgentCaptureIO, hint: int = -1) -> list[bytes]:
+        """Read lines from the file."""
+        lines = []
+        size = 0
+        while line := self.readline():
+            lines.append(line)
+            size += len(line)
+            if 0 < hint <= size:
+                break
+        return lines
+
+    def seek(self: AgentCaptureIO, offset: int, whence: int = 0) -> int | None:
+        """Seek to a position in the file. Seeking from the end is not supported."""
+        if whence == 0:
+            self._offset = offset
+        elif whence == 1:
+            self._offset += offset
+        else:
+            raise UnsupportedOperation
+        return self._offset
+
+    def seekable(self: AgentCaptureIO) -> bool:
+        """Whether the file is seekable."""
+        return True
+
+    def tell(self: AgentCaptureIO) -> int:
+        """Get the current position in the file."""
+        return self._offset
+
+    def writable(self: AgentCaptureIO) -> bool:
+        """Whether the file is writable."""
+        return False
+
+    def write(
+        self: AgentCaptureIO, s: bytes | bytearray | memoryview  # noqa: ARG002
+    ) -> int | None:
+        """Write to the file."""
+        raise UnsupportedOperation
+
+    def writelines(self: AgentCaptureIO, lines: list[bytes]) -> None:  # noqa: ARG002
+        """Write lines to the file."""
+        raise UnsupportedOperation
+
+    def set_blocking(self: AgentCaptureIO, blocking: bool) -> None:  # noqa: FBT001
+        """Set the file to blocking or non-blocking mode.
+
+        Reads wait for output to be captured, so only blocking mode is supported.
+        """
+        if not blocking:
+            raise UnsupportedOperation
+
+
+class AsyncAgentCaptureIO(AsyncIO[bytes]):
+    """Captured process output, for use with asyncio. See `AgentCaptureIO`."""
+
+    _client: BhAgentClient
+    _environment_id: int
+    _pid: int
+    _channel: int
+    _offset: int
+
+    def __init__(
+        self: AsyncAgentCaptureIO,
+        client: BhAgentClient,
+        environment_id: int,
+        pid: int,
+        channel: int,
+    ) -> None:
+        """Create an AsyncAgentCaptureIO."""
+        self._client = client
+        self._environment_id = environment_id
+        self._pid = pid
+        self._channel = channel
+        self._offset = 0
+
+    async def _read_at(self: AsyncAgentCaptureIO, offset: int, n: int | None) -> bytes:
+        return await self._client.process_read_capture_async(
+            self._environment_id, self._pid, self._channel, offset, n
+        )
+
+    async def close(self: AsyncAgentCaptureIO) -> None:
+        """Close the file."""
+
+    async def read(self: AsyncAgentCaptureIO, n: int = -1) -> bytes:
+        """Read n bytes from the file."""
+        if n != -1:
+            data = await self._read_at(self._offset, n)
+            self._offset += len(data)
+            return data
+        chunks = []
+        while data := await self._read_at(self._offset, None):
+            chunks.append(data)
+            self._offset += len(data)
+        return b"".join(chunks)
+
+    async def readline(self: AsyncAgentCaptureIO, limit: int = -1) -> bytes:
+        """Read a line from the file."""
+        line = b""
+        while limit == -1 or len(line) < limit:
+            size = _CAPTURE_LINE_CHUNK
+            if limit != -1:
+                size = min(size, limit - len(line))
+            data = await self._read_at(self._offset + len(line), size)
+            if not data:
+                break
+            end = data.find(b"\n")
+            if end != -1:
+                line += data[: end + 1]
+                break
+            line += data
+        self._offset += len(line)
+        return line
+
+    async def write(self: AsyncAgentCaptureIO, s: bytes) -> int | None:  # noqa: ARG002
+        """Write to the file."""
+        raise UnsupportedOperation
+
 
 class AgentProcess(Process):
     """A process running in an agent environment."""
@@ -105,6 +780,8 @@ class AgentProcess(Process):
     _client: BhAgentClient
     _env_id: int
     _pid: int
+    _channels: Channels | None
+    _captured: bool
 
     def __init__(  # noqa: PLR0913
         self: AgentProcess,
@@ -115,44 +792,58 @@ class AgentProcess(Process):
         args: Sequence[str],
         env: dict[str, str] | None,
         cwd: Path | None,
+        channels: Channels | None = None,
+        *,
+        captured: bool = False,
     ) -> None:
-        """Create an AgentProcess."""
+        """Create an AgentProcess.
+
+        If the file descriptors of the process' channels are already known,
+        they can be passed as `channels` to avoid looking them up again.
+        `captured` means the agent captures the process' output.
+        """
         super().__init__(environment, args, env, cwd)
         self._client = client
         self._env_id = env_id
         self._pid = pid
+        self._channels = channels
+        self._captured = captured
 
     @property
     def pid(self: AgentProcess) -> int:
         """Get the process' PID."""
         return self._pid
 
-    @cached_property
-    def stdin(self: AgentProcess) -> AgentIO | None:
-        """Get the standard input stream of the process."""
+    def _get_capture(self: AgentProcess, channel: int) -> AgentCaptureIO:
+        return AgentCaptureIO(self._client, self._env_id, self._pid, channel)
+
+    def _get_pipe(self: AgentProcess, channel: int) -> AgentIO | None:
+        mode = "wb" if channel == 0 else "rb"
+        if self._channels is not None:
+            fd = self._channels[channel]
+            if fd is None:
+                return None
+            return AgentIO(self._client, self._env_id, fd, mode)
         try:
-            fd = self._client.get_process_channel(self._env_id, self._pid, 0)
-            return AgentIO(self._client, self._env_id, fd)
+            fd = self._client.get_process_channel(self._env_id, self._pid, channel)
+            return AgentIO(self._client, self._env_id, fd, mode)
         except RuntimeError:
             return None  # TODO: verify that this is the right error
 
     @cached_property
-    def stdout(self: AgentProcess) -> AgentIO | None:
+    def stdin(self: AgentProcess) -> AgentIO | None:
+        """Get the standard input stream of the process."""
+        return self._get_pipe(0)
+
+    @cached_property
+    def stdout(self: AgentProcess) -> AgentIO | AgentCaptureIO | None:
         """Get the standard output stream of the process."""
-        try:
-            fd = self._client.get_process_channel(self._env_id, self._pid, 1)
-            return AgentIO(self._client, self._env_id, fd)
-        except RuntimeError:
-            return None  # TODO: verify that this is the right error
+        return self._get_capture(1) if self._captured else self._get_pipe(1)
 
     @cached_property
-    def stderr(self: AgentProcess) -> AgentIO | None:
+    def stderr(self: AgentProcess) -> AgentIO | AgentCaptureIO | None:
         """Get the standard error stream of the process."""
-        try:
-            fd = self._client.get_process_channel(self._env_id, self._pid, 2)
-            return AgentIO(self._client, self._env_id, fd)
-        except RuntimeError:
-            return None  # TODO: verify that this is the right error
+        return self._get_capture(2) if self._captured else self._get_pipe(2)
 
     @property
     def returncode(self: AgentProcess) -> int | None:
@@ -170,6 +861,90 @@ class AgentProcess(Process):
         raise TimeoutError
 
 
+class AsyncAgentProcess(AsyncProcess):
+    """A process running in an agent environment, for use with asyncio."""
+
+    _client: BhAgentClient
+    _env_id: int
+    _pid: int
+    _returncode: int | None
+    _stdin: AsyncAgentIO | None
+    _stdout: AsyncAgentIO | AsyncAgentCaptureIO | None
+    _stderr: AsyncAgentIO | AsyncAgentCaptureIO | None
+
+    def __init__(  # noqa: PLR0913
+        self: AsyncAgentProcess,
+        client: BhAgentClient,
+        env_id: int,
+        pid: int,
+        environment: Environment,
+        args: Sequence[str],
+        env: dict[str, str] | None,
+        cwd: Path | None,
+        channels: Channels,
+        *,
+        captured: bool = False,
+    ) -> None:
+        """Create an AsyncAgentProcess."""
+        super().__init__(environment, args, env, cwd)
+        self._client = client
+        self._env_id = env_id
+        self._pid = pid
+        self._returncode = None
+        self._stdin, self._stdout, self._stderr = (
+            AsyncAgentIO(client, env_id, fd) if fd is not None else None
+            for fd in channels
+        )
+        if captured:
+            self._stdout = AsyncAgentCaptureIO(client, env_id, pid, 1)
+            self._stderr = AsyncAgentCaptureIO(client, env_id, pid, 2)
+
+    @property
+    def pid(self: AsyncAgentProcess) -> int:
+        """Get the process' PID."""
+        return self._pid
+
+    @property
+    def stdin(self: AsyncAgentProcess) -> AsyncAgentIO | None:
+        """Get the standard input stream of the process."""
+        return self._stdin
+
+    @property
+    def stdout(
+        self: AsyncAgentProcess,
+    ) -> AsyncAgentIO | AsyncAgentCaptureIO | None:
+        """Get the standard output stream of the process."""
+        return self._stdout
+
+    @property
+    def stderr(
+        self: AsyncAgentProcess,
+    ) -> AsyncAgentIO | AsyncAgentCaptureIO | None:
+        """Get the standard error stream of the process."""
+        return self._stderr
+
+    @property
+    def returncode(self: AsyncAgentProcess) -> int | None:
+        """Get the process' exit code, if it is known to have terminated."""
+        return self._returncode
+
+    async def poll(self: AsyncAgentProcess) -> int | None:
+        """Return the process' exit code if it has terminated, or None."""
+        self._returncode = await self._client.process_poll_async(
+            self._env_id, self._pid
+        )
+        return self._returncode
+
+    async def wait(self: AsyncAgentProcess, timeout: float | None = None) -> int:
+        """Wait for the process to terminate and return its exit code."""
+        if await self._client.process_wait_async(self._env_id, self._pid, timeout):
+            raise TimeoutError
+        self._returncode = await self._client.process_returncode_async(
+            self._env_id, self._pid
+        )
+        return cast(int, self._returncode)
+
+
 class AgentEnvironment(Environment):
     """AgentEnvironment implements the Environment interface for agents."""
 
@@ -181,88 +956,171 @@ class AgentEnvironment(Environment):
         self._client = client
         self._id = id_
 
+    @property
+    def env_id(self: AgentEnvironment) -> int:
+        """The environment's ID on the agent."""
+        return self._id
+
     def run_command(
         self: AgentEnvironment,
         *args: Path | str | Sequence[Path | str],
         env: dict[str, str] | None = None,
         cwd: Path | None = None,
+        capture: bool = False,
+        capture_limit: int = _CAPTURE_LIMIT,
     ) -> AgentProcess:
-        """Run a command in the environment."""
+        """Run a command in the environment.
+
+        With `capture`, the agent drains the process' stdout and stderr in the
+        background, so the process never blocks on a full pipe no matter how
+        rarely they are read. Up to `capture_limit` bytes of each are kept in
+        memory, anything more is spilled to disk on the agent.
+        """
         normalized_args = list(normalize_args(*args))
 
-        pid = self._client.run_process(
-            env_id=self._id,
-            argv=normalized_args,
-            stdin=True,
-            stdout=True,
-            stderr=True,
-            executable=str(normalized_args[0]),
-            env=list(env.items()) if env else None,
-            cwd=str(cwd) if cwd else None,
-            setuid=None,
-            setgid=None,
-            setpgid=False,
-        )
+        # Start the process and fetch its channels in a single round trip
+        with self.batch() as batch:
+            pid, channels = _queue_run_process(
+                batch, normalized_args, env, cwd, capture, capture_limit
+            )
         return AgentProcess(
             self._client,
             self._id,
-            pid,
+            pid.result(),
             self,
             normalized_args,
             env,
             cwd,
+            _channel_fds(channels),
+            captured=capture,
         )
 
     def get_process_ids(self: AgentEnvironment) -> list[int]:
         """Get the PIDs of all processes managed by binharness in the environment."""
         return self._client.get_process_ids(self._id)
 
-    def get_process(self: AgentEnvironment, pid: int) -> Process:
-        """Get a process by PID."""
-        # TODO: These last three arguments are a lie. We need to store these on
-        # the agent at the time of process creation, and then retrieve them here.
-        return AgentProcess(self._client, self._id, pid, self, [], None, None)
+    def get_process(self: AgentEnvironment, pid: int) -> AgentProcess:
+        """Get a process by PID.
+
+        The agent keeps its processes across connections, so this also
+        reattaches to processes started by an earlier connection.
+        """
+        args, env, cwd, captured = self._client.get_process_config(self._id, pid)
+        return AgentProcess(
+            self._client,
+            self._id,
+            pid,
+            self,
+            args,
+            None if env is None else dict(env),
+            None if cwd is None else Path(cwd),
+            captured=captured,
+        )
+
+    def get_file(self: AgentEnvironment, fd: int) -> AgentIO:
+        """Reattach to a file opened by this or an earlier connection."""
+        if self._client.file_is_closed(self._id, fd):
+            raise ValueError
+        return AgentIO(self._client, self._id, fd)
+
+    def wait_processes(
+        self: AgentEnvironment,
+        pids: Sequence[int],
+        timeout: float | None = None,
+        *,
+        wait_all: bool = False,
+    ) -> dict[int, int]:
+        """Wait for any, or all, of the given processes to exit."""
+        return dict(
+            self._client.process_wait_many(self._id, list(pids), wait_all, timeout)
+        )
 
     def inject_files(self: AgentEnvironment, files: list[tuple[Path, Path]]) -> None:
-        """Inject files into the environment."""
-        for src, dst in files:
-            # TODO: Need a more robust solution to this. Current solution fixes
-            #  the common case where we're injecting into the system temp dir,
-            #  which presumably already exists.
-            try:
-                self.stat(dst.parent)
-            except RuntimeError:
-                self.run_command(
-                    "mkdir",  # TODO: Native mkdir function
-                    "-p",
-                    str(dst.parent),
-                ).wait()
-            try:
-                dst_stat = self.stat(dst)
-            except RuntimeError:
-                dst_stat = None
-            if dst_stat and stat.S_ISDIR(dst_stat.mode):
-                adjusted_dst = dst / src.name
-            else:
-                adjusted_dst = dst
-            fd = self._client.file_open(self._id, str(adjusted_dst), "wb")
-            with src.open("rb") as f:
-                while chunk := f.read(4194304):  # 4MB
-                    self._client.file_write(self._id, fd, chunk)
-            self._client.file_close(self._id, fd)
-            local_attrs = src.stat()
-            self.chmod(adjusted_dst, local_attrs.st_mode)
+        """Inject files into the environment.
+
+        Files are installed from the agent's store, so only content the agent
+        hasn't been sent before, by any client, is uploaded. Each file is
+        replaced atomically, so a copy that is running is unaffected.
+        """
+        if not files:
+            return
+        # Look up every destination and its parent in a single round trip
+        with self.batch() as batch:
+            stats = [(batch.stat(dst.parent), batch.stat(dst)) for _, dst in files]
+        missing, placements = _plan_injection(files, stats)
+        digests = [_sha256(src) for src, _ in placements]
+        sources = dict(zip(digests, (src for src, _ in placements), strict=True))
+
+        # Content another client is uploading is waited for, rather than sent twice
+        claimed, pending = self._client.store_claim(list(sources))
+        while pending:
+            with self.batch() as batch:
+                results = self._upload_to_store(batch, claimed, sources)
+            for result in results:
+                result.result()
+            claimed, pending = self._client.store_claim(pending)
+
+        # The last uploads, missing parents and the files themselves take a
+        # single round trip
+        with self.batch() as batch:
+            results = self._upload_to_store(batch, claimed, sources)
+            results += _queue_mkdirs(batch, missing)
+            results += _queue_store_installs(batch, placements, digests)
+        for result in results:
+            result.result()
+
+    def _upload_to_store(
+        self: AgentEnvironment,
+        batch: AgentBatch,
+        claimed: list[str],
+        sources: dict[str, Path],
+    ) -> list[AgentBatchResult[object]]:
+        """Upload claimed content, queueing adding it to the store in the batch."""
+        if not claimed:
+            return []
+        small, large = _plan_store_uploads(
+            self.get_tempdir(), {digest: sources[digest] for digest in claimed}
+        )
+        try:
+            for _, src, staging in large:
+                self._client.file_upload(self._id, src, str(staging))
+        except BaseException:
+            self._client.store_release(claimed)
+            raise
+        return _queue_store_adds(batch, small, large)
 
     def retrieve_files(self: AgentEnvironment, files: list[tuple[Path, Path]]) -> None:
         """Retrieve files from the environment."""
         for src, dst in files:
-            fd = self._client.file_open(self._id, str(src), "rb")
-            attrs = self.stat(src)
-            with dst.open("wb") as f:
-                while chunk := self._client.file_read(self._id, fd, 4096):
-                    f.write(chunk)
+            attrs = self._client.file_download(self._id, str(src), dst)
             dst.chmod(attrs.mode)
 
+    def inject_directory(
+        self: AgentEnvironment,
+        src: Path,
+        dst: Path,
+        compression_level: int | None = None,
+    ) -> None:
+        """Inject a directory tree into the environment.
+
+        The tree is streamed to the agent as a single tar archive, so many
+        small files cost about as much as one large one. With a zstd
+        `compression_level`, the archive is compressed on the way.
+        """
+        self._client.directory_upload(self._id, src, str(dst), compression_level)
+
+    def retrieve_directory(
+        self: AgentEnvironment,
+        src: Path,
+        dst: Path,
+        compression_level: int | None = None,
+    ) -> None:
+        """Retrieve a directory tree from the environment.
+
+        See `inject_directory` for how the tree is transferred.
+        """
+        self._client.directory_download(self._id, str(src), dst, compression_level)
+
     def get_tempdir(self: AgentEnvironment) -> Path:
         """Get a Path for a temporary directory."""
         return Path(self._client.get_tempdir(self._id))
@@ -271,7 +1129,10 @@ class AgentEnvironment(Environment):
         """Open a file in the environment. Follows the same semantics as `open`."""
         # TODO: Need to better handle mode/typing here
         fd = self._client.file_open(self._id, str(path), mode)
-        return AgentIO(self._client, self._id, fd)
+        raw = AgentIO(self._client, self._id, fd, mode)
+        # Text reads are counted in characters by the agent, so only binary
+        # files can be buffered locally
+        return BufferedAgentIO(raw) if "b" in mode else raw
 
     def chown(self: AgentEnvironment, path: Path, user: str, group: str) -> None:
         """Change the owner of a file."""
@@ -285,6 +1146,239 @@ class AgentEnvironment(Environment):
         """Get the stat of a file."""
         return FileStat.from_agent(self._client.stat(self._id, str(path)))
 
+    def stat_many(self: AgentEnvironment, paths: Sequence[Path]) -> FileStats:
+        """Get the stats of many files in a single round trip."""
+        names = [str(path) for path in paths]
+        return FileStats.from_agent(self._client.stat_many(self._id, names), names)
+
+    def walk(
+        self: AgentEnvironment, path: Path, max_depth: int | None = None
+    ) -> FileStats:
+        """Get the stats of everything under a directory in a single round trip."""
+        return FileStats.from_agent(self._client.walk(self._id, str(path), max_depth))
+
+    def hash_files(
+        self: AgentEnvironment,
+        paths: Sequence[Path],
+        algorithm: str = "sha256",
+        ranges: Sequence[tuple[int, int | None]] | None = None,
+    ) -> list[str]:
+        """Hash files on the agent and return their hex digests, in order.
+
+        The files are read in parallel on the agent, and only the digests are
+        sent back.
+        """
+        return self._client.file_hash(
+            self._id, _hash_requests(paths, ranges), algorithm
+        )
+
+    def mkdir(
+        self: AgentEnvironment,
+        path: Path,
+        *,
+        parents: bool = False,
+        exist_ok: bool = False,
+    ) -> None:
+        """Create a directory. Follows the same semantics as `Path.mkdir`."""
+        self._client.mkdir(self._id, str(path), parents, exist_ok)
+
+    def remove(self: AgentEnvironment, path: Path, *, recursive: bool = False) -> None:
+        """Remove a file, symlink or empty directory."""
+        self._client.remove(self._id, str(path), recursive)
+
+    def rename(self: AgentEnvironment, src: Path, dst: Path) -> None:
+        """Rename a file or directory."""
+        self._client.rename(self._id, str(src), str(dst))
+
+    def symlink(self: AgentEnvironment, target: Path, link: Path) -> None:
+        """Create a symlink at `link` pointing to `target`."""
+        self._client.symlink(self._id, str(target), str(link))
+
+    def mktemp(self: AgentEnvironment, *, directory: bool = False) -> Path:
+        """Create a uniquely named file, or directory, in `get_tempdir()`."""
+        return Path(self._client.mktemp(self._id, directory))
+
+    def listdir(self: AgentEnvironment, path: Path) -> list[str]:
+        """List the names of the entries in a directory, in arbitrary order."""
+        return self._client.listdir(self._id, str(path))
+
+    # Asyncio API
+
+    async def run_command_async(
+        self: AgentEnvironment,
+        *args: Path | str | Sequence[Path | str],
+        env: dict[str, str] | None = None,
+        cwd: Path | None = None,
+        capture: bool = False,
+        capture_limit: int = _CAPTURE_LIMIT,
+    ) -> AsyncAgentProcess:
+        """Run a command in the environment without blocking the event loop.
+
+        See `run_command` for `capture` and `capture_limit`.
+        """
+        normalized_args = list(normalize_args(*args))
+
+        async with self.batch() as batch:
+            pid, channels = _queue_run_process(
+                batch, normalized_args, env, cwd, capture, capture_limit
+            )
+        return AsyncAgentProcess(
+            self._client,
+            self._id,
+            pid.result(),
+            self,
+            normalized_args,
+            env,
+            cwd,
+            _channel_fds(channels),
+            captured=capture,
+        )
+
+    async def wait_processes_async(
+        self: AgentEnvironment,
+        pids: Sequence[int],
+        timeout: float | None = None,
+        *,
+        wait_all: bool = False,
+    ) -> dict[int, int]:
+        """Wait for processes to exit without blocking the event loop."""
+        return dict(
+            await self._client.process_wait_many_async(
+                self._id, list(pids), wait_all, timeout
+            )
+        )
+
+    async def stat_many_async(
+        self: AgentEnvironment, paths: Sequence[Path]
+    ) -> FileStats:
+        """Get the stats of many files without blocking the event loop."""
+        names = [str(path) for path in paths]
+        columns = await self._client.stat_many_async(self._id, names)
+        return FileStats.from_agent(columns, names)
+
+    async def walk_async(
+        self: AgentEnvironment, path: Path, max_depth: int | None = None
+    ) -> FileStats:
+        """Walk a directory without blocking the event loop."""
+        columns = await self._client.walk_async(self._id, str(path), max_depth)
+        return FileStats.from_agent(columns)
+
+    async def hash_files_async(
+        self: AgentEnvironment,
+        paths: Sequence[Path],
+        algorithm: str = "sha256",
+        ranges: Sequence[tuple[int, int | None]] | None = None,
+    ) -> list[str]:
+        """Hash files on the agent without blocking the event loop."""
+        return await self._client.file_hash_async(
+            self._id, _hash_requests(paths, ranges), algorithm
+        )
+
+    async def inject_files_async(
+        self: AgentEnvironment, files: list[tuple[Path, Path]]
+    ) -> None:
+        """Inject files into the environment without blocking the event loop."""
+        if not files:
+            return
+        async with self.batch() as batch:
+            stats = [(batch.stat(dst.parent), batch.stat(dst)) for _, dst in files]
+        missing, placements = _plan_injection(files, stats)
+        # Hashing reads every file, so it is done off the event loop
+        digests = await asyncio.to_thread(
+            lambda: [_sha256(src) for src, _ in placements]
+        )
+        sources = dict(zip(digests, (src for src, _ in placements), strict=True))
+
+        claimed, pending = await self._client.store_claim_async(list(sources))
+        while pending:
+            async with self.batch() as batch:
+                results = await self._upload_to_store_async(batch, claimed, sources)
+            for result in results:
+                result.result()
+            claimed, pending = await self._client.store_claim_async(pending)
+
+        async with self.batch() as batch:
+            results = await self._upload_to_store_async(batch, claimed, sources)
+            results += _queue_mkdirs(batch, missing)
+            results += _queue_store_installs(batch, placements, digests)
+        for result in results:
+            result.result()
+
+    async def _upload_to_store_async(
+        self: AgentEnvironment,
+        batch: AgentBatch,
+        claimed: list[str],
+        sources: dict[str, Path],
+    ) -> list[AgentBatchResult[object]]:
+        """Upload claimed content without blocking the event loop."""
+        if not claimed:
+            return []
+        small, large = _plan_store_uploads(
+            Path(await self._client.get_tempdir_async(self._id)),
+            {digest: sources[digest] for digest in claimed},
+        )
+        try:
+            await asyncio.gather(
+                *(
+                    self._client.file_upload_async(self._id, src, str(staging))
+                    for _, src, staging in large
+                )
+            )
+        except BaseException:
+            await self._client.store_release_async(claimed)
+            raise
+        return _queue_store_adds(batch, small, large)
+
+    async def retrieve_files_async(
+        self: AgentEnvironment, files: list[tuple[Path, Path]]
+    ) -> None:
+        """Retrieve files from the environment without blocking the event loop."""
+        attrs = await asyncio.gather(
+            *(
+                self._client.file_download_async(self._id, str(src), dst)
+                for src, dst in files
+            )
+        )
+        for (_, dst), attr in zip(files, attrs, strict=True):
+            dst.chmod(attr.mode)
+
+    async def inject_directory_async(
+        self: AgentEnvironment,
+        src: Path,
+        dst: Path,
+        compression_level: int | None = None,
+    ) -> None:
+        """Inject a directory tree without blocking the event loop."""
+        await self._client.directory_upload_async(
+            self._id, src, str(dst), compression_level
+        )
+
+    async def retrieve_directory_async(
+        self: AgentEnvironment,
+        src: Path,
+        dst: Path,
+        compression_level: int | None = None,
+    ) -> None:
+        """Retrieve a directory tree without blocking the event loop."""
+        await self._client.directory_download_async(
+            self._id, str(src), dst, compression_level
+        )
+
+    async def open_file_async(  # type: ignore [override]
+        self: AgentEnvironment, path: Path, mode: str
+    ) -> AsyncAgentIO:
+        """Open a file in the environment without blocking the event loop."""
+        fd = await self._client.file_open_async(self._id, str(path), mode)
+        return AsyncAgentIO(self._client, self._id, fd)
+
+    def batch(self: AgentEnvironment) -> AgentBatch:
+        """Create a batch of operations that run in a single round trip.
+
+        Operations queued on the batch are sent to the agent together when it
+        is executed, either by calling `execute` or by leaving a `with` block.
+        """
+        return AgentBatch(self._client, self._id)
+
     # Metadata API
 
     def get_metadata(self: AgentEnvironment, key: str) -> str | None:
@@ -305,15 +1399,88 @@ class AgentConnection:
     _client: BhAgentClient
     _env_cache: dict[int, AgentEnvironment]
 
-    def __init__(self: AgentConnection, host: str, port: int) -> None:
-        """Create an AgentConnection."""
-        self._client = BhAgentClient.initialize_client(host, port)
+    def __init__(  # noqa: PLR0913
+        self: AgentConnection,
+        host: str,
+        port: int,
+        codec: str | None = None,
+        compression_level: int | None = None,
+        compression_threshold: int | None = None,
+        bulk_connections: int = 1,
+    ) -> None:
+        """Create an AgentConnection.
+
+        The wire codec is negotiated with the agent when connecting. By default
+        the compact binary codec is used, and JSON is used as a fallback for
+        agents that do not support it. Pass `codec="json"` to force JSON.
+
+        Passing a zstd `compression_level` asks the agent to compress messages
+        of at least `compression_threshold` bytes, which in practice means
+        file contents and transfers. Whether it was agreed to is available as
+        `compressed`. See the README for when compression pays off.
+
+        Control requests, such as polls and stats, use a connection of their
+        own, so they are never stuck behind file contents and transfers. Those
+        are spread across `bulk_connections` further connections, and a single
+        transfer uses all of them. With zero, everything shares one connection.
+        """
+        self._attach(
+            BhAgentClient.initialize_client(
+                host,
+                port,
+                codec,
+                compression_level,
+                compression_threshold,
+                bulk_connections,
+            )
+        )
+
+    def _attach(self: AgentConnection, client: BhAgentClient) -> None:
+        """Use a connected client for this connection."""
+        self._client = client
         self._env_cache = {}
 
+    @property
+    def codec(self: AgentConnection) -> str:
+        """The wire codec negotiated with the agent."""
+        return self._client.codec
+
+    @property
+    def compressed(self: AgentConnection) -> bool:
+        """Whether messages to and from the agent are compressed."""
+        return self._client.compressed
+
+    def get_metrics(self: AgentConnection) -> AgentMetrics:
+        """Get a snapshot of how busy the agent is.
+
+        The agent refuses connections beyond `max_connections`, and answers
+        requests beyond `max_in_flight` on one connection with an error rather
+        than queueing them. `queue_depth` is the number of requests the agent
+        is currently working on, across every connection.
+        """
+        return self._client.get_metrics()
+
     def get_environment_ids(self: AgentConnection) -> list[int]:
         """Get a list of environment IDs that are currently active on the agent."""
         return self._client.get_environments()
 
+    def create_environment(self: AgentConnection) -> AgentEnvironment:
+        """Create a new environment on the agent.
+
+        Each environment has its own processes, files, metadata and temporary
+        directory, so several jobs can share one agent without interfering.
+        """
+        return self.get_environment(self._client.create_environment())
+
+    def destroy_environment(self: AgentConnection, id_: int) -> None:
+        """Destroy an environment, killing its processes.
+
+        The environment's temporary directory is removed. The default
+        environment, 0, can't be destroyed.
+        """
+        self._client.destroy_environment(id_)
+        self._env_cache.pop(id_, None)
+
     def get_environment(self: AgentConnection, id_: int) -> AgentEnvironment:
         """Get an AgentEnvironment for the given environment ID."""
         if id_ not in self._env_cache:
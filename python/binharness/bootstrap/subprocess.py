@@ -3,15 +3,24 @@
 from __future__ import annotations
 
 import os
+import socket
 import subprocess
+import sys
 import time
 from typing import TYPE_CHECKING
 
+from bh_agent_client import BhAgentClient
+
 from binharness.agentenvironment import AgentConnection
 
 if TYPE_CHECKING:
     from pathlib import Path
 
+DEFAULT_PORT = 60162
+# How long an agent listening on TCP gets to start accepting connections
+STARTUP_TIMEOUT = 10.0
+STARTUP_POLL_INTERVAL = 0.01
+
 
 class SubprocessAgent(AgentConnection):
     """SubprocessAgent runs an agent as a subprocess.
@@ -22,20 +31,137 @@ class SubprocessAgent(AgentConnection):
 
     _process: subprocess.Popen
 
-    def __init__(
+    def __init__(  # noqa: PLR0913
         self: SubprocessAgent,
         agent_binary: Path,
         address: str = "127.0.0.1",
-        port: int = 60162,
+        port: int | None = None,
+        codec: str | None = None,
+        max_connections: int | None = None,
+        compression_level: int | None = None,
+        compression_threshold: int | None = None,
+        bulk_connections: int = 1,
+        agent_log: str | None = None,
+    ) -> None:
+        """Create an AgentConnection.
+
+        Without a port, the agent serves the connection over socket pairs
+        shared with this process, so no port has to be free, and the agent is
+        ready as soon as it answers the handshake on them. With a port, or on
+        Windows, it listens on TCP instead. `agent_log` is passed to the agent
+        as `RUST_LOG`, otherwise it uses whatever is in the environment.
+        """
+        args = [str(agent_binary)]
+        if max_connections is not None:
+            args += ["--max-connections", str(max_connections)]
+        env = dict(os.environ)
+        if agent_log is not None:
+            env["RUST_LOG"] = agent_log
+
+        if port is None and sys.platform != "win32":
+            self._start_with_sockets(
+                args,
+                env,
+                codec,
+                compression_level,
+                compression_threshold,
+                bulk_connections,
+            )
+        else:
+            self._start_with_tcp(
+                args,
+                env,
+                address,
+                port or DEFAULT_PORT,
+                codec,
+                compression_level,
+                compression_threshold,
+                bulk_connections,
+            )
+
+    def _start_with_sockets(  # noqa: PLR0913
+        self: SubprocessAgent,
+        args: list[str],
+        env: dict[str, str],
+        codec: str | None,
+        compression_level: int | None,
+        compression_threshold: int | None,
+        bulk_connections: int,
+    ) -> None:
+        """Start the agent serving one socket pair per connection."""
+        pairs = [socket.socketpair() for _ in range(1 + bulk_connections)]
+        theirs = [agent_end.fileno() for _, agent_end in pairs]
+        for fd in theirs:
+            args += ["--socket-fd", str(fd)]
+        try:
+            self._process = subprocess.Popen(args, env=env, pass_fds=theirs)
+        finally:
+            for _, agent_end in pairs:
+                agent_end.close()
+        # The client owns our ends from here on, and closes them if it fails
+        try:
+            client = BhAgentClient.from_sockets(
+                [our_end.detach() for our_end, _ in pairs],
+                codec,
+                compression_level,
+                compression_threshold,
+            )
+        except Exception:
+            self.stop()
+            raise
+        self._attach(client)
+
+    def _start_with_tcp(  # noqa: PLR0913
+        self: SubprocessAgent,
+        args: list[str],
+        env: dict[str, str],
+        address: str,
+        port: int,
+        codec: str | None,
+        compression_level: int | None,
+        compression_threshold: int | None,
+        bulk_connections: int,
     ) -> None:
-        """Create an AgentConnection."""
-        process = subprocess.Popen(
-            [str(agent_binary), address, str(port)],
-            env={**os.environ, "RUST_LOG": "bh_agent_server::util::read_chars=trace"},
-        )
-        self._process = process
-        time.sleep(0.1)
-        super().__init__(address, port)
+        """Start the agent listening on TCP and connect once it accepts."""
+        self._process = subprocess.Popen([*args, address, str(port)], env=env)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while (
+            error := self._connect(
+                address,
+                port,
+                codec,
+                compression_level,
+                compression_threshold,
+                bulk_connections,
+            )
+        ) is not None:
+            if self._process.poll() is not None or time.monotonic() > deadline:
+                self.stop()
+                raise error
+            time.sleep(STARTUP_POLL_INTERVAL)
+
+    def _connect(  # noqa: PLR0913
+        self: SubprocessAgent,
+        address: str,
+        port: int,
+        codec: str | None,
+        compression_level: int | None,
+        compression_threshold: int | None,
+        bulk_connections: int,
+    ) -> RuntimeError | None:
+        """Connect to the agent, returning the error if it isn't accepting yet."""
+        try:
+            super().__init__(
+                address,
+                port,
+                codec,
+                compression_level,
+                compression_threshold,
+                bulk_connections,
+            )
+        except RuntimeError as e:
+            return e
+        return None
 
     def stop(self: SubprocessAgent) -> None:
         """Shutdown the agent."""
@@ -2,9 +2,8 @@
 
 from __future__ import annotations
 
-from os import environ
 from pathlib import Path
-from typing import TYPE_CHECKING, cast
+from typing import TYPE_CHECKING
 
 from binharness.types import InjectableExecutor, Target
 from binharness.types.injection import ExecutableInjection
@@ -29,27 +28,13 @@ class BusyboxInjection(ExecutableInjection):
     def install(self: BusyboxInjection, environment: Environment) -> None:
         """Install the injection into an environment."""
         self.env_path = environment.get_tempdir() / "busybox"
-        try:
-            super().install(environment)
-        except OSError as ex:
-            # Ignore "Text file busy" errors in CI. This is likely due to
-            # multiple tests running in parallel and trying to install the
-            # busybox injection at the same time.
-            if "PYTEST_CURRENT_TEST" in environ and (
-                "[Errno 26] Text file busy" in str(ex) or "Failure" in str(ex)
-            ):
-                self._environment = environment
-            else:
-                raise
+        super().install(environment)
 
     def mktemp(
         self: BusyboxInjection, directory: bool = False  # noqa: FBT001, FBT002
     ) -> Path:
-        """Run mktemp in the environment and returns the Path created."""
-        proc = self.run("mktemp", "-d") if directory else self.run("mktemp")
-        stdout, _ = proc.communicate()
-        # TODO: Find out how to not cast
-        return Path(cast(bytes, stdout).decode().strip())
+        """Create a temporary file, or directory, and return its Path."""
+        return self.environment.mktemp(directory=directory)
 
     def shell(
         self: BusyboxInjection, command: str, env: dict[str, str] | None = None
@@ -58,7 +58,7 @@ class QemuInjection(ExecutableInjection):
             yield from read_lines(cast(IO[bytes], file))
 
             # Cleanup log file
-            self.environment.run_command("rm", logfile)
+            self.environment.remove(logfile)
 
         return proc, log_generator()
 
@@ -2,24 +2,80 @@
 
 from __future__ import annotations
 
+import asyncio
 import fcntl
 import os
+import select
 import shutil
+import stat
 import subprocess
 import tempfile
+import time
 import typing
+from io import UnsupportedOperation
 from pathlib import Path
-from typing import AnyStr
+from typing import AnyStr, cast
+
+from bh_agent_client import file_hash
 
 from binharness.types.environment import Environment
-from binharness.types.io import IO
-from binharness.types.process import Process
-from binharness.types.stat import FileStat
-from binharness.util import normalize_args
+from binharness.types.io import IO, AsyncIO
+from binharness.types.process import AsyncProcess, Process
+from binharness.types.stat import FileStat, FileStats
+from binharness.util import generate_random_suffix, normalize_args
 
 if typing.TYPE_CHECKING:
     from collections.abc import Sequence
 
+# How often processes are polled when pidfds are not available
+_WAIT_POLL_INTERVAL = 0.01
+
+
+def _try_stat(
+    path: Path | os.DirEntry[str], *, follow_symlinks: bool = True
+) -> os.stat_result | OSError:
+    """Stat a path or directory entry, returning the error if it fails."""
+    try:
+        return path.stat(follow_symlinks=follow_symlinks)
+    except OSError as ex:
+        return ex
+
+
+def _wait_pidfds(pids: list[int], deadline: float | None, *, wait_all: bool) -> bool:
+    """Wait for any, or all, of pids to exit using pidfds.
+
+    Returns False if pidfds are not available, so the caller can fall back to
+    polling.
+    """
+    fds: list[int] = []
+    try:
+        # Extended one at a time, so the pidfds opened before a failure are closed
+        fds.extend(os.pidfd_open(pid) for pid in pids)
+    except (AttributeError, OSError):
+        for fd in fds:
+            os.close(fd)
+        return False
+
+    poller = select.poll()
+    for fd in fds:
+        poller.register(fd, select.POLLIN)
+    try:
+        remaining = len(fds)
+        while remaining:
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            events = poller.poll(None if wait is None else wait * 1000)
+            if not events:
+                break
+            for fd, _ in events:
+                poller.unregister(fd)
+                remaining -= 1
+            if not wait_all:
+                break
+    finally:
+        for fd in fds:
+            os.close(fd)
+    return True
+
 
 class LocalIO(IO[AnyStr]):
     """A file-like object for the local environment."""
@@ -75,9 +131,9 @@ class LocalIO(IO[AnyStr]):
         """Whether the file is writable."""
         return self.inner.writable()
 
-    def write(self: LocalIO[AnyStr], s: AnyStr) -> int | None:
+    def write(self: LocalIO[AnyStr], s: AnyStr | bytearray | memoryview) -> int | None:
         """Write to the file."""
-        return self.inner.write(s)
+        return self.inner.write(cast(AnyStr, s))
 
     def writelines(self: LocalIO[AnyStr], lines: list[AnyStr]) -> None:
         """Write lines to the file."""
@@ -94,6 +150,49 @@ class LocalIO(IO[AnyStr]):
         fcntl.fcntl(fd, fcntl.F_SETFL, flags)
 
 
+class LocalAsyncIO(AsyncIO[bytes]):
+    """An asyncio stream of a process in the local environment."""
+
+    reader: asyncio.StreamReader | None
+    writer: asyncio.StreamWriter | None
+
+    def __init__(
+        self: LocalAsyncIO,
+        reader: asyncio.StreamReader | None = None,
+        writer: asyncio.StreamWriter | None = None,
+    ) -> None:
+        """Create a LocalAsyncIO from a stream reader or writer."""
+        self.reader = reader
+        self.writer = writer
+
+    async def close(self: LocalAsyncIO) -> None:
+        """Close the file."""
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+
+    async def read(self: LocalAsyncIO, n: int = -1) -> bytes:
+        """Read n bytes from the file."""
+        if self.reader is None:
+            raise UnsupportedOperation
+        return await self.reader.read(n)
+
+    async def readline(self: LocalAsyncIO, limit: int = -1) -> bytes:
+        """Read a line from the file."""
+        if self.reader is None:
+            raise UnsupportedOperation
+        line = await self.reader.readline()
+        return line if limit < 0 else line[:limit]
+
+    async def write(self: LocalAsyncIO, s: bytes) -> int | None:
+        """Write to the file."""
+        if self.writer is None:
+            raise UnsupportedOperation
+        self.writer.write(s)
+        await self.writer.drain()
+        return len(s)
+
+
 class LocalEnvironment(Environment):
     """A local environment is the environment local to where binharness is run."""
 
@@ -122,6 +221,27 @@ class LocalEnvironment(Environment):
         self._managed_processes[process.pid] = process
         return process
 
+    async def run_command_async(
+        self: LocalEnvironment,
+        *args: Path | str | Sequence[Path | str],
+        env: dict[str, str] | None = None,
+        cwd: Path | None = None,
+    ) -> AsyncProcess:
+        """Run a command in the environment without blocking the event loop.
+
+        The command is run with `asyncio.create_subprocess_exec`.
+        """
+        normalized_args = list(normalize_args(*args))
+        process = await asyncio.create_subprocess_exec(
+            *normalized_args,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            cwd=cwd,
+        )
+        return LocalAsyncProcess(self, normalized_args, process, env=env, cwd=cwd)
+
     def get_process_ids(self: LocalEnvironment) -> list[int]:
         """Get the PIDs of all processes managed by binharness in the environment."""
         return list(self._managed_processes.keys())
@@ -130,6 +250,37 @@ class LocalEnvironment(Environment):
         """Get a process by PID."""
         return self._managed_processes[pid]
 
+    def wait_processes(
+        self: LocalEnvironment,
+        pids: Sequence[int],
+        timeout: float | None = None,
+        *,
+        wait_all: bool = False,
+    ) -> dict[int, int]:
+        """Wait for any, or all, of the given processes to exit.
+
+        Waits on pidfds where the platform supports them, and polls otherwise.
+        """
+        processes = [self._managed_processes[pid] for pid in pids]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pending = [p.pid for p in processes if p.poll() is None]
+        if (
+            pending
+            and (wait_all or len(pending) == len(processes))
+            and not _wait_pidfds(pending, deadline, wait_all=wait_all)
+        ):
+            while pending and (deadline is None or time.monotonic() < deadline):
+                time.sleep(_WAIT_POLL_INTERVAL)
+                still_running = [
+                    pid
+                    for pid in pending
+                    if self._managed_processes[pid].poll() is None
+                ]
+                if not wait_all and len(still_running) < len(pending):
+                    break
+                pending = still_running
+        return {p.pid: code for p in processes if (code := p.poll()) is not None}
+
     def inject_files(
         self: LocalEnvironment,
         files: list[tuple[Path, Path]],
@@ -138,10 +289,18 @@ class LocalEnvironment(Environment):
 
         The first element of the tuple is the path to the file on the host
         machine, the second element is the path to the file in the environment.
+        Each file is copied next to its destination and renamed over it, so a
+        copy that is running is unaffected.
         """
-        for file in files:
-            file[1].parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(file[0], file[1])
+        for src, dst in files:
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            target = dst / src.name if dst.is_dir() else dst
+            staging = target.with_name(f".{target.name}.{generate_random_suffix()}")
+            try:
+                shutil.copy2(src, staging)
+                staging.replace(target)
+            finally:
+                staging.unlink(missing_ok=True)
 
     def retrieve_files(
         self: LocalEnvironment,
@@ -156,6 +315,14 @@ class LocalEnvironment(Environment):
         for file in files:
             shutil.copy(file[0], file[1])
 
+    def inject_directory(self: LocalEnvironment, src: Path, dst: Path) -> None:
+        """Inject a directory tree into the environment."""
+        shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+
+    def retrieve_directory(self: LocalEnvironment, src: Path, dst: Path) -> None:
+        """Retrieve a directory tree from the environment."""
+        shutil.copytree(src, dst, symlinks=True, dirs_exist_ok=True)
+
     def get_tempdir(self: LocalEnvironment) -> Path:
         """Get a Path for a temporary directory."""
         return Path(tempfile.gettempdir())
@@ -176,6 +343,94 @@ class LocalEnvironment(Environment):
         """Get the stat of a file."""
         return FileStat.from_os(path.stat())
 
+    def stat_many(self: LocalEnvironment, paths: Sequence[Path]) -> FileStats:
+        """Get the stats of many files at once, following symlinks."""
+        results = [_try_stat(path) for path in paths]
+        return FileStats.from_os([str(path) for path in paths], results)
+
+    def walk(
+        self: LocalEnvironment, path: Path, max_depth: int | None = None
+    ) -> FileStats:
+        """Get the stats of everything under a directory, without following symlinks."""
+        paths: list[str] = []
+        results: list[os.stat_result | OSError] = []
+        dirs = [(Path(), 1)]
+        while dirs:
+            directory, depth = dirs.pop()
+            try:
+                entries = os.scandir(path / directory)
+            except OSError:
+                if not directory.parts:
+                    raise
+                continue
+            with entries:
+                for entry in entries:
+                    entry_path = directory / entry.name
+                    result = _try_stat(entry, follow_symlinks=False)
+                    if (
+                        not isinstance(result, OSError)
+                        and stat.S_ISDIR(result.st_mode)
+                        and (max_depth is None or depth < max_depth)
+                    ):
+                        dirs.append((entry_path, depth + 1))
+                    paths.append(str(entry_path))
+                    results.append(result)
+        return FileStats.from_os(paths, results)
+
+    def hash_files(
+        self: LocalEnvironment,
+        paths: Sequence[Path],
+        algorithm: str = "sha256",
+        ranges: Sequence[tuple[int, int | None]] | None = None,
+    ) -> list[str]:
+        """Hash files and return their hex digests, in order."""
+        if ranges is None:
+            ranges = [(0, None)] * len(paths)
+        return [
+            file_hash(path, algorithm, offset, length)
+            for path, (offset, length) in zip(paths, ranges, strict=True)
+        ]
+
+    def mkdir(
+        self: LocalEnvironment,
+        path: Path,
+        *,
+        parents: bool = False,
+        exist_ok: bool = False,
+    ) -> None:
+        """Create a directory. Follows the same semantics as `Path.mkdir`."""
+        path.mkdir(parents=parents, exist_ok=exist_ok)
+
+    def remove(self: LocalEnvironment, path: Path, *, recursive: bool = False) -> None:
+        """Remove a file, symlink or empty directory."""
+        if path.is_dir() and not path.is_symlink():
+            if recursive:
+                shutil.rmtree(path)
+            else:
+                path.rmdir()
+        else:
+            path.unlink()
+
+    def rename(self: LocalEnvironment, src: Path, dst: Path) -> None:
+        """Rename a file or directory."""
+        src.rename(dst)
+
+    def symlink(self: LocalEnvironment, target: Path, link: Path) -> None:
+        """Create a symlink at `link` pointing to `target`."""
+        link.symlink_to(target)
+
+    def mktemp(self: LocalEnvironment, *, directory: bool = False) -> Path:
+        """Create a uniquely named file, or directory, and return its path."""
+        if directory:
+            return Path(tempfile.mkdtemp())
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        return Path(path)
+
+    def listdir(self: LocalEnvironment, path: Path) -> list[str]:
+        """List the names of the entries in a directory, in arbitrary order."""
+        return [entry.name for entry in path.iterdir()]
+
     # Metadata API
 
     def get_metadata(self: LocalEnvironment, key: str) -> str | None:
@@ -249,3 +504,63 @@ class LocalProcess(Process):
     def wait(self: LocalProcess, timeout: float | None = None) -> int:
         """Wait for the process to terminate and return its exit code."""
         return self.popen.wait(timeout=timeout)
+
+
+class LocalAsyncProcess(AsyncProcess):
+    """A process running in a local environment, driven by asyncio."""
+
+    process: asyncio.subprocess.Process
+    _stdin: LocalAsyncIO | None
+    _stdout: LocalAsyncIO | None
+    _stderr: LocalAsyncIO | None
+
+    def __init__(
+        self: LocalAsyncProcess,
+        environment: Environment,
+        args: Sequence[str],
+        process: asyncio.subprocess.Process,
+        env: dict[str, str] | None = None,
+        cwd: Path | None = None,
+    ) -> None:
+        """Create a LocalAsyncProcess."""
+        super().__init__(environment, args, env=env, cwd=cwd)
+        self.process = process
+        self._stdin = LocalAsyncIO(writer=process.stdin) if process.stdin else None
+        self._stdout = LocalAsyncIO(reader=process.stdout) if process.stdout else None
+        self._stderr = LocalAsyncIO(reader=process.stderr) if process.stderr else None
+
+    @property
+    def pid(self: LocalAsyncProcess) -> int:
+        """Get the process' PID."""
+        return self.process.pid
+
+    @property
+    def stdin(self: LocalAsyncProcess) -> AsyncIO[bytes] | None:
+        """Get the standard input stream of the process."""
+        return self._stdin
+
+    @property
+    def stdout(self: LocalAsyncProcess) -> AsyncIO[bytes] | None:
+        """Get the standard output stream of the process."""
+        return self._stdout
+
+    @property
+    def stderr(self: LocalAsyncProcess) -> AsyncIO[bytes] | None:
+        """Get the standard error stream of the process."""
+        return self._stderr
+
+    @property
+    def returncode(self: LocalAsyncProcess) -> int | None:
+        """Get the process' exit code, if it is known to have terminated."""
+        return self.process.returncode
+
+    async def poll(self: LocalAsyncProcess) -> int | None:
+        """Return the process' exit code if it has terminated, or None."""
+        return self.process.returncode
+
+    async def wait(self: LocalAsyncProcess, timeout: float | None = None) -> int:
+        """Wait for the process to terminate and return its exit code."""
+        try:
+            return await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError from None
@@ -17,12 +17,14 @@ from binharness.types.injection import (
     InjectionError,
     InjectionNotInstalledError,
 )
-from binharness.types.io import IO
-from binharness.types.process import Process
+from binharness.types.io import IO, AsyncIO
+from binharness.types.process import AsyncProcess, Process
 from binharness.types.target import Target
 
 __all__ = [
     "IO",
+    "AsyncIO",
+    "AsyncProcess",
     "Environment",
     "ExecutableInjection",
     "Executor",
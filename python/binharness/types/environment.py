@@ -2,15 +2,21 @@
 
 from __future__ import annotations
 
+import asyncio
 from abc import ABC, abstractmethod
 from typing import TYPE_CHECKING, AnyStr
 
+from binharness.types.io import ThreadedAsyncIO
+from binharness.types.process import ThreadedAsyncProcess
+
 if TYPE_CHECKING:
     from collections.abc import Sequence
     from pathlib import Path
 
     from binharness import IO, Process
-    from binharness.types.stat import FileStat
+    from binharness.types.io import AsyncIO
+    from binharness.types.process import AsyncProcess
+    from binharness.types.stat import FileStat, FileStats
 
 
 class Environment(ABC):
@@ -45,6 +51,22 @@ class Environment(ABC):
         """Get a process by PID."""
         raise NotImplementedError
 
+    @abstractmethod
+    def wait_processes(
+        self: Environment,
+        pids: Sequence[int],
+        timeout: float | None = None,
+        *,
+        wait_all: bool = False,
+    ) -> dict[int, int]:
+        """Wait for any of the given processes to exit.
+
+        With `wait_all`, wait for all of them instead. The wait also ends when
+        the timeout elapses. Returns the exit codes of the processes that have
+        exited by then, keyed by PID.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def inject_files(
         self: Environment,
@@ -70,6 +92,25 @@ class Environment(ABC):
         """
         raise NotImplementedError
 
+    @abstractmethod
+    def inject_directory(self: Environment, src: Path, dst: Path) -> None:
+        """Inject a directory tree into the environment.
+
+        The contents of `src` on the host machine are copied into `dst` in the
+        environment, which is created if needed. Modes, mtimes and symlinks are
+        kept, and files already in `dst` are replaced.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def retrieve_directory(self: Environment, src: Path, dst: Path) -> None:
+        """Retrieve a directory tree from the environment.
+
+        The contents of `src` in the environment are copied into `dst` on the
+        host machine, the same way as `inject_directory`.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def get_tempdir(self: Environment) -> Path:
         """Get a Path for a temporary directory."""
@@ -95,6 +136,163 @@ class Environment(ABC):
         """Get the stat of a file."""
         raise NotImplementedError
 
+    @abstractmethod
+    def stat_many(self: Environment, paths: Sequence[Path]) -> FileStats:
+        """Get the stats of many files at once, following symlinks like `stat`.
+
+        Files that can't be stat'ed are listed in the result's `errors` rather
+        than raising.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def walk(self: Environment, path: Path, max_depth: int | None = None) -> FileStats:
+        """Get the stats of everything under a directory, without following symlinks.
+
+        Paths are relative to `path`, and each directory comes before its
+        contents. With `max_depth`, only entries up to that many levels down are
+        included, 1 being the entries of `path` itself.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def hash_files(
+        self: Environment,
+        paths: Sequence[Path],
+        algorithm: str = "sha256",
+        ranges: Sequence[tuple[int, int | None]] | None = None,
+    ) -> list[str]:
+        """Hash files in the environment and return their hex digests, in order.
+
+        `algorithm` is "sha256", or "xxh3" for the much faster 64-bit XXH3.
+        With `ranges`, each file is hashed from an offset for a length, or to
+        its end if the length is None.
+        """
+        raise NotImplementedError
+
+    def hash_file(
+        self: Environment,
+        path: Path,
+        algorithm: str = "sha256",
+        *,
+        offset: int = 0,
+        length: int | None = None,
+    ) -> str:
+        """Hash a file in the environment, or part of it, and return the digest."""
+        return self.hash_files([path], algorithm, [(offset, length)])[0]
+
+    @abstractmethod
+    def mkdir(
+        self: Environment, path: Path, *, parents: bool = False, exist_ok: bool = False
+    ) -> None:
+        """Create a directory. Follows the same semantics as `Path.mkdir`."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove(self: Environment, path: Path, *, recursive: bool = False) -> None:
+        """Remove a file, symlink or empty directory.
+
+        With `recursive`, a directory is removed along with everything in it.
+        Symlinks are removed rather than followed.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def rename(self: Environment, src: Path, dst: Path) -> None:
+        """Rename a file or directory."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def symlink(self: Environment, target: Path, link: Path) -> None:
+        """Create a symlink at `link` pointing to `target`."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def mktemp(self: Environment, *, directory: bool = False) -> Path:
+        """Create a uniquely named file, or directory, and return its path.
+
+        It is created in a temporary directory of the environment.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def listdir(self: Environment, path: Path) -> list[str]:
+        """List the names of the entries in a directory, in arbitrary order."""
+        raise NotImplementedError
+
+    # Asyncio API
+    # The default implementations run the blocking methods in a worker thread.
+    # Environments that can do better natively should override them.
+
+    async def run_command_async(
+        self: Environment,
+        *args: Path | str | Sequence[Path | str],
+        env: dict[str, str] | None = None,
+        cwd: Path | None = None,
+    ) -> AsyncProcess:
+        """Run a command in the environment without blocking the event loop."""
+        process = await asyncio.to_thread(self.run_command, *args, env=env, cwd=cwd)
+        return ThreadedAsyncProcess(process)
+
+    async def wait_processes_async(
+        self: Environment,
+        pids: Sequence[int],
+        timeout: float | None = None,
+        *,
+        wait_all: bool = False,
+    ) -> dict[int, int]:
+        """Wait for processes to exit without blocking the event loop."""
+        return await asyncio.to_thread(
+            self.wait_processes, pids, timeout, wait_all=wait_all
+        )
+
+    async def inject_files_async(
+        self: Environment,
+        files: list[tuple[Path, Path]],
+    ) -> None:
+        """Inject files into the environment without blocking the event loop."""
+        await asyncio.to_thread(self.inject_files, files)
+
+    async def retrieve_files_async(
+        self: Environment,
+        files: list[tuple[Path, Path]],
+    ) -> None:
+        """Retrieve files from the environment without blocking the event loop."""
+        await asyncio.to_thread(self.retrieve_files, files)
+
+    async def inject_directory_async(self: Environment, src: Path, dst: Path) -> None:
+        """Inject a directory tree without blocking the event loop."""
+        await asyncio.to_thread(self.inject_directory, src, dst)
+
+    async def retrieve_directory_async(self: Environment, src: Path, dst: Path) -> None:
+        """Retrieve a directory tree without blocking the event loop."""
+        await asyncio.to_thread(self.retrieve_directory, src, dst)
+
+    async def open_file_async(
+        self: Environment, path: Path, mode: str
+    ) -> AsyncIO[AnyStr]:
+        """Open a file in the environment without blocking the event loop."""
+        return ThreadedAsyncIO(await asyncio.to_thread(self.open_file, path, mode))
+
+    async def stat_many_async(self: Environment, paths: Sequence[Path]) -> FileStats:
+        """Get the stats of many files without blocking the event loop."""
+        return await asyncio.to_thread(self.stat_many, paths)
+
+    async def walk_async(
+        self: Environment, path: Path, max_depth: int | None = None
+    ) -> FileStats:
+        """Walk a directory without blocking the event loop."""
+        return await asyncio.to_thread(self.walk, path, max_depth)
+
+    async def hash_files_async(
+        self: Environment,
+        paths: Sequence[Path],
+        algorithm: str = "sha256",
+        ranges: Sequence[tuple[int, int | None]] | None = None,
+    ) -> list[str]:
+        """Hash files in the environment without blocking the event loop."""
+        return await asyncio.to_thread(self.hash_files, paths, algorithm, ranges)
+
     # Metadata API
     # Binharness environments have a simple key-value store applications can use
     # to persistantly store metadata about processes and files, or any other
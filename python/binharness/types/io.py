@@ -2,7 +2,8 @@
 
 from __future__ import annotations
 
-from contextlib import AbstractContextManager
+import asyncio
+from contextlib import AbstractAsyncContextManager, AbstractContextManager
 from typing import TYPE_CHECKING, AnyStr, Protocol
 
 if TYPE_CHECKING:
@@ -46,8 +47,12 @@ class IO(AbstractContextManager["IO[AnyStr]"], Protocol[AnyStr]):
     def writable(self: IO[AnyStr]) -> bool:
         """Whether the file is writable."""
 
-    def write(self: IO[AnyStr], s: AnyStr) -> int | None:
-        """Write to the file."""
+    def write(self: IO[AnyStr], s: AnyStr | bytearray | memoryview) -> int | None:
+        """Write to the file.
+
+        Files opened in binary mode accept any object supporting the buffer
+        protocol.
+        """
 
     def writelines(self: IO[AnyStr], lines: list[AnyStr]) -> None:
         """Write lines to the file."""
@@ -69,3 +74,58 @@ class IO(AbstractContextManager["IO[AnyStr]"], Protocol[AnyStr]):
     def set_blocking(self: IO[AnyStr], blocking: bool) -> None:  # noqa: FBT001
         """Set the file to blocking or non-blocking mode."""
         raise NotImplementedError
+
+
+class AsyncIO(AbstractAsyncContextManager["AsyncIO[AnyStr]"], Protocol[AnyStr]):
+    """A file-like object for use with asyncio."""
+
+    async def close(self: AsyncIO[AnyStr]) -> None:
+        """Close the file."""
+
+    async def read(self: AsyncIO[AnyStr], n: int = -1) -> AnyStr:
+        """Read n bytes from the file."""
+
+    async def readline(self: AsyncIO[AnyStr], limit: int = -1) -> AnyStr:
+        """Read a line from the file."""
+
+    async def write(self: AsyncIO[AnyStr], s: AnyStr) -> int | None:
+        """Write to the file."""
+
+    async def __aenter__(self: AsyncIO[AnyStr]) -> AsyncIO[AnyStr]:
+        """Enter the runtime context related to this object."""
+        return self
+
+    async def __aexit__(
+        self: AsyncIO[AnyStr],
+        exc_type: type[BaseException] | None,
+        exc_val: BaseException | None,
+        exc_tb: TracebackType | None,
+    ) -> None:
+        """Exit the runtime context and close the file."""
+        await self.close()
+
+
+class ThreadedAsyncIO(AsyncIO[AnyStr]):
+    """Adapts a blocking IO to AsyncIO by running its methods in a thread."""
+
+    inner: IO[AnyStr]
+
+    def __init__(self: ThreadedAsyncIO[AnyStr], inner: IO[AnyStr]) -> None:
+        """Create a ThreadedAsyncIO."""
+        self.inner = inner
+
+    async def close(self: ThreadedAsyncIO[AnyStr]) -> None:
+        """Close the file."""
+        await asyncio.to_thread(self.inner.close)
+
+    async def read(self: ThreadedAsyncIO[AnyStr], n: int = -1) -> AnyStr:
+        """Read n bytes from the file."""
+        return await asyncio.to_thread(self.inner.read, n)
+
+    async def readline(self: ThreadedAsyncIO[AnyStr], limit: int = -1) -> AnyStr:
+        """Read a line from the file."""
+        return await asyncio.to_thread(self.inner.readline, limit)
+
+    async def write(self: ThreadedAsyncIO[AnyStr], s: AnyStr) -> int | None:
+        """Write to the file."""
+        return await asyncio.to_thread(self.inner.write, s)
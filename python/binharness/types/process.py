@@ -2,15 +2,36 @@
 
 from __future__ import annotations
 
+import asyncio
+import threading
 from abc import ABC, abstractmethod, abstractproperty
+from concurrent.futures import Future
 from typing import TYPE_CHECKING
 
+from binharness.types.io import ThreadedAsyncIO
+
 if TYPE_CHECKING:
     from collections.abc import Sequence
     from pathlib import Path
 
     from binharness.types.environment import Environment
-    from binharness.types.io import IO
+    from binharness.types.io import IO, AsyncIO
+
+
+def _read_in_background(stream: IO[bytes] | None) -> Future[bytes] | None:
+    """Read a stream to the end on a daemon thread."""
+    if stream is None:
+        return None
+    future: Future[bytes] = Future()
+
+    def read() -> None:
+        try:
+            future.set_result(stream.read())
+        except BaseException as e:  # noqa: BLE001
+            future.set_exception(e)
+
+    threading.Thread(target=read, daemon=True).start()
+    return future
 
 
 class Process(ABC):
@@ -20,6 +41,7 @@ class Process(ABC):
     args: Sequence[str]
     env: dict[str, str]
     cwd: Path
+    _readers: tuple[Future[bytes] | None, Future[bytes] | None] | None
 
     def __init__(
         self: Process,
@@ -33,6 +55,7 @@ class Process(ABC):
         self.args = args
         self.env = env or {}
         self.cwd = cwd or environment.get_tempdir()
+        self._readers = None
 
     @abstractproperty
     def pid(self: Process) -> int:
@@ -72,12 +95,163 @@ class Process(ABC):
     def communicate(
         self: Process, input_: bytes | None = None, timeout: float | None = None
     ) -> tuple[bytes | None, bytes | None]:
-        """Send input to the process and return its output and error streams."""
+        """Send input to the process and return its output and error streams.
+
+        The output streams are read while waiting for the process, so a process
+        that fills a pipe can't deadlock. As with subprocess, after a timeout the
+        process can be killed and communicate called again to collect the output
+        read so far; the readers of the first call carry on until then.
+        """
+        if self._readers is None:
+            if self.stdin is not None:
+                if input_ is not None:
+                    self.stdin.write(input_)
+                self.stdin.close()
+            self._readers = (
+                _read_in_background(self.stdout),
+                _read_in_background(self.stderr),
+            )
+
+        stdout, stderr = self._readers
+        self.wait(timeout)
+        self._readers = None
+        return (
+            stdout.result() if stdout is not None else None,
+            stderr.result() if stderr is not None else None,
+        )
+
+
+class AsyncProcess(ABC):
+    """A process running in an environment, for use with asyncio.
+
+    Unlike Process, `returncode` only reflects the last exit code observed by
+    `poll` or `wait`, so reading it never blocks the event loop.
+    """
+
+    environment: Environment
+    args: Sequence[str]
+    env: dict[str, str]
+    cwd: Path | None
+
+    def __init__(
+        self: AsyncProcess,
+        environment: Environment,
+        args: Sequence[str],
+        env: dict[str, str] | None = None,
+        cwd: Path | None = None,
+    ) -> None:
+        """Create an AsyncProcess."""
+        self.environment = environment
+        self.args = args
+        self.env = env or {}
+        self.cwd = cwd
+
+    @abstractproperty
+    def pid(self: AsyncProcess) -> int:
+        """Get the process' PID."""
+        raise NotImplementedError
+
+    @abstractproperty
+    def stdin(self: AsyncProcess) -> AsyncIO[bytes] | None:
+        """Get the standard input stream of the process."""
+        raise NotImplementedError
+
+    @abstractproperty
+    def stdout(self: AsyncProcess) -> AsyncIO[bytes] | None:
+        """Get the standard output stream of the process."""
+        raise NotImplementedError
+
+    @abstractproperty
+    def stderr(self: AsyncProcess) -> AsyncIO[bytes] | None:
+        """Get the standard error stream of the process."""
+        raise NotImplementedError
+
+    @abstractproperty
+    def returncode(self: AsyncProcess) -> int | None:
+        """Get the process' exit code, if it is known to have terminated."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def poll(self: AsyncProcess) -> int | None:
+        """Return the process' exit code if it has terminated, or None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    async def wait(self: AsyncProcess, timeout: float | None = None) -> int:
+        """Wait for the process to terminate and return its exit code."""
+        raise NotImplementedError
+
+    async def communicate(
+        self: AsyncProcess, input_: bytes | None = None, timeout: float | None = None
+    ) -> tuple[bytes | None, bytes | None]:
+        """Send input to the process and return its output and error streams.
+
+        The output streams are read while waiting for the process, so a process
+        that fills a pipe can't deadlock.
+        """
         if self.stdin is not None:
             if input_ is not None:
-                self.stdin.write(input_)
-            self.stdin.close()
-        self.wait(timeout)
-        stdout = self.stdout.read() if self.stdout is not None else None
-        stderr = self.stderr.read() if self.stderr is not None else None
+                await self.stdin.write(input_)
+            await self.stdin.close()
+
+        async def read(stream: AsyncIO[bytes] | None) -> bytes | None:
+            return await stream.read() if stream is not None else None
+
+        try:
+            stdout, stderr, _ = await asyncio.wait_for(
+                asyncio.gather(read(self.stdout), read(self.stderr), self.wait()),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError from None
         return (stdout, stderr)
+
+
+class ThreadedAsyncProcess(AsyncProcess):
+    """Adapts a blocking Process to AsyncProcess by running it in a thread."""
+
+    inner: Process
+    _stdin: AsyncIO[bytes] | None
+    _stdout: AsyncIO[bytes] | None
+    _stderr: AsyncIO[bytes] | None
+
+    def __init__(self: ThreadedAsyncProcess, inner: Process) -> None:
+        """Create a ThreadedAsyncProcess."""
+        super().__init__(inner.environment, inner.args, inner.env, inner.cwd)
+        self.inner = inner
+        self._stdin = ThreadedAsyncIO(inner.stdin) if inner.stdin else None
+        self._stdout = ThreadedAsyncIO(inner.stdout) if inner.stdout else None
+        self._stderr = ThreadedAsyncIO(inner.stderr) if inner.stderr else None
+
+    @property
+    def pid(self: ThreadedAsyncProcess) -> int:
+        """Get the process' PID."""
+        return self.inner.pid
+
+    @property
+    def stdin(self: ThreadedAsyncProcess) -> AsyncIO[bytes] | None:
+        """Get the standard input stream of the process."""
+        return self._stdin
+
+    @property
+    def stdout(self: ThreadedAsyncProcess) -> AsyncIO[bytes] | None:
+        """Get the standard output stream of the process."""
+        return self._stdout
+
+    @property
+    def stderr(self: ThreadedAsyncProcess) -> AsyncIO[bytes] | None:
+        """Get the standard error stream of the process."""
+        return self._stderr
+
+    @property
+    def returncode(self: ThreadedAsyncProcess) -> int | None:
+        """Get the process' exit code, if it is known to have terminated."""
+        return self.inner.returncode
+
+    async def poll(self: ThreadedAsyncProcess) -> int | None:
+        """Return the process' exit code if it has terminated, or None."""
+        return await asyncio.to_thread(self.inner.poll)
+
+    async def wait(self: ThreadedAsyncProcess, timeout: float | None = None) -> int:
+        """Wait for the process to terminate and return its exit code."""
+        return await asyncio.to_thread(self.inner.wait, timeout)
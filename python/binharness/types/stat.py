@@ -2,16 +2,17 @@
 
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     import os
+    from collections.abc import Sequence
 
     import bh_agent_client
 
 
-@dataclass
+@dataclass(slots=True)
 class FileStat:
     """Represents file statistics."""
 
@@ -55,3 +56,98 @@ class FileStat:
             mtime=stat.mtime,
             ctime=stat.ctime,
         )
+
+
+@dataclass(slots=True)
+class FileStats:
+    """The stats of many files, kept in columns.
+
+    Entry `i` of every column belongs to `paths[i]`, so scanning a large
+    directory doesn't create an object per file. Indexing gives the FileStat of
+    a single file. Files that couldn't be stat'ed are listed in `errors` with
+    the reason, and are zero in the other columns.
+    """
+
+    paths: list[str]
+    """Path of each file."""
+    mode: list[int]
+    """File modes."""
+    uid: list[int]
+    """User IDs."""
+    gid: list[int]
+    """Group IDs."""
+    size: list[int]
+    """File sizes."""
+    atime: list[int]
+    """Access times."""
+    mtime: list[int]
+    """Modification times."""
+    ctime: list[int]
+    """Creation times."""
+    errors: dict[int, str] = field(default_factory=dict)
+    """Why the files at these indices couldn't be stat'ed."""
+
+    def __len__(self: FileStats) -> int:
+        """Return the number of files."""
+        return len(self.paths)
+
+    def __getitem__(self: FileStats, index: int) -> FileStat:
+        """Return the stat of a single file."""
+        return FileStat(
+            mode=self.mode[index],
+            uid=self.uid[index],
+            gid=self.gid[index],
+            size=self.size[index],
+            atime=self.atime[index],
+            mtime=self.mtime[index],
+            ctime=self.ctime[index],
+        )
+
+    @staticmethod
+    def from_os(
+        paths: list[str], stats: Sequence[os.stat_result | OSError]
+    ) -> FileStats:
+        """Create FileStats from the results of os.stat, or why it failed."""
+        columns = FileStats(paths, [], [], [], [], [], [], [])
+        for index, stat in enumerate(stats):
+            if isinstance(stat, OSError):
+                columns.errors[index] = str(stat)
+                values = (0, 0, 0, 0, 0, 0, 0)
+            else:
+                values = (
+                    stat.st_mode,
+                    stat.st_uid,
+                    stat.st_gid,
+                    stat.st_size,
+                    stat.st_atime_ns,
+                    stat.st_mtime_ns,
+                    stat.st_ctime_ns,
+                )
+            columns.mode.append(values[0])
+            columns.uid.append(values[1])
+            columns.gid.append(values[2])
+            columns.size.append(values[3])
+            columns.atime.append(values[4])
+            columns.mtime.append(values[5])
+            columns.ctime.append(values[6])
+        return columns
+
+    @staticmethod
+    def from_agent(
+        columns: bh_agent_client.StatColumns, paths: list[str] | None = None
+    ) -> FileStats:
+        """Create FileStats from a bh_agent_client.StatColumns.
+
+        Stats of given paths come without them, so they have to be passed in.
+        """
+        return FileStats(
+            paths=columns.paths if paths is None else paths,
+            mode=columns.mode,
+            uid=columns.uid,
+            gid=columns.gid,
+            size=columns.size,
+            atime=columns.atime,
+            mtime=columns.mtime,
+            ctime=columns.ctime,
+            errors=dict(columns.errors),
+        )
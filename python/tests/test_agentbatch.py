@@ -0,0 +1,43 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+import pytest
+
+from binharness.agentbatch import BatchNotExecutedError
+
+if TYPE_CHECKING:
+    from binharness.agentenvironment import AgentEnvironment
+
+FILE_MODE = 0o640
+
+
+def test_batch_file_roundtrip(agent_env: AgentEnvironment) -> None:
+    path = agent_env.get_tempdir() / "test_batch_file_roundtrip"
+    with agent_env.batch() as batch:
+        fd = batch.file_open(path, "wb")
+        batch.file_write(fd, b"hello batch")
+        batch.file_close(fd)
+        batch.chmod(path, FILE_MODE)
+        stat = batch.stat(path)
+        with pytest.raises(BatchNotExecutedError):
+            stat.result()
+
+    assert fd.ok
+    assert stat.result().size == len(b"hello batch")
+    assert stat.result().mode & 0o777 == FILE_MODE
+
+
+def test_batch_reports_failures(agent_env: AgentEnvironment) -> None:
+    missing = agent_env.get_tempdir() / "test_batch_reports_failures_missing"
+    with agent_env.batch() as batch:
+        fd = batch.file_open(missing, "rb")
+        read = batch.file_read(fd)
+        metadata = batch.set_metadata("test_batch", "value")
+
+    assert not fd.ok
+    assert not read.ok
+    with pytest.raises(RuntimeError):
+        read.result()
+    assert metadata.ok
+    assert agent_env.get_metadata("test_batch") == "value"
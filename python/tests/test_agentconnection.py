@@ -0,0 +1,318 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import pytest
+
+from binharness.agentenvironment import AgentConnection, AgentIO, AsyncAgentIO
+from binharness.bootstrap.subprocess import SubprocessAgent
+
+if TYPE_CHECKING:
+    from binharness.agentenvironment import AgentEnvironment
+
+
+@pytest.mark.parametrize(("codec", "port"), [("json", 60170), ("bincode", 60171)])
+def test_codec_negotiation(agent_binary_host: str, codec: str, port: int) -> None:
+    agent = SubprocessAgent(Path(agent_binary_host), port=port, codec=codec)
+    try:
+        assert agent.codec == codec
+        env = agent.get_environment(0)
+        proc = env.run_command(["echo", "hello"])
+        stdout, _ = proc.communicate()
+        assert stdout == b"hello\n"
+    finally:
+        agent.stop()
+
+
+@pytest.mark.linux
+@pytest.mark.parametrize("port", [None, 60175])
+def test_compression(agent_binary_host: str, tmp_path: Path, port: int | None) -> None:
+    agent = SubprocessAgent(
+        Path(agent_binary_host),
+        port=port,
+        compression_level=3,
+        compression_threshold=1024,
+    )
+    try:
+        assert agent.compressed
+        env = agent.get_environment(0)
+        data = b"compressible " * 100_000
+        src = tmp_path / "src"
+        src.write_bytes(data)
+        dst = env.get_tempdir() / "bh_test_compression"
+        env.inject_files([(src, dst)])
+        with env.open_file(dst, "rb") as f:
+            assert f.read() == data
+        env.retrieve_files([(dst, tmp_path / "dst")])
+        assert (tmp_path / "dst").read_bytes() == data
+        dst.unlink()
+    finally:
+        agent.stop()
+
+
+def test_connection_pool(agent_binary_host: str, tmp_path: Path) -> None:
+    agent = SubprocessAgent(Path(agent_binary_host), port=60176)
+    try:
+        pooled = AgentConnection("127.0.0.1", 60176, bulk_connections=4)
+        assert agent.get_metrics().connections == 2 + 5
+        env = pooled.get_environment(0)
+
+        # Chunks of one transfer are spread across every bulk connection
+        data = os.urandom(8 * 1024 * 1024 + 1)
+        src = tmp_path / "src"
+        src.write_bytes(data)
+        dst = env.get_tempdir() / "bh_test_connection_pool"
+        env.inject_files([(src, dst)])
+        env.retrieve_files([(dst, tmp_path / "dst")])
+        assert (tmp_path / "dst").read_bytes() == data
+        dst.unlink()
+    finally:
+        agent.stop()
+
+
+def test_connection_limit(agent_binary_host: str) -> None:
+    # One control and one bulk connection
+    max_connections = 2
+    agent = SubprocessAgent(
+        Path(agent_binary_host), port=60172, max_connections=max_connections
+    )
+    try:
+        metrics = agent.get_metrics()
+        assert metrics.connections == max_connections
+        assert metrics.max_connections == max_connections
+        # A second client is refused outright instead of waiting for a slot
+        with pytest.raises(RuntimeError, match="maximum number of connections"):
+            AgentConnection("127.0.0.1", 60172)
+        assert agent.get_metrics().rejected_connections == 1
+    finally:
+        agent.stop()
+
+
+@pytest.mark.linux
+def test_inherited_sockets(agent_binary_host: str) -> None:
+    # Agents serving socket pairs need no ports, so any number can run at once
+    agents = [
+        SubprocessAgent(Path(agent_binary_host), bulk_connections=2) for _ in range(4)
+    ]
+    try:
+        for agent in agents:
+            assert agent.get_metrics().connections == 1 + 2
+            proc = agent.get_environment(0).run_command(["echo", "hello"])
+            stdout, _ = proc.communicate()
+            assert stdout == b"hello\n"
+    finally:
+        for agent in agents:
+            agent.stop()
+
+
+@pytest.mark.linux
+def test_reattach(agent_binary_host: str) -> None:
+    agent = SubprocessAgent(Path(agent_binary_host), port=60173)
+    try:
+        env = agent.get_environment(0)
+        proc = env.run_command(["cat"], cwd=Path("/"))
+        env.set_metadata("campaign", "reattach")
+
+        # A second connection sees the same processes, files and metadata
+        other = AgentConnection("127.0.0.1", 60173).get_environment(0)
+        assert proc.pid in other.get_process_ids()
+        assert other.get_metadata("campaign") == "reattach"
+        reattached = other.get_process(proc.pid)
+        assert reattached.args == ["cat"]
+        assert reattached.cwd == Path("/")
+        assert reattached.stdin is not None
+        assert other.get_file(reattached.stdin.fd) is not None
+        stdout, _ = reattached.communicate(b"hello")
+        assert stdout == b"hello"
+    finally:
+        agent.stop()
+
+
+@pytest.mark.linux
+def test_environments(agent_binary_host: str) -> None:
+    agent = SubprocessAgent(Path(agent_binary_host), port=60174)
+    try:
+        default = agent.get_environment(0)
+        env = agent.create_environment()
+        assert agent.get_environment_ids() == [0, env.env_id]
+        assert env.get_tempdir() != default.get_tempdir()
+        assert env.get_tempdir().is_dir()
+
+        # Handles and metadata don't leak between environments
+        proc = env.run_command(["sleep", "60"])
+        env.set_metadata("job", "isolated")
+        assert proc.pid not in default.get_process_ids()
+        assert default.get_metadata("job") is None
+
+        tempdir = env.get_tempdir()
+        agent.destroy_environment(env.env_id)
+        assert agent.get_environment_ids() == [0]
+        assert not tempdir.exists()
+        with pytest.raises(RuntimeError):
+            agent.destroy_environment(0)
+    finally:
+        agent.stop()
+
+
+@pytest.mark.linux
+def test_wait_does_not_block_other_threads(agent_env: AgentEnvironment) -> None:
+    proc = agent_env.run_command(["sleep", "1"])
+    waiter = threading.Thread(target=proc.wait)
+    waiter.start()
+    try:
+        # The agent should keep answering requests from this thread while the
+        # other one is blocked waiting for the process
+        assert waiter.is_alive()
+        assert agent_env.get_tempdir().is_absolute()
+        assert waiter.is_alive()
+    finally:
+        waiter.join()
+    assert proc.returncode == 0
+
+
+@pytest.mark.linux
+def test_concurrent_commands(agent_env: AgentEnvironment) -> None:
+    def run(i: int) -> bytes:
+        stdout, _ = agent_env.run_command(["echo", str(i)]).communicate()
+        assert stdout is not None
+        return stdout
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        results = list(executor.map(run, range(64)))
+    assert results == [f"{i}\n".encode() for i in range(64)]
+
+
+@pytest.mark.linux
+def test_iter_chunks(agent_env: AgentEnvironment) -> None:
+    proc = agent_env.run_command(
+        ["sh", "-c", "for i in 1 2 3; do echo $i; sleep 0.1; done"]
+    )
+    assert isinstance(proc.stdout, AgentIO)
+    assert b"".join(proc.stdout.iter_chunks()) == b"1\n2\n3\n"
+    assert proc.wait() == 0
+
+
+@pytest.mark.linux
+def test_on_data(agent_env: AgentEnvironment) -> None:
+    proc = agent_env.run_command(["sh", "-c", "echo out; echo err >&2"])
+    assert isinstance(proc.stdout, AgentIO)
+    assert isinstance(proc.stderr, AgentIO)
+    received: list[bytes] = []
+    threads = [
+        proc.stdout.on_data(received.append),
+        proc.stderr.on_data(received.append),
+    ]
+    for thread in threads:
+        thread.join()
+    assert sorted(received) == [b"err\n", b"out\n"]
+
+
+@pytest.mark.linux
+def test_iter_chunks_async(agent_env: AgentEnvironment) -> None:
+    async def run() -> bytes:
+        proc = await agent_env.run_command_async(["seq", "1000"])
+        assert isinstance(proc.stdout, AsyncAgentIO)
+        return b"".join([chunk async for chunk in proc.stdout.iter_chunks()])
+
+    expected = "".join(f"{i}\n" for i in range(1, 1001)).encode()
+    assert asyncio.run(run()) == expected
+
+
+@pytest.mark.linux
+def test_capture_output(agent_env: AgentEnvironment) -> None:
+    # Much more output than the capture limit, so most of it is spilled
+    proc = agent_env.run_command(
+        ["sh", "-c", "head -c 5000000 /dev/zero; echo done; echo err >&2"],
+        capture=True,
+        capture_limit=64 * 1024,
+    )
+    # The process doesn't need its output to be read to finish
+    assert proc.wait(timeout=30) == 0
+    assert proc.stdout is not None
+    assert proc.stderr is not None
+    assert proc.stdout.read() == bytes(5000000) + b"done\n"
+    assert proc.stderr.readline() == b"err\n"
+    assert proc.stderr.readline() == b""
+
+
+@pytest.mark.linux
+def test_capture_read_by_offset(agent_env: AgentEnvironment) -> None:
+    proc = agent_env.run_command(["seq", "1000"], capture=True)
+    assert proc.wait() == 0
+    assert proc.stdout is not None
+    assert proc.stdout.readline() == b"1\n"
+    proc.stdout.seek(4)
+    assert proc.stdout.read(4) == b"3\n4\n"
+    assert proc.stdout.tell() == len(b"1\n2\n3\n4\n")
+    proc.stdout.seek(0)
+    assert proc.stdout.readlines() == [f"{i}\n".encode() for i in range(1, 1001)]
+
+
+def test_buffered_file(agent_env: AgentEnvironment) -> None:
+    path = agent_env.get_tempdir() / "buffered.txt"
+    lines = [f"line {i}\n".encode() for i in range(10000)]
+    with agent_env.open_file(path, "wb") as f:
+        assert f.writable()
+        assert not f.readable()
+        f.writelines(lines)
+        assert f.tell() == sum(len(line) for line in lines)
+
+    with agent_env.open_file(path, "rb") as f:
+        assert f.readable()
+        assert f.seekable()
+        assert f.readline() == lines[0]
+        assert f.tell() == len(lines[0])
+        buf = bytearray(len(lines[1]))
+        assert f.readinto(buf) == len(buf)  # type: ignore [attr-defined]
+        assert buf == lines[1]
+        assert f.readlines() == lines[2:]
+        assert f.readline() == b""
+        f.seek(0)
+        assert f.read(4) == b"line"
+
+
+def test_buffered_file_update(agent_env: AgentEnvironment) -> None:
+    path = agent_env.get_tempdir() / "update.txt"
+    with agent_env.open_file(path, "wb") as f:
+        f.write(b"hello world\n")
+
+    with agent_env.open_file(path, "r+b") as f:
+        assert f.read(6) == b"hello "
+        f.write(b"agent")
+        f.seek(0)
+        assert f.read() == b"hello agent\n"
+
+
+def test_buffer_protocol_io(agent_env: AgentEnvironment) -> None:
+    path = agent_env.get_tempdir() / "buffers.bin"
+    data = bytearray(os.urandom(300 * 1024))
+    with agent_env.open_file(path, "wb") as f:
+        # Large enough to skip the write buffer
+        f.write(memoryview(data)[: 200 * 1024])
+        f.write(memoryview(data)[200 * 1024 :])
+
+    with agent_env.open_file(path, "rb") as f:
+        buf = bytearray(len(data))
+        view = memoryview(buf)
+        split = 10
+        assert f.readinto(view[:split]) == split  # type: ignore [attr-defined]
+        assert f.readinto(view[split:]) == len(data) - split  # type: ignore [attr-defined]
+        assert f.readinto(bytearray(10)) == 0  # type: ignore [attr-defined]
+    assert buf == data
+
+
+@pytest.mark.linux
+def test_set_blocking(agent_env: AgentEnvironment) -> None:
+    proc = agent_env.run_command(["sh", "-c", "sleep 0.5; echo done"])
+    assert proc.stdout is not None
+    # Nothing has been written yet, so a non-blocking read comes back empty
+    proc.stdout.set_blocking(False)
+    assert proc.stdout.read() == b""
+    proc.stdout.set_blocking(True)
+    assert proc.stdout.read() == b"done\n"
+    assert proc.wait() == 0
@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import pytest
+
+if TYPE_CHECKING:
+    from binharness.types.environment import Environment
+
+
+@pytest.mark.linux
+def test_run_command_async(env: Environment) -> None:
+    async def run() -> None:
+        proc = await env.run_command_async("echo", "hello")
+        stdout, _ = await proc.communicate()
+        assert stdout == b"hello\n"
+        assert proc.returncode == 0
+
+    asyncio.run(run())
+
+
+@pytest.mark.linux
+def test_communicate_async_input(env: Environment) -> None:
+    async def run() -> None:
+        proc = await env.run_command_async("cat")
+        stdout, _ = await proc.communicate(b"hello from stdin")
+        assert stdout == b"hello from stdin"
+
+    asyncio.run(run())
+
+
+@pytest.mark.linux
+def test_wait_async_timeout(env: Environment) -> None:
+    async def run() -> None:
+        proc = await env.run_command_async("sleep", "5")
+        with pytest.raises(TimeoutError):
+            await proc.wait(timeout=0.1)
+        await proc.wait()
+
+    asyncio.run(run())
+
+
+@pytest.mark.linux
+def test_many_commands_one_loop(env: Environment) -> None:
+    async def echo(i: int) -> bytes | None:
+        proc = await env.run_command_async("echo", str(i))
+        stdout, _ = await proc.communicate()
+        return stdout
+
+    async def run() -> list[bytes | None]:
+        return await asyncio.gather(*(echo(i) for i in range(32)))
+
+    assert asyncio.run(run()) == [f"{i}\n".encode() for i in range(32)]
+
+
+def test_inject_retrieve_async(env: Environment) -> None:
+    data = os.urandom(2 * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        src = Path(tmpdir) / "src"
+        src.write_bytes(data)
+        small = Path(tmpdir) / "small"
+        small.write_bytes(b"small file")
+        dst_dir = env.get_tempdir() / "test_inject_retrieve_async"
+        back = Path(tmpdir) / "back"
+
+        async def run() -> None:
+            await env.inject_files_async(
+                [(src, dst_dir / "large"), (small, dst_dir / "small")]
+            )
+            await env.retrieve_files_async([(dst_dir / "large", back)])
+            async with await env.open_file_async(dst_dir / "small", "rb") as f:
+                assert await f.read() == b"small file"
+
+        asyncio.run(run())
+        assert back.read_bytes() == data
@@ -1,7 +1,13 @@
 from __future__ import annotations
 
+import hashlib
+import os
 import pathlib
+import shutil
+import stat
+import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from typing import TYPE_CHECKING
 
 import pytest
@@ -11,6 +17,10 @@ from binharness.common.busybox import BusyboxInjection
 if TYPE_CHECKING:
     from binharness import Environment
 
+EXECUTABLE_MODE = 0o750
+# XXH3 digests are 64 bits, written as hex
+XXH3_HEX_DIGITS = 16
+
 
 def test_run_command(env: Environment) -> None:
     proc = env.run_command(["echo", "hello"])
@@ -19,6 +29,27 @@ def test_run_command(env: Environment) -> None:
     assert stdout == b"hello\n"
 
 
+@pytest.mark.linux
+def test_communicate_large_output(env: Environment) -> None:
+    # Far more than a pipe holds, so reading only after the process exits
+    # would deadlock
+    proc = env.run_command(["sh", "-c", "head -c 1000000 /dev/zero; echo err >&2"])
+    stdout, stderr = proc.communicate(timeout=30)
+    assert proc.returncode == 0
+    assert stdout == bytes(1000000)
+    assert stderr == b"err\n"
+
+
+@pytest.mark.linux
+def test_communicate_after_timeout(env: Environment) -> None:
+    proc = env.run_command(["sh", "-c", "echo first; sleep 1; echo second"])
+    with pytest.raises((TimeoutError, subprocess.TimeoutExpired)):
+        proc.communicate(timeout=0.1)
+    # The readers of the first call kept going, so nothing was lost
+    stdout, _ = proc.communicate(timeout=30)
+    assert stdout == b"first\nsecond\n"
+
+
 def test_inject_files(env: Environment) -> None:
     env_temp = env.get_tempdir()
     with tempfile.TemporaryDirectory() as tmp_dir:
@@ -33,6 +64,149 @@ def test_inject_files(env: Environment) -> None:
         assert local_file.read_text() == "hello"
 
 
+def test_inject_large_file(env: Environment) -> None:
+    env_temp = env.get_tempdir()
+    # Spans several transfer chunks, with a partial chunk at the end
+    data = os.urandom(5 * 1024 * 1024 + 123)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_path = pathlib.Path(tmp_dir)
+        file = tmp_path / "large.bin"
+        file.write_bytes(data)
+        file.chmod(EXECUTABLE_MODE)
+        env.inject_files([(file, env_temp / "large.bin")])
+
+    assert env.stat(env_temp / "large.bin").mode & 0o777 == EXECUTABLE_MODE
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        local_file = pathlib.Path(tmp_dir) / "large.bin"
+        env.retrieve_files([(env_temp / "large.bin", local_file)])
+        assert local_file.read_bytes() == data
+
+
+def test_inject_into_missing_directory(env: Environment) -> None:
+    root = env.mktemp(directory=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file = pathlib.Path(tmp_dir) / "test.txt"
+        file.write_text("hello")
+        env.inject_files([(file, root / "a" / "b" / "test.txt")])
+    assert env.listdir(root / "a" / "b") == ["test.txt"]
+    env.remove(root, recursive=True)
+
+
+@pytest.mark.linux
+def test_reinject_running_executable(env: Environment) -> None:
+    sleep = pathlib.Path(shutil.which("sleep") or "/bin/sleep")
+    root = env.mktemp(directory=True)
+    env.inject_files([(sleep, root / "sleep")])
+    proc = env.run_command([str(root / "sleep"), "1"])
+    # Writing over a running executable fails with "Text file busy", so the
+    # same file installed again, several times at once, has to replace it
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda _: env.inject_files([(sleep, root / "sleep")]), range(4)))
+    assert proc.wait(timeout=30) == 0
+    assert env.listdir(root) == ["sleep"]
+    env.remove(root, recursive=True)
+
+
+@pytest.mark.linux
+def test_inject_directory(env: Environment, tmp_path: pathlib.Path) -> None:
+    src = tmp_path / "src"
+    (src / "nested").mkdir(parents=True)
+    file_count = 100
+    for i in range(file_count):
+        (src / "nested" / f"{i}.bin").write_bytes(bytes([i]) * i)
+    script = src / "run.sh"
+    script.write_text("#!/bin/sh\n")
+    script.chmod(EXECUTABLE_MODE)
+    mtime = 1_000_000_000
+    os.utime(script, (mtime, mtime))
+    (src / "link").symlink_to("run.sh")
+
+    remote = env.mktemp(directory=True)
+    env.inject_directory(src, remote)
+    assert len(env.listdir(remote / "nested")) == file_count
+
+    dst = tmp_path / "dst"
+    env.retrieve_directory(remote, dst)
+    for i in range(file_count):
+        assert (dst / "nested" / f"{i}.bin").read_bytes() == bytes([i]) * i
+    assert (dst / "run.sh").stat().st_mode & 0o777 == EXECUTABLE_MODE
+    assert (dst / "run.sh").stat().st_mtime == mtime
+    assert (dst / "link").readlink() == pathlib.Path("run.sh")
+    env.remove(remote, recursive=True)
+
+
+@pytest.mark.linux
+def test_filesystem_operations(env: Environment) -> None:
+    root = env.mktemp(directory=True)
+    file = env.mktemp()
+    assert stat.S_IFMT(env.stat(file).mode) == stat.S_IFREG
+
+    env.mkdir(root / "a" / "b", parents=True)
+    env.mkdir(root / "a", exist_ok=True)
+    with pytest.raises((OSError, RuntimeError)):
+        env.mkdir(root / "a")
+    env.rename(file, root / "file")
+    env.symlink(root / "file", root / "link")
+    assert sorted(env.listdir(root)) == ["a", "file", "link"]
+
+    env.remove(root / "link")
+    assert env.stat(root / "file") is not None
+    with pytest.raises((OSError, RuntimeError)):
+        env.remove(root / "a")
+    env.remove(root, recursive=True)
+    with pytest.raises((OSError, RuntimeError)):
+        env.listdir(root)
+
+
+@pytest.mark.linux
+def test_stat_many_and_walk(env: Environment) -> None:
+    root = env.mktemp(directory=True)
+    env.mkdir(root / "a" / "b", parents=True)
+    file = env.mktemp()
+    env.rename(file, root / "a" / "b" / "file")
+    env.symlink(root / "a", root / "link")
+
+    paths = [root / "link", root / "missing", root / "a" / "b" / "file"]
+    stats = env.stat_many(paths)
+    assert len(stats) == len(paths)
+    assert stats.paths[1] == str(root / "missing")
+    assert list(stats.errors) == [1]
+    assert stat.S_IFMT(stats[0].mode) == stat.S_IFDIR
+    assert stats[2].size == 0
+
+    walked = env.walk(root)
+    assert sorted(walked.paths) == ["a", "a/b", "a/b/file", "link"]
+    assert walked.paths.index("a") < walked.paths.index("a/b/file")
+    assert stat.S_IFMT(walked[walked.paths.index("link")].mode) == stat.S_IFLNK
+    assert sorted(env.walk(root, max_depth=1).paths) == ["a", "link"]
+    with pytest.raises((OSError, RuntimeError)):
+        env.walk(root / "missing")
+    env.remove(root, recursive=True)
+
+
+def test_hash_files(env: Environment, tmp_path: pathlib.Path) -> None:
+    file = tmp_path / "data.bin"
+    file.write_bytes(bytes(range(256)) * 1000)
+    remote = env.mktemp(directory=True)
+    env.inject_files([(file, remote / "data.bin")])
+    empty = env.mktemp()
+
+    data = file.read_bytes()
+    assert env.hash_files([remote / "data.bin", empty]) == [
+        hashlib.sha256(data).hexdigest(),
+        hashlib.sha256(b"").hexdigest(),
+    ]
+    part = env.hash_file(remote / "data.bin", offset=1000, length=500)
+    assert part == hashlib.sha256(data[1000:1500]).hexdigest()
+    xxh3 = env.hash_files([remote / "data.bin"] * 2, "xxh3", [(0, None), (0, 10**9)])
+    assert xxh3[0] == xxh3[1]
+    assert len(xxh3[0]) == XXH3_HEX_DIGITS
+    with pytest.raises((OSError, RuntimeError)):
+        env.hash_file(remote / "missing")
+    env.remove(remote, recursive=True)
+    env.remove(empty)
+
+
 # TODO: Need to think about how to handle this test with remote environments
 def test_get_tempdir(local_env: Environment) -> None:
     assert local_env.get_tempdir() == pathlib.Path(tempfile.gettempdir())
@@ -70,3 +244,26 @@ def test_process_poll(env: Environment) -> None:
     assert proc.poll() is not None
     assert proc.stdout is not None
     assert proc.stdout.read() == b"hello\n"
+
+
+@pytest.mark.linux
+def test_wait_processes_any(env: Environment) -> None:
+    fast = env.run_command("true")
+    slow = env.run_command("sleep", "5")
+    exited = env.wait_processes([fast.pid, slow.pid], timeout=4)
+    assert exited == {fast.pid: 0}
+    slow.wait()
+
+
+@pytest.mark.linux
+def test_wait_processes_all(env: Environment) -> None:
+    procs = [env.run_command("sh", "-c", f"exit {i}") for i in range(4)]
+    exited = env.wait_processes([p.pid for p in procs], wait_all=True)
+    assert exited == {p.pid: i for i, p in enumerate(procs)}
+
+
+@pytest.mark.linux
+def test_wait_processes_timeout(env: Environment) -> None:
+    proc = env.run_command("sleep", "5")
+    assert env.wait_processes([proc.pid], timeout=0.1) == {}
+    proc.wait()